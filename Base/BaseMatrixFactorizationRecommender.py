@@ -8,7 +8,9 @@ Created on 16/09/2017
 
 from Base.BaseRecommender import BaseRecommender
 from Base.DataIO import DataIO
+from Base.IVF_InnerProduct_Index import IVF_InnerProduct_Index
 import numpy as np
+import scipy.sparse as sps
 
 
 
@@ -25,6 +27,166 @@ class BaseMatrixFactorizationRecommender(BaseRecommender):
 
         self.use_bias = False
 
+        self.approximate_index_flag = False
+        self._item_index = None
+        self._item_index_ITEM_factors = None
+
+
+
+    #########################################################################################################
+    ##########                                                                                     ##########
+    ##########                             APPROXIMATE ITEM INDEX                                  ##########
+    ##########                                                                                     ##########
+    #########################################################################################################
+
+
+    def _get_item_index_vectors(self, user_id_array = None):
+        """
+        The item bias, if any, is ranked as an additional factor whose user value is 1.
+        The user and global biases do not change the ranking of a user
+        :param user_id_array:   If None returns the item vectors, otherwise the query vectors of the users
+        :return:
+        """
+
+        if user_id_array is None:
+            vectors, bias = self.ITEM_factors, getattr(self, "ITEM_bias", None)
+        else:
+            vectors, bias = self.USER_factors[user_id_array], np.ones(len(user_id_array))
+
+        if self.use_bias:
+            vectors = np.hstack([vectors, np.reshape(bias, (-1, 1))])
+
+        return vectors
+
+
+
+    def build_item_index(self, n_lists = None, n_probe = None, n_iterations = 10, random_seed = None):
+        """
+        Builds an IVF index for approximate maximum inner product search on the item factors and enables
+        the approximate index mode, see set_approximate_index_mode
+        :param n_lists:         number of k-means partitions of the items, if None 4*sqrt(n_items)
+        :param n_probe:         number of partitions scanned for each user, if None n_lists/8
+        :param n_iterations:    number of k-means iterations
+        :param random_seed:
+        :return:
+        """
+
+        self._item_index = IVF_InnerProduct_Index(n_lists = n_lists, n_probe = n_probe, n_iterations = n_iterations,
+                                                  random_seed = random_seed, verbose = self.verbose)
+
+        self._item_index.fit(self._get_item_index_vectors())
+        self._item_index_ITEM_factors = self.ITEM_factors
+
+        self.approximate_index_flag = True
+
+
+
+    def set_approximate_index_mode(self, approximate_index_flag = True, n_probe = None):
+        """
+        In approximate index mode recommend() computes the scores only of the items in the n_probe partitions of the index
+        closest to each user, the candidates are then ranked with their exact score.
+        Items which are not candidates are never recommended, therefore recommendation lists may be shorter than the cutoff,
+        and with return_scores=True the scores are returned as a CSR matrix in which only the candidates have an entry.
+        If the index has not been built, it is built with the default parameters at the first recommendation,
+        it is built again if ITEM_factors changes, e.g., after fit.
+        :param approximate_index_flag:
+        :param n_probe:     number of partitions scanned for each user, higher values increase recall and latency
+        :return:
+        """
+
+        self.approximate_index_flag = approximate_index_flag
+
+        if n_probe is not None:
+            if self._item_index is None:
+                self._item_index = IVF_InnerProduct_Index(n_probe = n_probe, verbose = self.verbose)
+            else:
+                self._item_index.n_probe = n_probe
+
+
+
+    def _get_item_index(self):
+
+        if self._item_index is None:
+            self._item_index = IVF_InnerProduct_Index(verbose = self.verbose)
+
+        if self._item_index.centroids is None or self._item_index_ITEM_factors is not self.ITEM_factors:
+            self._item_index.fit(self._get_item_index_vectors())
+            self._item_index_ITEM_factors = self.ITEM_factors
+
+        return self._item_index
+
+
+
+    def recommend(self, user_id_array, cutoff = None, remove_seen_flag=True, items_to_compute = None,
+                  remove_top_pop_flag = False, remove_custom_items_flag = False, return_scores = False, return_array = False):
+
+        if not self.approximate_index_flag:
+            return super(BaseMatrixFactorizationRecommender, self).recommend(user_id_array, cutoff = cutoff, remove_seen_flag = remove_seen_flag,
+                                                                             items_to_compute = items_to_compute, remove_top_pop_flag = remove_top_pop_flag,
+                                                                             remove_custom_items_flag = remove_custom_items_flag, return_scores = return_scores,
+                                                                             return_array = return_array)
+
+        # If is a scalar transform it in a 1-cell array
+        if np.isscalar(user_id_array):
+            user_id_array = np.atleast_1d(user_id_array)
+            single_user = True
+        else:
+            single_user = False
+
+        user_id_array = np.asarray(user_id_array)
+
+        # Exact re-rank of the candidates
+        scores_batch = self._get_item_index().get_candidate_items(self._get_item_index_vectors(user_id_array))
+        scores_batch.data = self.compute_candidate_item_score(user_id_array, scores_batch)
+
+        return self._recommend_candidate_scores(user_id_array, scores_batch, single_user, cutoff = cutoff, remove_seen_flag = remove_seen_flag,
+                                                items_to_compute = items_to_compute, remove_top_pop_flag = remove_top_pop_flag,
+                                                remove_custom_items_flag = remove_custom_items_flag, return_scores = return_scores,
+                                                return_array = return_array)
+
+
+
+    def evaluate_item_index_recall(self, user_id_array = None, cutoff = 10, n_users = 1000, remove_seen_flag = True, random_seed = None):
+        """
+        Measures how many of the exact top-cutoff recommendations are found by the approximate index mode
+        :param user_id_array:   If None n_users random users with at least one interaction are used
+        :param cutoff:
+        :param n_users:
+        :param remove_seen_flag:
+        :param random_seed:
+        :return:                recall@cutoff of the approximate recommendations against the exact ones, averaged over users
+        """
+
+        if user_id_array is None:
+            warm_users = np.arange(self.n_users)[np.logical_not(self._get_cold_user_mask())]
+            user_id_array = np.random.RandomState(random_seed).choice(warm_users, min(n_users, len(warm_users)), replace=False)
+
+        user_id_array = np.asarray(user_id_array)
+
+        approximate_index_flag = self.approximate_index_flag
+
+        self.approximate_index_flag = False
+        exact_ranking = self.recommend(user_id_array, cutoff = cutoff, remove_seen_flag = remove_seen_flag, return_array = True)
+
+        self.approximate_index_flag = True
+        approximate_ranking = self.recommend(user_id_array, cutoff = cutoff, remove_seen_flag = remove_seen_flag, return_array = True)
+
+        self.approximate_index_flag = approximate_index_flag
+
+        recall_list = []
+
+        for user_index in range(len(user_id_array)):
+            user_exact_ranking = exact_ranking[user_index][exact_ranking[user_index] != -1]
+
+            if len(user_exact_ranking) > 0:
+                recall_list.append(np.isin(user_exact_ranking, approximate_ranking[user_index]).sum()/len(user_exact_ranking))
+
+        recall = np.mean(recall_list) if len(recall_list) > 0 else 0.0
+
+        self._print("Approximate index recall@{} against exact search: {:.4f}, on {} users".format(cutoff, recall, len(recall_list)))
+
+        return recall
+
 
 
 
@@ -70,6 +232,38 @@ class BaseMatrixFactorizationRecommender(BaseRecommender):
         return item_scores
 
 
+    def _compute_candidate_item_score(self, user_id_array, item_id_array, block_size = 100000):
+        """
+        The score of each (user, item) couple is the dot product of its user and item factors,
+        couples are processed in blocks of block_size to limit the memory required by the factors of the block
+        :param user_id_array:
+        :param item_id_array:
+        :param block_size:
+        :return:
+        """
+
+        assert self.USER_factors.shape[1] == self.ITEM_factors.shape[1], \
+            "{}: User and Item factors have inconsistent shape".format(self.RECOMMENDER_NAME)
+
+        assert self.USER_factors.shape[0] > np.max(user_id_array),\
+                "{}: Cold users not allowed. Users in trained model are {}, requested prediction for users up to {}".format(
+                self.RECOMMENDER_NAME, self.USER_factors.shape[0], np.max(user_id_array))
+
+        item_scores = np.empty(len(user_id_array), dtype=np.result_type(self.USER_factors, self.ITEM_factors))
+
+        for block_start in range(0, len(user_id_array), block_size):
+            block_users = user_id_array[block_start:block_start + block_size]
+            block_items = item_id_array[block_start:block_start + block_size]
+
+            item_scores[block_start:block_start + block_size] = np.einsum("ij,ij->i", self.USER_factors[block_users], self.ITEM_factors[block_items])
+
+        if self.use_bias:
+            item_scores = item_scores + self.ITEM_bias[item_id_array] + self.USER_bias[user_id_array] + self.GLOBAL_bias
+
+        return item_scores
+
+
+
     #########################################################################################################
     ##########                                                                                     ##########
     ##########                                LOAD AND SAVE                                        ##########
@@ -78,7 +272,7 @@ class BaseMatrixFactorizationRecommender(BaseRecommender):
 
 
 
-    def save_model(self, folder_path, file_name = None):
+    def save_model(self, folder_path, file_name = None, compress = True):
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -95,8 +289,28 @@ class BaseMatrixFactorizationRecommender(BaseRecommender):
             data_dict_to_save["USER_bias"] = self.USER_bias
             data_dict_to_save["GLOBAL_bias"] = self.GLOBAL_bias
 
+        # The index is saved only if it has been built on the current item factors
+        if self._item_index is not None and self._item_index.centroids is not None and self._item_index_ITEM_factors is self.ITEM_factors:
+            data_dict_to_save["approximate_index_flag"] = self.approximate_index_flag
+
+            for attrib_name, attrib_value in self._item_index.get_data_dict().items():
+                data_dict_to_save["ITEM_index_" + attrib_name] = attrib_value
+
         dataIO = DataIO(folder_path=folder_path)
-        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save)
+        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save, compress = compress)
 
 
         self._print("Saving complete")
+
+
+
+    def load_model(self, folder_path, file_name = None, mmap_mode = None):
+        super(BaseMatrixFactorizationRecommender, self).load_model(folder_path, file_name = file_name, mmap_mode = mmap_mode)
+
+        # Move the saved index, if any, from the attributes to the index object
+        index_attrib_name_list = [attrib_name for attrib_name in self.__dict__.keys() if attrib_name.startswith("ITEM_index_")]
+
+        if len(index_attrib_name_list) > 0:
+            self._item_index = IVF_InnerProduct_Index(verbose = self.verbose)
+            self._item_index.set_data_dict({attrib_name[len("ITEM_index_"):]: self.__dict__.pop(attrib_name) for attrib_name in index_attrib_name_list})
+            self._item_index_ITEM_factors = self.ITEM_factors
@@ -6,11 +6,88 @@
 """
 
 import numpy as np
+import scipy.sparse as sps
 from Base.DataIO import DataIO
 import os
 from Base.Recommender_utils import check_matrix
 
 
+def _remove_inf_from_ranking(ranking, scores_batch):
+    """
+    Removes from each ranking the items with an infinite score, moving the remaining ones to the left
+    :param ranking:         array (n_users, cutoff) of item indices
+    :param scores_batch:    array (n_users, n_items)
+    :return: ranking        array (n_users, cutoff) padded with -1
+             n_ranked       array (n_users,) number of items in each ranking
+    """
+
+    not_inf_scores_mask = np.logical_not(np.isinf(scores_batch[np.arange(ranking.shape[0])[:, None], ranking]))
+
+    # The stable sort preserves the order of the valid items
+    valid_first = np.argsort(np.logical_not(not_inf_scores_mask), axis=1, kind="stable")
+    ranking = np.take_along_axis(ranking, valid_first, axis=1)
+
+    n_ranked = not_inf_scores_mask.sum(axis=1)
+    ranking[np.arange(ranking.shape[1]) >= n_ranked[:, None]] = -1
+
+    return ranking, n_ranked
+
+
+
+def _get_csr_entries_in_other(csr_matrix, other_csr_matrix):
+    """
+    Returns a boolean mask over the non-zero entries of csr_matrix, True if the same (row, column) is also present in other_csr_matrix.
+    Both matrices are encoded as sorted (row, column) keys which are then merged with a binary search
+    :param csr_matrix:
+    :param other_csr_matrix:
+    :return:
+    """
+
+    assert csr_matrix.shape == other_csr_matrix.shape, "csr_matrix and other_csr_matrix have different shapes"
+
+    n_columns = csr_matrix.shape[1]
+
+    keys = np.repeat(np.arange(csr_matrix.shape[0], dtype=np.int64), np.ediff1d(csr_matrix.indptr)) * n_columns + csr_matrix.indices
+
+    other_keys = np.repeat(np.arange(other_csr_matrix.shape[0], dtype=np.int64), np.ediff1d(other_csr_matrix.indptr)) * n_columns + other_csr_matrix.indices
+    other_keys = np.sort(other_keys)
+
+    if len(other_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+
+    other_position = np.searchsorted(other_keys, keys)
+    other_position[other_position == len(other_keys)] = 0
+
+    return other_keys[other_position] == keys
+
+
+
+def _get_csr_row_top_k(csr_matrix, cutoff):
+    """
+    Ranks the non-zero entries of each row in descending order of value and keeps the first cutoff
+    :param csr_matrix:
+    :param cutoff:
+    :return: ranked_columns     array with the ranked column indices of all rows, concatenated
+             n_ranked           array (n_rows,) number of ranked columns for each row
+    """
+
+    n_per_row = np.ediff1d(csr_matrix.indptr)
+    entry_row = np.repeat(np.arange(csr_matrix.shape[0]), n_per_row)
+
+    # Sort by descending value and then, with a stable sort, by row. This is much faster than np.lexsort
+    # as the stable sort of 16 bit integers uses radix sort
+    ranking = np.argsort(-csr_matrix.data)
+    entry_row_dtype = np.uint16 if csr_matrix.shape[0] <= np.iinfo(np.uint16).max else np.int64
+    ranking = ranking[np.argsort(entry_row[ranking].astype(entry_row_dtype), kind="stable")]
+
+    entry_rank = np.arange(len(ranking)) - csr_matrix.indptr[entry_row]
+
+    in_top_k = entry_rank < cutoff
+
+    return csr_matrix.indices[ranking[in_top_k]], np.minimum(n_per_row, cutoff)
+
+
+
 class BaseRecommender(object):
     """Abstract BaseRecommender"""
 
@@ -117,6 +194,20 @@ class BaseRecommender(object):
         return scores
 
 
+    def _remove_seen_on_scores_batch(self, user_id_array, scores_batch):
+
+        assert self.URM_train.getformat() == "csr", "Recommender_Base_Class: URM_train is not CSR, this will cause errors in filtering seen items"
+
+        seen_start = self.URM_train.indptr[user_id_array]
+        n_seen = self.URM_train.indptr[np.asarray(user_id_array) + 1] - seen_start
+
+        # Position in URM_train.indices of the seen items of all users, concatenated
+        seen_position = np.arange(n_seen.sum()) + np.repeat(seen_start - np.cumsum(n_seen) + n_seen, n_seen)
+
+        scores_batch[np.repeat(np.arange(len(user_id_array)), n_seen), self.URM_train.indices[seen_position]] = -np.inf
+        return scores_batch
+
+
     def _compute_item_score(self, user_id_array, items_to_compute = None):
         """
 
@@ -128,8 +219,63 @@ class BaseRecommender(object):
         raise NotImplementedError("BaseRecommender: compute_item_score not assigned for current recommender, unable to compute prediction scores")
 
 
+    def _compute_candidate_item_score(self, user_id_array, item_id_array):
+        """
+        Computes the scores of the given (user, item) couples. This default implementation computes the scores of
+        all the users in user_id_array for all the items in item_id_array, recommenders should override it
+        computing only the required couples
+        :param user_id_array:       array containing the user index of each couple
+        :param item_id_array:       array containing the item index of each couple
+        :return:                    array (len(user_id_array),) with the scores
+        """
+
+        unique_user_id_array, user_position = np.unique(user_id_array, return_inverse=True)
+
+        scores_batch = self._compute_item_score(unique_user_id_array, items_to_compute = np.unique(item_id_array))
+
+        return np.asarray(scores_batch[user_position, item_id_array]).ravel()
+
+
+    def compute_candidate_item_score(self, user_id_array, item_id_array):
+        """
+        Computes only the scores of the candidate items, the scores of all the other items are never computed.
+        The candidates can be given as a list of (user, item) couples or as a CSR matrix with the candidate items of each user
+        :param user_id_array:       array containing the user index of each couple,
+                                    or the users whose candidates are the rows of item_id_array
+        :param item_id_array:       array containing the item index of each couple,
+                                    or CSR matrix (len(user_id_array), n_items) whose non-zero entries are the candidate items
+        :return:                    array with the score of each couple, or of each non-zero entry of the CSR matrix in the order of its indices
+        """
+
+        user_id_array = np.asarray(user_id_array)
+
+        if sps.issparse(item_id_array):
+            item_id_array = sps.csr_matrix(item_id_array)
+
+            assert item_id_array.shape == (len(user_id_array), self.n_items), \
+                "{}: CSR candidate matrix has shape {}, expected was {}".format(self.RECOMMENDER_NAME, item_id_array.shape, (len(user_id_array), self.n_items))
+
+            user_id_array = np.repeat(user_id_array, np.ediff1d(item_id_array.indptr))
+            item_id_array = item_id_array.indices
+
+        else:
+            item_id_array = np.asarray(item_id_array)
+
+            assert user_id_array.shape == item_id_array.shape, \
+                "{}: user_id_array and item_id_array must contain one element for each couple".format(self.RECOMMENDER_NAME)
+
+        if len(user_id_array) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        return self._compute_candidate_item_score(user_id_array, item_id_array)
+
+
     def recommend(self, user_id_array, cutoff = None, remove_seen_flag=True, items_to_compute = None,
-                  remove_top_pop_flag = False, remove_custom_items_flag = False, return_scores = False):
+                  remove_top_pop_flag = False, remove_custom_items_flag = False, return_scores = False, return_array = False):
+        """
+        :param return_array:    If True the recommendations are returned as an array (len(user_id_array), cutoff)
+                                padded with -1 where the list is shorter than the cutoff, instead of a list of lists
+        """
 
         # If is a scalar transform it in a 1-cell array
         if np.isscalar(user_id_array):
@@ -161,23 +307,8 @@ class BaseRecommender(object):
         #     scores /= den
 
 
-        for user_index in range(len(user_id_array)):
-
-            user_id = user_id_array[user_index]
-
-            if remove_seen_flag:
-                scores_batch[user_index,:] = self._remove_seen_on_scores(user_id, scores_batch[user_index, :])
-
-            # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-            # - Partition the data to extract the set of relevant items
-            # - Sort only the relevant items
-            # - Get the original item index
-            # relevant_items_partition = (-scores_user).argpartition(cutoff)[0:cutoff]
-            # relevant_items_partition_sorting = np.argsort(-scores_user[relevant_items_partition])
-            # ranking = relevant_items_partition[relevant_items_partition_sorting]
-            #
-            # ranking_list.append(ranking)
-
+        if remove_seen_flag:
+            scores_batch = self._remove_seen_on_scores_batch(user_id_array, scores_batch)
 
         if remove_top_pop_flag:
             scores_batch = self._remove_TopPop_on_scores(scores_batch)
@@ -185,6 +316,10 @@ class BaseRecommender(object):
         if remove_custom_items_flag:
             scores_batch = self._remove_custom_items_on_scores(scores_batch)
 
+        # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
+        # - Partition the data to extract the set of relevant items
+        # - Sort only the relevant items
+        # - Get the original item index
         # relevant_items_partition is block_size x cutoff
         relevant_items_partition = (-scores_batch).argpartition(cutoff, axis=1)[:,0:cutoff]
 
@@ -195,25 +330,84 @@ class BaseRecommender(object):
         relevant_items_partition_sorting = np.argsort(-relevant_items_partition_original_value, axis=1)
         ranking = relevant_items_partition[np.arange(relevant_items_partition.shape[0])[:, None], relevant_items_partition_sorting]
 
-        ranking_list = [None] * ranking.shape[0]
-
         # Remove from the recommendation list any item that has a -inf score
         # Since -inf is a flag to indicate an item to remove
-        for user_index in range(len(user_id_array)):
-            user_recommendation_list = ranking[user_index]
-            user_item_scores = scores_batch[user_index, user_recommendation_list]
+        ranking, n_ranked = _remove_inf_from_ranking(ranking, scores_batch)
+
+        if return_array:
+            ranking_list = ranking
+        else:
+            ranking_list = [user_ranking[:user_n_ranked] for user_ranking, user_n_ranked in zip(ranking.tolist(), n_ranked)]
+
+        # Return single list for one user, instead of list of lists
+        if single_user:
+            ranking_list = ranking_list[0][:n_ranked[0]]
 
-            not_inf_scores_mask = np.logical_not(np.isinf(user_item_scores))
 
-            user_recommendation_list = user_recommendation_list[not_inf_scores_mask]
-            ranking_list[user_index] = user_recommendation_list.tolist()
+        if return_scores:
+            return ranking_list, scores_batch
+
+        else:
+            return ranking_list
 
 
 
+    def _recommend_candidate_scores(self, user_id_array, scores_batch, single_user, cutoff = None, remove_seen_flag=True, items_to_compute = None,
+                                    remove_top_pop_flag = False, remove_custom_items_flag = False, return_scores = False, return_array = False):
+        """
+        Ranks only the candidate items of each user, i.e., the entries of a CSR score matrix, without ever building the dense
+        score matrix. Items which are not candidates are never recommended, therefore recommendation lists may be shorter
+        than the cutoff, and with return_scores=True the scores are returned as a CSR matrix in which removed items have no entry.
+        :param user_id_array:
+        :param scores_batch:    CSR matrix (len(user_id_array), n_items) with the scores of the candidate items
+        :param single_user:     If True return the list of the only user, instead of a list of lists
+        :return:
+        """
+
+        if cutoff is None:
+            cutoff = self.URM_train.shape[1] - 1
+
+        # Items that cannot be recommended to any user in the batch
+        remove_item_mask = np.zeros(self.n_items, dtype=bool)
+
+        if items_to_compute is not None:
+            remove_item_mask[:] = True
+            remove_item_mask[items_to_compute] = False
+
+        if remove_top_pop_flag:
+            remove_item_mask[self.filterTopPop_ItemsID] = True
+
+        if remove_custom_items_flag:
+            remove_item_mask[self.items_to_ignore_ID] = True
+
+        remove_entry_mask = remove_item_mask[scores_batch.indices]
+
+        if remove_seen_flag:
+            assert self.URM_train.getformat() == "csr", "Recommender_Base_Class: URM_train is not CSR, this will cause errors in filtering seen items"
+            remove_entry_mask = np.logical_or(remove_entry_mask, _get_csr_entries_in_other(scores_batch, self.URM_train[user_id_array]))
+
+        # Entries are removed with a mask rather than setting them to zero, as a candidate may have a zero score
+        if remove_entry_mask.any():
+            keep_entry_mask = np.logical_not(remove_entry_mask)
+            entry_row = np.repeat(np.arange(scores_batch.shape[0]), np.ediff1d(scores_batch.indptr))
+
+            scores_batch = sps.csr_matrix((scores_batch.data[keep_entry_mask],
+                                           scores_batch.indices[keep_entry_mask],
+                                           np.concatenate([[0], np.cumsum(np.bincount(entry_row[keep_entry_mask], minlength=scores_batch.shape[0]))])),
+                                          shape=scores_batch.shape)
+
+        ranked_items, n_ranked = _get_csr_row_top_k(scores_batch, cutoff)
+
+        if return_array:
+            # The array is only as wide as the longest list, to avoid allocating (batch, n_items) when cutoff is None
+            ranking_list = -np.ones((len(n_ranked), min(cutoff, n_ranked.max(initial=0))), dtype=int)
+            ranking_list[np.arange(ranking_list.shape[1]) < n_ranked[:, None]] = ranked_items
+        else:
+            ranking_list = [user_ranking.tolist() for user_ranking in np.split(ranked_items, np.cumsum(n_ranked)[:-1])]
+
         # Return single list for one user, instead of list of lists
         if single_user:
-            ranking_list = ranking_list[0]
-
+            ranking_list = ranking_list[0][:n_ranked[0]]
 
         if return_scores:
             return ranking_list, scores_batch
@@ -231,13 +425,26 @@ class BaseRecommender(object):
 
 
 
-    def save_model(self, folder_path, file_name = None):
+    def save_model(self, folder_path, file_name = None, compress = True):
+        """
+        :param folder_path:
+        :param file_name:
+        :param compress:    If False the model is saved in an uncompressed archive which load_model can memory map
+        :return:
+        """
         raise NotImplementedError("BaseRecommender: save_model not implemented")
 
 
 
 
-    def load_model(self, folder_path, file_name = None):
+    def load_model(self, folder_path, file_name = None, mmap_mode = None):
+        """
+        :param folder_path:
+        :param file_name:
+        :param mmap_mode:   None or a numpy memory map mode, e.g., 'r'. The arrays of a model saved with compress = False
+                            are memory mapped from the archive, multiple processes opening the same model share its pages
+        :return:
+        """
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -245,7 +452,7 @@ class BaseRecommender(object):
         self._print("Loading model from file '{}'".format(folder_path + file_name))
 
         dataIO = DataIO(folder_path=folder_path)
-        data_dict = dataIO.load_data(file_name=file_name)
+        data_dict = dataIO.load_data(file_name=file_name, mmap_mode=mmap_mode)
 
         for attrib_name in data_dict.keys():
              self.__setattr__(attrib_name, data_dict[attrib_name])
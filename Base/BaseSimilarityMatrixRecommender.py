@@ -6,9 +6,73 @@ Created on 16/09/2017
 @author: Maurizio Ferrari Dacrema
 """
 
-from Base.BaseRecommender import BaseRecommender
+from Base.BaseRecommender import BaseRecommender, _get_csr_entries_in_other, _get_csr_row_top_k
 from Base.DataIO import DataIO
 import numpy as np
+import scipy.sparse as sps
+
+
+
+def _get_row_column_dot_product(left_csr_matrix, left_rows, right_matrix, right_columns):
+    """
+    Computes, for each couple, the dot product of row left_rows[i] of left_csr_matrix and column right_columns[i] of right_matrix
+    Only the rows and columns of the couples are accessed
+    :param left_csr_matrix:
+    :param left_rows:
+    :param right_matrix:    CSC or dense matrix
+    :param right_columns:
+    :return: array (len(left_rows),)
+    """
+
+    left_couples = left_csr_matrix[left_rows]
+
+    if sps.issparse(right_matrix):
+        # The selected columns of the CSC matrix, transposed, are a CSR matrix with one row per couple
+        right_couples = right_matrix[:, right_columns].T
+        return np.asarray(left_couples.multiply(right_couples).sum(axis=1)).ravel()
+
+    entry_couple = np.repeat(np.arange(len(left_rows)), np.ediff1d(left_couples.indptr))
+    entry_products = left_couples.data * np.asarray(right_matrix[left_couples.indices, right_columns[entry_couple]]).ravel()
+
+    return np.bincount(entry_couple, weights = entry_products, minlength = len(left_rows))
+
+
+
+def _get_row_product_entries(left_csr_matrix, left_rows, right_csr_matrix, right_columns):
+    """
+    Computes the sparse product of the distinct rows in left_rows and right_csr_matrix, then gathers for each couple
+    the entry (left_rows[i], right_columns[i]) with a binary search on the sorted (row, column) keys of the product.
+    This is faster than the dot product of each couple when many couples share the same row
+    :param left_csr_matrix:
+    :param left_rows:
+    :param right_csr_matrix:
+    :param right_columns:
+    :return: array (len(left_rows),)
+    """
+
+    unique_left_rows, left_row_position = np.unique(left_rows, return_inverse=True)
+
+    product = sps.csr_matrix(left_csr_matrix[unique_left_rows].dot(right_csr_matrix))
+    product.sort_indices()
+
+    n_columns = product.shape[1]
+
+    product_keys = np.repeat(np.arange(product.shape[0], dtype=np.int64), np.ediff1d(product.indptr)) * n_columns + product.indices
+    couple_keys = left_row_position.astype(np.int64) * n_columns + right_columns
+
+    couple_scores = np.zeros(len(left_rows), dtype=np.float64)
+
+    if len(product_keys) == 0:
+        return couple_scores
+
+    product_position = np.searchsorted(product_keys, couple_keys)
+    product_position[product_position == len(product_keys)] = 0
+
+    # Couples missing from the product have a zero score
+    in_product = product_keys[product_position] == couple_keys
+    couple_scores[in_product] = product.data[product_position[in_product]]
+
+    return couple_scores
 
 
 
@@ -24,6 +88,26 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
         self._URM_train_format_checked = False
         self._W_sparse_format_checked = False
 
+        self.sparse_candidates_flag = False
+
+        self._csc_copy_dict = {}
+
+
+
+    def set_sparse_candidates_mode(self, sparse_candidates_flag = True):
+        """
+        In sparse candidates mode recommend() ranks only the items with a non-zero score, without ever building the dense
+        score matrix. Memory scales with the number of non-zero scores rather than with n_users x n_items.
+        Items with a zero or negative score are never recommended, as the dense ranking would place the unscored items
+        before the negative ones, therefore recommendation lists may be shorter than the cutoff,
+        and with return_scores=True the scores are returned as a CSR matrix in which removed items have no entry.
+        If W_sparse is a dense matrix the mode has no effect.
+        :param sparse_candidates_flag:
+        :return:
+        """
+
+        self.sparse_candidates_flag = sparse_candidates_flag
+
 
 
     def _check_format(self):
@@ -45,7 +129,116 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
 
 
 
-    def save_model(self, folder_path, file_name = None):
+    def _get_csc_copy(self, attribute_name):
+        """
+        Returns a CSC copy of the given sparse matrix attribute, to access its columns.
+        The copy is computed again only if the attribute has been assigned a different object since the last call
+        :param attribute_name:
+        :return:
+        """
+
+        attribute_object = getattr(self, attribute_name)
+
+        if not sps.issparse(attribute_object):
+            return attribute_object
+
+        if attribute_name not in self._csc_copy_dict or self._csc_copy_dict[attribute_name][0] is not attribute_object:
+            self._csc_copy_dict[attribute_name] = (attribute_object, sps.csc_matrix(attribute_object))
+
+        return self._csc_copy_dict[attribute_name][1]
+
+
+
+    def _compute_candidate_item_score_blocks(self, left_matrix_name, left_rows, right_matrix_name, right_columns, block_size = 100000):
+        """
+        Computes the scores of the couples as dot products of rows of the left matrix and columns of the right one,
+        couples are processed in blocks of block_size to limit the memory required by the rows of the block.
+        For each block the cheapest of two strategies is used, based on the number of multiplications each requires:
+        - Dot product of each couple, cost proportional to the number of couples
+        - Sparse product of the distinct rows of the block and gather of the couples, cost independent of the number of couples
+        """
+
+        self._check_format()
+
+        left_csr_matrix = getattr(self, left_matrix_name)
+        right_csr_matrix = getattr(self, right_matrix_name)
+        right_csc_matrix = self._get_csc_copy(right_matrix_name)
+
+        if sps.issparse(right_csr_matrix):
+            left_row_length = np.ediff1d(sps.csr_matrix(left_csr_matrix).indptr)
+            right_row_length = np.ediff1d(sps.csr_matrix(right_csr_matrix).indptr)
+            right_column_length = np.ediff1d(right_csc_matrix.indptr)
+
+        item_scores = np.empty(len(left_rows), dtype=np.float64)
+
+        for block_start in range(0, len(left_rows), block_size):
+
+            block_left_rows = left_rows[block_start:block_start + block_size]
+            block_right_columns = right_columns[block_start:block_start + block_size]
+
+            if sps.issparse(right_csr_matrix):
+                dot_product_cost = left_row_length[block_left_rows].sum() + right_column_length[block_right_columns].sum()
+                sparse_product_cost = right_row_length[left_csr_matrix[np.unique(block_left_rows)].indices].sum()
+
+                # The sparse product has a higher cost per multiplication, mostly due to sorting its entries.
+                # The ratio has been measured on KNN models
+                use_sparse_product = sparse_product_cost * 8 < dot_product_cost
+
+            else:
+                use_sparse_product = False
+
+            if use_sparse_product:
+                item_scores[block_start:block_start + block_size] = _get_row_product_entries(left_csr_matrix, block_left_rows,
+                                                                                             right_csr_matrix, block_right_columns)
+            else:
+                item_scores[block_start:block_start + block_size] = _get_row_column_dot_product(left_csr_matrix, block_left_rows,
+                                                                                                right_csc_matrix, block_right_columns)
+
+        return item_scores
+
+
+
+    def _compute_item_score_sparse(self, user_id_array):
+        """
+        :param user_id_array:
+        :return: CSR matrix (len(user_id_array), n_items) with the scores
+        """
+        raise NotImplementedError("BaseSimilarityMatrixRecommender: _compute_item_score_sparse not assigned for current recommender, unable to compute prediction scores")
+
+
+
+    def recommend(self, user_id_array, cutoff = None, remove_seen_flag=True, items_to_compute = None,
+                  remove_top_pop_flag = False, remove_custom_items_flag = False, return_scores = False, return_array = False):
+
+        if not self.sparse_candidates_flag or not sps.issparse(self.W_sparse):
+            return super(BaseSimilarityMatrixRecommender, self).recommend(user_id_array, cutoff = cutoff, remove_seen_flag = remove_seen_flag,
+                                                                          items_to_compute = items_to_compute, remove_top_pop_flag = remove_top_pop_flag,
+                                                                          remove_custom_items_flag = remove_custom_items_flag, return_scores = return_scores,
+                                                                          return_array = return_array)
+
+        # If is a scalar transform it in a 1-cell array
+        if np.isscalar(user_id_array):
+            user_id_array = np.atleast_1d(user_id_array)
+            single_user = True
+        else:
+            single_user = False
+
+        scores_batch = sps.csr_matrix(self._compute_item_score_sparse(user_id_array))
+
+        # The dense ranking places the items with a zero score, which have no entry, before those with a negative score.
+        # Negative scores are removed as well, so the recommendations are the top of the dense ranking
+        scores_batch.data[scores_batch.data < 0] = 0.0
+        scores_batch.eliminate_zeros()
+        scores_batch.sort_indices()
+
+        return self._recommend_candidate_scores(user_id_array, scores_batch, single_user, cutoff = cutoff, remove_seen_flag = remove_seen_flag,
+                                                items_to_compute = items_to_compute, remove_top_pop_flag = remove_top_pop_flag,
+                                                remove_custom_items_flag = remove_custom_items_flag, return_scores = return_scores,
+                                                return_array = return_array)
+
+
+
+    def save_model(self, folder_path, file_name = None, compress = True):
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -55,7 +248,7 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
         data_dict_to_save = {"W_sparse": self.W_sparse}
 
         dataIO = DataIO(folder_path=folder_path)
-        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save)
+        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save, compress = compress)
 
         self._print("Saving complete")
 
@@ -92,6 +285,24 @@ class BaseItemSimilarityMatrixRecommender(BaseSimilarityMatrixRecommender):
         return item_scores
 
 
+    def _compute_item_score_sparse(self, user_id_array):
+
+        self._check_format()
+
+        return self.URM_train[user_id_array].dot(self.W_sparse)
+
+
+    def _compute_candidate_item_score(self, user_id_array, item_id_array):
+        """
+        The score of each (user, item) couple is URM_train[user] * W_sparse[:, item]
+        :param user_id_array:
+        :param item_id_array:
+        :return:
+        """
+
+        return self._compute_candidate_item_score_blocks("URM_train", user_id_array, "W_sparse", item_id_array)
+
+
 class BaseUserSimilarityMatrixRecommender(BaseSimilarityMatrixRecommender):
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
@@ -114,3 +325,21 @@ class BaseUserSimilarityMatrixRecommender(BaseSimilarityMatrixRecommender):
             item_scores = user_weights_array.dot(self.URM_train).toarray()
 
         return item_scores
+
+
+    def _compute_item_score_sparse(self, user_id_array):
+
+        self._check_format()
+
+        return self.W_sparse[user_id_array].dot(self.URM_train)
+
+
+    def _compute_candidate_item_score(self, user_id_array, item_id_array):
+        """
+        The score of each (user, item) couple is W_sparse[user] * URM_train[:, item]
+        :param user_id_array:
+        :param item_id_array:
+        :return:
+        """
+
+        return self._compute_candidate_item_score_blocks("W_sparse", user_id_array, "URM_train", item_id_array)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from KNN.ItemKNNCustomSimilarityRecommender import ItemKNNCustomSimilarityRecommender
+
+
+
+class MyTestCase(unittest.TestCase):
+
+
+    def test_sparse_candidates_negative_weights(self):
+
+        n_users = 100
+        n_items = 80
+        cutoff = 10
+
+        URM_train = sps.random(n_users, n_items, density=0.05, format='csr', random_state=np.random.RandomState(0))
+        URM_train.data = np.ones_like(URM_train.data)
+
+        # Weights with both signs, as in EASE_R or SLIM ElasticNet without positive_only
+        W_sparse = sps.random(n_items, n_items, density=0.05, format='csr', random_state=np.random.RandomState(1))
+        W_sparse.data = W_sparse.data - 0.5
+
+        recommender = ItemKNNCustomSimilarityRecommender(URM_train, verbose = False)
+        recommender.fit(W_sparse)
+
+        user_id_array = np.arange(n_users)
+
+        recommender.set_sparse_candidates_mode(False)
+        dense_ranking_list, dense_scores = recommender.recommend(user_id_array, cutoff = cutoff, return_scores = True)
+
+        recommender.set_sparse_candidates_mode(True)
+        sparse_ranking_list, sparse_scores = recommender.recommend(user_id_array, cutoff = cutoff, return_scores = True)
+
+        n_users_with_negative_candidates = 0
+
+        for user_id in user_id_array:
+
+            dense_ranking = np.array(dense_ranking_list[user_id], dtype=int)
+            sparse_ranking = np.array(sparse_ranking_list[user_id], dtype=int)
+
+            # The sparse recommendations are the top of the dense ranking, up to the first item with a non-positive score
+            n_positive = np.sum(dense_scores[user_id, dense_ranking] > 0)
+
+            assert np.array_equal(sparse_ranking, dense_ranking[:n_positive])
+            assert np.all(sparse_scores[user_id].data > 0)
+
+            # Seen items have a -inf score
+            n_users_with_negative_candidates += np.any(np.logical_and(dense_scores[user_id] < 0, np.isfinite(dense_scores[user_id])))
+
+        assert n_users_with_negative_candidates > 0
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
@@ -6,7 +6,7 @@ Created on 27/04/2019
 @author: Maurizio Ferrari Dacrema
 """
 
-import os, json, zipfile, shutil, platform
+import os, json, zipfile, shutil, platform, struct
 
 import scipy.sparse as sps
 from pandas import DataFrame
@@ -37,6 +37,11 @@ class DataIO(object):
 
     _DEFAULT_TEMP_FOLDER = ".temp"
 
+    # Uncompressed archives align the content of their members, the alignment
+    # is stored in an extra field with the same id used by Android zipalign
+    _MEMBER_ALIGNMENT = 64
+    _PADDING_EXTRA_FIELD_ID = 0xD935
+
     # _MAX_PATH_LENGTH_LINUX = 4096
     _MAX_PATH_LENGTH_WINDOWS = 255
 
@@ -102,7 +107,64 @@ class DataIO(object):
         return dict_to_save_key_str
 
 
-    def save_data(self, file_name, data_dict_to_save):
+    def _save_sparse_components(self, folder_path, sparse_matrix):
+        """
+        Saves a sparse matrix as separate uncompressed .npy files for data, indices and indptr so that
+        each of them can be memory mapped, the format and shape are saved in a json file.
+        Formats other than CSR and CSC are converted to CSR
+        :param folder_path:
+        :param sparse_matrix:
+        :return: list of the file names relative to folder_path
+        """
+
+        if sparse_matrix.format not in ["csr", "csc"]:
+            sparse_matrix = sps.csr_matrix(sparse_matrix)
+
+        os.makedirs(folder_path)
+
+        for component_name in ["data", "indices", "indptr"]:
+            np.save(folder_path + component_name, getattr(sparse_matrix, component_name), allow_pickle=False)
+
+        with open(folder_path + "attributes.json", 'w') as outfile:
+            json.dump({"format": sparse_matrix.format, "shape": sparse_matrix.shape}, outfile, default=json_not_serializable_handler)
+
+        return ["data.npy", "indices.npy", "indptr.npy", "attributes.json"]
+
+
+
+    def _write_aligned(self, myzip, file_path, arcname):
+        """
+        Writes a file in the zip archive without compression, padding the extra field of its local header
+        so that the file content starts at a multiple of _MEMBER_ALIGNMENT bytes from the beginning of the archive.
+        The header of .npy files is itself padded to a multiple of 64 bytes, therefore the array data is aligned as well.
+        Zip64 extensions are always used because their presence changes the header length.
+        """
+
+        zinfo = zipfile.ZipInfo.from_file(file_path, arcname = arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED
+
+        # Local header: 30 fixed bytes, the file name, the padding extra field (4 bytes + padding)
+        # and the zip64 extra field (20 bytes)
+        header_length = 30 + len(zinfo.filename.encode("utf-8")) + 4 + 20
+        padding = -(myzip.fp.tell() + header_length) % self._MEMBER_ALIGNMENT
+
+        zinfo.extra = struct.pack("<HH", self._PADDING_EXTRA_FIELD_ID, padding) + bytes(padding)
+
+        with open(file_path, "rb") as source_file, myzip.open(zinfo, "w", force_zip64=True) as destination_file:
+            shutil.copyfileobj(source_file, destination_file, 1024*1024)
+
+
+
+    def save_data(self, file_name, data_dict_to_save, compress = True):
+        """
+        Saves the dictionary in a zip archive
+        :param file_name:
+        :param data_dict_to_save:
+        :param compress:    If True the archive is compressed with DEFLATE.
+                            If False the archive is not compressed, its members are aligned and sparse matrices are
+                            saved as separate arrays, this allows load_data to memory map them directly from the archive.
+        :return:
+        """
 
         # If directory does not exist, create with .temp_model_folder
         if not os.path.exists(self.folder_path):
@@ -117,6 +179,9 @@ class DataIO(object):
         attribute_to_file_name = {}
         attribute_to_json_file = {}
 
+        # Files saved in the temp folder which are not listed in attribute_to_file_name
+        archive_file_name_list = []
+
         for attrib_name, attrib_data in data_dict_to_save.items():
 
             current_file_path = current_temp_folder + attrib_name
@@ -125,6 +190,11 @@ class DataIO(object):
                 attrib_data.to_csv(current_file_path + ".csv", index=False)
                 attribute_to_file_name[attrib_name] = attrib_name + ".csv"
 
+            elif isinstance(attrib_data, sps.spmatrix) and not compress:
+                component_file_name_list = self._save_sparse_components(current_file_path + ".sparse/", attrib_data)
+                attribute_to_file_name[attrib_name] = attrib_name + ".sparse"
+                archive_file_name_list.extend(attrib_name + ".sparse/" + component_file_name for component_file_name in component_file_name_list)
+
             elif isinstance(attrib_data, sps.spmatrix):
                 sps.save_npz(current_file_path, attrib_data)
                 attribute_to_file_name[attrib_name] = attrib_name + ".npz"
@@ -145,7 +215,7 @@ class DataIO(object):
 
                     if isinstance(attrib_data, dict):
                         dataIO = DataIO(folder_path = current_temp_folder)
-                        dataIO.save_data(file_name = attrib_name, data_dict_to_save=attrib_data)
+                        dataIO.save_data(file_name = attrib_name, data_dict_to_save=attrib_data, compress = compress)
                         attribute_to_file_name[attrib_name] = attrib_name + ".zip"
 
                     else:
@@ -179,75 +249,161 @@ class DataIO(object):
 
 
 
-        with zipfile.ZipFile(self.folder_path + file_name, 'w', compression=zipfile.ZIP_DEFLATED) as myzip:
+        archive_file_name_list.extend(file_name for file_name in attribute_to_file_name.values() if not file_name.endswith(".sparse"))
+
+        # Write the archive with a process-specific name and then rename it, so that readers never see a partial
+        # archive and existing memory maps of the previous one remain valid
+        archive_path = self.folder_path + file_name
+        temp_archive_path = "{}_{}.tmp".format(archive_path, os.getpid())
+
+        try:
+            if compress:
+                with zipfile.ZipFile(temp_archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as myzip:
+
+                    for archive_file_name in archive_file_name_list:
+                        myzip.write(current_temp_folder + archive_file_name, arcname = archive_file_name)
+
+            else:
+                with zipfile.ZipFile(temp_archive_path, 'w', compression=zipfile.ZIP_STORED) as myzip:
+
+                    for archive_file_name in archive_file_name_list:
+                        self._write_aligned(myzip, current_temp_folder + archive_file_name, arcname = archive_file_name)
+
+            os.replace(temp_archive_path, archive_path)
+
+        finally:
+            if os.path.exists(temp_archive_path):
+                os.remove(temp_archive_path)
+
+            shutil.rmtree(current_temp_folder, ignore_errors=True)
+
+
+    def _load_npy_from_archive(self, dataFile, file_name, mmap_mode):
+        """
+        Loads a .npy file contained in the archive without extracting it.
+        If mmap_mode is not None and the file is not compressed, the array is memory mapped from the archive itself
+        :param dataFile:
+        :param file_name:
+        :param mmap_mode:
+        :return:
+        """
+
+        zinfo = dataFile.getinfo(file_name)
+
+        if mmap_mode is None or zinfo.compress_type != zipfile.ZIP_STORED:
+            with dataFile.open(file_name) as npy_file:
+                # allow_pickle is FALSE to prevent using pickle and ensure portability
+                return np.load(npy_file, allow_pickle=False)
+
+        # The member content starts after its local header, whose extra field may differ from the one in the central directory
+        dataFile.fp.seek(zinfo.header_offset)
+        local_header = dataFile.fp.read(30)
+        file_name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        member_offset = zinfo.header_offset + 30 + file_name_length + extra_length
+
+        with dataFile.open(file_name) as npy_file:
+            version = np.lib.format.read_magic(npy_file)
+
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy_file)
 
-            for file_name in attribute_to_file_name.values():
-                myzip.write(current_temp_folder + file_name, arcname = file_name)
+            header_length = npy_file.tell()
 
+        if dtype.hasobject:
+            raise ValueError("DataIO: Array '{}' contains objects and cannot be memory mapped".format(file_name))
 
+        return np.memmap(dataFile.filename, dtype = dtype, shape = shape, order = "F" if fortran_order else "C",
+                         mode = mmap_mode, offset = member_offset + header_length)
 
-        shutil.rmtree(current_temp_folder, ignore_errors=True)
 
 
-    def load_data(self, file_name):
+    def load_data(self, file_name, mmap_mode = None):
+        """
+        Loads the dictionary saved in a zip archive, the files are read directly from the archive
+        :param file_name:
+        :param mmap_mode:   None or a numpy memory map mode, e.g., 'r'. Arrays and sparse matrices saved in an uncompressed
+                            archive (see save_data) are memory mapped instead of being read in memory.
+                            Arrays saved in a compressed archive are always read in memory.
+        :return:
+        """
 
         if file_name[-4:] != ".zip":
             file_name += ".zip"
 
         dataFile = zipfile.ZipFile(self.folder_path + file_name)
 
-        dataFile.testzip()
+        # Testing the archive requires to read all of it, memory mapped arrays should be read only when needed
+        if mmap_mode is None:
+            dataFile.testzip()
 
-        current_temp_folder = self._get_temp_folder(file_name)
+        # A temporary folder is needed only to load nested archives
+        current_temp_folder = None
 
         try:
 
             try:
-                attribute_to_file_name_path = dataFile.extract(".DataIO_attribute_to_file_name.json", path = current_temp_folder)
+                attribute_to_file_name_path = ".DataIO_attribute_to_file_name.json"
+                dataFile.getinfo(attribute_to_file_name_path)
             except KeyError:
-                attribute_to_file_name_path = dataFile.extract("__DataIO_attribute_to_file_name.json", path = current_temp_folder)
+                attribute_to_file_name_path = "__DataIO_attribute_to_file_name.json"
 
 
-            with open(attribute_to_file_name_path, "r") as json_file:
+            with dataFile.open(attribute_to_file_name_path, "r") as json_file:
                 attribute_to_file_name = json.load(json_file)
 
             data_dict_loaded = {}
 
             for attrib_name, file_name in attribute_to_file_name.items():
 
-                attrib_file_path = dataFile.extract(file_name, path = current_temp_folder)
                 attrib_data_type = file_name.split(".")[-1]
 
                 if attrib_data_type == "csv":
-                    attrib_data = pd.read_csv(attrib_file_path, index_col=False)
+                    with dataFile.open(file_name) as csv_file:
+                        attrib_data = pd.read_csv(csv_file, index_col=False)
 
                 elif attrib_data_type == "npz":
-                    attrib_data = sps.load_npz(attrib_file_path)
+                    with dataFile.open(file_name) as npz_file:
+                        attrib_data = sps.load_npz(npz_file)
 
                 elif attrib_data_type == "npy":
-                    # allow_pickle is FALSE to prevent using pickle and ensure portability
-                    attrib_data = np.load(attrib_file_path, allow_pickle=False)
+                    attrib_data = self._load_npy_from_archive(dataFile, file_name, mmap_mode)
+
+                elif attrib_data_type == "sparse":
+                    with dataFile.open(file_name + "/attributes.json", "r") as json_file:
+                        sparse_attributes = json.load(json_file)
+
+                    sparse_components = [self._load_npy_from_archive(dataFile, file_name + "/" + component_name + ".npy", mmap_mode)
+                                         for component_name in ["data", "indices", "indptr"]]
+
+                    if sparse_attributes["format"] == "csr":
+                        attrib_data = sps.csr_matrix(tuple(sparse_components), shape = tuple(sparse_attributes["shape"]), copy = False)
+                    else:
+                        attrib_data = sps.csc_matrix(tuple(sparse_components), shape = tuple(sparse_attributes["shape"]), copy = False)
 
                 elif attrib_data_type == "zip":
+                    if current_temp_folder is None:
+                        current_temp_folder = self._get_temp_folder(dataFile.filename.split("/")[-1])
+
+                    dataFile.extract(file_name, path = current_temp_folder)
                     dataIO = DataIO(folder_path = current_temp_folder)
                     attrib_data = dataIO.load_data(file_name = file_name)
 
                 elif attrib_data_type == "json":
-                    with open(attrib_file_path, "r") as json_file:
+                    with dataFile.open(file_name, "r") as json_file:
                         attrib_data = json.load(json_file)
 
                 else:
-                    raise Exception("Attribute type not recognized for: '{}' of class: '{}'".format(attrib_file_path, attrib_data_type))
+                    raise Exception("Attribute type not recognized for: '{}' of class: '{}'".format(file_name, attrib_data_type))
 
                 data_dict_loaded[attrib_name] = attrib_data
 
+        finally:
+            dataFile.close()
 
-        except Exception as exec:
-
-            shutil.rmtree(current_temp_folder, ignore_errors=True)
-            raise exec
-
-        shutil.rmtree(current_temp_folder, ignore_errors=True)
+            if current_temp_folder is not None:
+                shutil.rmtree(current_temp_folder, ignore_errors=True)
 
 
         return data_dict_loaded
@@ -8,13 +8,16 @@ Created on 26/06/18
 
 import numpy as np
 import scipy.sparse as sps
-import time, sys, copy
+import time, sys, copy, itertools, multiprocessing
+
+from functools import partial
 
 from enum import Enum
 from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
+from Base.BaseRecommender import _get_csr_entries_in_other, _get_csr_row_top_k
 
-from Base.Evaluation.metrics import precision, precision_recall_min_denominator, recall, MAP, MAP_MIN_DEN, MRR, HIT_RATE, ndcg, arhr_all_hits, \
-    Novelty, Coverage_Item, Coverage_Item_HIT, Items_In_GT, _Metrics_Object, Coverage_User, Coverage_User_HIT, Users_In_GT, Gini_Diversity, Shannon_Entropy, Diversity_MeanInterList,\
+from Base.Evaluation.metrics import precision_batch, precision_recall_min_denominator_batch, recall_batch, MAP, MAP_MIN_DEN, MRR, HIT_RATE, ndcg_batch, arhr_all_hits_batch, \
+    _sequential_sum, Novelty, Coverage_Item, Coverage_Item_HIT, Items_In_GT, _Metrics_Object, Coverage_User, Coverage_User_HIT, Users_In_GT, Gini_Diversity, Shannon_Entropy, Diversity_MeanInterList,\
     Diversity_Herfindahl, AveragePopularity
 
 
@@ -152,6 +155,83 @@ def _remove_item_interactions(URM, item_list):
     return URM
 
 
+def _get_padded_recommendation_array(recommended_items_batch_list, max_cutoff):
+    """
+    Converts the list of recommendation lists in a (n_users, max_cutoff) array, padded with -1
+    :param recommended_items_batch_list:    list of lists, or array padded with -1 as returned by recommend(return_array = True)
+    :param max_cutoff:
+    :return: recommended_items_batch, n_recommended
+    """
+
+    if isinstance(recommended_items_batch_list, np.ndarray):
+
+        recommended_items_batch = recommended_items_batch_list[:, 0:max_cutoff]
+
+        if recommended_items_batch.shape[1] < max_cutoff:
+            recommended_items_batch = np.hstack((recommended_items_batch,
+                                                 -np.ones((recommended_items_batch.shape[0], max_cutoff - recommended_items_batch.shape[1]), dtype=recommended_items_batch.dtype)))
+
+        return recommended_items_batch, np.sum(recommended_items_batch != -1, axis=1)
+
+
+    n_users_batch = len(recommended_items_batch_list)
+
+    n_recommended = np.fromiter(map(len, recommended_items_batch_list), dtype=int, count=n_users_batch)
+    recommended_items_flat = np.fromiter(itertools.chain.from_iterable(recommended_items_batch_list), dtype=int, count=n_recommended.sum())
+
+    width = max(max_cutoff, n_recommended.max(initial=0))
+
+    recommended_items_batch = -np.ones((n_users_batch, width), dtype=int)
+    recommended_items_batch[np.arange(width) < n_recommended[:, None]] = recommended_items_flat
+
+    return recommended_items_batch[:, 0:max_cutoff], np.minimum(n_recommended, max_cutoff)
+
+
+def _merge_results_dict(results_dict, other_results_dict):
+    """
+    Merges the metrics accumulated on two disjoint sets of users, before they are normalized
+    :param results_dict:
+    :param other_results_dict:
+    :return:
+    """
+
+    for cutoff in results_dict.keys():
+
+        results_current_cutoff = results_dict[cutoff]
+        other_results_current_cutoff = other_results_dict[cutoff]
+
+        for key in results_current_cutoff.keys():
+            value = results_current_cutoff[key]
+
+            if isinstance(value, _Metrics_Object):
+                value.merge_with_other(other_results_current_cutoff[key])
+            else:
+                results_current_cutoff[key] = value + other_results_current_cutoff[key]
+
+    return results_dict
+
+
+
+# Objects inherited by the processes forked by Evaluator._run_evaluation_on_shards
+_shard_evaluation_objects = None
+
+
+def _evaluate_shard(users_to_evaluate_shard, evaluator_object = None, recommender_object = None):
+
+    if evaluator_object is None:
+        evaluator_object, recommender_object = _shard_evaluation_objects
+
+    # This is the copy of the worker process, progress is printed by the main one
+    evaluator_object.verbose = False
+    evaluator_object._n_users_evaluated = 0
+
+    results_dict = evaluator_object._run_evaluation_on_selected_users(recommender_object, users_to_evaluate_shard.tolist())
+
+    return results_dict, evaluator_object._n_users_evaluated
+
+
+
+
 class Evaluator(object):
     """Abstract Evaluator"""
 
@@ -236,11 +316,15 @@ class Evaluator(object):
             print("{}: {}".format(self.EVALUATOR_NAME, string))
 
 
-    def evaluateRecommender(self, recommender_object):
+    def evaluateRecommender(self, recommender_object, n_workers = 1):
         """
         :param recommender_object: the trained recommender object, a BaseRecommender subclass
         :param URM_test_list: list of URMs to test the recommender against, or a single URM object
         :param cutoff_list: list of cutoffs to be use to report the scores, or a single cutoff
+        :param n_workers: number of processes the users to evaluate are split across. When the "fork" start method is available
+                          the workers inherit the recommender, otherwise it is pickled, therefore the recommender must be either
+                          fork-safe or picklable. Due to the different summation order the results may differ from the
+                          single process ones in the last digits
         """
 
         if self.ignore_items_flag:
@@ -250,7 +334,10 @@ class Evaluator(object):
         self._start_time_print = time.time()
         self._n_users_evaluated = 0
 
-        results_dict = self._run_evaluation_on_selected_users(recommender_object, self.users_to_evaluate)
+        if n_workers > 1 and len(self.users_to_evaluate) > 1:
+            results_dict = self._run_evaluation_on_shards(recommender_object, n_workers)
+        else:
+            results_dict = self._run_evaluation_on_selected_users(recommender_object, self.users_to_evaluate)
 
 
         if self._n_users_evaluated > 0:
@@ -302,6 +389,55 @@ class Evaluator(object):
 
 
 
+    def _get_relevance_batch(self, test_user_batch_array, recommended_items_batch, n_recommended):
+        """
+        Looks up the test data of a block of users for all their recommended items at once
+        :param test_user_batch_array:
+        :param recommended_items_batch:     array (n_users, max_cutoff) padded recommendation lists
+        :param n_recommended:               array (n_users,) length of each recommendation list
+        :return: is_relevant    boolean array (n_users, max_cutoff), True if the recommended item is in the user test data
+                 rank_scores    array (n_users, max_cutoff), test rating of the recommended item, 0.0 if not relevant
+                 ideal_scores   array (n_users, max_cutoff), test ratings of each user sorted in descending order
+                 n_relevant     array (n_users,) number of test items of each user
+        """
+
+        assert self.URM_test.getformat() == "csr", "Evaluator_Base_Class: URM_test is not CSR, this will cause errors in getting relevant items"
+
+        n_users_batch, max_cutoff = recommended_items_batch.shape
+
+        URM_test_batch = self.URM_test[test_user_batch_array]
+        n_relevant = np.ediff1d(URM_test_batch.indptr)
+        test_row = np.repeat(np.arange(n_users_batch, dtype=np.int64), n_relevant)
+
+        # Each (user, item) couple is encoded in a single key, the stable sort preserves the original order of duplicates
+        test_keys = test_row * self.n_items + URM_test_batch.indices
+        test_keys_sorting = np.argsort(test_keys, kind="stable")
+        test_keys = test_keys[test_keys_sorting]
+
+        valid_mask = np.arange(max_cutoff) < n_recommended[:, None]
+        recommended_keys = np.arange(n_users_batch, dtype=np.int64)[:, None] * self.n_items + recommended_items_batch
+
+        # If an item appears twice in a user profile the last rating is used, as in ndcg
+        test_position = np.searchsorted(test_keys, recommended_keys, side="right") - 1
+        is_relevant = np.logical_and(valid_mask, test_position >= 0)
+        is_relevant[is_relevant] = test_keys[test_position[is_relevant]] == recommended_keys[is_relevant]
+
+        rank_scores = np.zeros((n_users_batch, max_cutoff), dtype=np.float64)
+        rank_scores[is_relevant] = URM_test_batch.data[test_keys_sorting[test_position[is_relevant]]]
+
+        # Sort the test ratings of each user in descending order and keep only those that fit in the recommendation list
+        ideal_sorting = np.lexsort((URM_test_batch.data, -test_row))[::-1]
+        ideal_position = np.arange(len(test_row)) - URM_test_batch.indptr[test_row[ideal_sorting]]
+        ideal_in_list = ideal_position < max_cutoff
+
+        ideal_scores = np.zeros((n_users_batch, max_cutoff), dtype=URM_test_batch.data.dtype)
+        ideal_scores[test_row[ideal_sorting][ideal_in_list], ideal_position[ideal_in_list]] = URM_test_batch.data[ideal_sorting][ideal_in_list]
+
+        return is_relevant, rank_scores, ideal_scores, n_relevant
+
+
+
+
     def _compute_metrics_on_recommendation_list(self, test_user_batch_array, recommended_items_batch_list, scores_batch, results_dict):
 
         assert len(recommended_items_batch_list) == len(test_user_batch_array), "{}: recommended_items_batch_list contained recommendations for {} users, expected was {}".format(
@@ -314,76 +450,122 @@ class Evaluator(object):
             self.EVALUATOR_NAME, scores_batch.shape[1], self.n_items)
 
 
-        # Compute recommendation quality for each user in batch
-        for batch_user_index in range(len(recommended_items_batch_list)):
+        test_user_batch_array = np.array(test_user_batch_array)
 
-            test_user = test_user_batch_array[batch_user_index]
+        recommended_items_batch, n_recommended = _get_padded_recommendation_array(recommended_items_batch_list, self.max_cutoff)
 
-            relevant_items = self.get_user_relevant_items(test_user)
+        is_relevant, rank_scores, ideal_scores, n_relevant = self._get_relevance_batch(test_user_batch_array, recommended_items_batch, n_recommended)
 
-            # Add the RMSE to the global object, no need to loop through the various cutoffs
-            # This repository is not designed to ensure proper RMSE optimization
-            # relevant_items_rating = self.get_user_test_ratings(test_user)
-            #
-            # all_items_predicted_ratings = scores_batch[batch_user_index]
-            # global_RMSE_object = results_dict[self.cutoff_list[0]][EvaluatorMetrics.RMSE.value]
-            # global_RMSE_object.add_recommendations(all_items_predicted_ratings, relevant_items, relevant_items_rating)
+        self._n_users_evaluated += len(test_user_batch_array)
 
-            # Being the URM CSR, the indices are the non-zero column indexes
-            recommended_items = recommended_items_batch_list[batch_user_index]
-            is_relevant = np.in1d(recommended_items, relevant_items, assume_unique=True)
+        # Compute recommendation quality for all users in batch, each metric is computed on the whole block
+        for cutoff in self.cutoff_list:
 
-            self._n_users_evaluated += 1
+            results_current_cutoff = results_dict[cutoff]
 
-            for cutoff in self.cutoff_list:
+            is_relevant_current_cutoff = is_relevant[:, 0:cutoff]
+            recommended_items_current_cutoff = recommended_items_batch[:, 0:cutoff]
+            n_recommended_current_cutoff = np.minimum(n_recommended, cutoff)
 
-                results_current_cutoff = results_dict[cutoff]
+            results_current_cutoff[EvaluatorMetrics.PRECISION.value]            = _sequential_sum(results_current_cutoff[EvaluatorMetrics.PRECISION.value],
+                                                                                                  precision_batch(is_relevant_current_cutoff, n_recommended_current_cutoff))
+            results_current_cutoff[EvaluatorMetrics.PRECISION_RECALL_MIN_DEN.value]   = _sequential_sum(results_current_cutoff[EvaluatorMetrics.PRECISION_RECALL_MIN_DEN.value],
+                                                                                                  precision_recall_min_denominator_batch(is_relevant_current_cutoff, n_recommended_current_cutoff, n_relevant))
+            results_current_cutoff[EvaluatorMetrics.RECALL.value]               = _sequential_sum(results_current_cutoff[EvaluatorMetrics.RECALL.value],
+                                                                                                  recall_batch(is_relevant_current_cutoff, n_relevant))
+            results_current_cutoff[EvaluatorMetrics.NDCG.value]                 = _sequential_sum(results_current_cutoff[EvaluatorMetrics.NDCG.value],
+                                                                                                  ndcg_batch(rank_scores[:, 0:cutoff], n_recommended_current_cutoff, ideal_scores, np.minimum(n_relevant, cutoff)))
+            results_current_cutoff[EvaluatorMetrics.ARHR.value]                 = _sequential_sum(results_current_cutoff[EvaluatorMetrics.ARHR.value],
+                                                                                                  arhr_all_hits_batch(is_relevant_current_cutoff, n_recommended_current_cutoff))
 
-                is_relevant_current_cutoff = is_relevant[0:cutoff]
-                recommended_items_current_cutoff = recommended_items[0:cutoff]
+            results_current_cutoff[EvaluatorMetrics.MRR.value].add_recommendations_batch(is_relevant_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.MAP.value].add_recommendations_batch(is_relevant_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.MAP_MIN_DEN.value].add_recommendations_batch(is_relevant_current_cutoff, n_recommended_current_cutoff, n_relevant)
+            results_current_cutoff[EvaluatorMetrics.HIT_RATE.value].add_recommendations_batch(is_relevant_current_cutoff)
 
-                results_current_cutoff[EvaluatorMetrics.PRECISION.value]            += precision(is_relevant_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.PRECISION_RECALL_MIN_DEN.value]   += precision_recall_min_denominator(is_relevant_current_cutoff, len(relevant_items))
-                results_current_cutoff[EvaluatorMetrics.RECALL.value]               += recall(is_relevant_current_cutoff, relevant_items)
-                results_current_cutoff[EvaluatorMetrics.NDCG.value]                 += ndcg(recommended_items_current_cutoff, relevant_items, relevance=self.get_user_test_ratings(test_user), at=cutoff)
-                results_current_cutoff[EvaluatorMetrics.ARHR.value]                 += arhr_all_hits(is_relevant_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.NOVELTY.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.AVERAGE_POPULARITY.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.DIVERSITY_GINI.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.SHANNON_ENTROPY.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.COVERAGE_ITEM.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.COVERAGE_ITEM_HIT.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff, is_relevant_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.COVERAGE_USER.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff, test_user_batch_array)
+            results_current_cutoff[EvaluatorMetrics.COVERAGE_USER_HIT.value].add_recommendations_batch(is_relevant_current_cutoff, test_user_batch_array)
+            results_current_cutoff[EvaluatorMetrics.DIVERSITY_MEAN_INTER_LIST.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
+            results_current_cutoff[EvaluatorMetrics.DIVERSITY_HERFINDAHL.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
 
-                results_current_cutoff[EvaluatorMetrics.MRR.value].add_recommendations(is_relevant_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.MAP.value].add_recommendations(is_relevant_current_cutoff, relevant_items)
-                results_current_cutoff[EvaluatorMetrics.MAP_MIN_DEN.value].add_recommendations(is_relevant_current_cutoff, relevant_items)
-                results_current_cutoff[EvaluatorMetrics.HIT_RATE.value].add_recommendations(is_relevant_current_cutoff)
+            if EvaluatorMetrics.DIVERSITY_SIMILARITY.value in results_current_cutoff:
+                results_current_cutoff[EvaluatorMetrics.DIVERSITY_SIMILARITY.value].add_recommendations_batch(recommended_items_current_cutoff, n_recommended_current_cutoff)
 
-                results_current_cutoff[EvaluatorMetrics.NOVELTY.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.AVERAGE_POPULARITY.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.DIVERSITY_GINI.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.SHANNON_ENTROPY.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.COVERAGE_ITEM.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.COVERAGE_ITEM_HIT.value].add_recommendations(recommended_items_current_cutoff, is_relevant_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.COVERAGE_USER.value].add_recommendations(recommended_items_current_cutoff, test_user)
-                results_current_cutoff[EvaluatorMetrics.COVERAGE_USER_HIT.value].add_recommendations(is_relevant_current_cutoff, test_user)
-                results_current_cutoff[EvaluatorMetrics.DIVERSITY_MEAN_INTER_LIST.value].add_recommendations(recommended_items_current_cutoff)
-                results_current_cutoff[EvaluatorMetrics.DIVERSITY_HERFINDAHL.value].add_recommendations(recommended_items_current_cutoff)
 
-                if EvaluatorMetrics.DIVERSITY_SIMILARITY.value in results_current_cutoff:
-                    results_current_cutoff[EvaluatorMetrics.DIVERSITY_SIMILARITY.value].add_recommendations(recommended_items_current_cutoff)
+        if time.time() - self._start_time_print > 300 or self._n_users_evaluated==len(self.users_to_evaluate):
+            self._print_evaluation_progress()
 
 
-        if time.time() - self._start_time_print > 300 or self._n_users_evaluated==len(self.users_to_evaluate):
+        return results_dict
+
+
+
+    def _print_evaluation_progress(self):
+
+        elapsed_time = time.time()-self._start_time
+        new_time_value, new_time_unit = seconds_to_biggest_unit(elapsed_time)
+
+        self._print("Processed {} ({:4.1f}%) in {:.2f} {}. Users per second: {:.0f}".format(
+                      self._n_users_evaluated,
+                      100.0* float(self._n_users_evaluated)/len(self.users_to_evaluate),
+                      new_time_value, new_time_unit,
+                      float(self._n_users_evaluated)/elapsed_time))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self._start_time_print = time.time()
+
+
+
+    def _run_evaluation_on_shards(self, recommender_object, n_workers):
+        """
+        Splits the users to evaluate in n_workers shards, each evaluated in a different process,
+        and merges the metrics of all shards
+        :param recommender_object:
+        :param n_workers:
+        :return:
+        """
+
+        global _shard_evaluation_objects
+
+        users_to_evaluate_shards = np.array_split(np.array(self.users_to_evaluate), min(n_workers, len(self.users_to_evaluate)))
+
+        self._print("Evaluating {} users with {} workers".format(len(self.users_to_evaluate), len(users_to_evaluate_shards)))
+
+        if "fork" in multiprocessing.get_all_start_methods():
+            # The forked processes inherit evaluator and recommender, no need to pickle them
+            _shard_evaluation_objects = (self, recommender_object)
+            context = multiprocessing.get_context("fork")
+            evaluate_shard_partial = _evaluate_shard
+        else:
+            context = multiprocessing.get_context()
+            evaluate_shard_partial = partial(_evaluate_shard, evaluator_object = self, recommender_object = recommender_object)
+
+        try:
+            # If an exception is raised the pool is terminated when leaving the block
+            with context.Pool(processes=len(users_to_evaluate_shards)) as pool:
+                shard_result_list = pool.map(evaluate_shard_partial, users_to_evaluate_shards)
 
-            elapsed_time = time.time()-self._start_time
-            new_time_value, new_time_unit = seconds_to_biggest_unit(elapsed_time)
+                pool.close()
+                pool.join()
 
-            self._print("Processed {} ({:4.1f}%) in {:.2f} {}. Users per second: {:.0f}".format(
-                          self._n_users_evaluated,
-                          100.0* float(self._n_users_evaluated)/len(self.users_to_evaluate),
-                          new_time_value, new_time_unit,
-                          float(self._n_users_evaluated)/elapsed_time))
+        finally:
+            _shard_evaluation_objects = None
 
-            sys.stdout.flush()
-            sys.stderr.flush()
+        results_dict, self._n_users_evaluated = shard_result_list[0]
 
-            self._start_time_print = time.time()
+        for shard_results_dict, shard_n_users_evaluated in shard_result_list[1:]:
+            results_dict = _merge_results_dict(results_dict, shard_results_dict)
+            self._n_users_evaluated += shard_n_users_evaluated
 
+        self._print_evaluation_progress()
 
         return results_dict
 
@@ -452,7 +634,8 @@ class EvaluatorHoldout(Evaluator):
                                                                       cutoff = self.max_cutoff,
                                                                       remove_top_pop_flag=False,
                                                                       remove_custom_items_flag=self.ignore_items_flag,
-                                                                      return_scores = True
+                                                                      return_scores = True,
+                                                                      return_array = True
                                                                      )
 
             results_dict = self._compute_metrics_on_recommendation_list(test_user_batch_array = test_user_batch_array,
@@ -512,8 +695,56 @@ class EvaluatorNegativeItemSample(Evaluator):
 
 
 
+    def _get_candidate_scores_batch(self, recommender_object, test_user_batch_array):
+        """
+        Computes the scores of the items to rank of a block of users, the other items are never ranked
+        :param recommender_object:
+        :param test_user_batch_array:
+        :return: CSR matrix (len(test_user_batch_array), n_items) with the scores of the items to rank of each user,
+                 the seen, ignored and -inf score items have no entry
+        """
+
+        URM_items_to_rank_batch = self.URM_items_to_rank[test_user_batch_array]
+
+        candidate_row = np.repeat(np.arange(len(test_user_batch_array)), np.ediff1d(URM_items_to_rank_batch.indptr))
+        candidate_items = URM_items_to_rank_batch.indices
+
+        # Only the scores of the items to rank are computed
+        candidate_scores = recommender_object.compute_candidate_item_score(test_user_batch_array, URM_items_to_rank_batch)
+
+        remove_candidate_mask = np.isinf(candidate_scores)
+
+        if self.exclude_seen:
+            remove_candidate_mask = np.logical_or(remove_candidate_mask,
+                                                  _get_csr_entries_in_other(URM_items_to_rank_batch, recommender_object.URM_train[test_user_batch_array]))
+
+        if self.ignore_items_flag:
+            remove_candidate_mask = np.logical_or(remove_candidate_mask, np.isin(candidate_items, self.ignore_items_ID))
+
+        keep_candidate_mask = np.logical_not(remove_candidate_mask)
+
+        candidate_indptr = np.zeros(len(test_user_batch_array) + 1, dtype=np.int64)
+        candidate_indptr[1:] = np.cumsum(np.bincount(candidate_row[keep_candidate_mask], minlength = len(test_user_batch_array)))
+
+        # Zero scores must be kept, therefore the matrix is built from its components
+        return sps.csr_matrix((candidate_scores[keep_candidate_mask], candidate_items[keep_candidate_mask], candidate_indptr),
+                              shape = (len(test_user_batch_array), self.n_items))
+
+
+
     def _run_evaluation_on_selected_users(self, recommender_object, users_to_evaluate, block_size = None):
+        """
+        The users are evaluated in blocks, for each block only the scores of the items to rank are gathered and
+        each user ranks only its own items to rank, the cost is O(users x items to rank) rather than O(users x items)
+        :param recommender_object:
+        :param users_to_evaluate:
+        :param block_size:
+        :return:
+        """
 
+        if block_size is None:
+            # Reduce block size if estimated memory requirement exceeds 4 GB
+            block_size = min([1000, int(4*1e9*8/64/self.n_items), len(users_to_evaluate)])
 
 
         results_dict = _create_empty_metrics_dict(self.cutoff_list,
@@ -529,26 +760,21 @@ class EvaluatorNegativeItemSample(Evaluator):
             recommender_object.set_items_to_ignore(self.ignore_items_ID)
 
 
+        for user_batch_start in range(0, len(users_to_evaluate), block_size):
 
-        for test_user in users_to_evaluate:
+            test_user_batch_array = np.array(users_to_evaluate[user_batch_start:user_batch_start + block_size])
 
-            items_to_compute = self._get_user_specific_items_to_compute(test_user)
+            candidate_scores_batch = self._get_candidate_scores_batch(recommender_object, test_user_batch_array)
 
-            recommended_items, all_items_predicted_ratings = recommender_object.recommend(np.atleast_1d(test_user),
-                                                              remove_seen_flag=self.exclude_seen,
-                                                              cutoff = self.max_cutoff,
-                                                              remove_top_pop_flag=False,
-                                                              items_to_compute = items_to_compute,
-                                                              remove_custom_items_flag=self.ignore_items_flag,
-                                                              return_scores = True
-                                                             )
+            ranked_items, n_ranked = _get_csr_row_top_k(candidate_scores_batch, self.max_cutoff)
 
+            recommended_items_batch = -np.ones((len(test_user_batch_array), self.max_cutoff), dtype=int)
+            recommended_items_batch[np.arange(self.max_cutoff) < n_ranked[:, None]] = ranked_items
 
-            results_dict = self._compute_metrics_on_recommendation_list(test_user_batch_array = [test_user],
-                                                         recommended_items_batch_list = recommended_items,
-                                                         scores_batch = all_items_predicted_ratings,
+            results_dict = self._compute_metrics_on_recommendation_list(test_user_batch_array = test_user_batch_array,
+                                                         recommended_items_batch_list = recommended_items_batch,
+                                                         scores_batch = candidate_scores_batch,
                                                          results_dict = results_dict)
 
 
         return results_dict
-
@@ -24,6 +24,9 @@ class _Metrics_Object(object):
     def add_recommendations(self, recommended_items_ids):
         raise NotImplementedError()
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+        raise NotImplementedError()
+
     def get_metric_value(self):
         raise NotImplementedError()
 
@@ -31,6 +34,58 @@ class _Metrics_Object(object):
         raise NotImplementedError()
 
 
+
+def _sequential_sum(initial_value, values):
+    """
+    Adds the values to initial_value one at a time, in the same order a loop of += would.
+    np.sum uses pairwise summation and would not give bit-identical results w.r.t. the per-user accumulation
+    :param initial_value:
+    :param values:
+    :return:
+    """
+
+    return np.cumsum(np.concatenate(([initial_value], values)), dtype=np.float64)[-1]
+
+
+def _sum_first_k(values, n_first):
+    """
+    Sums the first n_first[row] elements of each row.
+    Rows with the same length are summed together along the contiguous axis, this ensures the result of each row
+    is identical to the one np.sum would return for the corresponding 1-dimensional array
+    :param values:      array (n_rows, width)
+    :param n_first:     array (n_rows,) with the number of elements to sum for each row
+    :return:
+    """
+
+    row_sum = np.zeros(values.shape[0], dtype=np.float64)
+
+    for row_length in np.unique(n_first):
+        if row_length > 0:
+            row_mask = n_first == row_length
+            row_sum[row_mask] = np.sum(values[row_mask, :row_length], axis=1, dtype=np.float64)
+
+    return row_sum
+
+
+def _sum_masked(values, mask):
+    """
+    Sums, for each row, only the values selected by mask, in the order they appear in the row
+    :param values:
+    :param mask:
+    :return:
+    """
+
+    # Stable sort moves the selected values to the left of each row preserving their order
+    compact_order = np.argsort(np.logical_not(mask), axis=1, kind="stable")
+    values_compact = np.take_along_axis(values, compact_order, axis=1)
+
+    return _sum_first_k(values_compact, mask.sum(axis=1))
+
+
+def _get_valid_mask(n_recommended, width):
+    return np.arange(width) < np.asarray(n_recommended)[:, None]
+
+
 ####################################################################################################################
 ###############                 ACCURACY METRICS
 ####################################################################################################################
@@ -51,11 +106,15 @@ class MAP(_Metrics_Object):
         self.cumulative_AP += average_precision(is_relevant)
         self.n_users += 1
 
+    def add_recommendations_batch(self, is_relevant, n_recommended):
+        self.cumulative_AP = _sequential_sum(self.cumulative_AP, average_precision_batch(is_relevant, n_recommended))
+        self.n_users += is_relevant.shape[0]
+
     def get_metric_value(self):
         return self.cumulative_AP/self.n_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is MAP, "MAP: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, MAP), "MAP: attempting to merge with a metric object of different type"
 
         self.cumulative_AP += other_metric_object.cumulative_AP
         self.n_users += other_metric_object.n_users
@@ -74,6 +133,29 @@ def average_precision(is_relevant):
     return a_p
 
 
+def _precision_at_k_batch(is_relevant):
+    # Element-wise the same operations of average_precision, the cumsum is exact as it only counts hits
+    return is_relevant * np.cumsum(is_relevant, axis=1, dtype=np.float64) / (1 + np.arange(is_relevant.shape[1]))
+
+
+def average_precision_batch(is_relevant, n_recommended):
+    """
+    Vectorized average_precision for a block of users
+    :param is_relevant:     boolean array (n_users, cutoff), positions beyond n_recommended must be False
+    :param n_recommended:   array (n_users,) with the length of each recommendation list
+    :return:
+    """
+
+    p_at_k_sum = _sum_first_k(_precision_at_k_batch(is_relevant), n_recommended)
+
+    a_p = np.zeros(len(n_recommended), dtype=np.float64)
+    non_empty = n_recommended > 0
+    a_p[non_empty] = p_at_k_sum[non_empty] / n_recommended[non_empty]
+
+    assert np.all(np.logical_and(0 <= a_p, a_p <= 1)), a_p
+    return a_p
+
+
 
 
 class MAP_MIN_DEN(_Metrics_Object):
@@ -92,11 +174,15 @@ class MAP_MIN_DEN(_Metrics_Object):
         self.cumulative_AP += average_precision_min_denominator(is_relevant, pos_items)
         self.n_users += 1
 
+    def add_recommendations_batch(self, is_relevant, n_recommended, n_pos_items):
+        self.cumulative_AP = _sequential_sum(self.cumulative_AP, average_precision_min_denominator_batch(is_relevant, n_recommended, n_pos_items))
+        self.n_users += is_relevant.shape[0]
+
     def get_metric_value(self):
         return self.cumulative_AP/self.n_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is MAP_MIN_DEN, "MAP_MIN_DEN: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, MAP_MIN_DEN), "MAP_MIN_DEN: attempting to merge with a metric object of different type"
 
         self.cumulative_AP += other_metric_object.cumulative_AP
         self.n_users += other_metric_object.n_users
@@ -115,6 +201,18 @@ def average_precision_min_denominator(is_relevant, pos_items):
     return a_p
 
 
+def average_precision_min_denominator_batch(is_relevant, n_recommended, n_pos_items):
+
+    p_at_k_sum = _sum_first_k(_precision_at_k_batch(is_relevant), n_recommended)
+
+    a_p = np.zeros(len(n_recommended), dtype=np.float64)
+    non_empty = n_recommended > 0
+    a_p[non_empty] = p_at_k_sum[non_empty] / np.minimum(n_pos_items, n_recommended)[non_empty]
+
+    assert np.all(np.logical_and(0 <= a_p, a_p <= 1)), a_p
+    return a_p
+
+
 
 class MRR(_Metrics_Object):
     """
@@ -132,11 +230,15 @@ class MRR(_Metrics_Object):
         self.cumulative_RR += rr(is_relevant)
         self.n_users += 1
 
+    def add_recommendations_batch(self, is_relevant):
+        self.cumulative_RR = _sequential_sum(self.cumulative_RR, rr_batch(is_relevant))
+        self.n_users += is_relevant.shape[0]
+
     def get_metric_value(self):
         return self.cumulative_RR/self.n_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is MRR, "MRR: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, MRR), "MRR: attempting to merge with a metric object of different type"
 
         self.cumulative_RR += other_metric_object.cumulative_RR
         self.n_users += other_metric_object.n_users
@@ -158,6 +260,22 @@ def rr(is_relevant):
         return 0.0
 
 
+def rr_batch(is_relevant):
+    """
+    Vectorized rr for a block of users
+    :param is_relevant: boolean array (n_users, cutoff)
+    :return:
+    """
+
+    has_hit = np.any(is_relevant, axis=1)
+    first_hit_rank = np.argmax(is_relevant, axis=1) + 1
+
+    rr_score = np.zeros(is_relevant.shape[0], dtype=np.float64)
+    rr_score[has_hit] = 1. / first_hit_rank[has_hit]
+
+    return rr_score
+
+
 
 
 
@@ -182,6 +300,10 @@ class HIT_RATE(_Metrics_Object):
         self.cumulative_HR += np.any(is_relevant)
         self.n_users += 1
 
+    def add_recommendations_batch(self, is_relevant):
+        self.cumulative_HR = _sequential_sum(self.cumulative_HR, np.any(is_relevant, axis=1))
+        self.n_users += is_relevant.shape[0]
+
     def get_metric_value(self):
         if self.n_users == 0:
             return 0.0
@@ -189,7 +311,7 @@ class HIT_RATE(_Metrics_Object):
         return self.cumulative_HR/self.n_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is HIT_RATE, "HR: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, HIT_RATE), "HR: attempting to merge with a metric object of different type"
 
         self.cumulative_HR += other_metric_object.cumulative_HR
         self.n_users += other_metric_object.n_users
@@ -204,13 +326,23 @@ def arhr_all_hits(is_relevant):
     # http://glaros.dtc.umn.edu/gkhome/fetch/papers/itemrsTOIS04.pdf
     # https://emunix.emich.edu/~sverdlik/COSC562/ItemBasedTopTen.pdf
 
+    # np.sum instead of dot, the BLAS summation order would make the result differ from arhr_all_hits_batch
     p_reciprocal = 1/np.arange(1,len(is_relevant)+1, 1.0, dtype=np.float64)
-    arhr_score = is_relevant.dot(p_reciprocal)
+    arhr_score = np.sum(is_relevant * p_reciprocal, dtype=np.float64)
 
     assert not np.isnan(arhr_score), "ARHR_all_hits is NaN"
     return arhr_score
 
 
+def arhr_all_hits_batch(is_relevant, n_recommended):
+
+    p_reciprocal = 1/np.arange(1,is_relevant.shape[1]+1, 1.0, dtype=np.float64)
+    arhr_score = _sum_first_k(is_relevant * p_reciprocal, n_recommended)
+
+    assert not np.any(np.isnan(arhr_score)), "ARHR_all_hits is NaN"
+    return arhr_score
+
+
 def precision(is_relevant):
 
     if len(is_relevant) == 0:
@@ -222,6 +354,16 @@ def precision(is_relevant):
     return precision_score
 
 
+def precision_batch(is_relevant, n_recommended):
+
+    precision_score = np.zeros(len(n_recommended), dtype=np.float64)
+    non_empty = n_recommended > 0
+    precision_score[non_empty] = np.sum(is_relevant, axis=1, dtype=np.float64)[non_empty] / n_recommended[non_empty]
+
+    assert np.all(np.logical_and(0 <= precision_score, precision_score <= 1)), precision_score
+    return precision_score
+
+
 def precision_recall_min_denominator(is_relevant, n_test_items):
 
     if len(is_relevant) == 0:
@@ -233,6 +375,16 @@ def precision_recall_min_denominator(is_relevant, n_test_items):
     return precision_score
 
 
+def precision_recall_min_denominator_batch(is_relevant, n_recommended, n_test_items):
+
+    precision_score = np.zeros(len(n_recommended), dtype=np.float64)
+    non_empty = n_recommended > 0
+    precision_score[non_empty] = np.sum(is_relevant, axis=1, dtype=np.float64)[non_empty] / np.minimum(n_test_items, n_recommended)[non_empty]
+
+    assert np.all(np.logical_and(0 <= precision_score, precision_score <= 1)), precision_score
+    return precision_score
+
+
 
 def recall(is_relevant, pos_items):
 
@@ -242,6 +394,14 @@ def recall(is_relevant, pos_items):
     return recall_score
 
 
+def recall_batch(is_relevant, n_pos_items):
+
+    recall_score = np.sum(is_relevant, axis=1, dtype=np.float64) / n_pos_items
+
+    assert np.all(np.logical_and(0 <= recall_score, recall_score <= 1)), recall_score
+    return recall_score
+
+
 
 
 def ndcg(ranked_list, pos_items, relevance=None, at=None):
@@ -279,6 +439,32 @@ def dcg(scores):
                   dtype=np.float64)
 
 
+def ndcg_batch(rank_scores, n_recommended, ideal_scores, n_ideal):
+    """
+    Vectorized ndcg for a block of users
+    :param rank_scores:     array (n_users, cutoff) with the relevance of each recommended item, 0.0 if not relevant
+    :param n_recommended:   array (n_users,) with the length of each recommendation list
+    :param ideal_scores:    array (n_users, >= cutoff) with the relevance of each user's test items sorted in descending order.
+                            It must have the dtype of the test data, as ndcg computes the ideal dcg on the original relevance values
+    :param n_ideal:         array (n_users,) with the number of test items that fit in the recommendation list
+    :return:
+    """
+
+    rank_dcg = dcg_batch(rank_scores, n_recommended)
+    ideal_dcg = dcg_batch(ideal_scores[:, :rank_scores.shape[1]], n_ideal)
+
+    ndcg_ = np.zeros(rank_scores.shape[0], dtype=np.float64)
+    non_zero = np.logical_and(rank_dcg != 0.0, ideal_dcg != 0.0)
+    ndcg_[non_zero] = rank_dcg[non_zero] / ideal_dcg[non_zero]
+
+    return ndcg_
+
+
+def dcg_batch(scores, n_scores):
+    gain = np.divide(np.power(2, scores) - 1, np.log2(np.arange(scores.shape[1], dtype=np.float64) + 2))
+    return _sum_first_k(gain, n_scores)
+
+
 
 
 ####################################################################################################################
@@ -302,6 +488,10 @@ class _Global_Item_Distribution_Counter(_Metrics_Object):
         if len(recommended_items_ids) > 0:
             self.recommended_counter[recommended_items_ids] += 1
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+        recommended_items_ids = recommended_items_batch[_get_valid_mask(n_recommended, recommended_items_batch.shape[1])]
+        self.recommended_counter += np.bincount(recommended_items_ids, minlength=len(self.recommended_counter))
+
     def _get_recommended_items_counter(self):
 
         recommended_counter = self.recommended_counter.copy()
@@ -355,6 +545,10 @@ class Coverage_Item_HIT(_Global_Item_Distribution_Counter):
     def add_recommendations(self, recommended_items_ids, is_relevant):
         super(Coverage_Item_HIT, self).add_recommendations(np.array(recommended_items_ids)[is_relevant])
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended, is_relevant):
+        recommended_items_ids = recommended_items_batch[:, :is_relevant.shape[1]][is_relevant]
+        self.recommended_counter += np.bincount(recommended_items_ids, minlength=len(self.recommended_counter))
+
     def get_metric_value(self):
 
         recommended_mask = self._get_recommended_items_counter() > 0
@@ -387,6 +581,12 @@ class Items_In_GT(_Metrics_Object):
 
         return in_GT_mask.sum()/(len(in_GT_mask) - len(self.ignore_items))
 
+    def merge_with_other(self, other_metric_object):
+        assert isinstance(other_metric_object, Items_In_GT), "Items_In_GT: attempting to merge with a metric object of different type"
+
+        # The value only depends on URM_test, which is the same for both objects
+        assert np.array_equal(self.interaction_in_GT_counter, other_metric_object.interaction_in_GT_counter), "Items_In_GT: attempting to merge with a metric object built on different data"
+
 
 
 class Users_In_GT(_Metrics_Object):
@@ -412,6 +612,12 @@ class Users_In_GT(_Metrics_Object):
 
         return in_GT_mask.sum()/(len(in_GT_mask) - len(self.ignore_users))
 
+    def merge_with_other(self, other_metric_object):
+        assert isinstance(other_metric_object, Users_In_GT), "Users_In_GT: attempting to merge with a metric object of different type"
+
+        # The value only depends on URM_test, which is the same for both objects
+        assert np.array_equal(self.interaction_in_GT_counter, other_metric_object.interaction_in_GT_counter), "Users_In_GT: attempting to merge with a metric object built on different data"
+
 
 
 
@@ -435,11 +641,14 @@ class Coverage_User(_Metrics_Object):
     def add_recommendations(self, recommended_items_ids, user_id):
         self.users_mask[user_id] = len(recommended_items_ids)>0
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended, user_id_array):
+        self.users_mask[user_id_array] = n_recommended>0
+
     def get_metric_value(self):
         return self.users_mask.sum()/(len(self.users_mask)-self.n_ignore_users)
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is Coverage_User, "Coverage_User: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, Coverage_User), "Coverage_User: attempting to merge with a metric object of different type"
 
         self.users_mask = np.logical_or(self.users_mask, other_metric_object.users_mask)
 
@@ -464,11 +673,14 @@ class Coverage_User_HIT(_Metrics_Object):
     def add_recommendations(self, is_relevant, user_id):
         self.users_mask[user_id] = np.any(is_relevant)
 
+    def add_recommendations_batch(self, is_relevant, user_id_array):
+        self.users_mask[user_id_array] = np.any(is_relevant, axis=1)
+
     def get_metric_value(self):
         return self.users_mask.sum()/(len(self.users_mask)-self.n_ignore_users)
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is Coverage_User, "Coverage_User_HIT: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, Coverage_User_HIT), "Coverage_User_HIT: attempting to merge with a metric object of different type"
 
         self.users_mask = np.logical_or(self.users_mask, other_metric_object.users_mask)
 
@@ -650,6 +862,22 @@ class Novelty(_Metrics_Object):
             self.novelty += np.sum(-np.log2(probability)/self.n_items)
 
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+
+        self.n_evaluated_users += recommended_items_batch.shape[0]
+
+        valid_mask = _get_valid_mask(n_recommended, recommended_items_batch.shape[1])
+
+        probability = np.zeros(recommended_items_batch.shape, dtype=np.float64)
+        probability[valid_mask] = self.item_popularity[recommended_items_batch[valid_mask]]/self.n_interactions
+        valid_mask = np.logical_and(valid_mask, probability!=0)
+
+        self_information = np.zeros(recommended_items_batch.shape, dtype=np.float64)
+        self_information[valid_mask] = -np.log2(probability[valid_mask])/self.n_items
+
+        self.novelty = _sequential_sum(self.novelty, _sum_masked(self_information, valid_mask))
+
+
     def get_metric_value(self):
 
         if self.n_evaluated_users == 0:
@@ -658,7 +886,7 @@ class Novelty(_Metrics_Object):
         return self.novelty/self.n_evaluated_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is Novelty, "Novelty: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, Novelty), "Novelty: attempting to merge with a metric object of different type"
 
         self.novelty = self.novelty + other_metric_object.novelty
         self.n_evaluated_users = self.n_evaluated_users + other_metric_object.n_evaluated_users
@@ -699,6 +927,22 @@ class AveragePopularity(_Metrics_Object):
             self.cumulative_popularity += np.sum(recommended_items_popularity)/len(recommended_items_ids)
 
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+
+        self.n_evaluated_users += recommended_items_batch.shape[0]
+
+        valid_mask = _get_valid_mask(n_recommended, recommended_items_batch.shape[1])
+
+        recommended_items_popularity = np.zeros(recommended_items_batch.shape, dtype=np.float64)
+        recommended_items_popularity[valid_mask] = self.item_popularity_normalized[recommended_items_batch[valid_mask]]
+
+        average_popularity = np.zeros(recommended_items_batch.shape[0], dtype=np.float64)
+        non_empty = n_recommended > 0
+        average_popularity[non_empty] = _sum_first_k(recommended_items_popularity, n_recommended)[non_empty]/n_recommended[non_empty]
+
+        self.cumulative_popularity = _sequential_sum(self.cumulative_popularity, average_popularity)
+
+
     def get_metric_value(self):
 
         if self.n_evaluated_users == 0:
@@ -707,7 +951,7 @@ class AveragePopularity(_Metrics_Object):
         return self.cumulative_popularity/self.n_evaluated_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is Novelty, "AveragePopularity: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, AveragePopularity), "AveragePopularity: attempting to merge with a metric object of different type"
 
         self.cumulative_popularity = self.cumulative_popularity + other_metric_object.cumulative_popularity
         self.n_evaluated_users = self.n_evaluated_users + other_metric_object.n_evaluated_users
@@ -758,6 +1002,13 @@ class Diversity_similarity(_Metrics_Object):
         self.n_evaluated_users += 1
 
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+
+        # The pairwise lookup in item_diversity_matrix is done one list at a time
+        for user_index in range(recommended_items_batch.shape[0]):
+            self.add_recommendations(recommended_items_batch[user_index, :n_recommended[user_index]])
+
+
     def get_metric_value(self):
 
         if self.n_evaluated_users == 0:
@@ -766,7 +1017,7 @@ class Diversity_similarity(_Metrics_Object):
         return self.diversity/self.n_evaluated_users
 
     def merge_with_other(self, other_metric_object):
-        assert other_metric_object is Diversity_similarity, "Diversity: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, Diversity_similarity), "Diversity: attempting to merge with a metric object of different type"
 
         self.diversity = self.diversity + other_metric_object.diversity
         self.n_evaluated_users = self.n_evaluated_users + other_metric_object.n_evaluated_users
@@ -859,6 +1110,15 @@ class Diversity_MeanInterList(_Metrics_Object):
             self.recommended_counter[recommended_items_ids] += 1
 
 
+    def add_recommendations_batch(self, recommended_items_batch, n_recommended):
+
+        assert np.all(n_recommended <= self.cutoff), "Diversity_MeanInterList: recommended list is contains more elements than cutoff"
+
+        self.n_evaluated_users += recommended_items_batch.shape[0]
+
+        recommended_items_ids = recommended_items_batch[_get_valid_mask(n_recommended, recommended_items_batch.shape[1])]
+        self.recommended_counter += np.bincount(recommended_items_ids, minlength=len(self.recommended_counter))
+
 
 
     def get_metric_value(self):
@@ -889,7 +1149,8 @@ class Diversity_MeanInterList(_Metrics_Object):
 
     def merge_with_other(self, other_metric_object):
 
-        assert other_metric_object is Diversity_MeanInterList, "Diversity_MeanInterList: attempting to merge with a metric object of different type"
+        assert isinstance(other_metric_object, Diversity_MeanInterList), "Diversity_MeanInterList: attempting to merge with a metric object of different type"
+        assert self.cutoff == other_metric_object.cutoff, "Diversity_MeanInterList: attempting to merge with a metric object with a different cutoff"
 
         assert np.all(self.recommended_counter >= 0.0), "Diversity_MeanInterList: self.recommended_counter contains negative counts"
         assert np.all(other_metric_object.recommended_counter >= 0.0), "Diversity_MeanInterList: other.recommended_counter contains negative counts"
@@ -308,6 +308,171 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(ndcg(ranked_list_3, pos_items, pos_relevances), 0.0))
 
 
+
+    def test_batch_metrics_equal_per_user(self):
+
+        from Base.Evaluation.metrics import precision, precision_batch, recall, recall_batch, rr, rr_batch, \
+            average_precision, average_precision_batch, average_precision_min_denominator, average_precision_min_denominator_batch, \
+            arhr_all_hits, arhr_all_hits_batch, ndcg, ndcg_batch, _sequential_sum
+
+        n_users = 300
+        n_items = 500
+        cutoff = 20
+
+        pos_items_list = [np.random.choice(n_items, size=np.random.randint(1, 40), replace=False) for _ in range(n_users)]
+        relevance_list = [np.random.randint(1, 6, size=len(pos_items)).astype(np.float32) for pos_items in pos_items_list]
+
+        # Some recommendation lists are shorter than the cutoff
+        n_recommended = np.random.randint(0, cutoff+1, size=n_users)
+        n_recommended[n_recommended < 10] = cutoff
+
+        recommended_items = -np.ones((n_users, cutoff), dtype=int)
+        is_relevant = np.zeros((n_users, cutoff), dtype=bool)
+        rank_scores = np.zeros((n_users, cutoff), dtype=np.float64)
+        ideal_scores = np.zeros((n_users, cutoff), dtype=np.float32)
+
+        per_user = {"precision": [], "recall": [], "rr": [], "map": [], "map_min_den": [], "arhr": [], "ndcg": []}
+
+        for user_index in range(n_users):
+
+            pos_items = pos_items_list[user_index]
+            relevance = relevance_list[user_index]
+
+            # Mix relevant and random items
+            candidates = np.unique(np.concatenate((pos_items[:5], np.random.choice(n_items, size=cutoff*2))))
+            ranked_list = np.random.permutation(candidates)[:n_recommended[user_index]]
+            n_recommended[user_index] = len(ranked_list)
+
+            user_is_relevant = np.in1d(ranked_list, pos_items, assume_unique=True)
+            it2rel = {it: r for it, r in zip(pos_items, relevance)}
+
+            recommended_items[user_index, :len(ranked_list)] = ranked_list
+            is_relevant[user_index, :len(ranked_list)] = user_is_relevant
+            rank_scores[user_index, :len(ranked_list)] = [it2rel.get(it, 0.0) for it in ranked_list]
+            ideal_relevance = np.sort(relevance)[::-1][:cutoff]
+            ideal_scores[user_index, :len(ideal_relevance)] = ideal_relevance
+
+            per_user["precision"].append(precision(user_is_relevant))
+            per_user["recall"].append(recall(user_is_relevant, pos_items))
+            per_user["rr"].append(rr(user_is_relevant))
+            per_user["map"].append(average_precision(user_is_relevant))
+            per_user["map_min_den"].append(average_precision_min_denominator(user_is_relevant, pos_items))
+            per_user["arhr"].append(arhr_all_hits(user_is_relevant))
+            per_user["ndcg"].append(ndcg(ranked_list, pos_items, relevance=relevance, at=cutoff))
+
+        n_pos_items = np.array([len(pos_items) for pos_items in pos_items_list])
+
+        batch = {"precision": precision_batch(is_relevant, n_recommended),
+                 "recall": recall_batch(is_relevant, n_pos_items),
+                 "rr": rr_batch(is_relevant),
+                 "map": average_precision_batch(is_relevant, n_recommended),
+                 "map_min_den": average_precision_min_denominator_batch(is_relevant, n_recommended, n_pos_items),
+                 "arhr": arhr_all_hits_batch(is_relevant, n_recommended),
+                 "ndcg": ndcg_batch(rank_scores, n_recommended, ideal_scores, np.minimum(n_pos_items, cutoff)),
+                 }
+
+        for metric_name in per_user.keys():
+            self.assertTrue(np.array_equal(np.array(per_user[metric_name]), batch[metric_name]), "{} batch differs from per-user value".format(metric_name))
+
+            cumulative_per_user = 0.0
+            for value in per_user[metric_name]:
+                cumulative_per_user += value
+
+            self.assertEqual(cumulative_per_user, _sequential_sum(0.0, batch[metric_name]), "{} batch cumulative value differs".format(metric_name))
+
+
+
+    def test_batch_metric_objects_equal_per_user(self):
+
+        from Base.Evaluation.metrics import Novelty, AveragePopularity, Coverage_Item, Diversity_MeanInterList
+        import scipy.sparse as sps
+
+        n_users = 200
+        n_items = 300
+        cutoff = 10
+
+        URM_train = sps.random(n_users, n_items, density=0.05, format="csr")
+
+        recommended_items = np.array([np.random.choice(n_items, size=cutoff, replace=False) for _ in range(n_users)])
+        n_recommended = np.random.randint(0, cutoff+1, size=n_users)
+
+        for metric_class in [Novelty, AveragePopularity, Coverage_Item, Diversity_MeanInterList]:
+
+            if metric_class is Coverage_Item:
+                per_user_object, batch_object = metric_class(n_items, np.array([])), metric_class(n_items, np.array([]))
+            elif metric_class is Diversity_MeanInterList:
+                per_user_object, batch_object = metric_class(n_items, cutoff), metric_class(n_items, cutoff)
+            else:
+                per_user_object, batch_object = metric_class(URM_train), metric_class(URM_train)
+
+            for user_index in range(n_users):
+                per_user_object.add_recommendations(recommended_items[user_index, :n_recommended[user_index]])
+
+            batch_object.add_recommendations_batch(recommended_items, n_recommended)
+
+            self.assertEqual(per_user_object.get_metric_value(), batch_object.get_metric_value(), "{} batch differs from per-user value".format(metric_class))
+
+
+
+
+    def test_merge_with_other(self):
+
+        from Base.Evaluation.metrics import MAP, MAP_MIN_DEN, MRR, HIT_RATE, Novelty, AveragePopularity, Coverage_Item, Coverage_Item_HIT, \
+            Coverage_User, Coverage_User_HIT, Gini_Diversity, Shannon_Entropy, Diversity_Herfindahl, Diversity_MeanInterList, Items_In_GT, Users_In_GT
+        import scipy.sparse as sps
+
+        n_users = 100
+        n_items = 200
+        cutoff = 10
+
+        URM_train = sps.random(n_users, n_items, density=0.05, format="csr")
+        URM_test = sps.random(n_users, n_items, density=0.05, format="csr")
+        ignore = np.array([])
+
+        constructor_list = [lambda: MAP(), lambda: MAP_MIN_DEN(), lambda: MRR(), lambda: HIT_RATE(),
+                            lambda: Novelty(URM_train), lambda: AveragePopularity(URM_train),
+                            lambda: Coverage_Item(n_items, ignore), lambda: Coverage_Item_HIT(n_items, ignore),
+                            lambda: Coverage_User(n_users, ignore), lambda: Coverage_User_HIT(n_users, ignore),
+                            lambda: Gini_Diversity(n_items, ignore), lambda: Shannon_Entropy(n_items, ignore),
+                            lambda: Diversity_Herfindahl(n_items, ignore), lambda: Diversity_MeanInterList(n_items, cutoff),
+                            lambda: Items_In_GT(URM_test, ignore), lambda: Users_In_GT(URM_test, ignore)]
+
+        recommended_items = np.array([np.random.choice(n_items, size=cutoff, replace=False) for _ in range(n_users)])
+        pos_items = np.random.choice(n_items, size=20, replace=False)
+        is_relevant = np.isin(recommended_items, pos_items)
+
+        def add_recommendations(metric_object, user_id):
+
+            if isinstance(metric_object, (MAP, MAP_MIN_DEN)):
+                metric_object.add_recommendations(is_relevant[user_id], pos_items)
+            elif isinstance(metric_object, (MRR, HIT_RATE)):
+                metric_object.add_recommendations(is_relevant[user_id])
+            elif isinstance(metric_object, Coverage_Item_HIT):
+                metric_object.add_recommendations(recommended_items[user_id], is_relevant[user_id])
+            elif isinstance(metric_object, Coverage_User):
+                metric_object.add_recommendations(recommended_items[user_id], user_id)
+            elif isinstance(metric_object, Coverage_User_HIT):
+                metric_object.add_recommendations(is_relevant[user_id], user_id)
+            else:
+                metric_object.add_recommendations(recommended_items[user_id])
+
+        for constructor in constructor_list:
+
+            metric_all, metric_first, metric_second = constructor(), constructor(), constructor()
+
+            for user_id in range(n_users):
+                add_recommendations(metric_all, user_id)
+                add_recommendations(metric_first if user_id < n_users//3 else metric_second, user_id)
+
+            metric_first.merge_with_other(metric_second)
+
+            self.assertTrue(np.isclose(metric_all.get_metric_value(), metric_first.get_metric_value()), "{} merged value differs".format(metric_all.__class__))
+
+            with self.assertRaises(AssertionError):
+                metric_first.merge_with_other(object())
+
+
+
 if __name__ == '__main__':
 
     unittest.main()
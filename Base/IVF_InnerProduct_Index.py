@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse as sps
+import time
+from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
+
+
+
+def _get_nearest_centroid(data_matrix, centroids, block_size = 10000):
+    """
+    Returns the index of the nearest centroid of each row, in euclidean distance.
+    ||x - c||^2 = ||x||^2 - 2 x*c + ||c||^2 and ||x||^2 does not change the nearest centroid
+    :param data_matrix:
+    :param centroids:
+    :param block_size:      number of rows processed at once, each block requires a dense |block_size|x|n_centroids| matrix
+    :return:
+    """
+
+    centroids_norm = np.einsum("ij,ij->i", centroids, centroids)
+    nearest_centroid = np.empty(data_matrix.shape[0], dtype=np.int64)
+
+    for block_start in range(0, data_matrix.shape[0], block_size):
+        block_distance = centroids_norm - 2 * data_matrix[block_start:block_start + block_size].dot(centroids.T)
+        nearest_centroid[block_start:block_start + block_size] = np.argmin(block_distance, axis=1)
+
+    return nearest_centroid
+
+
+
+class IVF_InnerProduct_Index(object):
+    """
+    Inverted file index for approximate maximum inner product search (MIPS).
+
+    The item vectors are transformed so that the maximum inner product becomes the nearest neighbour in euclidean distance,
+    appending to each vector the component sqrt(max_norm^2 - ||v||^2), all transformed vectors have norm max_norm
+    and a query with a zero in the new component has inner product unchanged.
+    The transformed vectors are partitioned with k-means in n_lists inverted lists, a query only scans the items
+    of the n_probe lists with the nearest centroids.
+
+    See:
+    Y. Bachrach et al., Speeding up the Xbox recommender system using a euclidean transformation for inner-product spaces,
+    RecSys 2014.
+    """
+
+    def __init__(self, n_lists = None, n_probe = None, n_iterations = 10, random_seed = None, verbose = True):
+        """
+        :param n_lists:         number of k-means partitions, if None 4*sqrt(n_items)
+        :param n_probe:         number of lists scanned by each query, if None n_lists/8
+        :param n_iterations:    number of k-means iterations
+        :param random_seed:
+        :param verbose:
+        """
+        super(IVF_InnerProduct_Index, self).__init__()
+
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iterations = n_iterations
+        self.random_seed = random_seed
+        self.verbose = verbose
+
+        self.centroids = None
+        self.list_indptr = None
+        self.list_items = None
+
+
+    def _print(self, string):
+        if self.verbose:
+            print("IVF_InnerProduct_Index: {}".format(string))
+
+
+
+    def fit(self, ITEM_vectors, max_k_means_items = 256):
+        """
+        :param ITEM_vectors:        array (n_items, n_factors)
+        :param max_k_means_items:   k-means is trained on a sample of at most max_k_means_items*n_lists items,
+                                    then all items are assigned to the nearest centroid
+        :return:
+        """
+
+        start_time = time.time()
+
+        n_items = ITEM_vectors.shape[0]
+
+        if self.n_lists is None:
+            self.n_lists = int(4*np.sqrt(n_items))
+
+        self.n_lists = int(max(1, min(self.n_lists, n_items)))
+
+        if self.n_probe is None:
+            self.n_probe = int(np.ceil(self.n_lists/8))
+
+        self.n_probe = int(max(1, min(self.n_probe, self.n_lists)))
+
+        self._print("Building index of {} items in {} lists...".format(n_items, self.n_lists))
+
+        ITEM_vectors = np.asarray(ITEM_vectors, dtype=np.float64)
+        item_norm = np.einsum("ij,ij->i", ITEM_vectors, ITEM_vectors)
+        ITEM_vectors = np.hstack([ITEM_vectors, np.sqrt(item_norm.max(initial=0.0) - item_norm)[:, None]])
+
+        random_state = np.random.RandomState(self.random_seed)
+
+        k_means_items = np.arange(n_items)
+        if n_items > max_k_means_items*self.n_lists:
+            k_means_items = random_state.choice(n_items, max_k_means_items*self.n_lists, replace=False)
+
+        k_means_vectors = ITEM_vectors[k_means_items]
+
+        centroids = k_means_vectors[random_state.choice(len(k_means_vectors), self.n_lists, replace=False)]
+
+        for n_iteration in range(self.n_iterations):
+
+            nearest_centroid = _get_nearest_centroid(k_means_vectors, centroids)
+
+            # The sum of the vectors in each list is the product of the |n_lists|x|n_items| assignment matrix and the vectors
+            assignment = sps.csr_matrix((np.ones(len(nearest_centroid)), (nearest_centroid, np.arange(len(nearest_centroid)))),
+                                        shape=(self.n_lists, len(nearest_centroid)))
+
+            list_size = np.bincount(nearest_centroid, minlength=self.n_lists)
+            non_empty = list_size > 0
+
+            centroids[non_empty] = assignment.dot(k_means_vectors)[non_empty] / list_size[non_empty, None]
+
+            # Empty lists are moved to random items, to be split from the lists they are in
+            if not non_empty.all():
+                centroids[~non_empty] = k_means_vectors[random_state.choice(len(k_means_vectors), (~non_empty).sum(), replace=False)]
+
+        nearest_centroid = _get_nearest_centroid(ITEM_vectors, centroids)
+
+        self.centroids = centroids
+        self.list_items = np.argsort(nearest_centroid, kind="stable")
+        self.list_indptr = np.concatenate([[0], np.cumsum(np.bincount(nearest_centroid, minlength=self.n_lists))])
+
+        new_time_value, new_time_unit = seconds_to_biggest_unit(time.time()-start_time)
+        self._print("Building index of {} items in {} lists... done in {:.2f} {}".format(n_items, self.n_lists, new_time_value, new_time_unit))
+
+
+
+    def get_candidate_items(self, query_vectors, n_probe = None):
+        """
+        Selects for each query the items in the n_probe lists with the nearest centroids.
+        For a query q with a zero in the added component ||q - c||^2 = ||q||^2 - 2 q*c + ||c||^2,
+        the lists are ranked by 2 q*c - ||c||^2
+        :param query_vectors:   array (n_queries, n_factors)
+        :param n_probe:         if None the value of the index is used
+        :return:                CSR matrix (n_queries, n_items) whose non-zero entries are the candidate items of each query
+        """
+
+        if n_probe is None:
+            n_probe = self.n_probe
+
+        n_probe = int(max(1, min(n_probe, len(self.centroids))))
+
+        n_queries = query_vectors.shape[0]
+        n_items = len(self.list_items)
+
+        centroids_norm = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        list_scores = 2 * np.dot(query_vectors, self.centroids[:, :-1].T) - centroids_norm
+
+        if n_probe < len(self.centroids):
+            probed_lists = np.argpartition(-list_scores, n_probe-1, axis=1)[:, :n_probe]
+        else:
+            probed_lists = np.broadcast_to(np.arange(len(self.centroids)), list_scores.shape)
+
+        probed_lists = probed_lists.ravel()
+
+        list_start = self.list_indptr[probed_lists]
+        list_size = self.list_indptr[probed_lists + 1] - list_start
+
+        # Position in list_items of the items of all the probed lists, concatenated
+        item_position = np.arange(list_size.sum()) + np.repeat(list_start - np.cumsum(list_size) + list_size, list_size)
+
+        query_indptr = np.concatenate([[0], np.cumsum(list_size.reshape(n_queries, n_probe).sum(axis=1))])
+
+        return sps.csr_matrix((np.ones(len(item_position), dtype=np.float32), self.list_items[item_position], query_indptr),
+                              shape=(n_queries, n_items))
+
+
+
+    def get_data_dict(self):
+        return {"centroids": self.centroids,
+                "list_indptr": self.list_indptr,
+                "list_items": self.list_items,
+                "n_probe": self.n_probe,
+                }
+
+
+    def set_data_dict(self, data_dict):
+
+        self.centroids = data_dict["centroids"]
+        self.list_indptr = data_dict["list_indptr"]
+        self.list_items = data_dict["list_items"]
+        self.n_probe = int(data_dict["n_probe"])
+        self.n_lists = len(self.centroids)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse as sps
+import threading
+
+
+
+class Negative_Sampler(object):
+    """
+    Generates the training instances of an epoch, all the positive interactions of the URM with num_negatives
+    uniformly sampled items the user did not interact with.
+
+    All the negative items of an epoch are sampled at once. The interactions of the URM are encoded as the sorted
+    keys user*n_items + item, so the sampled items that collide with an interaction are found with a single searchsorted
+    and only those are sampled again.
+    If prefetch is True, as soon as an epoch is returned the samples of the next one are generated in a background thread,
+    numpy releases the GIL for most of the work so this overlaps with the training of the current epoch.
+    Use prefetch_next=False for the last epoch, if it is known, and call close() when the training ends.
+    """
+
+    def __init__(self, URM_train, prefetch = True, random_seed = None):
+        """
+        :param URM_train:
+        :param prefetch:        if True the samples of the next epoch are generated in a background thread
+        :param random_seed:
+        """
+        super(Negative_Sampler, self).__init__()
+
+        URM_train = sps.csr_matrix(URM_train, dtype=np.float32, copy=True)
+        URM_train.eliminate_zeros()
+        URM_train.sort_indices()
+
+        self.n_users, self.n_items = URM_train.shape
+        self.n_interactions = URM_train.nnz
+
+        self.user_input = np.repeat(np.arange(self.n_users, dtype=np.int32), np.ediff1d(URM_train.indptr))
+        self.item_input = URM_train.indices.astype(np.int32)
+
+        # Sorted because the CSR rows are in order and the indices within each row are sorted
+        self._interaction_keys = self.user_input.astype(np.int64) * self.n_items + self.item_input
+
+        # Users who interacted with all items have no negative, sampling them again would never end
+        self._no_negative_users = np.ediff1d(URM_train.indptr) >= self.n_items
+
+        self.prefetch = prefetch
+        self._random_state = np.random.RandomState(random_seed)
+
+        self._prefetch_thread = None
+        self._prefetch_args = None
+        self._prefetch_result = None
+
+
+    def _sample_negative_items(self, user_array):
+        """
+        Samples for each user one item the user did not interact with
+        :param user_array:
+        :return: int32 array with the same shape of user_array
+        """
+
+        user_array = user_array.astype(np.int64)
+        negative_items = self._random_state.randint(self.n_items, size=user_array.shape).astype(np.int32)
+
+        colliding = np.flatnonzero(self._is_interaction(user_array.ravel(), negative_items.ravel()))
+
+        while len(colliding) > 0:
+            colliding_users = user_array.ravel()[colliding]
+            resampled_items = self._random_state.randint(self.n_items, size=len(colliding)).astype(np.int32)
+
+            negative_items.ravel()[colliding] = resampled_items
+            colliding = colliding[self._is_interaction(colliding_users, resampled_items)]
+
+        return negative_items
+
+
+    def _is_interaction(self, user_array, item_array):
+
+        keys = user_array * self.n_items + item_array
+
+        if len(self._interaction_keys) == 0:
+            return np.zeros(len(keys), dtype=np.bool_)
+
+        position = np.searchsorted(self._interaction_keys, keys)
+        position[position == len(self._interaction_keys)] = 0
+
+        return self._interaction_keys[position] == keys
+
+
+    def _sample_pointwise(self, num_negatives):
+
+        user_input = np.repeat(self.user_input[:,None], 1 + num_negatives, axis=1)
+        item_input = np.empty_like(user_input)
+        labels = np.zeros_like(user_input)
+
+        # Each positive instance is followed by its negatives
+        item_input[:,0] = self.item_input
+        labels[:,0] = 1
+
+        sampled_users = ~self._no_negative_users[self.user_input]
+        item_input[sampled_users, 1:] = self._sample_negative_items(user_input[sampled_users, 1:])
+
+        # Users who interacted with all items only have positive instances
+        keep_mask = np.ones_like(user_input, dtype=np.bool_)
+        keep_mask[~sampled_users, 1:] = False
+
+        return user_input[keep_mask], item_input[keep_mask], labels[keep_mask]
+
+
+    def _sample_pairwise(self, num_negatives):
+
+        sampled_users = ~self._no_negative_users[self.user_input]
+
+        user_input = self.user_input[sampled_users]
+        item_input_pos = self.item_input[sampled_users]
+        item_input_neg = self._sample_negative_items(np.repeat(user_input[:,None], num_negatives, axis=1))
+
+        return user_input, item_input_pos, item_input_neg
+
+
+    def _join_prefetch(self):
+
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+
+    def _get_epoch(self, sample_function, num_negatives, prefetch_next):
+
+        args = (sample_function, num_negatives)
+
+        self._join_prefetch()
+
+        if self._prefetch_args == args:
+            result = self._prefetch_result
+        else:
+            result = sample_function(num_negatives)
+
+        self._prefetch_args = None
+        self._prefetch_result = None
+
+        if self.prefetch and prefetch_next:
+            self._prefetch_args = args
+            self._prefetch_thread = threading.Thread(target=self._prefetch, args=args, daemon=True)
+            self._prefetch_thread.start()
+
+        return result
+
+
+    def _prefetch(self, sample_function, num_negatives):
+        self._prefetch_result = sample_function(num_negatives)
+
+
+    def close(self):
+        """
+        Waits for the samples being prefetched, if any, and discards them. Call it when the training ends
+        """
+
+        self._join_prefetch()
+
+        self._prefetch_args = None
+        self._prefetch_result = None
+
+
+    def get_pointwise_epoch(self, num_negatives, prefetch_next = True):
+        """
+        Training instances for a pointwise loss, each interaction is followed by num_negatives negative instances
+        :param num_negatives:
+        :param prefetch_next:   if False the next epoch is not prefetched, e.g., because this is the last one
+        :return: user_input, item_input, labels    contiguous int32 arrays
+        """
+        return self._get_epoch(self._sample_pointwise, num_negatives, prefetch_next)
+
+
+    def get_pairwise_epoch(self, num_negatives, prefetch_next = True):
+        """
+        Training instances for a pairwise loss, each interaction is paired with num_negatives negative items
+        :param num_negatives:
+        :param prefetch_next:   if False the next epoch is not prefetched, e.g., because this is the last one
+        :return: user_input, item_input_pos        contiguous int32 arrays with one entry per interaction
+                 item_input_neg                    int32 array |n_interactions|x|num_negatives|
+        """
+        return self._get_epoch(self._sample_pairwise, num_negatives, prefetch_next)
+
+
+    def get_n_pointwise_instances(self, num_negatives):
+        """
+        :param num_negatives:
+        :return: the number of training instances returned by get_pointwise_epoch
+        """
+        return self.n_interactions + num_negatives * int(np.sum(~self._no_negative_users[self.user_input]))
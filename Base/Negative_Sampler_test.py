@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from Base.Negative_Sampler import Negative_Sampler
+
+
+
+def random_URM(n_users, n_items, random_seed):
+
+    URM_train = sps.random(n_users, n_items, density=0.3, format='lil', random_state=np.random.RandomState(random_seed))
+
+    # A user who interacted with all items and one with no interactions
+    URM_train[0, :] = 1.0
+    URM_train[1, :] = 0.0
+
+    URM_train = sps.csr_matrix(URM_train)
+    URM_train.data = np.ones_like(URM_train.data)
+
+    return URM_train
+
+
+
+class MyTestCase(unittest.TestCase):
+
+
+    def test_negatives_not_in_profile(self):
+
+        URM_train = random_URM(50, 20, 0)
+        negative_sampler = Negative_Sampler(URM_train, prefetch = False, random_seed = 0)
+
+        num_negatives = 4
+
+        user_input, item_input, labels = negative_sampler.get_pointwise_epoch(num_negatives)
+
+        assert np.all(np.asarray(URM_train[user_input[labels == 1], item_input[labels == 1]]).ravel() == 1)
+        assert np.all(np.asarray(URM_train[user_input[labels == 0], item_input[labels == 0]]).ravel() == 0)
+
+        # The user who interacted with all items only has positive instances
+        assert np.all(labels[user_input == 0] == 1)
+
+        user_input, item_input_pos, item_input_neg = negative_sampler.get_pairwise_epoch(num_negatives)
+
+        assert np.all(np.asarray(URM_train[user_input, item_input_pos]).ravel() == 1)
+        assert np.all(URM_train[np.repeat(user_input, num_negatives), item_input_neg.ravel()] == 0)
+        assert not np.any(user_input == 0)
+
+
+    def test_shapes_and_dtypes(self):
+
+        URM_train = random_URM(50, 20, 1)
+        num_negatives = 3
+
+        negative_sampler = Negative_Sampler(URM_train, prefetch = False, random_seed = 0)
+
+        n_instances = negative_sampler.get_n_pointwise_instances(num_negatives)
+        pointwise_epoch = negative_sampler.get_pointwise_epoch(num_negatives)
+
+        for array in pointwise_epoch:
+            self.assertEqual(array.shape, (n_instances,))
+            self.assertEqual(array.dtype, np.int32)
+
+        self.assertEqual(np.sum(pointwise_epoch[2] == 1), URM_train.nnz)
+        self.assertEqual(np.sum(pointwise_epoch[2] == 0), num_negatives * (URM_train.nnz - URM_train.shape[1]))
+
+        user_input, item_input_pos, item_input_neg = negative_sampler.get_pairwise_epoch(num_negatives)
+        n_pairwise = URM_train.nnz - URM_train.shape[1]
+
+        self.assertEqual(user_input.shape, (n_pairwise,))
+        self.assertEqual(item_input_pos.shape, (n_pairwise,))
+        self.assertEqual(item_input_neg.shape, (n_pairwise, num_negatives))
+
+        for array in [user_input, item_input_pos, item_input_neg]:
+            self.assertEqual(array.dtype, np.int32)
+
+
+    def test_random_seed_with_and_without_prefetch(self):
+
+        URM_train = random_URM(50, 20, 2)
+        num_negatives = 2
+        n_epochs = 3
+
+        epochs_list = []
+
+        for prefetch in [False, True, True]:
+
+            negative_sampler = Negative_Sampler(URM_train, prefetch = prefetch, random_seed = 42)
+
+            epochs = [negative_sampler.get_pairwise_epoch(num_negatives, prefetch_next = epoch < n_epochs - 1) for epoch in range(n_epochs)]
+            epochs += [negative_sampler.get_pointwise_epoch(num_negatives) for _ in range(n_epochs)]
+            negative_sampler.close()
+
+            epochs_list.append(epochs)
+
+        for epochs in epochs_list[1:]:
+            for epoch, epoch_reference in zip(epochs, epochs_list[0]):
+                for array, array_reference in zip(epoch, epoch_reference):
+                    assert np.array_equal(array, array_reference)
+
+        # Different epochs have different negatives
+        assert not np.array_equal(epochs_list[0][0][2], epochs_list[0][1][2])
+
+
+    def test_close(self):
+
+        URM_train = random_URM(50, 20, 3)
+        negative_sampler = Negative_Sampler(URM_train, prefetch = True, random_seed = 0)
+
+        negative_sampler.get_pointwise_epoch(1)
+        self.assertIsNotNone(negative_sampler._prefetch_thread)
+
+        negative_sampler.close()
+        self.assertIsNone(negative_sampler._prefetch_thread)
+        self.assertIsNone(negative_sampler._prefetch_result)
+
+        negative_sampler.get_pointwise_epoch(1, prefetch_next = False)
+        self.assertIsNone(negative_sampler._prefetch_thread)
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
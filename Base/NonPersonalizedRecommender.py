@@ -43,7 +43,7 @@ class TopPop(BaseRecommender):
         return item_scores
 
 
-    def save_model(self, folder_path, file_name = None):
+    def save_model(self, folder_path, file_name = None, compress = True):
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -53,7 +53,7 @@ class TopPop(BaseRecommender):
         data_dict_to_save = {"item_pop": self.item_pop}
 
         dataIO = DataIO(folder_path=folder_path)
-        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save)
+        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save, compress = compress)
 
         self._print("Saving complete")
 
@@ -132,7 +132,7 @@ class GlobalEffects(BaseRecommender):
         return item_scores
 
 
-    def save_model(self, folder_path, file_name = None):
+    def save_model(self, folder_path, file_name = None, compress = True):
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -142,7 +142,7 @@ class GlobalEffects(BaseRecommender):
         data_dict_to_save = {"item_bias": self.item_bias}
 
         dataIO = DataIO(folder_path=folder_path)
-        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save)
+        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save, compress = compress)
 
         self._print("Saving complete")
 
@@ -177,7 +177,7 @@ class Random(BaseRecommender):
 
 
 
-    def save_model(self, folder_path, file_name = None):
+    def save_model(self, folder_path, file_name = None, compress = True):
 
         if file_name is None:
             file_name = self.RECOMMENDER_NAME
@@ -187,7 +187,7 @@ class Random(BaseRecommender):
         data_dict_to_save = {}
 
         dataIO = DataIO(folder_path=folder_path)
-        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save)
+        dataIO.save_data(file_name=file_name, data_dict_to_save = data_dict_to_save, compress = compress)
 
         self._print("Saving complete")
 
@@ -9,6 +9,32 @@ import numpy as np
 import scipy.sparse as sps
 import time
 import os
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+def get_sparse_matrix_fingerprint(X, use_data = True):
+    """
+    Returns a hash of the shape and non-zero structure of a matrix, to be used as key of cached data derived from it.
+    Duplicate entries are summed, so equal matrices have the same fingerprint regardless of their format
+    :param X:
+    :param use_data:    if False only the position of the non-zero entries is hashed, not their values
+    :return: hexadecimal string
+    """
+
+    X = sps.csr_matrix(X)
+    X.sum_duplicates()
+
+    data_hash = hashlib.sha256()
+    data_hash.update(np.array(X.shape, dtype=np.int64).tobytes())
+    data_hash.update(X.indptr.astype(np.int64).tobytes())
+    data_hash.update(X.indices.astype(np.int64).tobytes())
+
+    if use_data:
+        data_hash.update(X.data.astype(np.float64).tobytes())
+
+    return data_hash.hexdigest()[:32]
+
+
 
 def check_matrix(X, format='csc', dtype=np.float32):
     """
@@ -52,69 +78,219 @@ def check_matrix(X, format='csc', dtype=np.float32):
         return X.astype(dtype)
 
 
-def similarityMatrixTopK(item_weights, k=100, verbose = False):
+def _get_dense_block_top_k(block, k):
     """
-    The function selects the TopK most similar elements, column-wise
+    Selects the k greatest non-zero values of each row of a dense block with a single partition on the whole block
+    :param block:   ndarray (n_block_rows, n_columns)
+    :param k:
+    :return: indices, data      the selected column indices and values, row by row, sorted by column within each row
+             n_per_row          number of selected values of each row
+    """
+
+    block = np.ascontiguousarray(block)
+    k = min(k, block.shape[1])
+
+    if k == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=block.dtype), np.zeros(block.shape[0], dtype=np.int64)
+
+    # Zeros are moved to the end of the partition so that they are selected only if the row has less than k non-zeros
+    partition_key = np.negative(block)
+    partition_key[block == 0] = np.inf
+
+    top_k_idx = np.argpartition(partition_key, k-1, axis=1)[:, 0:k]
+    top_k_idx.sort(axis=1)
+
+    top_k_values = np.take_along_axis(block, top_k_idx, axis=1)
+    not_zero_mask = top_k_values != 0.0
+
+    return top_k_idx[not_zero_mask], top_k_values[not_zero_mask], not_zero_mask.sum(axis=1)
+
+
 
-    :param item_weights:
-    :param forceSparseOutput:
+def _get_sparse_block_top_k(block, k):
+    """
+    Selects the k greatest non-zero values of each row of a sparse block without ever building the dense block
+    Only the rows with more than k values are ranked
+    :param block:   scipy sparse (n_block_rows, n_columns)
     :param k:
-    :param verbose:
-    :param inplace: Default True, WARNING matrix will be modified
-    :return:
+    :return: indices, data      the selected column indices and values, row by row, in the original order within each row
+             n_per_row          number of selected values of each row
     """
 
-    assert (item_weights.shape[0] == item_weights.shape[1]), "selectTopK: ItemWeights is not a square matrix"
+    block = sps.csr_matrix(block, copy=True)
+    block.eliminate_zeros()
 
-    start_time = time.time()
+    n_per_row = np.ediff1d(block.indptr)
+    entry_row = np.repeat(np.arange(block.shape[0]), n_per_row)
 
-    if verbose:
-        print("Generating topK matrix")
+    in_top_k = np.ones(block.nnz, dtype=bool)
+    to_rank_mask = n_per_row[entry_row] > k
 
-    nitems = item_weights.shape[1]
-    k = min(k, nitems)
+    if np.any(to_rank_mask):
+        to_rank_entries = np.flatnonzero(to_rank_mask)
 
-    # for each column, keep only the top-k scored items
-    sparse_weights = not isinstance(item_weights, np.ndarray)
+        # Sort by descending value and then, with a stable sort, by row
+        # The stable sort of 16 bit integers uses radix sort, which is much faster
+        ranking = to_rank_entries[np.argsort(-block.data[to_rank_entries])]
+        entry_row_dtype = np.uint16 if block.shape[0] <= np.iinfo(np.uint16).max else np.int64
+        ranking = ranking[np.argsort(entry_row[ranking].astype(entry_row_dtype), kind="stable")]
 
-    # iterate over each column and keep only the top-k similar items
-    data, rows_indices, cols_indptr = [], [], []
+        # The rank of each entry within its row is its position minus the position of the first entry of the row
+        ranked_rows = entry_row[ranking]
+        row_first_position = np.flatnonzero(np.r_[True, ranked_rows[1:] != ranked_rows[:-1]])
+        row_first_position = np.repeat(row_first_position, np.ediff1d(row_first_position, to_end=len(ranking)-row_first_position[-1]))
 
-    if sparse_weights:
-        item_weights = check_matrix(item_weights, format='csc', dtype=np.float32)
-    else:
-        column_row_index = np.arange(nitems, dtype=np.int32)
+        in_top_k[ranking] = np.arange(len(ranking)) - row_first_position < k
+
+    return block.indices[in_top_k], block.data[in_top_k], np.minimum(n_per_row, k)
 
 
 
-    for item_idx in range(nitems):
+def build_sparse_matrix_top_k(get_row_block, shape, k, block_size = 1000, num_threads = 1, dtype = np.float32):
+    """
+    Builds a CSR matrix keeping only the k greatest non-zero values of each row.
+    The rows are provided in blocks by get_row_block, each block can be either a dense ndarray or a sparse matrix
+    and its top-k are selected with vectorized operations on the whole block.
+    The selected values are written directly in preallocated CSR buffers.
+
+    If num_threads > 1 the blocks are requested and processed by a pool of threads, get_row_block must therefore be
+    thread safe. The buffers are still written in order, block by block.
+
+    :param get_row_block:   function (start_row, end_row) -> block of rows [start_row, end_row)
+    :param shape:           shape of the resulting matrix
+    :param k:
+    :param block_size:      number of rows requested at once
+    :param num_threads:
+    :param dtype:
+    :return: CSR matrix
+    """
+
+    n_rows, n_columns = shape
+    k = min(k, n_columns)
 
-        cols_indptr.append(len(data))
+    indptr = np.zeros(n_rows+1, dtype=np.int64)
+    indices = np.zeros(n_rows*k, dtype=np.int32)
+    data = np.zeros(n_rows*k, dtype=dtype)
 
-        if sparse_weights:
-            start_position = item_weights.indptr[item_idx]
-            end_position = item_weights.indptr[item_idx+1]
+    def compute_block_top_k(block_start_end):
 
-            column_data = item_weights.data[start_position:end_position]
-            column_row_index = item_weights.indices[start_position:end_position]
+        block = get_row_block(*block_start_end)
 
+        if sps.issparse(block):
+            return _get_sparse_block_top_k(block, k)
         else:
-            column_data = item_weights[:,item_idx]
+            return _get_dense_block_top_k(block, k)
+
+
+    block_start_list = list(range(0, n_rows, block_size))
+    block_end_list = block_start_list[1:] + [n_rows]
+
+    if num_threads > 1:
+        pool = ThreadPool(processes=num_threads)
+        block_result_iterator = pool.imap(compute_block_top_k, zip(block_start_list, block_end_list))
+    else:
+        pool = None
+        block_result_iterator = map(compute_block_top_k, zip(block_start_list, block_end_list))
+
+
+    try:
+        for block_start, block_end, (block_indices, block_data, block_n_per_row) in zip(block_start_list, block_end_list, block_result_iterator):
+
+            data_pointer = indptr[block_start]
+
+            indices[data_pointer:data_pointer+len(block_indices)] = block_indices
+            data[data_pointer:data_pointer+len(block_data)] = block_data
+            indptr[block_start+1:block_end+1] = data_pointer + np.cumsum(block_n_per_row)
+
+    finally:
+        # On success all the blocks have been consumed, if an exception is raised the remaining ones are discarded
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    n_cells = indptr[-1]
+
+    return sps.csr_matrix((data[:n_cells], indices[:n_cells], indptr), shape=shape)
+
+
+
+
+def compute_item_score_batched(predict_pairs, user_id_array, n_items, items_to_compute = None, max_pairs = 100000):
+    """
+    Computes the item scores of a model which predicts the score of a flat list of (user, item) pairs.
+    Rather than one prediction per user over its items, the pairs of all the users are flattened in user-major order
+    and predicted in chunks of at most max_pairs, so that a chunk spans as many users as fit in it.
+
+    :param predict_pairs:       function (user_input, item_input) -> scores of the pairs, the inputs are int32 arrays
+                                of the same length
+    :param user_id_array:
+    :param n_items:
+    :param items_to_compute:    if None all items are scored
+    :param max_pairs:           maximum number of pairs predicted at once, it bounds the memory of the model inputs
+    :return: array |n_users|x|n_items| with -inf for the items not in items_to_compute
+    """
+
+    if items_to_compute is None:
+        item_indices = np.arange(n_items, dtype=np.int32)
+    else:
+        item_indices = np.asarray(items_to_compute, dtype=np.int32)
+
+    user_id_array = np.asarray(user_id_array, dtype=np.int32)
+
+    n_pairs = len(user_id_array)*len(item_indices)
+    pair_scores = np.zeros(n_pairs, dtype=np.float32)
+
+    for chunk_start in range(0, n_pairs, max_pairs):
+
+        pair_index = np.arange(chunk_start, min(chunk_start + max_pairs, n_pairs))
+
+        user_input = user_id_array[pair_index // len(item_indices)]
+        item_input = item_indices[pair_index % len(item_indices)]
 
+        pair_scores[pair_index] = np.asarray(predict_pairs(user_input, item_input)).ravel()
 
-        non_zero_data = column_data!=0
+    item_scores = np.full((len(user_id_array), n_items), -np.inf, dtype=np.float32)
+    item_scores[:, item_indices] = pair_scores.reshape(len(user_id_array), len(item_indices))
 
-        idx_sorted = np.argsort(column_data[non_zero_data])  # sort by column
-        top_k_idx = idx_sorted[-k:]
+    return item_scores
 
-        data.extend(column_data[non_zero_data][top_k_idx])
-        rows_indices.extend(column_row_index[non_zero_data][top_k_idx])
 
 
-    cols_indptr.append(len(data))
 
-    # During testing CSR is faster
-    W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
+def similarityMatrixTopK(item_weights, k=100, verbose = False, num_threads = 1):
+    """
+    The function selects the TopK most similar elements, column-wise
+
+    :param item_weights:    dense ndarray or sparse matrix
+    :param k:
+    :param verbose:
+    :param num_threads:     number of threads used to process the blocks of columns
+    :return: CSC matrix
+    """
+
+    assert (item_weights.shape[0] == item_weights.shape[1]), "selectTopK: ItemWeights is not a square matrix"
+
+    start_time = time.time()
+
+    if verbose:
+        print("Generating topK matrix")
+
+    nitems = item_weights.shape[1]
+
+    # The columns of item_weights are the rows of its transpose, the transpose of the CSR result is the CSC
+    if isinstance(item_weights, np.ndarray):
+        get_row_block = lambda start_row, end_row: item_weights[:, start_row:end_row].T
+        block_size = max(1, min(1000, int(2**24 / max(1, nitems))))
+
+    else:
+        item_weights_T = check_matrix(item_weights, format='csc', dtype=np.float32).T
+        get_row_block = lambda start_row, end_row: item_weights_T[start_row:end_row]
+        block_size = 10000
+
+    W_sparse_T = build_sparse_matrix_top_k(get_row_block, (nitems, nitems), k,
+                                           block_size = block_size, num_threads = num_threads)
+
+    W_sparse = W_sparse_T.T
 
     if verbose:
         print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
@@ -6,7 +6,7 @@ Created on 30/09/17
 @author: Maurizio Ferrari Dacrema
 """
 
-from Base.Recommender_utils import similarityMatrixTopK
+from Base.Recommender_utils import similarityMatrixTopK, build_sparse_matrix_top_k
 
 import numpy as np
 import scipy.sparse as sps
@@ -50,6 +50,38 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(topk_on_dense_input, topk_on_sparse_input), "sparseToSparse CSC incorrect")
 
 
+    def test_build_sparse_matrix_top_k(self):
+
+        numRows = 50
+
+        TopK = 7
+
+        dense_input = np.random.random((numRows, numRows)) - 0.3
+        dense_input[dense_input < 0.2] = 0.0
+
+        # Reference, keep the TopK greatest non-zero values of each row
+        control_output = np.zeros_like(dense_input)
+
+        for row_index in range(numRows):
+            non_zero_columns = np.flatnonzero(dense_input[row_index])
+            top_k_columns = non_zero_columns[np.argsort(-dense_input[row_index, non_zero_columns])[:TopK]]
+            control_output[row_index, top_k_columns] = dense_input[row_index, top_k_columns]
+
+        sparse_input = sps.csr_matrix(dense_input)
+
+        for num_threads in [1, 3]:
+
+            topk_on_dense_input = build_sparse_matrix_top_k(lambda start_row, end_row: dense_input[start_row:end_row],
+                                                            dense_input.shape, TopK, block_size = 8, num_threads = num_threads)
+
+            topk_on_sparse_input = build_sparse_matrix_top_k(lambda start_row, end_row: sparse_input[start_row:end_row],
+                                                             dense_input.shape, TopK, block_size = 8, num_threads = num_threads)
+
+            self.assertTrue(np.allclose(topk_on_dense_input.toarray(), control_output), "Dense blocks incorrect")
+            self.assertTrue(np.allclose(topk_on_sparse_input.toarray(), control_output), "Sparse blocks incorrect")
+
+
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -30,7 +30,7 @@ class SimilarityFunction(Enum):
 class Compute_Similarity:
 
 
-    def __init__(self, dataMatrix, use_implementation = "density", similarity = None, **args):
+    def __init__(self, dataMatrix, use_implementation = "density", similarity = None, memory_budget_MB = 2048, **args):
         """
         Interface object that will call the appropriate similarity implementation
         :param dataMatrix:              scipy sparse matrix |features|x|items| or |users|x|items|
@@ -38,6 +38,8 @@ class Compute_Similarity:
                                         "cython" will use the cython implementation, if available. Most efficient for sparse matrix
                                         "python" will use the python implementation. Most efficient for dense matrix
         :param similarity:              the type of similarity to use, see SimilarityFunction enum
+        :param memory_budget_MB:        memory the python implementation may use for its dense column blocks,
+                                        the block size is selected accordingly
         :param args:                    other args required by the specific similarity implementation
         """
 
@@ -45,6 +47,7 @@ class Compute_Similarity:
             "Compute_Similarity: Data matrix contains {} non finite values".format(np.sum(np.logical_not(np.isfinite(dataMatrix.data))))
 
         self.dense = False
+        self.block_size = None
 
         if similarity == "euclidean":
             # This is only available here
@@ -108,10 +111,12 @@ class Compute_Similarity:
                 except ImportError:
                     print("Unable to load Cython Compute_Similarity, reverting to Python")
                     self.compute_similarity_object = Compute_Similarity_Python(dataMatrix, **args)
+                    self.block_size = self._get_block_size(dataMatrix.shape, memory_budget_MB, args.get("num_threads", 1))
 
 
             elif use_implementation == "python":
                 self.compute_similarity_object = Compute_Similarity_Python(dataMatrix, **args)
+                self.block_size = self._get_block_size(dataMatrix.shape, memory_budget_MB, args.get("num_threads", 1))
 
             else:
 
@@ -121,7 +126,33 @@ class Compute_Similarity:
 
 
 
+    def _get_block_size(self, shape, memory_budget_MB, num_threads):
+        """
+        Select the number of columns the python implementation processes at once so that the dense blocks
+        of all threads fit in the memory budget.
+        For each column of a block a thread holds the dense data column, the similarity column and about four
+        temporary copies of it used for the normalization and the TopK partition
+        :param shape:               shape of the data matrix
+        :param memory_budget_MB:
+        :param num_threads:
+        :return:
+        """
+
+        n_rows, n_columns = shape
+
+        bytes_per_column = (n_rows + 5 * n_columns) * np.dtype(np.float64).itemsize
+
+        block_size = int(memory_budget_MB * 2**20 / (bytes_per_column * num_threads))
+
+        return max(1, min(block_size, n_columns))
+
+
+
+
     def compute_similarity(self,  **args):
 
+        if self.block_size is not None and "block_size" not in args:
+            args["block_size"] = self.block_size
+
         return self.compute_similarity_object.compute_similarity(**args)
 
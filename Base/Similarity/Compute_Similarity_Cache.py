@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse as sps
+import os, time
+
+from Base.DataIO import DataIO
+from Base.Recommender_utils import check_matrix, get_sparse_matrix_fingerprint
+from Base.Similarity.Compute_Similarity import Compute_Similarity
+from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
+
+
+
+class Compute_Similarity_Cache(object):
+    """
+    Cache of the column dot products of a data matrix, to be shared by the fit of KNN models with different hyperparameters.
+
+    The dot products of all the couples of columns and the column norms are computed once for each data matrix,
+    the similarity of each configuration of topK, shrink and normalization is then derived by re-weighting the cached
+    dot products and selecting the TopK of each column. All the dot products are kept, rather than only the TopK ones,
+    because normalization and shrink change which are the most similar columns, so every configuration is exact.
+
+    Deriving the similarity costs one operation for each cached dot product while computing it from scratch costs one
+    multiplication for each couple of non-zero values in the same row. If there are less than MIN_MULTIPLICATIONS_PER_DOT_PRODUCT
+    multiplications per cached dot product the cache is slower, only this ratio is cached and the similarity is computed from scratch.
+
+    Data matrices are identified by the hash of their content, e.g., the URM with and without feature weighting
+    are different entries. If folder_path is provided the entries are saved in uncompressed archives and memory mapped,
+    so processes using the same folder compute each entry only once.
+    Similarities not supported by the cache, or data whose dot products exceed memory_budget_MB, are computed by Compute_Similarity.
+    """
+
+    SUPPORTED_SIMILARITY_VALUES = ["cosine", "asymmetric", "jaccard", "tanimoto", "dice", "tversky"]
+    BOOLEAN_SIMILARITY_VALUES = ["jaccard", "tanimoto", "dice", "tversky"]
+
+    # Measured against the Cython implementation on collaborative KNNs
+    MIN_MULTIPLICATIONS_PER_DOT_PRODUCT = 5
+
+    def __init__(self, folder_path = None, memory_budget_MB = 4096, verbose = True):
+        """
+        :param folder_path:         Folder in which to persist the cache entries, if None they are kept only in memory
+        :param memory_budget_MB:    Maximum memory of the dot products of a data matrix, estimated from the number of
+                                    couples of non-zero values in the same row
+        :param verbose:
+        """
+        super(Compute_Similarity_Cache, self).__init__()
+
+        self.folder_path = folder_path
+        self.memory_budget_MB = memory_budget_MB
+        self.verbose = verbose
+
+        self._cache_entry_dict = {}
+
+
+    def _print(self, string):
+        if self.verbose:
+            print("Compute_Similarity_Cache: {}".format(string))
+
+
+    def __getstate__(self):
+        # Entries in memory are not copied to other processes, they are loaded from folder_path if available
+        state = self.__dict__.copy()
+        state["_cache_entry_dict"] = {}
+        return state
+
+
+
+    def _get_data_key(self, dataMatrix, boolean):
+        return "{}_{}".format("boolean" if boolean else "weighted", get_sparse_matrix_fingerprint(dataMatrix, use_data = not boolean))
+
+
+
+    def _get_n_multiplications(self, dataMatrix):
+        # Each row contributes the square of its non-zero values
+        row_length = np.ediff1d(sps.csr_matrix(dataMatrix).indptr).astype(np.float64)
+        return np.sum(row_length**2)
+
+
+    def _fits_memory_budget(self, dataMatrix):
+
+        # Each column has at most a dot product with all the others
+        max_dot_products = min(self._get_n_multiplications(dataMatrix), dataMatrix.shape[1]**2)
+
+        # Values, indices and the temporary copies of the sparse product
+        return max_dot_products * 24 / 2**20 <= self.memory_budget_MB
+
+
+
+    def _compute_cache_entry(self, dataMatrix, boolean):
+        """
+        :return: dictionary with "n_multiplications_per_dot_product", "dot_product", matrix |n_columns|x|n_columns|
+                with a zero diagonal, and "sum_of_squared", the squared norm of each column.
+                The matrix is dense if at least a quarter of the dot products are non-zero, CSR otherwise
+        """
+
+        start_time = time.time()
+        self._print("Computing column dot products of data with shape {}...".format(dataMatrix.shape))
+
+        dataMatrix = dataMatrix.copy()
+
+        if boolean:
+            dataMatrix.data = np.ones_like(dataMatrix.data)
+
+        # The norms are computed as Compute_Similarity does, in the data type of the matrix, so that they are identical
+        sum_of_squared = np.array(dataMatrix.power(2).sum(axis=0), dtype=np.float64).ravel()
+
+        dataMatrix = sps.csc_matrix(dataMatrix, dtype=np.float64)
+        dot_product = sps.csr_matrix(dataMatrix.T.dot(dataMatrix))
+
+        entry_row = np.repeat(np.arange(dot_product.shape[0]), np.ediff1d(dot_product.indptr))
+        dot_product.data[entry_row == dot_product.indices] = 0.0
+        dot_product.eliminate_zeros()
+        dot_product.sort_indices()
+
+        n_dot_products = dot_product.nnz
+
+        # The dense matrix is processed faster and requires less memory than the CSR one
+        if n_dot_products * 4 >= dot_product.shape[0]**2:
+            dot_product = dot_product.toarray()
+
+        # A dense matrix costs one operation also for its zeros
+        n_multiplications_per_dot_product = self._get_n_multiplications(dataMatrix) / max(1, dot_product.nnz if sps.issparse(dot_product) else dot_product.size)
+
+        new_time_value, new_time_unit = seconds_to_biggest_unit(time.time()-start_time)
+        self._print("Computing column dot products of data with shape {}... done in {:.2f} {}. {} dot products".format(
+            dataMatrix.shape, new_time_value, new_time_unit, n_dot_products))
+
+        if n_multiplications_per_dot_product < self.MIN_MULTIPLICATIONS_PER_DOT_PRODUCT:
+            self._print("Data has {:.2f} multiplications per dot product, the similarity will be computed from scratch".format(n_multiplications_per_dot_product))
+            return {"n_multiplications_per_dot_product": n_multiplications_per_dot_product}
+
+        return {"n_multiplications_per_dot_product": n_multiplications_per_dot_product,
+                "dot_product": dot_product,
+                "sum_of_squared": sum_of_squared}
+
+
+
+    def _get_cache_entry(self, dataMatrix, boolean):
+
+        data_key = self._get_data_key(dataMatrix, boolean)
+
+        if data_key in self._cache_entry_dict:
+            return self._cache_entry_dict[data_key]
+
+        file_name = "similarity_cache_{}".format(data_key)
+
+        if self.folder_path is not None and os.path.isfile(self.folder_path + file_name + ".zip"):
+            self._print("Loading column dot products from file '{}'".format(self.folder_path + file_name))
+            cache_entry = DataIO(folder_path = self.folder_path).load_data(file_name, mmap_mode = "r")
+
+        else:
+            cache_entry = self._compute_cache_entry(dataMatrix, boolean)
+
+            if self.folder_path is not None:
+                # Save with a process-specific name and then rename, so that other processes never read a partial archive
+                temp_file_name = "{}_{}".format(file_name, os.getpid())
+                DataIO(folder_path = self.folder_path).save_data(temp_file_name, cache_entry, compress = False)
+                os.replace(self.folder_path + temp_file_name + ".zip", self.folder_path + file_name + ".zip")
+
+        self._cache_entry_dict[data_key] = cache_entry
+
+        return cache_entry
+
+
+
+    def _get_weight(self, dot_product, sum_of_squared_column, sum_of_squared_row):
+        """
+        Applies normalization and shrinkage to the dot products as Compute_Similarity does, ensure denominator != 0
+        The arguments can be the arrays of the entries of a sparse matrix or broadcastable blocks of a dense one
+        """
+
+        weight = np.array(dot_product, dtype=np.float64)
+
+        if self.normalize and self.similarity == "asymmetric":
+            weight /= np.power(sum_of_squared_column + 1e-6, 2 * self.asymmetric_alpha) * \
+                      np.power(sum_of_squared_row + 1e-6, 2 * (1 - self.asymmetric_alpha)) + self.shrink + 1e-6
+
+        elif self.normalize and self.similarity == "cosine":
+            weight /= sum_of_squared_column * sum_of_squared_row + self.shrink + 1e-6
+
+        elif self.similarity in ["jaccard", "tanimoto"]:
+            weight /= sum_of_squared_column + sum_of_squared_row - weight + self.shrink + 1e-6
+
+        elif self.similarity == "dice":
+            weight /= sum_of_squared_column + sum_of_squared_row + self.shrink + 1e-6
+
+        elif self.similarity == "tversky":
+            weight /= weight + (sum_of_squared_column - weight) * self.tversky_alpha + \
+                      (sum_of_squared_row - weight) * self.tversky_beta + self.shrink + 1e-6
+
+        elif self.shrink != 0:
+            weight /= self.shrink
+
+        return weight
+
+
+
+    def _get_top_k_sparse(self, dot_product, sum_of_squared, block_size_cells = 2**22):
+        """
+        Selects the TopK of the weights of the CSR dot products. Columns with at most TopK dot products are kept as they are,
+        the others are processed with a partition in blocks of similar length, padded to at most block_size_cells values
+        :return: rows, columns and weights of the TopK of each column
+        """
+
+        # The dot products are symmetric, row j of the matrix contains the dot products of column j
+        n_per_column = np.ediff1d(dot_product.indptr)
+        column = np.repeat(np.arange(dot_product.shape[0]), n_per_column)
+        row = dot_product.indices
+
+        weight = self._get_weight(dot_product.data, sum_of_squared[column], sum_of_squared[row])
+
+        top_k_position = [np.flatnonzero(n_per_column[column] <= self.TopK)]
+
+        long_columns = np.flatnonzero(n_per_column > self.TopK)
+        long_columns = long_columns[np.argsort(-n_per_column[long_columns], kind="stable")]
+
+        block_start = 0
+
+        while block_start < len(long_columns):
+
+            # Columns are sorted by decreasing length, the first of the block is the longest
+            block_width = n_per_column[long_columns[block_start]]
+            block_end = min(block_start + max(1, block_size_cells // block_width), len(long_columns))
+            block_columns = long_columns[block_start:block_end]
+
+            block_position = dot_product.indptr[block_columns][:, None] + np.arange(block_width)
+            is_padding = np.arange(block_width) >= n_per_column[block_columns][:, None]
+            block_position[is_padding] = 0
+
+            block_weight = weight[block_position]
+            block_weight[is_padding] = -np.inf
+
+            block_top_k = np.argpartition(-block_weight, self.TopK-1, axis=1)[:, :self.TopK]
+            top_k_position.append(np.take_along_axis(block_position, block_top_k, axis=1).ravel())
+
+            block_start = block_end
+
+        top_k_position = np.concatenate(top_k_position)
+
+        return row[top_k_position], column[top_k_position], weight[top_k_position]
+
+
+
+    def _get_top_k_dense(self, dot_product, sum_of_squared, block_size_cells = 2**22):
+        """
+        Selects the TopK of the weights of the dense dot products with a partition, in blocks of at most block_size_cells values
+        :return: rows, columns and weights of the TopK of each column
+        """
+
+        n_columns = dot_product.shape[0]
+        block_size = max(1, block_size_cells // n_columns)
+
+        top_k_row, top_k_column, top_k_weight = [], [], []
+
+        for block_start in range(0, n_columns, block_size):
+
+            block_end = min(block_start + block_size, n_columns)
+            block_dot_product = dot_product[block_start:block_end]
+
+            block_weight = self._get_weight(block_dot_product, sum_of_squared[block_start:block_end, None], sum_of_squared[None, :])
+
+            # Zero dot products, as the diagonal, are missing from the sparse computation. They are
+            # given -inf weight so that they are selected only if the column has less than TopK
+            block_weight[block_dot_product == 0] = -np.inf
+
+            block_top_k_row = np.argpartition(-block_weight, self.TopK-1, axis=1)[:, :self.TopK]
+            block_top_k_weight = np.take_along_axis(block_weight, block_top_k_row, axis=1)
+
+            is_valid = np.isfinite(block_top_k_weight)
+
+            top_k_row.append(block_top_k_row[is_valid])
+            top_k_column.append(np.broadcast_to(np.arange(block_start, block_end)[:, None], block_top_k_row.shape)[is_valid])
+            top_k_weight.append(block_top_k_weight[is_valid])
+
+        return np.concatenate(top_k_row), np.concatenate(top_k_column), np.concatenate(top_k_weight)
+
+
+
+    def compute_similarity(self, dataMatrix, topK = 100, shrink = 0, normalize = True, similarity = "cosine",
+                           asymmetric_alpha = 0.5, tversky_alpha = 1.0, tversky_beta = 1.0, **similarity_args):
+        """
+        Computes the similarity on the columns of dataMatrix with the same arguments and result of Compute_Similarity
+        :param dataMatrix:
+        :param topK:
+        :param shrink:
+        :param normalize:
+        :param similarity:
+        :param asymmetric_alpha:
+        :param tversky_alpha:
+        :param tversky_beta:
+        :param similarity_args:     other arguments, e.g., row_weights, are not supported by the cache
+        :return:
+        """
+
+        if similarity is None:
+            similarity = "cosine"
+
+        use_cache = similarity in self.SUPPORTED_SIMILARITY_VALUES and len(similarity_args) == 0 and topK != 0 and \
+                    sps.issparse(dataMatrix) and self._fits_memory_budget(dataMatrix)
+
+        if use_cache:
+            cache_entry = self._get_cache_entry(dataMatrix, boolean = similarity in self.BOOLEAN_SIMILARITY_VALUES)
+            use_cache = "dot_product" in cache_entry
+
+        if not use_cache:
+            compute_similarity_object = Compute_Similarity(dataMatrix, topK = topK, shrink = shrink, normalize = normalize, similarity = similarity,
+                                                           asymmetric_alpha = asymmetric_alpha, tversky_alpha = tversky_alpha, tversky_beta = tversky_beta,
+                                                           **similarity_args)
+
+            return compute_similarity_object.compute_similarity()
+
+
+        self.TopK = min(topK, dataMatrix.shape[1])
+        self.shrink = shrink
+        self.normalize = normalize
+        self.similarity = similarity
+        self.asymmetric_alpha = asymmetric_alpha
+        self.tversky_alpha = tversky_alpha
+        self.tversky_beta = tversky_beta
+
+        dot_product = cache_entry["dot_product"]
+        sum_of_squared = cache_entry["sum_of_squared"]
+
+        # Set-based similarities do not require the square root to be applied
+        if similarity in ["cosine", "asymmetric"]:
+            sum_of_squared = np.sqrt(sum_of_squared)
+
+        if sps.issparse(dot_product):
+            top_k_row, top_k_column, top_k_weight = self._get_top_k_sparse(dot_product, sum_of_squared)
+        else:
+            top_k_row, top_k_column, top_k_weight = self._get_top_k_dense(dot_product, sum_of_squared)
+
+        W_sparse = sps.csr_matrix((top_k_weight, (top_k_row, top_k_column)),
+                                  shape=dot_product.shape,
+                                  dtype=np.float32)
+
+        W_sparse.eliminate_zeros()
+
+        return check_matrix(W_sparse, format='csr')
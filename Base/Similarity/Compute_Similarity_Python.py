@@ -9,6 +9,7 @@ Created on 23/10/17
 import numpy as np
 import time, sys
 import scipy.sparse as sps
+from multiprocessing.pool import ThreadPool
 from Base.Recommender_utils import check_matrix
 from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
 
@@ -16,7 +17,7 @@ class Compute_Similarity_Python:
 
     def __init__(self, dataMatrix, topK=100, shrink = 0, normalize = True,
                  asymmetric_alpha = 0.5, tversky_alpha = 1.0, tversky_beta = 1.0,
-                 similarity = "cosine", row_weights = None):
+                 similarity = "cosine", row_weights = None, num_threads = 1):
         """
         Computes the cosine similarity on the columns of dataMatrix
         If it is computed on URM=|users|x|items|, pass the URM as is.
@@ -27,6 +28,7 @@ class Compute_Similarity_Python:
         :param normalize:           If True divide the dot product by the product of the norms
         :param row_weights:         Multiply the values in each row by a specified value. Array
         :param asymmetric_alpha     Coefficient alpha for the asymmetric cosine
+        :param num_threads:         Number of threads the column blocks are dispatched to
         :param similarity:  "cosine"        computes Cosine similarity
                             "adjusted"      computes Adjusted Cosine, removing the average of the users
                             "asymmetric"    computes Asymmetric Cosine
@@ -45,6 +47,10 @@ class Compute_Similarity_Python:
 
         super(Compute_Similarity_Python, self).__init__()
 
+        if num_threads < 1:
+            raise ValueError("Cosine_Similarity: num_threads must be a positive integer. Passed value was '{}'".format(num_threads))
+
+        self.num_threads = num_threads
         self.shrink = shrink
         self.normalize = normalize
 
@@ -203,12 +209,89 @@ class Compute_Similarity_Python:
 
 
 
+    def _compute_block_similarity(self, start_col_block, end_col_block):
+        """
+        Compute the similarity of the columns in [start_col_block, end_col_block) and select the TopK of each
+        The block is processed as a whole dense matrix |n_columns|x|block size|, scipy and numpy release the GIL
+        for the product and the partition so blocks can be processed by different threads
+        :param start_col_block: first column of the block
+        :param end_col_block: column to stop before, end_col_block is excluded
+        :return: values, rows and cols of the non-zero TopK similarities of the block
+        """
+
+        block_columns = np.arange(start_col_block, end_col_block)
+        this_block_size = end_col_block-start_col_block
+
+        # All data points for a given item
+        item_data = self.dataMatrix[:, start_col_block:end_col_block]
+        item_data = item_data.toarray()
+
+        # Compute item similarities
+        if self.use_row_weights:
+            this_block_weights = self.dataMatrix_weighted.T.dot(item_data)
+        else:
+            this_block_weights = self.dataMatrix.T.dot(item_data)
+
+        this_block_weights[block_columns, np.arange(this_block_size)] = 0.0
+
+        # Apply normalization and shrinkage, ensure denominator != 0
+        # Rows are the other items, columns the items of the block
+        if self.normalize:
+
+            if self.asymmetric_cosine:
+                denominator = np.outer(self.sum_of_squared_to_1_minus_alpha, self.sum_of_squared_to_alpha[block_columns]) + self.shrink + 1e-6
+            else:
+                denominator = np.outer(self.sum_of_squared, self.sum_of_squared[block_columns]) + self.shrink + 1e-6
+
+            this_block_weights = np.multiply(this_block_weights, 1 / denominator)
+
+
+        # Apply the specific denominator for Tanimoto
+        elif self.tanimoto_coefficient:
+            denominator = self.sum_of_squared[block_columns] + self.sum_of_squared[:,None] - this_block_weights + self.shrink + 1e-6
+            this_block_weights = np.multiply(this_block_weights, 1 / denominator)
+
+        elif self.dice_coefficient:
+            denominator = self.sum_of_squared[block_columns] + self.sum_of_squared[:,None] + self.shrink + 1e-6
+            this_block_weights = np.multiply(this_block_weights, 1 / denominator)
+
+        elif self.tversky_coefficient:
+            denominator = this_block_weights + \
+                          (self.sum_of_squared[block_columns] - this_block_weights)*self.tversky_alpha + \
+                          (self.sum_of_squared[:,None] - this_block_weights)*self.tversky_beta + self.shrink + 1e-6
+            this_block_weights = np.multiply(this_block_weights, 1 / denominator)
+
+        # If no normalization or tanimoto is selected, apply only shrink
+        elif self.shrink != 0:
+            this_block_weights = this_block_weights/self.shrink
+
+
+        # Select the TopK of all the columns of the block with a single partition, the ordering
+        # within the TopK is not relevant to build the sparse matrix
+        top_k_idx = (-this_block_weights).argpartition(self.TopK-1, axis=0)[0:self.TopK]
+        top_k_values = np.take_along_axis(this_block_weights, top_k_idx, axis=0)
+
+        # Build sparse matrix, do not add zeros
+        notZerosMask = top_k_values != 0.0
+
+        values = top_k_values[notZerosMask]
+        rows = top_k_idx[notZerosMask]
+        cols = np.broadcast_to(block_columns, top_k_idx.shape)[notZerosMask]
+
+        return values, rows, cols
+
+
+
+
     def compute_similarity(self, start_col=None, end_col=None, block_size = 100):
         """
         Compute the similarity for the given dataset
+        The columns are processed in blocks of block_size, which are dispatched to num_threads threads
         :param self:
         :param start_col: column to begin with
         :param end_col: column to stop before, end_col is excluded
+        :param block_size: number of columns processed at once, each thread requires
+                            a dense |n_columns|x|block_size| matrix
         :return:
         """
 
@@ -236,16 +319,16 @@ class Compute_Similarity_Python:
 
 
         # Compute sum of squared values to be used in normalization
-        sum_of_squared = np.array(self.dataMatrix.power(2).sum(axis=0)).ravel()
+        self.sum_of_squared = np.array(self.dataMatrix.power(2).sum(axis=0)).ravel()
 
         # Tanimoto does not require the square root to be applied
         if not (self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient):
-            sum_of_squared = np.sqrt(sum_of_squared)
+            self.sum_of_squared = np.sqrt(self.sum_of_squared)
 
 
         if self.asymmetric_cosine:
-            sum_of_squared_to_alpha = np.power(sum_of_squared + 1e-6, 2 * self.asymmetric_alpha)
-            sum_of_squared_to_1_minus_alpha = np.power(sum_of_squared + 1e-6, 2 * (1 - self.asymmetric_alpha))
+            self.sum_of_squared_to_alpha = np.power(self.sum_of_squared + 1e-6, 2 * self.asymmetric_alpha)
+            self.sum_of_squared_to_1_minus_alpha = np.power(self.sum_of_squared + 1e-6, 2 * (1 - self.asymmetric_alpha))
 
 
         self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
@@ -260,111 +343,55 @@ class Compute_Similarity_Python:
             end_col_local = end_col
 
 
+        block_start_list = list(range(start_col_local, end_col_local, block_size))
+        block_end_list = block_start_list[1:] + [end_col_local]
 
-
-        start_col_block = start_col_local
-
-        this_block_size = 0
-
-        # Compute all similarities for each item using vectorization
-        while start_col_block < end_col_local:
-
-            # Compute block first and last column
-            end_col_block = min(start_col_block + block_size, end_col_local)
-            this_block_size = end_col_block-start_col_block
-
-            # All data points for a given item
-            item_data = self.dataMatrix[:, start_col_block:end_col_block]
-            item_data = item_data.toarray()
-
-            # Compute item similarities
-            if self.use_row_weights:
-                this_block_weights = self.dataMatrix_weighted.T.dot(item_data)
-            else:
-                this_block_weights = self.dataMatrix.T.dot(item_data)
-
-
-            for col_index_in_block in range(this_block_size):
-
-                if this_block_size == 1:
-                    this_column_weights = this_block_weights.ravel()
-                else:
-                    this_column_weights = this_block_weights[:,col_index_in_block]
-
-
-                columnIndex = col_index_in_block + start_col_block
-                this_column_weights[columnIndex] = 0.0
-
-                # Apply normalization and shrinkage, ensure denominator != 0
-                if self.normalize:
-
-                    if self.asymmetric_cosine:
-                        denominator = sum_of_squared_to_alpha[columnIndex] * sum_of_squared_to_1_minus_alpha + self.shrink + 1e-6
-                    else:
-                        denominator = sum_of_squared[columnIndex] * sum_of_squared + self.shrink + 1e-6
-
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
-
-
-                # Apply the specific denominator for Tanimoto
-                elif self.tanimoto_coefficient:
-                    denominator = sum_of_squared[columnIndex] + sum_of_squared - this_column_weights + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
-
-                elif self.dice_coefficient:
-                    denominator = sum_of_squared[columnIndex] + sum_of_squared + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
-
-                elif self.tversky_coefficient:
-                    denominator = this_column_weights + \
-                                  (sum_of_squared[columnIndex] - this_column_weights)*self.tversky_alpha + \
-                                  (sum_of_squared - this_column_weights)*self.tversky_beta + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
-
-                # If no normalization or tanimoto is selected, apply only shrink
-                elif self.shrink != 0:
-                    this_column_weights = this_column_weights/self.shrink
+        if self.num_threads > 1:
+            pool = ThreadPool(processes=self.num_threads)
+            block_result_iterator = pool.imap(lambda block: self._compute_block_similarity(*block), zip(block_start_list, block_end_list))
+        else:
+            pool = None
+            block_result_iterator = map(self._compute_block_similarity, block_start_list, block_end_list)
 
 
+        try:
+            # Compute all similarities for each item using vectorization, blocks are returned in order
+            for end_col_block, (block_values, block_rows, block_cols) in zip(block_end_list, block_result_iterator):
 
-                # Sort indices and select TopK
-                # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-                # - Partition the data to extract the set of relevant items
-                # - Sort only the relevant items
-                # - Get the original item index
-                relevant_items_partition = (-this_column_weights).argpartition(self.TopK-1)[0:self.TopK]
-                relevant_items_partition_sorting = np.argsort(-this_column_weights[relevant_items_partition])
-                top_k_idx = relevant_items_partition[relevant_items_partition_sorting]
+                values.append(block_values)
+                rows.append(block_rows)
+                cols.append(block_cols)
 
-                # Incrementally build sparse matrix, do not add zeros
-                notZerosMask = this_column_weights[top_k_idx] != 0.0
-                numNotZeros = np.sum(notZerosMask)
+                processed_items = end_col_block - start_col_local
 
-                values.extend(this_column_weights[top_k_idx][notZerosMask])
-                rows.extend(top_k_idx[notZerosMask])
-                cols.extend(np.ones(numNotZeros) * columnIndex)
+                if time.time() - start_time_print_batch >= 300 or end_col_block==end_col_local:
+                    column_per_sec = processed_items / (time.time() - start_time + 1e-9)
+                    new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
 
-            # Add previous block size
-            start_col_block += this_block_size
-            processed_items += this_block_size
+                    print("Similarity column {} ({:4.1f}%), {:.2f} column/sec. Elapsed time {:.2f} {}".format(
+                        processed_items, processed_items / (end_col_local - start_col_local) * 100, column_per_sec, new_time_value, new_time_unit))
 
-            if time.time() - start_time_print_batch >= 300 or end_col_block==end_col_local:
-                column_per_sec = processed_items / (time.time() - start_time + 1e-9)
-                new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
 
-                print("Similarity column {} ({:4.1f}%), {:.2f} column/sec. Elapsed time {:.2f} {}".format(
-                    processed_items, processed_items / (end_col_local - start_col_local) * 100, column_per_sec, new_time_value, new_time_unit))
+                    start_time_print_batch = time.time()
 
-                sys.stdout.flush()
-                sys.stderr.flush()
 
-                start_time_print_batch = time.time()
+            # End while on columns
 
+        finally:
+            # On success all the blocks have been consumed, if an exception is raised the remaining ones are discarded
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-        # End while on columns
+        if len(values) > 0:
+            values = np.concatenate(values)
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
 
         W_sparse = sps.csr_matrix((values, (rows, cols)),
                                   shape=(self.n_columns, self.n_columns),
                                   dtype=np.float32)
 
-        return W_sparse
\ No newline at end of file
+        return W_sparse
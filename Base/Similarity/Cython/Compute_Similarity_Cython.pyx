@@ -13,28 +13,11 @@ Created on 23/10/17
 #cython: unpack_method_calls=True
 #cython: overflowcheck=False
 
-"""
-Determine the operative system. The interface of numpy returns a different type for argsort under windows and linux
-
-http://docs.cython.org/en/latest/src/userguide/language_basics.html#conditional-compilation
-"""
-IF UNAME_SYSNAME == "linux":
-    DEF LONG_t = "long"
-ELIF  UNAME_SYSNAME == "Windows":
-    DEF LONG_t = "long long"
-ELSE:
-    DEF LONG_t = "long long"
-
-
-
 import time, sys
 import cython
 import numpy as np
-cimport numpy as np
-
-from cpython.array cimport array, clone
 
-from libc.math cimport sqrt
+from cython.parallel import prange, threadid
 
 
 
@@ -51,12 +34,13 @@ from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
 @cython.overflowcheck(False)
 cdef class Compute_Similarity_Cython:
 
-    cdef int TopK
+    cdef int TopK, num_threads
     cdef long n_columns, n_rows
 
-    cdef double[:] this_item_weights
-    cdef int[:] this_item_weights_mask, this_item_weights_id
-    cdef int this_item_weights_counter
+    # One accumulator per thread, row thread_id is used only by that thread
+    cdef double[:,:] this_item_weights
+    cdef signed char[:,:] this_item_weights_mask
+    cdef int[:,:] this_item_weights_id
 
     cdef int[:] user_to_item_row_ptr, user_to_item_cols
     cdef int[:] item_to_user_rows, item_to_user_col_ptr
@@ -72,7 +56,7 @@ cdef class Compute_Similarity_Cython:
 
     def __init__(self, dataMatrix, topK = 100, shrink=0, normalize = True,
                  asymmetric_alpha = 0.5, tversky_alpha = 1.0, tversky_beta = 1.0,
-                 similarity = "cosine", row_weights = None):
+                 similarity = "cosine", row_weights = None, num_threads = 1):
         """
         Computes the cosine similarity on the columns of dataMatrix
         If it is computed on URM=|users|x|items|, pass the URM as is.
@@ -83,6 +67,7 @@ cdef class Compute_Similarity_Cython:
         :param normalize:           If True divide the dot product by the product of the norms
         :param row_weights:         Multiply the values in each row by a specified value. Array
         :param asymmetric_alpha     Coefficient alpha for the asymmetric cosine
+        :param num_threads:         Number of OpenMP threads the columns are split across
         :param similarity:  "cosine"        computes Cosine similarity
                             "adjusted"      computes Adjusted Cosine, removing the average of the users
                             "asymmetric"    computes Asymmetric Cosine
@@ -144,11 +129,11 @@ cdef class Compute_Similarity_Cython:
                              " Passed value was '{}'".format(similarity))
 
 
+        if num_threads < 1:
+            raise ValueError("Cosine_Similarity: num_threads must be a positive integer. Passed value was '{}'".format(num_threads))
+
         self.TopK = min(topK, self.n_columns)
-        self.this_item_weights = np.zeros(self.n_columns, dtype=np.float64)
-        self.this_item_weights_id = np.zeros(self.n_columns, dtype=np.int32)
-        self.this_item_weights_mask = np.zeros(self.n_columns, dtype=np.int32)
-        self.this_item_weights_counter = 0
+        self.num_threads = num_threads
 
         # Copy data to avoid altering the original object
         dataMatrix = dataMatrix.copy()
@@ -315,16 +300,7 @@ cdef class Compute_Similarity_Cython:
 
 
 
-    cdef int[:] getUsersThatRatedItem(self, long item_id):
-        return self.item_to_user_rows[self.item_to_user_col_ptr[item_id]:self.item_to_user_col_ptr[item_id+1]]
-
-    cdef int[:] getItemsRatedByUser(self, long user_id):
-        return self.user_to_item_cols[self.user_to_item_row_ptr[user_id]:self.user_to_item_row_ptr[user_id+1]]
-
-
-
-
-    cdef computeItemSimilarities(self, long item_id_input):
+    cdef long computeItemSimilarities(self, long item_id_input, int thread_id) noexcept nogil:
         """
         For every item the cosine similarity against other items depends on whether they have users in common. The more
         common users the higher the similarity.
@@ -348,37 +324,20 @@ cdef class Compute_Similarity_Cython:
         -- Given a user, get the items he rated (second item)
         -- Update the similarity of the items he rated
 
-
+        The similarities are accumulated in the row thread_id of the accumulators, the item ids touched are stored
+        in this_item_weights_id and their number is returned.
         """
 
-        # Create template used to initialize an array with zeros
-        # Much faster than np.zeros(self.n_columns)
-        #cdef array[double] template_zero = array('d')
-        #cdef array[double] result = clone(template_zero, self.n_columns, zero=True)
-
-
-        cdef long user_index, user_id, item_index, item_id, item_id_second
-
-        cdef int[:] users_that_rated_item = self.getUsersThatRatedItem(item_id_input)
-        cdef int[:] items_rated_by_user
-
-        cdef double rating_item_input, rating_item_second, row_weight
-
-        # Clean previous item
-        for item_index in range(self.this_item_weights_counter):
-            item_id = self.this_item_weights_id[item_index]
-            self.this_item_weights_mask[item_id] = False
-            self.this_item_weights[item_id] = 0.0
-
-        self.this_item_weights_counter = 0
-
+        cdef long user_index, user_id, item_index, item_id_second
+        cdef long counter = 0
 
+        cdef double rating_item_input, row_weight
 
         # Get users that rated the items
-        for user_index in range(len(users_that_rated_item)):
+        for user_index in range(self.item_to_user_col_ptr[item_id_input], self.item_to_user_col_ptr[item_id_input+1]):
 
-            user_id = users_that_rated_item[user_index]
-            rating_item_input = self.item_to_user_data[self.item_to_user_col_ptr[item_id_input]+user_index]
+            user_id = self.item_to_user_rows[user_index]
+            rating_item_input = self.item_to_user_data[user_index]
 
             if self.use_row_weights:
                 row_weight = self.row_weights[user_id]
@@ -386,213 +345,229 @@ cdef class Compute_Similarity_Cython:
                 row_weight = 1.0
 
             # Get all items rated by that user
-            items_rated_by_user = self.getItemsRatedByUser(user_id)
-
-            for item_index in range(len(items_rated_by_user)):
+            for item_index in range(self.user_to_item_row_ptr[user_id], self.user_to_item_row_ptr[user_id+1]):
 
-                item_id_second = items_rated_by_user[item_index]
+                item_id_second = self.user_to_item_cols[item_index]
 
                 # Do not compute the similarity on the diagonal
                 if item_id_second != item_id_input:
                     # Increment similairty
-                    rating_item_second = self.user_to_item_data[self.user_to_item_row_ptr[user_id]+item_index]
-
-                    self.this_item_weights[item_id_second] += rating_item_input*rating_item_second*row_weight
-
+                    self.this_item_weights[thread_id, item_id_second] += rating_item_input*self.user_to_item_data[item_index]*row_weight
 
                     # Update global data structure
-                    if not self.this_item_weights_mask[item_id_second]:
+                    if not self.this_item_weights_mask[thread_id, item_id_second]:
 
-                        self.this_item_weights_mask[item_id_second] = True
-                        self.this_item_weights_id[self.this_item_weights_counter] = item_id_second
-                        self.this_item_weights_counter += 1
+                        self.this_item_weights_mask[thread_id, item_id_second] = True
+                        self.this_item_weights_id[thread_id, counter] = item_id_second
+                        counter += 1
 
+        return counter
 
 
 
-    def compute_similarity(self, start_col=None, end_col=None):
+    cdef void normalizeItemSimilarities(self, long item_id_input, int thread_id, long counter) noexcept nogil:
         """
-        Compute the similarity for the given dataset
-        :param self:
-        :param start_col: column to begin with
-        :param end_col: column to stop before, end_col is excluded
-        :return:
+        Apply normalization and shrinkage, ensure denominator != 0
+        Only the items touched by computeItemSimilarities are normalized, all the others have similarity 0
         """
 
-        cdef int print_block_size = 500
+        cdef long inner_item_index, item_id
+        cdef double weight
 
-        cdef int item_index, inner_item_index, item_id, local_topK
-        cdef long long topK_item_index
+        for inner_item_index in range(counter):
 
-        cdef long long[:] top_k_idx
+            item_id = self.this_item_weights_id[thread_id, inner_item_index]
+            weight = self.this_item_weights[thread_id, item_id]
 
-        # Declare numpy data type to use vetor indexing and simplify the topK selection code
-        cdef np.ndarray[LONG_t, ndim=1] top_k_partition, top_k_partition_sorting
-        cdef np.ndarray[np.float64_t, ndim=1] this_item_weights_np = np.zeros(self.n_columns, dtype=np.float64)
-        #cdef double[:] this_item_weights
+            if self.normalize:
 
-        cdef long processed_items = 0
+                if self.asymmetric_cosine:
+                    weight /= self.sum_of_squared_to_alpha[item_id_input] * self.sum_of_squared_to_1_minus_alpha[item_id]\
+                              + self.shrink + 1e-6
 
-        # Data structure to incrementally build sparse matrix
-        # Preinitialize max possible length
-        cdef unsigned long long max_cells = <long long> self.n_columns*self.TopK
-        cdef double[:] values = np.zeros((max_cells))
-        cdef int[:] rows = np.zeros((max_cells,), dtype=np.int32)
-        cdef int[:] cols = np.zeros((max_cells,), dtype=np.int32)
-        cdef long sparse_data_pointer = 0
+                else:
+                    weight /= self.sum_of_squared[item_id_input] * self.sum_of_squared[item_id]\
+                              + self.shrink + 1e-6
 
-        cdef int start_col_local = 0, end_col_local = self.n_columns
+            # Apply the specific denominator for Tanimoto
+            elif self.tanimoto_coefficient:
+                weight /= self.sum_of_squared[item_id_input] + self.sum_of_squared[item_id] -\
+                          weight + self.shrink + 1e-6
 
-        cdef array[double] template_zero = array('d')
+            elif self.dice_coefficient:
+                weight /= self.sum_of_squared[item_id_input] + self.sum_of_squared[item_id] +\
+                          self.shrink + 1e-6
 
+            elif self.tversky_coefficient:
+                weight /= weight + \
+                          (self.sum_of_squared[item_id_input]-weight)*self.tversky_alpha + \
+                          (self.sum_of_squared[item_id]-weight)*self.tversky_beta +\
+                          self.shrink + 1e-6
 
+            elif self.shrink != 0:
+                weight /= self.shrink
 
-        if start_col is not None and start_col>0 and start_col<self.n_columns:
-            start_col_local = start_col
+            self.this_item_weights[thread_id, item_id] = weight
 
-        if end_col is not None and end_col>start_col_local and end_col<self.n_columns:
-            end_col_local = end_col
 
 
+    cdef long selectTopK(self, int thread_id, long counter, double[:] values, int[:] rows, long data_pointer) noexcept nogil:
+        """
+        Select the TopK most similar items among the ones touched by computeItemSimilarities and write them
+        in values[data_pointer:data_pointer+TopK], rows[data_pointer:data_pointer+TopK], zeros are not added.
 
+        The output slice is used as a min-heap of size TopK whose root is the smallest of the selected similarities,
+        this avoids sorting elements we already know we don't care about and does not require the GIL.
+        :return: number of non-zero similarities written
+        """
 
+        cdef long inner_item_index, item_id, heap_size = 0, n_non_zero = 0
+        cdef double weight
 
+        for inner_item_index in range(counter):
 
-        start_time = time.time()
-        last_print_time = start_time
+            item_id = self.this_item_weights_id[thread_id, inner_item_index]
+            weight = self.this_item_weights[thread_id, item_id]
 
-        item_index = start_col_local
+            if heap_size < self.TopK:
+                heap_push(values, rows, data_pointer, heap_size, weight, item_id)
+                heap_size += 1
 
-        # Compute all similarities for each item
-        while item_index < end_col_local:
+            elif weight > values[data_pointer]:
+                heap_replace_root(values, rows, data_pointer, heap_size, weight, item_id)
 
-            processed_items += 1
+        # Incrementally build sparse matrix, do not add zeros
+        for inner_item_index in range(heap_size):
 
-            # Computed similarities go in self.this_item_weights
-            self.computeItemSimilarities(item_index)
+            if values[data_pointer + inner_item_index] != 0.0:
+                values[data_pointer + n_non_zero] = values[data_pointer + inner_item_index]
+                rows[data_pointer + n_non_zero] = rows[data_pointer + inner_item_index]
+                n_non_zero += 1
 
+        return n_non_zero
 
-            # Apply normalization and shrinkage, ensure denominator != 0
-            if self.normalize:
-                for inner_item_index in range(self.n_columns):
 
-                    if self.asymmetric_cosine:
-                        self.this_item_weights[inner_item_index] /= self.sum_of_squared_to_alpha[item_index] * self.sum_of_squared_to_1_minus_alpha[inner_item_index]\
-                                                             + self.shrink + 1e-6
 
-                    else:
-                        self.this_item_weights[inner_item_index] /= self.sum_of_squared[item_index] * self.sum_of_squared[inner_item_index]\
-                                                             + self.shrink + 1e-6
+    cdef void computeColumn(self, long item_index, long output_index, double[:] values, int[:] rows, int[:] n_values) noexcept nogil:
+        """
+        Compute the similarity of column item_index using the accumulators of the calling thread, the TopK results
+        are written in the output slot output_index
+        """
 
-            # Apply the specific denominator for Tanimoto
-            elif self.tanimoto_coefficient:
-                for inner_item_index in range(self.n_columns):
-                    self.this_item_weights[inner_item_index] /= self.sum_of_squared[item_index] + self.sum_of_squared[inner_item_index] -\
-                                                         self.this_item_weights[inner_item_index] + self.shrink + 1e-6
+        cdef int thread_id = threadid()
+        cdef long inner_item_index, item_id, counter
 
-            elif self.dice_coefficient:
-                for inner_item_index in range(self.n_columns):
-                    self.this_item_weights[inner_item_index] /= self.sum_of_squared[item_index] + self.sum_of_squared[inner_item_index] +\
-                                                         self.shrink + 1e-6
+        # Computed similarities go in self.this_item_weights[thread_id]
+        counter = self.computeItemSimilarities(item_index, thread_id)
 
-            elif self.tversky_coefficient:
-                for inner_item_index in range(self.n_columns):
-                    self.this_item_weights[inner_item_index] /= self.this_item_weights[inner_item_index] + \
-                                                              (self.sum_of_squared[item_index]-self.this_item_weights[inner_item_index])*self.tversky_alpha + \
-                                                              (self.sum_of_squared[inner_item_index]-self.this_item_weights[inner_item_index])*self.tversky_beta +\
-                                                              self.shrink + 1e-6
+        self.normalizeItemSimilarities(item_index, thread_id, counter)
 
-            elif self.shrink != 0:
-                for inner_item_index in range(self.n_columns):
-                    self.this_item_weights[inner_item_index] /= self.shrink
+        if self.TopK == 0:
 
+            for inner_item_index in range(counter):
+                item_id = self.this_item_weights_id[thread_id, inner_item_index]
+                self.W_dense[item_id, item_index] = self.this_item_weights[thread_id, item_id]
 
-            if self.TopK == 0:
+        else:
+            n_values[output_index] = self.selectTopK(thread_id, counter, values, rows, output_index*self.TopK)
 
-                for inner_item_index in range(self.n_columns):
-                    self.W_dense[inner_item_index,item_index] = self.this_item_weights[inner_item_index]
 
-            else:
+        # Clean the accumulators for the next item processed by this thread
+        for inner_item_index in range(counter):
+            item_id = self.this_item_weights_id[thread_id, inner_item_index]
+            self.this_item_weights_mask[thread_id, item_id] = False
+            self.this_item_weights[thread_id, item_id] = 0.0
 
-                # Sort indices and select TopK
-                # Using numpy implies some overhead, unfortunately the plain C qsort function is even slower
-                #top_k_idx = np.argsort(this_item_weights) [-self.TopK:]
 
-                # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-                # because we avoid sorting elements we already know we don't care about
-                # - Partition the data to extract the set of TopK items, this set is unsorted
-                # - Sort only the TopK items, discarding the rest
-                # - Get the original item index
-                #
 
 
+    def compute_similarity(self, start_col=None, end_col=None):
+        """
+        Compute the similarity for the given dataset
+        The columns are split across num_threads OpenMP threads, each thread has its own accumulators and
+        writes its TopK results in a separate slot of the output, the slots are then concatenated.
+        :param self:
+        :param start_col: column to begin with
+        :param end_col: column to stop before, end_col is excluded
+        :return:
+        """
 
-                #this_item_weights_np = clone(template_zero, self.this_item_weights_counter, zero=False)
-                for inner_item_index in range(self.n_columns):
-                    this_item_weights_np[inner_item_index] = 0.0
+        cdef long print_block_size = 500
 
+        cdef long item_index, block_start, block_end
 
-                # Add weights in the same ordering as the self.this_item_weights_id data structure
-                for inner_item_index in range(self.this_item_weights_counter):
-                    item_id = self.this_item_weights_id[inner_item_index]
-                    this_item_weights_np[inner_item_index] = - self.this_item_weights[item_id]
+        cdef long processed_items = 0
 
+        cdef int start_col_local = 0, end_col_local = self.n_columns
 
-                local_topK = min([self.TopK, self.this_item_weights_counter])
+        cdef double[:] values
+        cdef int[:] rows, n_values
 
-                # Get the unordered set of topK items
-                top_k_partition = np.argpartition(this_item_weights_np, local_topK-1)[0:local_topK]
-                # Sort only the elements in the partition
-                top_k_partition_sorting = np.argsort(this_item_weights_np[top_k_partition])
-                # Get original index
-                top_k_idx = top_k_partition[top_k_partition_sorting]
 
+        if start_col is not None and start_col>0 and start_col<self.n_columns:
+            start_col_local = start_col
 
+        if end_col is not None and end_col>start_col_local and end_col<self.n_columns:
+            end_col_local = end_col
 
-                # Incrementally build sparse matrix, do not add zeros
-                for inner_item_index in range(len(top_k_idx)):
 
-                    topK_item_index = top_k_idx[inner_item_index]
+        self.this_item_weights = np.zeros((self.num_threads, self.n_columns), dtype=np.float64)
+        self.this_item_weights_id = np.zeros((self.num_threads, self.n_columns), dtype=np.int32)
+        self.this_item_weights_mask = np.zeros((self.num_threads, self.n_columns), dtype=np.int8)
 
-                    item_id = self.this_item_weights_id[topK_item_index]
+        # Each column has its own slot of TopK cells, the slots are concatenated at the end
+        # Preinitialize max possible length
+        cdef unsigned long long max_cells = <long long> (end_col_local - start_col_local)*self.TopK
+        values = np.zeros((max_cells))
+        rows = np.zeros((max_cells,), dtype=np.int32)
+        n_values = np.zeros((end_col_local - start_col_local,), dtype=np.int32)
 
-                    if self.this_item_weights[item_id] != 0.0:
 
-                        values[sparse_data_pointer] = self.this_item_weights[item_id]
-                        rows[sparse_data_pointer] = item_id
-                        cols[sparse_data_pointer] = item_index
+        start_time = time.time()
+        last_print_time = start_time
 
-                        sparse_data_pointer += 1
+        block_start = start_col_local
 
+        # Compute all similarities, one block of columns at a time in order to print the progress
+        while block_start < end_col_local:
 
-            item_index += 1
+            block_end = min(block_start + print_block_size, end_col_local)
 
+            with nogil:
+                for item_index in prange(block_start, block_end, schedule='dynamic', num_threads=self.num_threads):
+                    self.computeColumn(item_index, item_index - start_col_local, values, rows, n_values)
 
-            if processed_items % print_block_size==0 or processed_items==end_col_local:
+            processed_items += block_end - block_start
+            block_start = block_end
 
-                current_time = time.time()
+            current_time = time.time()
 
-                # Set block size to the number of items necessary in order to print every 300 seconds
-                if current_time - start_time != 0:
-                    items_per_sec = processed_items/(current_time - start_time)
-                else:
-                    items_per_sec = 1
+            # Set block size to the number of items necessary in order to print every 300 seconds
+            if current_time - start_time != 0:
+                items_per_sec = processed_items/(current_time - start_time)
+            else:
+                items_per_sec = 1
 
-                print_block_size = int(items_per_sec*300)
+            print_block_size = max(int(items_per_sec*300), self.num_threads)
 
-                if current_time - last_print_time > 300  or processed_items==end_col_local:
-                    new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
+            if current_time - last_print_time > 300  or block_start==end_col_local:
+                new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
 
-                    print("Similarity column {} ({:4.1f}%), {:.2f} column/sec. Elapsed time {:.2f} {}".format(
-                        processed_items, processed_items*1.0/(end_col_local-start_col_local)*100, items_per_sec, new_time_value, new_time_unit))
+                print("Similarity column {} ({:4.1f}%), {:.2f} column/sec. Elapsed time {:.2f} {}".format(
+                    processed_items, processed_items*1.0/(end_col_local-start_col_local)*100, items_per_sec, new_time_value, new_time_unit))
 
-                    last_print_time = current_time
+                last_print_time = current_time
 
-                    sys.stdout.flush()
-                    sys.stderr.flush()
+                sys.stdout.flush()
+                sys.stderr.flush()
 
         # End while on columns
 
+        # Release the accumulators
+        self.this_item_weights = None
+        self.this_item_weights_id = None
+        self.this_item_weights_mask = None
+
 
         if self.TopK == 0:
 
@@ -600,12 +575,70 @@ cdef class Compute_Similarity_Cython:
 
         else:
 
-            values = np.array(values[0:sparse_data_pointer])
-            rows = np.array(rows[0:sparse_data_pointer])
-            cols = np.array(cols[0:sparse_data_pointer])
+            n_values_np = np.array(n_values, dtype=np.int64)
+            is_valid = np.arange(self.TopK) < n_values_np[:,None]
+
+            values_np = np.array(values).reshape(-1, self.TopK)[is_valid]
+            rows_np = np.array(rows).reshape(-1, self.TopK)[is_valid]
+            cols_np = np.repeat(np.arange(start_col_local, end_col_local, dtype=np.int32), n_values_np)
 
-            W_sparse = sps.csr_matrix((values, (rows, cols)),
+            W_sparse = sps.csr_matrix((values_np, (rows_np, cols_np)),
                                     shape=(self.n_columns, self.n_columns),
                                     dtype=np.float32)
 
             return W_sparse
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void heap_push(double[:] values, int[:] rows, long offset, long heap_size, double value, long row) noexcept nogil:
+    """
+    Add an element to the min-heap stored in values[offset:offset+heap_size], heap_size is the size before the push
+    """
+
+    cdef long position = heap_size, parent
+
+    while position > 0:
+        parent = (position - 1) // 2
+
+        if values[offset + parent] <= value:
+            break
+
+        values[offset + position] = values[offset + parent]
+        rows[offset + position] = rows[offset + parent]
+        position = parent
+
+    values[offset + position] = value
+    rows[offset + position] = row
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void heap_replace_root(double[:] values, int[:] rows, long offset, long heap_size, double value, long row) noexcept nogil:
+    """
+    Replace the smallest element of the min-heap stored in values[offset:offset+heap_size]
+    """
+
+    cdef long position = 0, child
+
+    while True:
+        child = 2*position + 1
+
+        if child >= heap_size:
+            break
+
+        if child + 1 < heap_size and values[offset + child + 1] < values[offset + child]:
+            child += 1
+
+        if values[offset + child] >= value:
+            break
+
+        values[offset + position] = values[offset + child]
+        rows[offset + position] = rows[offset + child]
+        position = child
+
+    values[offset + position] = value
+    rows[offset + position] = row
@@ -18,10 +18,6 @@ from tqdm import tqdm
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-_user_input = None
-_item_input_pos = None
-_batch_size = None
-_index = None
 _model = None
 _sess = None
 _dataset = None
@@ -30,7 +26,6 @@ _feed_dict = None
 _output = None
 
 _eval_feed_dicts = None
-_samples = None
 _max_ndcg = None
 _max_res = None
 
@@ -44,65 +39,23 @@ TEST_KEEP_PROB = 1
 
 # data sampling and shuffling
 
-# input: dataset(Mat, List, Rating, Negatives), batch_choice, num_negatives
-# output: [_user_input_list, _item_input_pos_list]
-def sampling(dataset):
-    _user_input, _item_input_pos = [], []
-    for (u, i) in dataset.trainMatrix.keys():
-        # positive instance
-        _user_input.append(u)
-        _item_input_pos.append(i)
-    return _user_input, _item_input_pos
-
-def shuffle(samples, batch_size, dataset, model):
-    global _user_input
-    global _item_input_pos
-    global _batch_size
-    global _index
-    global _model
-    global _dataset
-    _user_input, _item_input_pos = samples
-    _batch_size = batch_size
-    _index = np.arange(len(_user_input))
-    _model = model
-    _dataset = dataset
-    np.random.shuffle(_index)
-    num_batch = len(_user_input) // _batch_size
-    pool = Pool(cpu_count())
-    res = pool.map(_get_train_batch, range(num_batch))
-    pool.close()
-    pool.join()
-    user_list = [r[0] for r in res]
-    item_pos_list = [r[1] for r in res]
-    user_dns_list = [r[2] for r in res]
-    item_dns_list = [r[3] for r in res]
+def shuffle(batch_size, dataset, model):
+    """
+    Samples the negative items of the epoch with the negative sampler of the dataset and splits the shuffled
+    interactions in batches
+    """
+    user_input, item_input_pos, item_input_neg = dataset.negative_sampler.get_pairwise_epoch(model.dns)
+    index = np.arange(len(user_input))
+    np.random.shuffle(index)
+    num_batch = len(user_input) // batch_size
+    batch_index = index[:num_batch * batch_size].reshape(num_batch, batch_size)
+    # each user is repeated for its model.dns negative items, which are contiguous
+    user_list = list(user_input[batch_index][:,:,None])
+    item_pos_list = list(item_input_pos[batch_index][:,:,None])
+    user_dns_list = list(np.repeat(user_input[batch_index], model.dns, axis=1)[:,:,None])
+    item_dns_list = list(item_input_neg[batch_index].reshape(num_batch, batch_size * model.dns)[:,:,None])
     return user_list, item_pos_list, user_dns_list, item_dns_list
 
-def _get_train_batch(i):
-    global _dataset
-    user_batch, item_batch = [], []
-    user_neg_batch, item_neg_batch = [], []
-    begin = i * _batch_size
-    for idx in range(begin, begin + _batch_size):
-        user_batch.append(_user_input[_index[idx]])
-        item_batch.append(_item_input_pos[_index[idx]])
-        for dns in range(_model.dns):
-            user = _user_input[_index[idx]]
-            user_neg_batch.append(user)
-            # negtive k
-            # add this try except because not all users could have a test item, so in this case the while condition doesnt't fail (Simone Boglio)
-            # try:
-            #     gtItem = _dataset.testRatings[user][1]
-            # except IndexError:
-            #     gtItem = -1
-            j = np.random.randint(_dataset.num_items)
-            # the condition "j == gtItem" could lead to a potential overfitting with large number of epochs (Simone Boglio)
-            while j in _dataset.trainList[_user_input[_index[idx]]]:# or j == gtItem:
-                j = np.random.randint(_dataset.num_items)
-            item_neg_batch.append(j)
-    return np.array(user_batch)[:,None], np.array(item_batch)[:,None], \
-           np.array(user_neg_batch)[:,None], np.array(item_neg_batch)[:,None]
-
 #---------- model definition -------
 
 def weight_variable(shape):
@@ -294,6 +247,8 @@ def dxyeval(sess, model, dataset):
 # training
 def initialize(model, dataset, args, saver = None): # saver is an object to save pq
     global _sess
+    global _model
+    _model = model
     global _ckpt_save_path, _ckpt_save_file ,_saver_ckpt
     _sess= tf.Session()
     # initialized the save op
@@ -316,16 +271,12 @@ def initialize(model, dataset, args, saver = None): # saver is an object to save
 
 
     global _eval_feed_dicts
-    global _samples
     global _max_ndcg
     global _max_res
 
     # initialize for Evaluate
     #####_eval_feed_dicts = init_eval_model(model, dataset)
 
-    # sample the data
-    _samples = sampling(dataset)
-
     #initialize the max_ndcg to memorize the best result
     _max_ndcg = 0
     _max_res = " "
@@ -340,7 +291,7 @@ def run_epoch(model, dataset, epoch_count, args, original_evaluation=False, verb
     if verbose: print("Start epoch: {}".format(epoch_count))
     # initialize for training batches
     batch_begin = time()
-    batches = shuffle(_samples, args.batch_size, dataset, model)
+    batches = shuffle(args.batch_size, dataset, model)
     batch_time = time() - batch_begin
 
     # compute the accuracy before training
@@ -7,9 +7,11 @@ Created on 25/02/19
 """
 
 import numpy as np
+from Base.Negative_Sampler import Negative_Sampler
 import CNN_on_embeddings.IJCAI.ConvNCF_our_interface.ConvNCF as ConvNCF
 from Conferences.IJCAI.ConvNCF_our_interface.MFBPR_Wrapper import MFBPR_Wrapper
 from Base.BaseTempFolder import BaseTempFolder
+from Base.Recommender_utils import compute_item_score_batched
 from Base.DataIO import DataIO
 import os, platform
 
@@ -31,6 +33,8 @@ class DatasetInterface:
             train_list.append(items)
         self.trainList = train_list
 
+        self.negative_sampler = Negative_Sampler(URM_train)
+
         # m_test = URM_test.tocsr()
         # test_list = []
         # for u in range(m_test.shape[0]):
@@ -98,41 +102,18 @@ class ConvNCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Sto
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        if items_to_compute is None:
-            item_indices = self._item_indices
-        else:
-            item_indices = items_to_compute
-
-        item_scores = - np.ones((len(user_id_array), self.n_items)) * np.inf
-
-        item_input = np.array(item_indices)
-        item_input = item_input.reshape((item_input.shape[0], 1))
-
-        for user_index in range(len(user_id_array)):
-
-            user_id = user_id_array[user_index]
+        def predict_pairs(user_input, item_input):
 
-            # predictions = np.array(ConvNCF.compute_score_single_user(user_id, items_to_compute))
-
-            user_input = np.full(item_input.shape[0], user_id)
-            # item_input = item_input.reshape((item_input.shape[0], 1))
-            user_input = user_input.reshape((item_input.shape[0], 1))
-
-            feed_dict = {ConvNCF._model.user_input: user_input,
-                         ConvNCF._model.item_input_pos: item_input,
+            feed_dict = {ConvNCF._model.user_input: user_input[:,None],
+                         ConvNCF._model.item_input_pos: item_input[:,None],
                          ConvNCF._model.keep_prob: ConvNCF.TEST_KEEP_PROB}
 
-            item_score_user = ConvNCF._sess.run(ConvNCF._model.output, feed_dict).flatten()
-
-            # scores = np.ones(self.dataset.num_items) * (-np.inf)
-            # scores[items_to_compute] = predictions
-            # item_scores[user_index, :] = scores.ravel()
-
-            if items_to_compute is not None:
-                item_scores[user_index, item_indices] = item_score_user.ravel()
-            else:
-                item_scores[user_index, :] = item_score_user.ravel()
+            return ConvNCF._sess.run(ConvNCF._model.output, feed_dict)
 
+        # Each pair requires its |embedding_size|x|embedding_size| interaction map, at most as many pairs
+        # as the items are predicted at once
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.n_items, items_to_compute = items_to_compute,
+                                                 max_pairs = self.n_items)
 
         return item_scores
 
@@ -243,6 +224,8 @@ class ConvNCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Sto
                                         algorithm_name=self.RECOMMENDER_NAME,
                                         **earlystopping_kwargs)
 
+        self.dataset.negative_sampler.close()
+
         # close session tensorflow
         ConvNCF.close_session()
 
@@ -7,6 +7,7 @@ Created on 24/02/19
 """
 
 import numpy as np
+from Base.Negative_Sampler import Negative_Sampler
 import Conferences.IJCAI.ConvNCF_our_interface.MF_BPR as MF_BPR
 
 class DatasetInterface:
@@ -24,6 +25,8 @@ class DatasetInterface:
             train_list.append(items)
         self.trainList = train_list
 
+        self.negative_sampler = Negative_Sampler(URM_train)
+
         # m_test = URM_test.tocoo()
         # test_users = np.unique(m_test.row)
         # # original paper sampling avoid to sample item if in test set (but in this way they use the test set as knowledge)
@@ -100,9 +103,6 @@ class MFBPR_Wrapper(BaseMatrixFactorizationRecommender, Incremental_Training_Ear
         self.sess = MF_BPR.tf.Session()
         self.sess.run(MF_BPR.tf.global_variables_initializer())
 
-        # sample the data
-        self.samples = MF_BPR.sampling(self.dataset)
-
 
 
 
@@ -149,6 +149,8 @@ class MFBPR_Wrapper(BaseMatrixFactorizationRecommender, Incremental_Training_Ear
                                         algorithm_name = self.RECOMMENDER_NAME,
                                         **earlystopping_kwargs)
 
+        self.dataset.negative_sampler.close()
+
         self.epochs_best_MFBPR = self.epochs_best
 
         self._print("Training complete")
@@ -159,13 +161,18 @@ class MFBPR_Wrapper(BaseMatrixFactorizationRecommender, Incremental_Training_Ear
 
     def _dealloc_global_variables(self):
 
-        del MF_BPR._user_input
-        del MF_BPR._item_input_pos
-        del MF_BPR._batch_size
-        del MF_BPR._index
-        del MF_BPR._model
         del MF_BPR._sess
-        del MF_BPR._dataset
+
+        # Only set by the evaluation of the original implementation
+        try:
+            del MF_BPR._model
+        except:
+            pass
+
+        try:
+            del MF_BPR._dataset
+        except:
+            pass
 
         try:
             del MF_BPR._K
@@ -206,7 +213,7 @@ class MFBPR_Wrapper(BaseMatrixFactorizationRecommender, Incremental_Training_Ear
     def _run_epoch(self, num_epoch):
 
         # initialize for training batches
-        batches = MF_BPR.shuffle(self.samples, self.args.batch_size, self.dataset, self.model_GMF)  # , args.exclude_gtItem)
+        batches = MF_BPR.shuffle(self.args.batch_size, self.dataset, self.model_GMF)  # , args.exclude_gtItem)
 
         # training the model
         _ = MF_BPR.training_batch(self.model_GMF, self.sess, batches)
@@ -14,10 +14,6 @@ from time import localtime
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-_user_input = None
-_item_input_pos = None
-_batch_size = None
-_index = None
 _model = None
 _sess = None
 _dataset = None
@@ -30,70 +26,23 @@ _user_exclude_validation = set()
 #---------- data preparation -------
 # data sampling and shuffling
 
-# input: dataset(Mat, List, Rating, Negatives), batch_choice
-# output: [_user_input_list, _item_input_pos_list]
-def sampling(dataset):
-    _user_input, _item_input_pos = [], []
-    for (u, i) in dataset.trainMatrix.keys():
-        # positive instance
-        _user_input.append(u)
-        _item_input_pos.append(i)
-    return _user_input, _item_input_pos
-
-def shuffle(samples, batch_size, dataset, model):#, exclude_gtItem=True):
-    global _user_input
-    global _item_input_pos
-    global _batch_size
-    global _index
-    global _model
-    global _dataset
-    # global _exclude_gtItem
-    # _exclude_gtItem = exclude_gtItem
-    _user_input, _item_input_pos = samples
-    _batch_size = batch_size
-    _index = np.array(range(len(_user_input)))
-    _model = model
-    _dataset = dataset
-    np.random.shuffle(_index)
-    num_batch = len(_user_input) // _batch_size
-    pool = Pool(cpu_count())
-    res = pool.map(_get_train_batch, range(num_batch))
-    pool.close()
-    pool.join()
-    user_list = [r[0] for r in res]
-    item_pos_list = [r[1] for r in res]
-    user_dns_list = [r[2] for r in res]
-    item_dns_list = [r[3] for r in res]
+def shuffle(batch_size, dataset, model):
+    """
+    Samples the negative items of the epoch with the negative sampler of the dataset and splits the shuffled
+    interactions in batches
+    """
+    user_input, item_input_pos, item_input_neg = dataset.negative_sampler.get_pairwise_epoch(model.dns)
+    index = np.arange(len(user_input))
+    np.random.shuffle(index)
+    num_batch = len(user_input) // batch_size
+    batch_index = index[:num_batch * batch_size].reshape(num_batch, batch_size)
+    # each user is repeated for its model.dns negative items, which are contiguous
+    user_list = list(user_input[batch_index][:,:,None])
+    item_pos_list = list(item_input_pos[batch_index][:,:,None])
+    user_dns_list = list(np.repeat(user_input[batch_index], model.dns, axis=1)[:,:,None])
+    item_dns_list = list(item_input_neg[batch_index].reshape(num_batch, batch_size * model.dns)[:,:,None])
     return user_list, item_pos_list, user_dns_list, item_dns_list
 
-def _get_train_batch(i):
-    user_batch, item_batch = [], []
-    user_neg_batch, item_neg_batch = [], []
-    begin = i * _batch_size
-    for idx in range(begin, begin + _batch_size):
-        user_batch.append(_user_input[_index[idx]])
-        item_batch.append(_item_input_pos[_index[idx]])
-        for dns in range(_model.dns):
-            user = _user_input[_index[idx]]
-            user_neg_batch.append(user)
-            # negtive k
-            # if _exclude_gtItem:
-            #     try:
-            #         gtItem = _dataset.testRatings[user][1]
-            #     except IndexError:  # User does not have item in test set
-            #         gtItem = -1
-            # else:
-            #     # trick to avoid original paper overfitting
-            #     gtItem = -1
-            #
-            # Never check whether a train negative item is also in test
-            j = np.random.randint(_dataset.num_items)
-            while j in _dataset.trainList[_user_input[_index[idx]]]:# or j == gtItem:
-                j = np.random.randint(_dataset.num_items)
-            item_neg_batch.append(j)
-    return np.array(user_batch)[:,None], np.array(item_batch)[:,None], \
-           np.array(user_neg_batch)[:,None], np.array(item_neg_batch)[:,None]
-
 #---------- model definition -------
 class GMF:
     def __init__(self, num_users, num_items, args):
@@ -200,9 +149,6 @@ def training(model, dataset, args, saver = None): # saver is an object to save p
         # initialize for Evaluate
         eval_feed_dicts = init_eval_model(model, dataset)
 
-        # sample the data
-        samples = sampling(dataset)
-
         #initialize the max_ndcg to memorize the best result
         max_ndcg = 0
         max_res = " "
@@ -212,7 +158,7 @@ def training(model, dataset, args, saver = None): # saver is an object to save p
 
             # initialize for training batches
             batch_begin = time()
-            batches = shuffle(samples, args.batch_size, dataset, model)#, args.exclude_gtItem)
+            batches = shuffle(args.batch_size, dataset, model)#, args.exclude_gtItem)
             batch_time = time() - batch_begin
 
             # compute the accuracy before training
@@ -21,6 +21,7 @@ from Conferences.IJCAI.CoupledCF_our_interface import mainMovieUserCnn
 from Conferences.IJCAI.CoupledCF_our_interface import mainTafengUserCnn
 from Conferences.IJCAI.CoupledCF_our_interface.mainMovieUserCnn import get_train_instances
 from Base.BaseTempFolder import BaseTempFolder
+from Base.Recommender_utils import compute_item_score_batched
 
 class CoupledCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopping, BaseTempFolder):
 
@@ -53,46 +54,23 @@ class CoupledCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_S
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        if items_to_compute is None:
-            item_indices = self._item_indices
-        else:
-            item_indices = items_to_compute
-
-        item_scores = - np.ones((len(user_id_array), self.n_items)) * np.inf
-
-
-        for user_index in range(len(user_id_array)):
-
-            items = items_to_compute
-            user_id = user_id_array[user_index]
-
-            user_attr_input, user_id_input, item_id_input, item_attr_input = [], [], [], []
-
-            for i in range(len(items)):
-                item_id = items[i]
-                user_attr_input.append(self.users_attr_mat[user_id])
-                user_id_input.append([user_id])
-                item_id_input.append([item_id])
-                item_attr_input.append(self.items_attr_mat[item_id])
+        def predict_pairs(user_input, item_input):
 
-            user_attr_input_mat = np.array(user_attr_input)
-            user_id_input_mat = np.array(user_id_input)
-            item_id_input_mat = np.array(item_id_input)
-            item_attr_input_mat = np.array(item_attr_input)
+            # The attribute inputs of the pairs are rows of the user and item attribute matrices
+            user_attr_input_mat = self.users_attr_mat[user_input]
+            item_attr_input_mat = self.items_attr_mat[item_input]
+            user_id_input_mat = user_input[:,None]
+            item_id_input_mat = item_input[:,None]
 
             if self.dataset_name != 'Tafeng': # all model with one icm
-                item_score_user = self.model.predict([user_attr_input_mat, item_attr_input_mat, user_id_input_mat, item_id_input_mat], batch_size=100, verbose=0)
+                return self.model.predict([user_attr_input_mat, item_attr_input_mat, user_id_input_mat, item_id_input_mat], batch_size=1000, verbose=0)
             else: #tafeng model has different structure
                 item_sub_class = item_attr_input_mat[:, 0]
                 item_asset_price = item_attr_input_mat[:, 1:]
-                item_score_user = self.model.predict([user_attr_input_mat, item_sub_class, item_asset_price, user_id_input_mat, item_id_input_mat],batch_size=100, verbose=0)
+                return self.model.predict([user_attr_input_mat, item_sub_class, item_asset_price, user_id_input_mat, item_id_input_mat],batch_size=1000, verbose=0)
 
-            item_score_user = np.array(item_score_user).ravel()
 
-            if items_to_compute is not None:
-                item_scores[user_index, item_indices] = item_score_user.ravel()
-            else:
-                item_scores[user_index, :] = item_score_user.ravel()
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.n_items, items_to_compute = items_to_compute)
 
         return item_scores
 
@@ -10,6 +10,7 @@ Created on 17/03/19
 from Base.BaseRecommender import BaseRecommender
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
 from Base.BaseTempFolder import BaseTempFolder
+from Base.Recommender_utils import compute_item_score_batched
 
 import time
 from Base.DataIO import DataIO
@@ -46,36 +47,9 @@ class DeepCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stop
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        if items_to_compute is None:
-            item_indices = self._item_indices
-        else:
-            item_indices = items_to_compute
-
-        item_scores = - np.ones((len(user_id_array), self.n_items)) * np.inf
-
-
-        for user_index in range(len(user_id_array)):
-
-            # items = items_to_compute
-            user_id = user_id_array[user_index]
-
-            # user_id_input, item_id_input = [], []
-            #
-            # for i in range(len(items)):
-            #     item_id = items[i]
-            #     user_id_input.append([user_id])
-            #     item_id_input.append([item_id])
-
-            user_id_input = np.ones(len(item_indices))*user_id
-            # item_id_input = np.array(item_id_input)
-
-            item_score_user = self.model.predict([user_id_input, item_indices], batch_size=100, verbose=0)
-            item_score_user = np.array(item_score_user).ravel()
+        predict_pairs = lambda user_input, item_input: self.model.predict([user_input, item_input], batch_size=10000, verbose=0)
 
-            if items_to_compute is not None:
-                item_scores[user_index, item_indices] = item_score_user.ravel()
-            else:
-                item_scores[user_index, :] = item_score_user.ravel()
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.n_items, items_to_compute = items_to_compute)
 
         return item_scores
 
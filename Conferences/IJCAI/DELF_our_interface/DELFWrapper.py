@@ -10,6 +10,8 @@ from Base.BaseRecommender import BaseRecommender
 from Base.BaseTempFolder import BaseTempFolder
 from Base.DataIO import DataIO
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
+from Base.Negative_Sampler import Negative_Sampler
+from Base.Recommender_utils import compute_item_score_batched
 
 import tensorflow as tf
 import numpy as np
@@ -27,7 +29,8 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
     def __init__(self, URM_train, model_type='MLP'):
         super(_DELF_RecommenderWrapper, self).__init__(URM_train)
 
-        self.train = sps.dok_matrix(self.URM_train, dtype=np.float32)
+        self.train = sps.csr_matrix(self.URM_train, dtype=np.float32)
+        self._negative_sampler = Negative_Sampler(self.URM_train)
 
         self.num_users = int(self.train.shape[0])
         self.num_items = int(self.train.shape[1])
@@ -45,28 +48,16 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        if items_to_compute is None:
-            item_indices = self._item_indices
-        else:
-            item_indices = items_to_compute
+        def predict_pairs(user_input, item_input):
 
-        n_items = len(item_indices)
-        n_users_batch = len(user_id_array)
-        item_scores = - np.ones((n_users_batch, self.num_items), dtype=np.float32)*np.inf
+            return self.sess.run(self.model.predict, feed_dict={self.input_user: user_input[:,None],
+                                                                self.input_item: item_input[:,None],
+                                                                self.rating_matrix: self.train_arr})
 
-        for user_index in range(n_users_batch):
-            u_i = user_id_array[user_index]
-
-            users = np.full(n_items, u_i, dtype='int32')
-
-
-            predictions = self.sess.run(self.model.predict, feed_dict={self.input_user: np.expand_dims(users, axis=1).astype(int32),
-                                                                       self.input_item: np.expand_dims(item_indices, axis=1).astype(int32),
-                                                                       self.rating_matrix: self.train_arr})
-            # predictions = np.array(predictions).reshape((-1))
-            # scores = np.ones(self.n_items) * (-np.inf)
-            # scores[items_to_compute] = predictions
-            item_scores[user_index, items_to_compute] = np.array(predictions).ravel()
+        # Each pair gathers its user row and item column of the rating matrix, at most as many pairs
+        # as the items are predicted at once
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.num_items, items_to_compute = items_to_compute,
+                                                 max_pairs = self.num_items)
 
         return item_scores
 
@@ -107,9 +98,7 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
         self.output = tf.placeholder(tf.float32, [None, 1])
         self.rating_matrix = tf.placeholder(tf.float32, shape=(self.num_users, self.num_items))
 
-        user_input, item_input, labels = get_train_instances(self.train, self.num_negatives)
-
-        self.batch_len = len(user_input) // self.batch_size
+        self.batch_len = self._negative_sampler.get_n_pointwise_instances(self.num_negatives) // self.batch_size
 
         self.model = NMF.Model(self.input_user, self.input_item, self.output, self.num_users, self.num_items, self.rating_matrix, self.layers, self.batch_len)
         tf.summary.histogram("input_user", self.input_user)
@@ -134,6 +123,8 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
         self._train_with_early_stopping(epochs_max=self.epochs, algorithm_name=self.RECOMMENDER_NAME,
                                         **earlystopping_kwargs)
 
+        self._negative_sampler.close()
+
         # close session tensorflow
         self.sess.close()
         self.sess = tf.Session()
@@ -155,8 +146,9 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
 
         if self.verbose: print("Generate training instances epoch: {}".format(currentEpoch))
         # Generate training instances
-        user_input, item_input, labels = get_train_instances(self.train, self.num_negatives)
-        user_input, item_input, labels = unison_shuffled_copies(np.asarray(user_input), np.asarray(item_input), np.asarray(labels))
+        user_input, item_input, labels = self._negative_sampler.get_pointwise_epoch(self.num_negatives,
+                                                                                    prefetch_next = currentEpoch < self.epochs - 1)
+        user_input, item_input, labels = unison_shuffled_copies(user_input, item_input, labels)
 
         if self.verbose: print("Begin training epoch: {}".format(currentEpoch))
         batch_len = len(user_input) // self.batch_size
@@ -226,9 +218,7 @@ class _DELF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
         self.output = tf.placeholder(tf.float32, [None, 1])
         self.rating_matrix = tf.placeholder(tf.float32, shape=(self.num_users, self.num_items))
 
-        user_input, item_input, labels = get_train_instances(self.train, self.num_negatives)
-
-        self.batch_len = len(user_input) // self.batch_size
+        self.batch_len = self._negative_sampler.get_n_pointwise_instances(self.num_negatives) // self.batch_size
         NMFs = {"EF": NMF_attention_EF, 'MLP': NMF_attention_MLP}
         NMF = NMFs[self.model_type]
 
@@ -267,26 +257,6 @@ class DELF_EF_RecommenderWrapper(_DELF_RecommenderWrapper):
 
 
 
-def get_train_instances(train, num_negatives):
-    user_input, item_input, labels = [], [], []
-    num_users = train.shape[0]
-    num_items = train.shape[1]
-    for (u, i) in train.keys():
-        # positive instance
-        user_input.append(u)
-        item_input.append(i)
-        labels.append(1)
-        # negative instances
-        for t in range(num_negatives):
-            j = np.random.randint(num_items)
-            while (u, j) in train: # python3
-                j = np.random.randint(num_items)
-            user_input.append(u)
-            item_input.append(j)
-            labels.append(0)
-    return user_input, item_input, labels
-
-
 def unison_shuffled_copies(a, b, c):
     assert len(a) == len(b)
     assert len(a) == len(c)
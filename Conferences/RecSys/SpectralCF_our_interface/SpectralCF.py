@@ -1,12 +1,15 @@
 import tensorflow as tf
 import numpy as np
+import scipy.sparse as sps
+from scipy.sparse.linalg import eigsh
 import time
 from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
 
 class SpectralCF(object):
-    def __init__(self, K, graph, n_users, n_items, emb_dim, lr, batch_size, decay):
+    def __init__(self, K, graph, n_users, n_items, emb_dim, lr, batch_size, decay, n_eigenpairs = None):
         self.model_name = 'GraphCF with eigen decomposition'
         self.graph = graph
+        self.n_eigenpairs = n_eigenpairs
         self.n_users = n_users
         self.n_items = n_items
         self.emb_dim = emb_dim
@@ -19,7 +22,16 @@ class SpectralCF(object):
 
         start_time = time.time()
 
-        if lamda is None or U is None:
+        if (lamda is None or U is None) and self.n_eigenpairs is not None:
+
+            print("SpectralCF: Computing {} eigenvalues of the sparse laplacian_matrix...".format(self.n_eigenpairs))
+            self.lamda, self.U = self._sparse_laplacian_eigenpairs(self.n_eigenpairs)
+            self.lamda = np.diag(self.lamda)
+
+            new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
+            print("SpectralCF: Initialization complete in {:.2f} {}".format(new_time_value, new_time_unit))
+
+        elif lamda is None or U is None:
 
             print("SpectralCF: Computing adjacient_matrix...")
             self.A = self._adjacient_matrix(self_connection=True)
@@ -69,15 +81,24 @@ class SpectralCF(object):
             )
 
 
-        A_hat = np.dot(self.U, self.U.T) + np.dot(np.dot(self.U, self.lamda), self.U.T)
-        #A_hat += np.dot(np.dot(self.U, self.lamda_2), self.U.T)
-        A_hat = A_hat.astype(np.float32)
+        if self.U.shape[1] < self.U.shape[0]:
+            # With a truncated spectrum A_hat = U*(I + lamda)*U^T has low rank and is applied as
+            # U*((I + lamda)*(U^T*embeddings)), without building the dense |n_nodes|x|n_nodes| matrix
+            U = self.U.astype(np.float32)
+            filter_weight = (1 + np.diag(self.lamda)).astype(np.float32)[:,None]
+            A_hat_dot = lambda embeddings: tf.matmul(U, filter_weight * tf.matmul(U, embeddings, transpose_a=True))
+
+        else:
+            A_hat = np.dot(self.U, self.U.T) + np.dot(np.dot(self.U, self.lamda), self.U.T)
+            #A_hat += np.dot(np.dot(self.U, self.lamda_2), self.U.T)
+            A_hat = A_hat.astype(np.float32)
+            A_hat_dot = lambda embeddings: tf.matmul(A_hat, embeddings)
 
         embeddings = tf.concat([self.user_embeddings, self.item_embeddings], axis=0)
         all_embeddings = [embeddings]
         for k in range(0, self.K):
 
-            embeddings = tf.matmul(A_hat, embeddings)
+            embeddings = A_hat_dot(embeddings)
 
             #filters = self.filters[k]#tf.squeeze(tf.gather(self.filters, k))
             embeddings = tf.nn.sigmoid(tf.matmul(embeddings, self.filters[k]))
@@ -115,9 +136,10 @@ class SpectralCF(object):
 
 
     def _adjacient_matrix(self, self_connection=False):
+        graph = self.graph.toarray() if sps.issparse(self.graph) else self.graph
         A = np.zeros([self.n_users+self.n_items, self.n_users+self.n_items], dtype=np.float32)
-        A[:self.n_users, self.n_users:] = self.graph
-        A[self.n_users:, :self.n_users] = self.graph.T
+        A[:self.n_users, self.n_users:] = graph
+        A[self.n_users:, :self.n_users] = graph.T
         if self_connection == True:
             return np.identity(self.n_users+self.n_items,dtype=np.float32) + A
         return A
@@ -138,6 +160,33 @@ class SpectralCF(object):
 
 
 
+    def _sparse_laplacian_eigenpairs(self, n_eigenpairs):
+        """
+        Computes the n_eigenpairs largest eigenvalues, and their eigenvectors, of the same normalized laplacian
+        L = I - D^-1*A of _laplacian_matrix, built as a sparse matrix.
+        L is not symmetric but it is similar to the symmetric L_sym = I - D^-1/2*A*D^-1/2, whose eigenpairs are
+        computed with Lanczos. If v is an eigenvector of L_sym then D^-1/2*v is an eigenvector of L
+        with the same eigenvalue, it is normalized to unit length as np.linalg.eig does.
+        The largest eigenvalues have the largest weight 1 + lamda in A_hat
+        :param n_eigenpairs:
+        :return: lamda, U
+        """
+
+        n_nodes = self.n_users + self.n_items
+        n_eigenpairs = min(n_eigenpairs, n_nodes - 1)
+
+        graph = sps.csr_matrix(self.graph, dtype=np.float64)
+
+        A = sps.bmat([[None, graph], [graph.T, None]], format="csr") + sps.identity(n_nodes, format="csr")
+        degree = np.asarray(A.sum(axis=1)).ravel()
+
+        D_inv_sqrt = sps.diags(np.power(degree, -0.5))
+        L_sym = sps.identity(n_nodes, format="csr") - D_inv_sqrt.dot(A).dot(D_inv_sqrt)
+
+        lamda, V = eigsh(L_sym, k=n_eigenpairs, which="LA")
 
+        U = D_inv_sqrt.dot(V)
+        U /= np.linalg.norm(U, axis=0, keepdims=True)
 
+        return lamda, U
 
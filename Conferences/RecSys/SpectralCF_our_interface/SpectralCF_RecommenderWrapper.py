@@ -11,6 +11,7 @@ from Base.BaseRecommender import BaseRecommender
 from Base.BaseTempFolder import BaseTempFolder
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
 from Base.DataIO import DataIO
+from Base.Recommender_utils import get_sparse_matrix_fingerprint
 
 import numpy as np
 import scipy.sparse as sps
@@ -95,6 +96,10 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
 
         self._train = sps.dok_matrix(self.URM_train)
 
+        self.n_eigenpairs = None
+        self.eigenpairs_folder_path = None
+        self._eigenpairs_dict = {}
+
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
@@ -147,9 +152,18 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
             decay = 0.001,
             k = 3,
             learning_rate = 1e-3,
+            n_eigenpairs = None,
+            eigenpairs_folder_path = None,
             temp_file_folder = None,
             **earlystopping_kwargs
             ):
+        """
+        :param n_eigenpairs:            if None the convolution uses the full spectrum of the laplacian, computed on the
+                                        dense matrix. Otherwise only the n_eigenpairs largest eigenpairs are computed on the
+                                        sparse laplacian, which approximates the convolution but scales to large graphs
+        :param eigenpairs_folder_path:  if provided the eigenpairs are saved in this folder and reused by any model
+                                        trained on the same URM_train
+        """
 
 
         self.temp_file_folder = self._get_unique_temp_folder(input_temp_file_folder=temp_file_folder)
@@ -160,6 +174,8 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
         self.learning_rate = learning_rate
         self.decay = decay
         self.batch_size = batch_size
+        self.n_eigenpairs = n_eigenpairs
+        self.eigenpairs_folder_path = eigenpairs_folder_path
 
 
 
@@ -170,19 +186,17 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
         self.data_generator = Data(self.URM_train, batch_size=self.batch_size)
 
         self.model = SpectralCF(K=self.k,
-                           graph = self.URM_train.toarray(),
+                           graph = self.URM_train,
                            n_users = self.n_users,
                            n_items = self.n_items,
                            emb_dim = self.embedding_size,
                            lr = self.learning_rate,
                            decay = self.decay,
-                           batch_size = self.batch_size)
-
-        self.model.compute_eigenvalues()
+                           batch_size = self.batch_size,
+                           n_eigenpairs = self.n_eigenpairs)
 
         # Keep it to avoid recomputing every time the model is loaded
-        # self.model_lamda = self.model.lamda.copy()
-        # self.model_U = self.model.U
+        self._compute_eigenvalues()
 
         self.model.build_graph()
 
@@ -219,6 +233,38 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
 
 
 
+    def _compute_eigenvalues(self):
+        """
+        The eigenpairs only depend on URM_train and n_eigenpairs, they are computed once and reused every time the model
+        is loaded. If eigenpairs_folder_path is provided they are also saved to disk using the fingerprint of URM_train as key
+        """
+
+        file_name = "SpectralCF_eigenpairs_{}_{}".format(get_sparse_matrix_fingerprint(self.URM_train),
+                                                         "all" if self.n_eigenpairs is None else self.n_eigenpairs)
+
+        if file_name in self._eigenpairs_dict:
+            eigenpairs = self._eigenpairs_dict[file_name]
+
+        elif self.eigenpairs_folder_path is not None and os.path.isfile(self.eigenpairs_folder_path + file_name + ".zip"):
+            self._print("Loading eigenvalues from file '{}'".format(self.eigenpairs_folder_path + file_name))
+            eigenpairs = DataIO(folder_path = self.eigenpairs_folder_path).load_data(file_name)
+
+        else:
+            self.model.compute_eigenvalues()
+            eigenpairs = {"lamda": self.model.lamda, "U": self.model.U}
+
+            if self.eigenpairs_folder_path is not None:
+                # Save with a process-specific name and then rename, so that other processes never read a partial archive
+                temp_file_name = "{}_{}".format(file_name, os.getpid())
+                DataIO(folder_path = self.eigenpairs_folder_path).save_data(temp_file_name, eigenpairs, compress = False)
+                os.replace(self.eigenpairs_folder_path + temp_file_name + ".zip", self.eigenpairs_folder_path + file_name + ".zip")
+
+        self._eigenpairs_dict[file_name] = eigenpairs
+
+        self.model.compute_eigenvalues(lamda = eigenpairs["lamda"], U = eigenpairs["U"])
+
+
+
     def _prepare_model_for_validation(self):
         pass
 
@@ -275,6 +321,7 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
                               "learning_rate": self.learning_rate,
                               "decay": self.decay,
                               "batch_size": self.batch_size,
+                              "n_eigenpairs": self.n_eigenpairs,
                               # "model_lamda": self.model_lamda,
                               # "model_U": self.model_U,
                               }
@@ -311,15 +358,16 @@ class SpectralCF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_
         self.data_generator = Data(self.URM_train, batch_size=self.batch_size)
 
         self.model = SpectralCF(K=self.k,
-                           graph = self.URM_train.toarray(),
+                           graph = self.URM_train,
                            n_users = self.n_users,
                            n_items = self.n_items,
                            emb_dim = self.embedding_size,
                            lr = self.learning_rate,
                            decay = self.decay,
-                           batch_size = self.batch_size)
+                           batch_size = self.batch_size,
+                           n_eigenpairs = self.n_eigenpairs)
 
-        self.model.compute_eigenvalues()
+        self._compute_eigenvalues()
         self.model.build_graph()
 
 
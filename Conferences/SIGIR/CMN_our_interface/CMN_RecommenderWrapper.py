@@ -11,6 +11,7 @@ from Base.BaseRecommender import BaseRecommender
 from Base.BaseTempFolder import BaseTempFolder
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
 from Base.DataIO import DataIO
+from Base.Recommender_utils import compute_item_score_batched
 
 import numpy as np
 import scipy.sparse as sps
@@ -143,65 +144,67 @@ class CMN_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stoppin
 
         self.URM_train = sps.csr_matrix(self.URM_train)
 
+        self._item_neighborhoods = None
 
 
 
-    def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        if items_to_compute is None:
-            item_indices = self._item_indices
-        else:
-            item_indices = items_to_compute
+    def _get_item_neighborhoods(self):
+        """
+        The neighborhood of an item is the list of its users, truncated to max_neighbors.
+        The neighborhoods of all items only depend on URM_train and are built once per model
+        :return: neighborhoods |n_items|x|max_neighbors| and their length, which is 0 for items with no users
+        """
 
-        item_scores = - np.ones((len(user_id_array), self.n_items)) * np.inf
+        max_neighbors = self.cmn_config.max_neighbors
 
-        input_user_handle = self.model.input_users
-        input_item_handle = self.model.input_items
-        neighborhood = self.item_users_list
-        input_neighborhood_handle = self.model.input_neighborhoods
-        input_neighborhood_length_handle = self.model.input_neighborhood_lengths
-        score_op = self.model.score
+        if self._item_neighborhoods is None or self._item_neighborhoods.shape[1] != max_neighbors:
 
+            # The users of each item are sorted as in item_users_list
+            URM_train_csc = sps.csc_matrix(self.URM_train)
+            URM_train_csc.sort_indices()
 
-        for user_index in range(len(user_id_array)):
+            neighborhood_length = np.minimum(np.ediff1d(URM_train_csc.indptr), max_neighbors).astype(np.int32)
 
-            user_id = user_id_array[user_index]
+            entry_item = np.repeat(np.arange(self.n_items), neighborhood_length)
+            entry_position = np.arange(neighborhood_length.sum()) - np.repeat(np.cumsum(neighborhood_length) - neighborhood_length, neighborhood_length)
 
-            # The prediction requires a list of two arrays user_id, item_id of equal length
-            # To compute the recommendations for a single user, we must provide its intex as many times as the
-            # number of items
+            neighborhoods = np.zeros((self.n_items, max_neighbors), dtype=np.int32)
+            neighborhoods[entry_item, entry_position] = URM_train_csc.indices[URM_train_csc.indptr[entry_item] + entry_position]
 
-            feed = {
-                #input_user_handle: self._user_ones_vector*user_id,
-                input_user_handle: np.ones(len(item_indices)) * user_id,
-                input_item_handle: item_indices,
-            }
+            self._item_neighborhoods = neighborhoods
+            self._item_neighborhood_length = neighborhood_length
 
-            if neighborhood is not None:
-                # neighborhoods, neighborhood_length = np.zeros((self.n_items, self.cmn_config.max_neighbors),
-                #                                               dtype=np.int32), np.ones(self.n_items, dtype=np.int32)
-                neighborhoods, neighborhood_length = np.zeros((len(item_indices), self.cmn_config.max_neighbors),
-                                                              dtype=np.int32), np.ones(len(item_indices), dtype=np.int32)
-
-                for _idx, item in enumerate(item_indices):
-                    _len = min(len(neighborhood[item]), self.cmn_config.max_neighbors)
-                    if _len > 0:
-                        neighborhoods[_idx, :_len] = neighborhood[item][:_len]
-                        neighborhood_length[_idx] = _len
-                    else:
-                        neighborhoods[_idx, :1] = user_id
-                feed.update({
-                    input_neighborhood_handle: neighborhoods,
-                    input_neighborhood_length_handle: neighborhood_length
-                })
+        return self._item_neighborhoods, self._item_neighborhood_length
 
 
-            item_score_user = self.sess.run(score_op, feed)
 
-            if items_to_compute is not None:
-                item_scores[user_index, item_indices] = item_score_user.ravel()
-            else:
-                item_scores[user_index, :] = item_score_user.ravel()
+    def _compute_item_score(self, user_id_array, items_to_compute=None):
+
+        item_neighborhoods, item_neighborhood_length = self._get_item_neighborhoods()
+
+        def predict_pairs(user_input, item_input):
+
+            neighborhoods = item_neighborhoods[item_input]
+            neighborhood_length = item_neighborhood_length[item_input]
+
+            # Items with no users have as neighborhood the user itself
+            no_neighbors_mask = neighborhood_length == 0
+            neighborhoods[no_neighbors_mask, 0] = user_input[no_neighbors_mask]
+            neighborhood_length[no_neighbors_mask] = 1
+
+            feed = {
+                self.model.input_users: user_input,
+                self.model.input_items: item_input,
+                self.model.input_neighborhoods: neighborhoods,
+                self.model.input_neighborhood_lengths: neighborhood_length,
+            }
+
+            return self.sess.run(self.model.score, feed)
+
+        # Each pair requires its |max_neighbors| neighborhood, at most as many pairs as the items are predicted at once
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.n_items, items_to_compute = items_to_compute,
+                                                 max_pairs = self.n_items)
 
         return item_scores
 
@@ -108,6 +108,47 @@ class MF_cold_user_wrapper(BaseMatrixFactorizationRecommender):
 
 
 
+    def _compute_candidate_item_score(self, user_id_array, item_id_array):
+        """
+        Compute the candidate scores with the MF algorithm, the couples of cold users are scored with the ItemKNN model
+        as _compute_item_score does
+        :param user_id_array:
+        :param item_id_array:
+        :return:
+        """
+
+        item_scores = super(MF_cold_user_wrapper, self)._compute_candidate_item_score(user_id_array, item_id_array)
+
+        if self._cold_user_KNN_model_flag and not self._cold_user_KNN_estimated_factors_flag:
+
+            # Couples of users cold for MF but warm in KNN model
+            cold_users_in_MF_warm_in_KNN_mask = np.logical_and(self._get_cold_user_mask()[user_id_array], self._warm_user_KNN_mask[user_id_array])
+
+            if cold_users_in_MF_warm_in_KNN_mask.any():
+                item_scores[cold_users_in_MF_warm_in_KNN_mask] = self._ItemKNNRecommender.compute_candidate_item_score(user_id_array[cold_users_in_MF_warm_in_KNN_mask],
+                                                                                                                       item_id_array[cold_users_in_MF_warm_in_KNN_mask])
+
+        return item_scores
+
+
+
+    def build_item_index(self, *posargs, **kwargs):
+        raise NotImplementedError("{}: Approximate index mode not supported, the item index cannot rank the cold users scored by the ItemKNN model".format(self.RECOMMENDER_NAME))
+
+
+    def set_approximate_index_mode(self, approximate_index_flag = True, n_probe = None):
+
+        if approximate_index_flag:
+            raise NotImplementedError("{}: Approximate index mode not supported, the item index cannot rank the cold users scored by the ItemKNN model".format(self.RECOMMENDER_NAME))
+
+        self.approximate_index_flag = False
+
+
+    def _get_item_index(self):
+        raise NotImplementedError("{}: Approximate index mode not supported, the item index cannot rank the cold users scored by the ItemKNN model".format(self.RECOMMENDER_NAME))
+
+
+
     def set_URM_train(self, URM_train_new):
         """
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from MatrixFactorization.PureSVDRecommender import PureSVDRecommender
+from Conferences.WWW.MultiVAE_our_interface.EvaluatorUserSubsetWrapper import MF_cold_user_wrapper
+
+
+
+class MyTestCase(unittest.TestCase):
+
+
+    def test_MF_cold_user_wrapper_candidate_scores(self):
+
+        n_users = 100
+        n_items = 80
+        n_cold_users = 20
+
+        URM_all = sps.random(n_users, n_items, density=0.2, format='csr', random_state=np.random.RandomState(0))
+        URM_all.data = np.ones_like(URM_all.data)
+
+        # The last users are cold in the train data and warm in the data given to set_URM_train
+        URM_train = URM_all.copy().tolil()
+        URM_train[n_users - n_cold_users:, :] = 0
+        URM_train = sps.csr_matrix(URM_train)
+        URM_train.eliminate_zeros()
+
+        recommender = MF_cold_user_wrapper(PureSVDRecommender, URM_train, verbose = False)
+        recommender.fit(num_factors = 10, estimate_model_for_cold_users = "itemKNN", estimate_model_for_cold_users_topK = 20)
+        recommender.set_URM_train(URM_all)
+
+        user_id_array = np.arange(n_users)
+        item_scores = recommender._compute_item_score(user_id_array)
+
+        candidate_URM = sps.random(n_users, n_items, density=0.3, format='csr', random_state=np.random.RandomState(1))
+        candidate_scores = recommender.compute_candidate_item_score(user_id_array, candidate_URM)
+
+        candidate_user = np.repeat(user_id_array, np.ediff1d(candidate_URM.indptr))
+
+        # Cold users must be scored with the ItemKNN model in both cases
+        assert np.any(candidate_scores[candidate_user >= n_users - n_cold_users] != 0.0)
+        assert np.allclose(candidate_scores, item_scores[candidate_user, candidate_URM.indices], atol=1e-5)
+
+        with self.assertRaises(NotImplementedError):
+            recommender.set_approximate_index_mode(True)
+
+        with self.assertRaises(NotImplementedError):
+            recommender.build_item_index()
+
+        with self.assertRaises(NotImplementedError):
+            recommender.evaluate_item_index_recall(cutoff = 5)
+
+        recommender.set_approximate_index_mode(False)
+        self.assertEqual(len(recommender.recommend(n_users - 1, cutoff = 5)), 5)
+
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
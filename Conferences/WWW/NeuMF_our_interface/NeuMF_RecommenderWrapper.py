@@ -9,6 +9,8 @@ Created on 18/12/18
 
 from Base.BaseRecommender import BaseRecommender
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
+from Base.Negative_Sampler import Negative_Sampler
+from Base.Recommender_utils import compute_item_score_batched
 
 
 import numpy as np
@@ -152,26 +154,6 @@ def load_pretrain_model(model, gmf_model, mlp_model, num_layers):
     return model
 
 
-def get_train_instances(train, num_negatives, num_items):
-    user_input, item_input, labels = [],[],[]
-    num_users = train.shape[0]
-    for (u, i) in train.keys():
-        # positive instance
-        user_input.append(u)
-        item_input.append(i)
-        labels.append(1)
-        # negative instances
-        for t in range(num_negatives):
-            j = np.random.randint(num_items)
-            while (u, j) in train.keys():#train.has_key((u, j)):
-                j = np.random.randint(num_items)
-            user_input.append(u)
-            item_input.append(j)
-            labels.append(0)
-    return user_input, item_input, labels
-
-
-
 def set_learner(model, learning_rate, learner):
 
     if learner.lower() == "adagrad":
@@ -203,7 +185,7 @@ class NeuMF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
     def __init__(self, URM_train):
         super(NeuMF_RecommenderWrapper, self).__init__(URM_train)
 
-        self._train = sps.dok_matrix(self.URM_train)
+        self._negative_sampler = Negative_Sampler(self.URM_train)
         self.n_users, self.n_items = self.URM_train.shape
 
         self._item_indices = np.arange(0, self.n_items, dtype=int)
@@ -212,24 +194,11 @@ class NeuMF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
 
     def _compute_item_score(self, user_id_array, items_to_compute=None):
 
-        item_scores = - np.ones((len(user_id_array), self.n_items)) * np.inf
-
-        for user_index in range(len(user_id_array)):
-
-            user_id = user_id_array[user_index]
-
-            # The prediction requires a list of two arrays user_id, item_id of equal length
-            # To compute the recommendations for a single user, we must provide its index as many times as the
-            # number of items
-            item_score_user = self.model.predict([self._user_ones_vector*user_id, self._item_indices],
-                                                 batch_size=100, verbose=0)
-
-
-            if items_to_compute is not None:
-                item_scores[user_index, items_to_compute] = item_score_user.ravel()[items_to_compute]
-            else:
-                item_scores[user_index, :] = item_score_user.ravel()
+        # The prediction requires a list of two arrays user_id, item_id of equal length
+        # the pairs of a block of users are predicted at once
+        predict_pairs = lambda user_input, item_input: self.model.predict([user_input, item_input], batch_size=10000, verbose=0)
 
+        item_scores = compute_item_score_batched(predict_pairs, user_id_array, self.n_items, items_to_compute = items_to_compute)
 
         return item_scores
 
@@ -377,6 +346,7 @@ class NeuMF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
                                         algorithm_name = self.RECOMMENDER_NAME,
                                         **earlystopping_kwargs)
 
+        self._negative_sampler.close()
 
         self._print("Training complete")
 
@@ -397,12 +367,11 @@ class NeuMF_RecommenderWrapper(BaseRecommender, Incremental_Training_Early_Stopp
     def _run_epoch(self, currentEpoch):
 
         # Generate training instances
-        user_input, item_input, labels = get_train_instances(self._train, self.num_negatives, self.n_items)
+        user_input, item_input, labels = self._negative_sampler.get_pointwise_epoch(self.num_negatives)
 
         # Training
-        hist = self.model.fit([np.array(user_input).astype(int32),
-                               np.array(item_input).astype(int32)], #input
-                         np.array(labels).astype(int32), # labels
+        hist = self.model.fit([user_input, item_input], #input
+                         labels, # labels
                          batch_size=self.batch_size, epochs=1, verbose=0, shuffle=True)
 
         print("NeuMF_RecommenderWrapper: Epoch {}, loss {:.2E}".format(currentEpoch+1, hist.history['loss'][0]))
@@ -37,9 +37,23 @@ del sys.argv[1]
 extensionName = re.sub("\.pyx", "", fileToCompile)
 
 
+# OpenMP is required by the prange loops, the default compiler on MacOS does not support it
+# and prange falls back to a sequential loop
+if sys.platform == "win32":
+    openmp_compile_args = ['/openmp']
+    openmp_link_args = []
+elif sys.platform == "darwin":
+    openmp_compile_args = []
+    openmp_link_args = []
+else:
+    openmp_compile_args = ['-fopenmp']
+    openmp_link_args = ['-fopenmp']
+
+
 ext_modules = Extension(extensionName,
                 [fileToCompile],
-                extra_compile_args=['-O2'],
+                extra_compile_args=['-O2'] + openmp_compile_args,
+                extra_link_args=openmp_link_args,
                 include_dirs=[numpy.get_include(),],
                 )
 
@@ -7,22 +7,86 @@ Created on 10/01/18
 """
 
 
-import ast, gzip, os
+import ast, gzip, os, json, itertools, multiprocessing
 from Data_manager.Dataset import Dataset
 from Data_manager.DataReader import DataReader
 from Data_manager.DataReader_utils import download_from_URL, remove_features, load_CSV_into_SparseBuilder
 
 
 
-def parse_json(file_path):
-    g = open(file_path, 'r')
+def _parse_line_list(line_list):
+    """
+    Parses a list of lines, each containing a dictionary.
+    Review files are JSON and are decoded with the much faster json parser, lines which are not valid JSON
+    (e.g., metadata files use python literals with single quotes) are decoded with ast.literal_eval.
+    If most lines are not valid JSON the json parser is no longer attempted
+    :param line_list:
+    :return: list of the parsed dictionaries
+    """
+
+    parsed_list = []
+    n_json_attempts = 0
+    n_json_errors = 0
+
+    for line in line_list:
+
+        if n_json_errors < 10 or n_json_errors*2 < n_json_attempts:
+            n_json_attempts += 1
+
+            try:
+                parsed_list.append(json.loads(line))
+                continue
+            except ValueError:
+                n_json_errors += 1
 
-    for l in g:
         try:
-            yield ast.literal_eval(l)
+            parsed_list.append(ast.literal_eval(line))
         except Exception as exception:
             print("Exception: {}. Skipping".format(str(exception)))
 
+    return parsed_list
+
+
+
+def parse_json(file_path, processes = None, chunk_size = 10000):
+    """
+    Yields the dictionaries contained in the file, one per line, in the order they appear.
+    The file is read in chunks of chunk_size lines, chunks are parsed in parallel by processes processes and
+    at most 2*processes chunks are read in advance
+    :param file_path:
+    :param processes:   number of processes, by default the number of cores
+    :param chunk_size:
+    :return:
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    with open(file_path, 'r') as file:
+
+        line_chunk_iterator = iter(lambda: list(itertools.islice(file, chunk_size)), [])
+
+        if processes > 1:
+            pool = multiprocessing.Pool(processes=processes)
+
+            try:
+                while True:
+                    line_chunk_list = list(itertools.islice(line_chunk_iterator, 2*processes))
+
+                    if len(line_chunk_list) == 0:
+                        break
+
+                    for parsed_list in pool.map(_parse_line_list, line_chunk_list):
+                        yield from parsed_list
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            for line_list in line_chunk_iterator:
+                yield from _parse_line_list(line_list)
+
 
 
 class _AmazonReviewDataReader(DataReader):
@@ -31,6 +95,9 @@ class _AmazonReviewDataReader(DataReader):
 
     IS_IMPLICIT = False
 
+    # Number of tokens or tags between two progress messages while building the ICMs
+    _PRINT_STEP = 1000000
+
 
     def _get_ICM_metadata_path(self, data_folder, compressed_file_name, decompressed_file_name, file_url):
         """
@@ -181,24 +248,10 @@ class _AmazonReviewDataReader(DataReader):
                                                         preinitialized_row_mapper = self.item_original_ID_to_index, on_new_row = if_new_item)
 
 
-        from Data_manager.TagPreprocessing import tagFilterAndStemming, tagFilter
-        import itertools
-
-
-        parser_metadata = parse_json(file_path)
-
-        numMetadataParsed = 0
-
-        for newMetadata in parser_metadata:
+        from Data_manager.TagPreprocessing import get_tag_rows_in_bulk
 
-            numMetadataParsed+=1
-            if (numMetadataParsed % 20000 == 0):
-                print("Processed {}".format(numMetadataParsed))
 
-            item_ID = newMetadata["asin"]
-
-            # The file might contain other elements, restrict to
-            # Those in the URM
+        def get_metadata_tokens(newMetadata):
 
             tokenList = []
 
@@ -225,15 +278,27 @@ class _AmazonReviewDataReader(DataReader):
                 tokenList.append(item_description)
 
 
-            tokenList = ' '.join(tokenList)
+            return ' '.join(tokenList)
+
+
+        # The file might contain other elements, restrict to
+        # Those in the URM
+        item_ID_and_metadata_iterator = ((newMetadata["asin"], get_metadata_tokens(newMetadata)) for newMetadata in parse_json(file_path))
+
+        numTokensParsed = 0
 
-            # Remove non alphabetical character and split on spaces
-            tokenList = tagFilterAndStemming(tokenList)
+        # Remove non alphabetical character and split on spaces, remove duplicates
+        for item_ID_list, tokenList in get_tag_rows_in_bulk(item_ID_and_metadata_iterator, stemming = True, remove_duplicates = True):
 
-            # Remove duplicates
-            tokenList = list(set(tokenList))
+            ICM_builder.add_data_lists(item_ID_list, tokenList, [1.0]*len(tokenList))
 
-            ICM_builder.add_single_row(item_ID, tokenList, data=1.0)
+            numTokensParsed += len(tokenList)
+
+            # Print only when the count crosses a multiple of _PRINT_STEP
+            if numTokensParsed // self._PRINT_STEP > (numTokensParsed - len(tokenList)) // self._PRINT_STEP:
+                self._print("Processed {} tokens".format(numTokensParsed))
+
+        self._print("Processed {} tokens".format(numTokensParsed))
 
 
         return ICM_builder.get_SparseMatrix(), ICM_builder.get_column_token_to_id_mapper(), ICM_builder.get_row_token_to_id_mapper()
@@ -255,31 +320,25 @@ class _AmazonReviewDataReader(DataReader):
 
 
 
-        from Data_manager.TagPreprocessing import tagFilterAndStemming, tagFilter
-
-
-        parser_reviews = parse_json(file_path)
+        from Data_manager.TagPreprocessing import get_tag_rows_in_bulk
 
-        numReviewParsed = 0
 
-        for newReview in parser_reviews:
+        item_ID_and_review_iterator = ((newReview["asin"], ' '.join([newReview["reviewText"], newReview["summary"]])) for newReview in parse_json(file_path))
 
-            numReviewParsed+=1
-            if (numReviewParsed % 20000 == 0):
-                print("Processed {} reviews".format(numReviewParsed))
+        numTagsParsed = 0
 
-            user_ID = newReview["reviewerID"]
-            item_ID = newReview["asin"]
+        # Remove non alphabetical character and split on spaces
+        for item_ID_list, tagList in get_tag_rows_in_bulk(item_ID_and_review_iterator, stemming = True):
 
-            reviewText = newReview["reviewText"]
-            reviewSummary = newReview["summary"]
+            ICM_builder.add_data_lists(item_ID_list, tagList, [1.0]*len(tagList))
 
-            tagList = ' '.join([reviewText, reviewSummary])
+            numTagsParsed += len(tagList)
 
-            # Remove non alphabetical character and split on spaces
-            tagList = tagFilterAndStemming(tagList)
+            # Print only when the count crosses a multiple of _PRINT_STEP
+            if numTagsParsed // self._PRINT_STEP > (numTagsParsed - len(tagList)) // self._PRINT_STEP:
+                self._print("Processed {} tags".format(numTagsParsed))
 
-            ICM_builder.add_single_row(item_ID, tagList, data=1.0)
+        self._print("Processed {} tags".format(numTagsParsed))
 
 
 
@@ -8,6 +8,7 @@ Created on 01/01/2018
 
 import os, traceback
 from Data_manager.Dataset import Dataset
+from Data_manager.DataReader_utils import save_cache_fingerprint, is_cache_fingerprint_valid
 
 
 #################################################################################################################
@@ -104,6 +105,41 @@ class DataReader(object):
         return self.DATASET_SUBFOLDER_ORIGINAL
 
 
+    def _get_source_folder_path(self):
+        """
+        Returns the folder containing the original data files, whose size, modification time and hash are part of the
+        fingerprint of the saved data. If None the saved data is never considered stale because of the original files
+
+        :return: DATASET_OFFLINE_ROOT_FOLDER/dataset_subfolder/ or None
+        """
+
+        dataset_subfolder = getattr(self, "DATASET_SUBFOLDER", None)
+
+        if dataset_subfolder is None:
+            return None
+
+        return self.DATASET_OFFLINE_ROOT_FOLDER + dataset_subfolder
+
+
+    def _get_cache_parameters(self):
+        """
+        Returns the parameters which determine the content of the loaded data, if they differ from the ones
+        of the saved data the latter is stale and is loaded again from the original files.
+        This method should be extended by any DataReader whose data depends on other attributes
+
+        :return: json serializable dictionary
+        """
+
+        return {"data_reader": self.__class__.__name__,
+                "dataset_name_root": self._get_dataset_name_root(),
+                "dataset_name_data_subfolder": self._get_dataset_name_data_subfolder(),
+                "AVAILABLE_URM": list(self.AVAILABLE_URM),
+                "AVAILABLE_ICM": list(self.AVAILABLE_ICM),
+                "AVAILABLE_UCM": list(self.AVAILABLE_UCM),
+                "IS_IMPLICIT": self.IS_IMPLICIT,
+                }
+
+
     def load_data(self, save_folder_path = None):
         """
         :param save_folder_path:    path in which to save the loaded dataset
@@ -117,12 +153,20 @@ class DataReader(object):
             save_folder_path = self.DATASET_SPLIT_ROOT_FOLDER + self._get_dataset_name_root() + self._get_dataset_name_data_subfolder()
 
 
+        # The parameters must be computed before loading, as the loading may alter the object attributes
+        cache_parameters = self._get_cache_parameters()
+
         # If save_folder_path contains any path try to load a previously built split from it
         if save_folder_path is not False and not self.reload_from_original_data:
 
             try:
+                if not is_cache_fingerprint_valid(save_folder_path, cache_parameters, self._get_source_folder_path()):
+                    self._print("Preloaded data is stale, its parameters or original files have changed")
+                    raise FileNotFoundError("{}: Preloaded data is stale".format(self._get_dataset_name()))
+
+                # The data is memory mapped, copy on write ensures it is never altered
                 loaded_dataset = Dataset()
-                loaded_dataset.load_data(save_folder_path)
+                loaded_dataset.load_data(save_folder_path, mmap_mode = "c")
 
                 self._print("Verifying data consistency...")
                 loaded_dataset.verify_data_consistency()
@@ -159,7 +203,10 @@ class DataReader(object):
             else:
                 self._print("Found already existing folder '{}'".format(save_folder_path))
 
-            loaded_dataset.save_data(save_folder_path)
+            # Uncompressed data can be memory mapped by all the processes loading it, the archives are replaced
+            # atomically so the processes still mapping a stale cache are not affected by the rebuild
+            loaded_dataset.save_data(save_folder_path, compress = False)
+            save_cache_fingerprint(save_folder_path, cache_parameters, self._get_source_folder_path())
 
             self._print("Saving complete!")
 
@@ -7,9 +7,10 @@ Created on 22/11/18
 """
 
 import numpy as np
-import time, sys, os
+import time, sys, os, json, hashlib
 from Base.Recommender_utils import check_matrix
 import  scipy.sparse as sps
+from Base.DataIO import DataIO
 
 
 
@@ -89,15 +90,80 @@ def remove_empty_rows_and_cols(URM, ICM = None):
 
 
 
-from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix
+from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix, _map_id_array_to_index
 import pandas as pd
 
 
-def load_CSV_into_SparseBuilder (filePath, header = False, separator="::", timestamp = False, remove_duplicates = False,
-                                 custom_user_item_rating_columns = None):
 
-    URM_all_builder = IncrementalSparseMatrix(auto_create_col_mapper = True, auto_create_row_mapper = True)
-    URM_timestamp_builder = IncrementalSparseMatrix(auto_create_col_mapper = True, auto_create_row_mapper = True)
+def _get_string_sort_rank(id_list):
+    """
+    Returns the position of each id in the list of ids sorted as pandas sorts a column of strings
+    :param id_list:
+    :return:
+    """
+
+    sorted_position = np.array(sorted(range(len(id_list)), key=id_list.__getitem__), dtype=np.int64)
+
+    id_rank = np.zeros(len(id_list), dtype=np.int64)
+    id_rank[sorted_position] = np.arange(len(id_list))
+
+    return id_rank
+
+
+
+def _remove_duplicates_keep_last(user_index, item_index, sort_value, user_id_list, item_id_list):
+    """
+    Removes the duplicate (user, item) pairs keeping the one with the largest sort_value, NaN being the smallest.
+    The result is identical to sorting the DataFrame with the string ids by user, item and sort_value and keeping the
+    last duplicate, but all sorts are done on integer keys, only the distinct ids are sorted as strings.
+    As in the sorted DataFrame, users are indexed in sorted order and items in order of first appearance.
+    :return: selected positions, new user index, new item index, new user id list, new item id list
+    """
+
+    user_rank = _get_string_sort_rank(user_id_list)[user_index]
+    item_rank = _get_string_sort_rank(item_id_list)[item_index]
+
+    sort_value = np.where(np.isnan(sort_value), -np.inf, sort_value)
+
+    # Last key is the primary one
+    sorted_position = np.lexsort((sort_value, item_rank, user_rank))
+
+    user_rank = user_rank[sorted_position]
+    item_rank = item_rank[sorted_position]
+
+    is_last_of_pair = np.ones(len(sorted_position), dtype=bool)
+    is_last_of_pair[:-1] = np.logical_or(user_rank[1:] != user_rank[:-1], item_rank[1:] != item_rank[:-1])
+
+    selected_position = sorted_position[is_last_of_pair]
+    user_rank = user_rank[is_last_of_pair]
+    item_rank = item_rank[is_last_of_pair]
+
+    new_user_id_list = sorted(user_id_list)
+
+    new_item_index, item_rank_by_appearance = pd.factorize(item_rank)
+    sorted_item_id_list = sorted(item_id_list)
+    new_item_id_list = [sorted_item_id_list[rank] for rank in item_rank_by_appearance]
+
+    return selected_position, user_rank, new_item_index, new_user_id_list, new_item_id_list
+
+
+
+def load_CSV_into_SparseBuilder (filePath, header = False, separator="::", timestamp = False, remove_duplicates = False,
+                                 custom_user_item_rating_columns = None, chunk_size = 1000000):
+    """
+    Loads a CSV of interactions in a sparse matrix. The file is read in chunks of chunk_size rows, the string ids of
+    each chunk are mapped to integer indices before reading the next one, so the memory required is proportional to
+    the number of interactions and of distinct ids rather than to the size of the text.
+    Duplicates are detected and removed sorting the integer indices.
+    :param filePath:
+    :param header:
+    :param separator:
+    :param timestamp:
+    :param remove_duplicates:
+    :param custom_user_item_rating_columns:
+    :param chunk_size:      number of rows read at once
+    :return:
+    """
 
     if timestamp:
         dtype={0:str, 1:str, 2:float, 3:float}
@@ -107,67 +173,90 @@ def load_CSV_into_SparseBuilder (filePath, header = False, separator="::", times
         dtype={0:str, 1:str, 2:float}
         columns = ['userId', 'itemId', 'interaction']
 
-    df_original = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
-                    dtype=dtype, usecols=custom_user_item_rating_columns)
+    user_original_ID_to_index = {}
+    item_original_ID_to_index = {}
+
+    user_index_chunks = []
+    item_index_chunks = []
+    interaction_chunks = []
+    timestamp_chunks = []
+
+    df_chunk_iterator = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
+                    dtype=dtype, usecols=custom_user_item_rating_columns, chunksize=chunk_size)
+
+    for df_chunk in df_chunk_iterator:
+
+        # If the original file has more columns, keep them but ignore them
+        df_chunk.columns = columns
+
+        user_index_chunks.append(_map_id_array_to_index(df_chunk['userId'].values, user_original_ID_to_index, add_new_ids = True).astype(np.int32))
+        item_index_chunks.append(_map_id_array_to_index(df_chunk['itemId'].values, item_original_ID_to_index, add_new_ids = True).astype(np.int32))
+        interaction_chunks.append(df_chunk['interaction'].values.astype(np.float64))
+
+        if timestamp:
+            timestamp_chunks.append(df_chunk['timestamp'].values.astype(np.float64))
+
+    del df_chunk_iterator
 
-    # If the original file has more columns, keep them but ignore them
-    df_original.columns = columns
+    user_index = np.concatenate(user_index_chunks)
+    item_index = np.concatenate(item_index_chunks)
+    interaction_list = np.concatenate(interaction_chunks)
+    timestamp_list = np.concatenate(timestamp_chunks) if timestamp else None
 
+    del user_index_chunks, item_index_chunks, interaction_chunks, timestamp_chunks
 
-    user_id_list = df_original['userId'].values
-    item_id_list = df_original['itemId'].values
-    interaction_list = df_original['interaction'].values
+    n_users = len(user_original_ID_to_index)
+    n_items = len(item_original_ID_to_index)
 
     # Check if duplicates exist
-    num_unique_user_item_ids = df_original.drop_duplicates(['userId', 'itemId'], keep='first', inplace=False).shape[0]
-    contains_duplicates_flag = num_unique_user_item_ids != len(user_id_list)
+    user_item_key = np.sort(user_index.astype(np.int64)*n_items + item_index)
+    num_unique_user_item_ids = len(user_item_key) - np.count_nonzero(user_item_key[1:] == user_item_key[:-1])
+    contains_duplicates_flag = num_unique_user_item_ids != len(user_index)
+
+    del user_item_key
 
     if contains_duplicates_flag:
         if remove_duplicates:
             # # Remove duplicates.
+            # Sort in ascending order so that the last (bigger) timestamp is in the last position and keep the last row
+            # for each user-item, NaN are considered the smallest values to remove them if possible
 
-            # This way of removing the duplicates keeping the last tiemstamp without removing other columns
-            # would be the simplest, but it is so slow to the point of being unusable on any dataset but ML100k
-            # idxs = df_original.groupby(by=['userId', 'itemId'], as_index=False)["timestamp"].idxmax()
-            # df_original = df_original.loc[idxs]
+            user_id_list = list(user_original_ID_to_index.keys())
+            item_id_list = list(item_original_ID_to_index.keys())
 
-            # Alternative faster way:
-            # 1 - Sort in ascending order so that the last (bigger) timestamp is in the last position. Set Nan to be in the first position, to remove them if possible
-            # 2 - Then remove duplicates for user-item keeping the last row, which will be the last timestamp.
+            selected_position, user_index, item_index, user_id_list, item_id_list = _remove_duplicates_keep_last(user_index, item_index,
+                                                                                        timestamp_list if timestamp else interaction_list,
+                                                                                        user_id_list, item_id_list)
 
-            if timestamp:
-                sort_by = ["userId", "itemId", "timestamp"]
-            else:
-                sort_by = ["userId", "itemId", 'interaction']
+            user_original_ID_to_index = {user_id:index for index, user_id in enumerate(user_id_list)}
+            item_original_ID_to_index = {item_id:index for index, item_id in enumerate(item_id_list)}
 
-            df_original.sort_values(by=sort_by, ascending=True, inplace=True, kind="quicksort", na_position="first")
-            df_original.drop_duplicates(["userId", "itemId"], keep='last', inplace=True)
+            interaction_list = interaction_list[selected_position]
 
-            user_id_list = df_original['userId'].values
-            item_id_list = df_original['itemId'].values
-            interaction_list = df_original['interaction'].values
+            if timestamp:
+                timestamp_list = timestamp_list[selected_position]
 
-            assert num_unique_user_item_ids == len(user_id_list), "load_CSV_into_SparseBuilder: duplicate (user, item) values found"
+            assert num_unique_user_item_ids == len(user_index), "load_CSV_into_SparseBuilder: duplicate (user, item) values found"
 
         else:
-            assert num_unique_user_item_ids == len(user_id_list), "load_CSV_into_SparseBuilder: duplicate (user, item) values found"
-
-
+            assert num_unique_user_item_ids == len(user_index), "load_CSV_into_SparseBuilder: duplicate (user, item) values found"
 
 
-    URM_all_builder.add_data_lists(user_id_list, item_id_list, interaction_list)
+    # The indices are already available, build the matrices directly instead of copying them into an IncrementalSparseMatrix
+    URM_all = sps.csr_matrix((interaction_list, (user_index, item_index)), shape=(n_users, n_items), dtype=np.float64)
+    URM_all.eliminate_zeros()
 
     if timestamp:
-        timestamp_list = df_original['timestamp'].values
-        URM_timestamp_builder.add_data_lists(user_id_list, item_id_list, timestamp_list)
+        URM_timestamp = sps.csr_matrix((timestamp_list, (user_index, item_index)), shape=(n_users, n_items), dtype=np.float64)
+        URM_timestamp.eliminate_zeros()
 
-        return  URM_all_builder.get_SparseMatrix(), URM_timestamp_builder.get_SparseMatrix(), \
-                URM_all_builder.get_column_token_to_id_mapper(), URM_all_builder.get_row_token_to_id_mapper()
+        return  URM_all, URM_timestamp, \
+                item_original_ID_to_index, user_original_ID_to_index
 
 
 
-    return  URM_all_builder.get_SparseMatrix(), \
-            URM_all_builder.get_column_token_to_id_mapper(), URM_all_builder.get_row_token_to_id_mapper()
+    return  URM_all, \
+            item_original_ID_to_index, user_original_ID_to_index
 
 
 
@@ -401,3 +490,127 @@ def add_boolean_matrix_iterator(original_data_dict):
             output_data_dict[matrix_name + "_bool"] = matrix_object_implicit
 
     return output_data_dict
+
+
+
+
+#########################################################################################################
+##########                                                                                     ##########
+##########                                CACHE FINGERPRINT                                    ##########
+##########                                                                                     ##########
+#########################################################################################################
+
+
+_CACHE_FINGERPRINT_FILE_NAME = "cache_fingerprint"
+
+
+def _get_file_sha256(file_path, block_size = 2**24):
+
+    file_hash = hashlib.sha256()
+
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+
+def get_source_files_fingerprint(source_folder_path, previous_source_fingerprint = None):
+    """
+    Returns the size, modification time and sha256 of all the files in source_folder_path and its subfolders.
+    The hash of a file is computed only if its size or modification time differ from the ones in previous_source_fingerprint,
+    otherwise the previous hash is used.
+    :param source_folder_path:              None or folder containing the original data files
+    :param previous_source_fingerprint:     a fingerprint previously returned by this function
+    :return: dictionary [relative_file_path] -> {"size", "mtime_ns", "sha256"}, empty if the folder does not exist
+    """
+
+    source_fingerprint = {}
+
+    if source_folder_path is None or not os.path.isdir(source_folder_path):
+        return source_fingerprint
+
+    if previous_source_fingerprint is None:
+        previous_source_fingerprint = {}
+
+    for folder_path, _, file_name_list in os.walk(source_folder_path):
+        for file_name in sorted(file_name_list):
+
+            file_path = os.path.join(folder_path, file_name)
+            relative_file_path = os.path.relpath(file_path, source_folder_path).replace(os.sep, "/")
+
+            file_stat = os.stat(file_path)
+            file_fingerprint = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+            previous_file_fingerprint = previous_source_fingerprint.get(relative_file_path, {})
+
+            if all(previous_file_fingerprint.get(key) == value for key, value in file_fingerprint.items()):
+                file_fingerprint["sha256"] = previous_file_fingerprint["sha256"]
+
+            # The size is enough to detect most changes without reading the file
+            elif previous_file_fingerprint.get("size", file_stat.st_size) != file_stat.st_size:
+                file_fingerprint["sha256"] = None
+
+            else:
+                file_fingerprint["sha256"] = _get_file_sha256(file_path)
+
+            source_fingerprint[relative_file_path] = file_fingerprint
+
+    return source_fingerprint
+
+
+
+def save_cache_fingerprint(save_folder_path, cache_parameters, source_folder_path):
+    """
+    Saves in save_folder_path the fingerprint of the data it contains: the parameters used to build it
+    and the size, modification time and hash of the original data files.
+    It must be called after all the data has been saved.
+    :param save_folder_path:
+    :param cache_parameters:        json serializable dictionary
+    :param source_folder_path:      None or folder containing the original data files
+    :return:
+    """
+
+    dataIO = DataIO(folder_path = save_folder_path)
+
+    dataIO.save_data(data_dict_to_save = {"cache_parameters": cache_parameters,
+                                          "source_fingerprint": get_source_files_fingerprint(source_folder_path)},
+                     file_name = _CACHE_FINGERPRINT_FILE_NAME,
+                     compress = False)
+
+
+
+def is_cache_fingerprint_valid(save_folder_path, cache_parameters, source_folder_path):
+    """
+    Checks whether the data in save_folder_path was built with cache_parameters from the current original data files.
+    Data saved without a fingerprint is considered valid, as well as data whose original files are no longer available.
+    Touching a file does not invalidate the data, its hash is computed again and compared.
+    :param save_folder_path:
+    :param cache_parameters:        json serializable dictionary
+    :param source_folder_path:      None or folder containing the original data files
+    :return: False if the data is stale
+    """
+
+    try:
+        dataIO = DataIO(folder_path = save_folder_path)
+        cache_fingerprint = dataIO.load_data(file_name = _CACHE_FINGERPRINT_FILE_NAME)
+
+    except FileNotFoundError:
+        return True
+
+    # Compare the parameters as they would be loaded from the json file
+    if json.loads(json.dumps(cache_parameters)) != cache_fingerprint["cache_parameters"]:
+        return False
+
+    current_source_fingerprint = get_source_files_fingerprint(source_folder_path,
+                                                              previous_source_fingerprint = cache_fingerprint["source_fingerprint"])
+
+    if len(current_source_fingerprint) == 0:
+        return True
+
+    # The modification time is not compared, if it changed the hash has been computed again
+    get_size_and_hash = lambda source_fingerprint: {relative_file_path: (file_fingerprint["size"], file_fingerprint["sha256"])
+                                                     for relative_file_path, file_fingerprint in source_fingerprint.items()}
+
+    return get_size_and_hash(current_source_fingerprint) == get_size_and_hash(cache_fingerprint["source_fingerprint"])
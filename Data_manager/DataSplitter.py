@@ -8,6 +8,7 @@ Created on 30/11/18
 
 import traceback, os
 from Data_manager.DataReader import DataReader
+from Data_manager.DataReader_utils import save_cache_fingerprint, is_cache_fingerprint_valid
 
 class DataSplitter(object):
     """
@@ -125,6 +126,20 @@ class DataSplitter(object):
         return save_folder_path
 
 
+    def _get_cache_parameters(self):
+        """
+        Returns the parameters which determine the content of the split, including the ones of the DataReader,
+        if they differ from the ones of the saved split the latter is stale and a new split is created.
+        This method should be extended by any DataSplitter whose split depends on other attributes
+        :return: json serializable dictionary
+        """
+
+        return {"data_splitter": self.__class__.__name__,
+                "split_subfolder": self._get_split_subfolder_name(),
+                "data_reader": self.get_dataReader_object()._get_cache_parameters(),
+                }
+
+
 
     def load_data(self, save_folder_path = None):
         """
@@ -140,11 +155,19 @@ class DataSplitter(object):
             save_folder_path = self._get_default_save_path()
 
 
+        # The parameters must be computed before loading, as the loading may alter the object attributes
+        cache_parameters = self._get_cache_parameters()
+        source_folder_path = self.get_dataReader_object()._get_source_folder_path()
+
         # If save_folder_path contains any path try to load a previously built split from it
         if save_folder_path is not False and not self.force_new_split:
 
             try:
 
+                if not is_cache_fingerprint_valid(save_folder_path, cache_parameters, source_folder_path):
+                    self._print("Preloaded data is stale, its parameters or original files have changed")
+                    raise FileNotFoundError("{}: Preloaded data is stale".format(self.DATA_SPLITTER_NAME))
+
                 self._load_previously_built_split_and_attributes(save_folder_path)
 
                 self._print("Verifying data consistency...")
@@ -165,6 +188,8 @@ class DataSplitter(object):
                         os.makedirs(save_folder_path)
 
                     self._split_data_from_original_dataset(save_folder_path)
+                    save_cache_fingerprint(save_folder_path, cache_parameters, source_folder_path)
+
                     self._load_previously_built_split_and_attributes(save_folder_path)
 
                     self._print("Verifying data consistency...")
@@ -186,6 +211,9 @@ class DataSplitter(object):
 
             self._split_data_from_original_dataset(save_folder_path)
 
+            if save_folder_path is not False:
+                save_cache_fingerprint(save_folder_path, cache_parameters, source_folder_path)
+
             self._print("Reading from original files...Done")
 
 
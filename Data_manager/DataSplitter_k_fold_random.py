@@ -78,6 +78,16 @@ class DataSplitter_k_fold_random(_DataSplitter):
          assert self.FOLD_DATA_SPLITTER_LIST is not None, "{}: Unable to load data split. The split has not been generated yet, call the load_data function to do so.".format(self.DATA_SPLITTER_NAME)
 
 
+    def _get_cache_parameters(self):
+
+        cache_parameters = super(DataSplitter_k_fold_random, self)._get_cache_parameters()
+
+        cache_parameters["n_folds"] = self.n_folds
+        cache_parameters["fold_data_splitter"] = self._dataSplitter_object_empty._get_cache_parameters()
+
+        return cache_parameters
+
+
     def get_statistics_URM(self):
         pass
 
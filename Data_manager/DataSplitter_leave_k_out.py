@@ -95,6 +95,18 @@ class DataSplitter_leave_k_out(_DataSplitter):
         return "leave_{}_out_{}/".format(self.k_out_value, order_suffix)
 
 
+    def _get_cache_parameters(self):
+
+        cache_parameters = super(DataSplitter_leave_k_out, self)._get_cache_parameters()
+
+        cache_parameters["k_out_value"] = self.k_out_value
+        cache_parameters["use_validation_set"] = self.use_validation_set
+        cache_parameters["allow_cold_users"] = self.allow_cold_users
+        cache_parameters["leave_random_out"] = self.leave_random_out
+
+        return cache_parameters
+
+
     def get_statistics_URM(self):
 
 
@@ -260,31 +272,39 @@ class DataSplitter_leave_k_out(_DataSplitter):
 
 
 
+            # Uncompressed data can be memory mapped by all the processes loading it
             dataIO = DataIO(folder_path = save_folder_path)
 
             dataIO.save_data(data_dict_to_save = split_parameters_dict,
-                             file_name = "split_parameters" + name_suffix)
+                             file_name = "split_parameters" + name_suffix,
+                             compress = False)
 
             dataIO.save_data(data_dict_to_save = self.SPLIT_GLOBAL_MAPPER_DICT,
-                             file_name = "split_mappers" + name_suffix)
+                             file_name = "split_mappers" + name_suffix,
+                             compress = False)
 
             dataIO.save_data(data_dict_to_save = self.SPLIT_URM_DICT,
-                             file_name = "split_URM" + name_suffix)
+                             file_name = "split_URM" + name_suffix,
+                             compress = False)
 
             if len(self.SPLIT_ICM_DICT)>0:
                 dataIO.save_data(data_dict_to_save = self.SPLIT_ICM_DICT,
-                                 file_name = "split_ICM" + name_suffix)
+                                 file_name = "split_ICM" + name_suffix,
+                                 compress = False)
 
                 dataIO.save_data(data_dict_to_save = self.SPLIT_ICM_MAPPER_DICT,
-                                 file_name = "split_ICM_mappers" + name_suffix)
+                                 file_name = "split_ICM_mappers" + name_suffix,
+                                 compress = False)
 
 
             if len(self.SPLIT_UCM_DICT)>0:
                 dataIO.save_data(data_dict_to_save = self.SPLIT_UCM_DICT,
-                                 file_name = "split_UCM" + name_suffix)
+                                 file_name = "split_UCM" + name_suffix,
+                                 compress = False)
 
                 dataIO.save_data(data_dict_to_save = self.SPLIT_UCM_MAPPER_DICT,
-                                 file_name = "split_UCM_mappers" + name_suffix)
+                                 file_name = "split_UCM_mappers" + name_suffix,
+                                 compress = False)
 
 
     def _load_previously_built_split_and_attributes(self, save_folder_path):
@@ -308,28 +328,29 @@ class DataSplitter_leave_k_out(_DataSplitter):
         name_suffix = "_{}_{}".format(allow_cold_users_suffix, validation_set_suffix)
 
 
+        # The data is memory mapped, copy on write ensures it is never altered
         dataIO = DataIO(folder_path = save_folder_path)
 
-        split_parameters_dict = dataIO.load_data(file_name ="split_parameters" + name_suffix)
+        split_parameters_dict = dataIO.load_data(file_name ="split_parameters" + name_suffix, mmap_mode = "c")
 
         for attrib_name in split_parameters_dict.keys():
              self.__setattr__(attrib_name, split_parameters_dict[attrib_name])
 
 
-        self.SPLIT_GLOBAL_MAPPER_DICT = dataIO.load_data(file_name ="split_mappers" + name_suffix)
+        self.SPLIT_GLOBAL_MAPPER_DICT = dataIO.load_data(file_name ="split_mappers" + name_suffix, mmap_mode = "c")
 
-        self.SPLIT_URM_DICT = dataIO.load_data(file_name ="split_URM" + name_suffix)
+        self.SPLIT_URM_DICT = dataIO.load_data(file_name ="split_URM" + name_suffix, mmap_mode = "c")
 
         if len(self.dataReader_object.get_loaded_ICM_names())>0:
-            self.SPLIT_ICM_DICT = dataIO.load_data(file_name ="split_ICM" + name_suffix)
+            self.SPLIT_ICM_DICT = dataIO.load_data(file_name ="split_ICM" + name_suffix, mmap_mode = "c")
 
-            self.SPLIT_ICM_MAPPER_DICT = dataIO.load_data(file_name ="split_ICM_mappers" + name_suffix)
+            self.SPLIT_ICM_MAPPER_DICT = dataIO.load_data(file_name ="split_ICM_mappers" + name_suffix, mmap_mode = "c")
 
 
         if len(self.dataReader_object.get_loaded_UCM_names())>0:
-            self.SPLIT_UCM_DICT = dataIO.load_data(file_name ="split_UCM" + name_suffix)
+            self.SPLIT_UCM_DICT = dataIO.load_data(file_name ="split_UCM" + name_suffix, mmap_mode = "c")
 
-            self.SPLIT_UCM_MAPPER_DICT = dataIO.load_data(file_name ="split_UCM_mappers" + name_suffix)
+            self.SPLIT_UCM_MAPPER_DICT = dataIO.load_data(file_name ="split_UCM_mappers" + name_suffix, mmap_mode = "c")
 
     #########################################################################################################
     ##########                                                                                     ##########
@@ -169,7 +169,12 @@ class Dataset(object):
     ##########                                                                                     ##########
     #########################################################################################################
 
-    def save_data(self, save_folder_path):
+    def save_data(self, save_folder_path, compress = True):
+        """
+        :param save_folder_path:
+        :param compress:    If False the data is saved in uncompressed archives which load_data can memory map
+        :return:
+        """
 
         dataIO = DataIO(folder_path = save_folder_path)
 
@@ -184,52 +189,64 @@ class Dataset(object):
         }
 
         dataIO.save_data(data_dict_to_save = global_attributes_dict,
-                         file_name = "dataset_global_attributes")
+                         file_name = "dataset_global_attributes",
+                         compress = compress)
 
         dataIO.save_data(data_dict_to_save = self.AVAILABLE_URM,
-                         file_name = "dataset_URM")
+                         file_name = "dataset_URM",
+                         compress = compress)
 
         if self._HAS_ICM:
             dataIO.save_data(data_dict_to_save = self.AVAILABLE_ICM,
-                             file_name = "dataset_ICM")
+                             file_name = "dataset_ICM",
+                             compress = compress)
 
             dataIO.save_data(data_dict_to_save = self.AVAILABLE_ICM_feature_mapper,
-                             file_name = "dataset_ICM_mappers")
+                             file_name = "dataset_ICM_mappers",
+                             compress = compress)
 
         if self._HAS_UCM:
             dataIO.save_data(data_dict_to_save = self.AVAILABLE_UCM,
-                             file_name = "dataset_UCM")
+                             file_name = "dataset_UCM",
+                             compress = compress)
 
             dataIO.save_data(data_dict_to_save = self.AVAILABLE_UCM_feature_mapper,
-                             file_name = "dataset_UCM_mappers")
+                             file_name = "dataset_UCM_mappers",
+                             compress = compress)
 
         if self._HAS_additional_mapper:
             dataIO.save_data(data_dict_to_save = self.additional_data_mapper,
-                             file_name = "dataset_additional_mappers")
+                             file_name = "dataset_additional_mappers",
+                             compress = compress)
 
 
 
-    def load_data(self, save_folder_path):
+    def load_data(self, save_folder_path, mmap_mode = None):
+        """
+        :param save_folder_path:
+        :param mmap_mode:   None or a numpy memory map mode, e.g., 'c', the matrices saved with compress = False are memory mapped
+        :return:
+        """
 
         dataIO = DataIO(folder_path = save_folder_path)
 
-        global_attributes_dict = dataIO.load_data(file_name = "dataset_global_attributes")
+        global_attributes_dict = dataIO.load_data(file_name = "dataset_global_attributes", mmap_mode = mmap_mode)
 
         for attrib_name, attrib_object in global_attributes_dict.items():
             self.__setattr__(attrib_name, attrib_object)
 
-        self.AVAILABLE_URM = dataIO.load_data(file_name = "dataset_URM")
+        self.AVAILABLE_URM = dataIO.load_data(file_name = "dataset_URM", mmap_mode = mmap_mode)
 
         if self._HAS_ICM > 0:
-            self.AVAILABLE_ICM = dataIO.load_data(file_name = "dataset_ICM")
-            self.AVAILABLE_ICM_feature_mapper = dataIO.load_data(file_name = "dataset_ICM_mappers")
+            self.AVAILABLE_ICM = dataIO.load_data(file_name = "dataset_ICM", mmap_mode = mmap_mode)
+            self.AVAILABLE_ICM_feature_mapper = dataIO.load_data(file_name = "dataset_ICM_mappers", mmap_mode = mmap_mode)
 
         if self._HAS_UCM > 0:
-            self.AVAILABLE_UCM = dataIO.load_data(file_name = "dataset_UCM")
-            self.AVAILABLE_UCM_feature_mapper = dataIO.load_data(file_name = "dataset_UCM_mappers")
+            self.AVAILABLE_UCM = dataIO.load_data(file_name = "dataset_UCM", mmap_mode = mmap_mode)
+            self.AVAILABLE_UCM_feature_mapper = dataIO.load_data(file_name = "dataset_UCM_mappers", mmap_mode = mmap_mode)
 
         if self._HAS_additional_mapper:
-            self.dataset_additional_mappers = dataIO.load_data(file_name = "dataset_additional_mappers")
+            self.dataset_additional_mappers = dataIO.load_data(file_name = "dataset_additional_mappers", mmap_mode = mmap_mode)
 
 
     #########################################################################################################
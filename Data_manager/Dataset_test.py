@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import unittest, shutil, tempfile
+
+import numpy as np
+import scipy.sparse as sps
+
+from Data_manager.Dataset import Dataset
+
+
+def sparse_are_equals(A, B):
+
+    if A.shape != B.shape:
+        return False
+
+    return  (A!=B).nnz==0
+
+
+
+def random_dataset(n_users, n_items, random_state):
+
+    URM_all = sps.random(n_users, n_items, density=0.1, format='csr', random_state=random_state)
+
+    return Dataset(dataset_name = "Random",
+                   URM_dictionary = {"URM_all": URM_all},
+                   user_original_ID_to_index = {str(user_id): user_id for user_id in range(n_users)},
+                   item_original_ID_to_index = {str(item_id): item_id for item_id in range(n_items)})
+
+
+
+class MyTestCase(unittest.TestCase):
+
+
+    def test_Dataset_rebuild_while_memory_mapped(self):
+
+        save_folder_path = tempfile.mkdtemp() + "/"
+        random_state = np.random.RandomState(0)
+
+        try:
+            random_dataset(1000, 500, random_state).save_data(save_folder_path, compress = False)
+
+            loaded_dataset = Dataset()
+            loaded_dataset.load_data(save_folder_path, mmap_mode = "c")
+            URM_all = loaded_dataset.AVAILABLE_URM["URM_all"]
+            URM_all_copy = URM_all.copy()
+
+            # Rebuilding the cache with smaller data must not truncate the archives the loaded dataset is mapped from
+            rebuilt_dataset = random_dataset(10, 5, random_state)
+            rebuilt_dataset.save_data(save_folder_path, compress = False)
+
+            assert sparse_are_equals(URM_all, URM_all_copy)
+
+            loaded_dataset = Dataset()
+            loaded_dataset.load_data(save_folder_path, mmap_mode = "c")
+
+            assert sparse_are_equals(loaded_dataset.AVAILABLE_URM["URM_all"], rebuilt_dataset.AVAILABLE_URM["URM_all"])
+            self.assertEqual(loaded_dataset.get_user_original_ID_to_index_mapper(), rebuilt_dataset.get_user_original_ID_to_index_mapper())
+
+        finally:
+            shutil.rmtree(save_folder_path, ignore_errors=True)
+
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
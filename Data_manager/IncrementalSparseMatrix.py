@@ -152,6 +152,60 @@ class IncrementalSparseMatrix_ListBased(object):
 
 
 import numpy as np
+import pandas as pd
+
+
+
+def _map_id_array_to_index(id_array, original_ID_to_index, add_new_ids):
+    """
+    Maps all the ids at once with the original_ID_to_index dictionary. The ids are first factorized with a hash table
+    so that the dictionary is accessed only once for each distinct id.
+    New ids are added to the dictionary in order of first appearance, as it would happen adding them one at a time
+    :param id_array:
+    :param original_ID_to_index:    dictionary, it is updated if add_new_ids is True
+    :param add_new_ids:             if False new ids are not added and their index is -1
+    :return: array with the index of each id
+    """
+
+    # Keep the type of the ids as they were provided, numpy scalars for numpy arrays and python objects for lists.
+    # Lists are factorized as objects to avoid numpy converting ids of different types to a common one
+    if isinstance(id_array, np.ndarray):
+        id_codes, unique_ids = pd.factorize(id_array)
+        unique_ids = list(unique_ids.astype(id_array.dtype, copy=False))
+
+    else:
+        id_object_array = np.empty(len(id_array), dtype=object)
+        id_object_array[:] = id_array
+
+        id_codes, unique_ids = pd.factorize(id_object_array)
+        unique_ids = unique_ids.tolist()
+
+    # factorize gives code -1 to None and NaN ids, which the dictionary treats as ids like any other.
+    # In that case map the ids one at a time as they would be added individually
+    if np.any(id_codes == -1):
+        id_index = np.empty(len(id_codes), dtype=np.int64)
+
+        for position, original_id in enumerate(id_array):
+            index = original_ID_to_index.get(original_id, -1)
+
+            if index == -1 and add_new_ids:
+                index = len(original_ID_to_index)
+                original_ID_to_index[original_id] = index
+
+            id_index[position] = index
+
+        return id_index
+
+    unique_index = np.array([original_ID_to_index.get(unique_id, -1) for unique_id in unique_ids], dtype=np.int64)
+
+    if add_new_ids:
+        is_new_id = unique_index == -1
+        unique_index[is_new_id] = np.arange(len(original_ID_to_index), len(original_ID_to_index) + is_new_id.sum())
+
+        original_ID_to_index.update((unique_ids[position], int(unique_index[position])) for position in np.flatnonzero(is_new_id))
+
+    return unique_index[id_codes]
+
 
 
 
@@ -180,27 +234,71 @@ class IncrementalSparseMatrix(IncrementalSparseMatrix_ListBased):
         return self._next_cell_pointer
 
 
-    def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
+    def _get_column_index_array(self, column_id_array):
 
-        assert len(row_list_to_add) == len(col_list_to_add) and len(row_list_to_add) == len(data_list_to_add),\
-            "IncrementalSparseMatrix: element lists must have the same length"
+        if not self._auto_create_column_mapper:
+            return np.asarray(column_id_array)
+
+        return _map_id_array_to_index(column_id_array, self._column_original_ID_to_index, add_new_ids = True)
 
-        for data_point_index in range(len(row_list_to_add)):
 
-            if self._next_cell_pointer == len(self._row_array):
-                self._row_array = np.concatenate((self._row_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._col_array = np.concatenate((self._col_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._data_array = np.concatenate((self._data_array, np.zeros(self._dataBlock, dtype=self._dtype_data)))
+    def _get_row_index_array(self, row_id_array):
+
+        if not self._auto_create_row_mapper:
+            return np.asarray(row_id_array)
 
+        return _map_id_array_to_index(row_id_array, self._row_original_ID_to_index, add_new_ids = True)
 
-            row_index = self._get_row_index(row_list_to_add[data_point_index])
-            col_index = self._get_column_index(col_list_to_add[data_point_index])
 
-            self._row_array[self._next_cell_pointer] = row_index
-            self._col_array[self._next_cell_pointer] = col_index
-            self._data_array[self._next_cell_pointer] = data_list_to_add[data_point_index]
 
-            self._next_cell_pointer += 1
+    def _ensure_capacity(self, n_cells_to_add):
+        """
+        Grows the buffers geometrically so that they can contain n_cells_to_add more cells
+        :param n_cells_to_add:
+        :return:
+        """
+
+        n_cells_required = self._next_cell_pointer + n_cells_to_add
+
+        if n_cells_required <= len(self._row_array):
+            return
+
+        new_size = max(2*len(self._row_array), n_cells_required)
+
+        for array_name in ["_row_array", "_col_array", "_data_array"]:
+            old_array = getattr(self, array_name)
+            new_array = np.zeros(new_size, dtype=old_array.dtype)
+            new_array[:self._next_cell_pointer] = old_array[:self._next_cell_pointer]
+            setattr(self, array_name, new_array)
+
+
+
+    def _add_cells(self, row_index_array, col_index_array, data_array):
+
+        n_cells_to_add = len(row_index_array)
+
+        self._ensure_capacity(n_cells_to_add)
+
+        self._row_array[self._next_cell_pointer:self._next_cell_pointer + n_cells_to_add] = row_index_array
+        self._col_array[self._next_cell_pointer:self._next_cell_pointer + n_cells_to_add] = col_index_array
+        self._data_array[self._next_cell_pointer:self._next_cell_pointer + n_cells_to_add] = data_array
+
+        self._next_cell_pointer += n_cells_to_add
+
+
+
+    def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
+
+        assert len(row_list_to_add) == len(col_list_to_add) and len(row_list_to_add) == len(data_list_to_add),\
+            "IncrementalSparseMatrix: element lists must have the same length"
+
+        if len(row_list_to_add) == 0:
+            return
+
+        row_index_array = self._get_row_index_array(row_list_to_add)
+        col_index_array = self._get_column_index_array(col_list_to_add)
+
+        self._add_cells(row_index_array, col_index_array, np.asarray(data_list_to_add))
 
 
 
@@ -340,31 +438,31 @@ class IncrementalSparseMatrix_FilterIDs(IncrementalSparseMatrix):
 
 
 
-    def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
+    def _get_column_index_array(self, column_id_array):
+        return _map_id_array_to_index(column_id_array, self._column_original_ID_to_index, add_new_ids = self._on_new_col_add_flag)
 
-        assert len(row_list_to_add) == len(col_list_to_add) and len(row_list_to_add) == len(data_list_to_add),\
-            "IncrementalSparseMatrix: element lists must have different length"
+
+    def _get_row_index_array(self, row_id_array):
+        return _map_id_array_to_index(row_id_array, self._row_original_ID_to_index, add_new_ids = self._on_new_row_add_flag)
 
 
-        for data_point_index in range(len(row_list_to_add)):
 
-            if self._next_cell_pointer == len(self._row_array):
-                self._row_array = np.concatenate((self._row_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._col_array = np.concatenate((self._col_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._data_array = np.concatenate((self._data_array, np.zeros(self._dataBlock, dtype=self._dtype_data)))
 
+    def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
 
-            row_index = self._get_row_index(row_list_to_add[data_point_index])
-            col_index = self._get_column_index(col_list_to_add[data_point_index])
+        assert len(row_list_to_add) == len(col_list_to_add) and len(row_list_to_add) == len(data_list_to_add),\
+            "IncrementalSparseMatrix: element lists must have different length"
 
+        if len(row_list_to_add) == 0:
+            return
 
-            if row_index is not None and col_index is not None:
+        row_index_array = self._get_row_index_array(row_list_to_add)
+        col_index_array = self._get_column_index_array(col_list_to_add)
 
-                self._row_array[self._next_cell_pointer] = row_index
-                self._col_array[self._next_cell_pointer] = col_index
-                self._data_array[self._next_cell_pointer] = data_list_to_add[data_point_index]
+        # Ignored ids have index -1
+        valid_mask = np.logical_and(row_index_array != -1, col_index_array != -1)
 
-                self._next_cell_pointer += 1
+        self._add_cells(row_index_array[valid_mask], col_index_array[valid_mask], np.asarray(data_list_to_add)[valid_mask])
 
 
 
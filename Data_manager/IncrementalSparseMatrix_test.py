@@ -13,7 +13,7 @@ import unittest
 
 import scipy.sparse as sps
 
-from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix
+from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix, IncrementalSparseMatrix_FilterIDs
 
 
 def sparse_are_equals(A, B):
@@ -99,6 +99,65 @@ class MyTestCase(unittest.TestCase):
 
 
 
+    def test_IncrementalSparseMatrix_FilterIDs_ignore(self):
+
+        import numpy as np
+
+        row_list = ["u2", "u1", "u3", "u2", "u4", "u1"]
+        col_list = ["i1", "i9", "i2", "i2", "i1", "i8"]
+        data_list = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+        incrementalMatrix = IncrementalSparseMatrix_FilterIDs(preinitialized_row_mapper = {"u1": 0, "u2": 1},
+                                                              preinitialized_col_mapper = {"i2": 0},
+                                                              on_new_row = "ignore", on_new_col = "add")
+
+        incrementalMatrix.add_data_lists(row_list, col_list, data_list)
+
+        # New columns are added in order of first appearance, also when the row is ignored
+        self.assertEqual(incrementalMatrix.get_row_token_to_id_mapper(), {"u1": 0, "u2": 1})
+        self.assertEqual(incrementalMatrix.get_column_token_to_id_mapper(), {"i2": 0, "i1": 1, "i9": 2, "i8": 3})
+
+        randomMatrix_incremental = incrementalMatrix.get_SparseMatrix()
+
+        expected_matrix = np.array([[0.0, 0.0, 2.0, 6.0],
+                                    [4.0, 1.0, 0.0, 0.0]])
+
+        assert sparse_are_equals(sps.csr_matrix(expected_matrix), randomMatrix_incremental)
+
+
+
+
+    def test_IncrementalSparseMatrix_missing_ids(self):
+
+        import numpy as np
+
+        incrementalMatrix = IncrementalSparseMatrix(auto_create_col_mapper = True, auto_create_row_mapper = True)
+
+        incrementalMatrix.add_data_lists(["a", None, "b"], ["x", "y", None], [1.0, 2.0, 3.0])
+
+        # None is an id like any other and gets its own index
+        self.assertEqual(incrementalMatrix.get_row_token_to_id_mapper(), {"a": 0, None: 1, "b": 2})
+        self.assertEqual(incrementalMatrix.get_column_token_to_id_mapper(), {"x": 0, "y": 1, None: 2})
+
+        assert sparse_are_equals(sps.csr_matrix(np.diag([1.0, 2.0, 3.0])), incrementalMatrix.get_SparseMatrix())
+
+
+        nan_id = np.nan
+
+        incrementalMatrix = IncrementalSparseMatrix(auto_create_col_mapper = True, auto_create_row_mapper = True)
+
+        incrementalMatrix.add_data_lists(["a", nan_id, "a"], [nan_id, "y", "y"], [1.0, 2.0, 3.0])
+
+        self.assertEqual(incrementalMatrix.get_row_token_to_id_mapper(), {"a": 0, nan_id: 1})
+        self.assertEqual(incrementalMatrix.get_column_token_to_id_mapper(), {nan_id: 0, "y": 1})
+
+        expected_matrix = np.array([[1.0, 3.0],
+                                    [0.0, 2.0]])
+
+        assert sparse_are_equals(sps.csr_matrix(expected_matrix), incrementalMatrix.get_SparseMatrix())
+
+
+
 
 if __name__ == '__main__':
 
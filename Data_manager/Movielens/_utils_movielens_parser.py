@@ -13,7 +13,11 @@ import pandas as pd
 def _loadURM_preinitialized_item_id (filePath, header = False, separator="::",
                                      if_new_user = "add", if_new_item = "ignore",
                                      item_original_ID_to_index = None,
-                                     user_original_ID_to_index = None):
+                                     user_original_ID_to_index = None,
+                                     chunk_size = 1000000):
+    """
+    The file is read in chunks of chunk_size rows, each chunk is added to the builders before reading the next one
+    """
 
 
     from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix_FilterIDs
@@ -29,25 +33,31 @@ def _loadURM_preinitialized_item_id (filePath, header = False, separator="::",
                                                 on_new_row = if_new_user)
 
     if header:
-        df_original = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
+        df_chunk_iterator = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
                         usecols=['userId', 'movieId', 'rating', 'timestamp'],
-                        dtype={'userId':str, 'movieId':str, 'rating':float, 'timestamp':float})
+                        dtype={'userId':str, 'movieId':str, 'rating':float, 'timestamp':float},
+                        chunksize=chunk_size)
     else:
-        df_original = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
-                        dtype={0:str, 1:str, 2:float, 3:float})
+        df_chunk_iterator = pd.read_csv(filepath_or_buffer=filePath, sep=separator, header= 0 if header else None,
+                        dtype={0:str, 1:str, 2:float, 3:float},
+                        chunksize=chunk_size)
 
-        df_original.columns = ['userId', 'movieId', 'rating', 'timestamp']
 
-    # Remove data with rating non valid
-    df_original.drop(df_original[df_original.rating == 0.0].index, inplace=True)
+    for df_chunk in df_chunk_iterator:
 
-    user_id_list = df_original['userId'].values
-    item_id_list = df_original['movieId'].values
-    rating_list = df_original['rating'].values
-    timestamp_list = df_original['timestamp'].values
+        if not header:
+            df_chunk.columns = ['userId', 'movieId', 'rating', 'timestamp']
 
-    URM_all_builder.add_data_lists(user_id_list, item_id_list, rating_list)
-    URM_timestamp_builder.add_data_lists(user_id_list, item_id_list, timestamp_list)
+        # Remove data with rating non valid
+        df_chunk = df_chunk[df_chunk.rating != 0.0]
+
+        user_id_list = df_chunk['userId'].values
+        item_id_list = df_chunk['movieId'].values
+        rating_list = df_chunk['rating'].values
+        timestamp_list = df_chunk['timestamp'].values
+
+        URM_all_builder.add_data_lists(user_id_list, item_id_list, rating_list)
+        URM_timestamp_builder.add_data_lists(user_id_list, item_id_list, timestamp_list)
 
 
 
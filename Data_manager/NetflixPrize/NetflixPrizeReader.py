@@ -7,12 +7,63 @@ Created on 06/01/18
 """
 
 
-import zipfile, os, shutil
+import zipfile, os, multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+from functools import partial
 from Data_manager.Dataset import Dataset
 from Data_manager.DataReader import DataReader
 
 
 
+def _load_split_file(split_file_name, zip_file_path, chunk_size = 1000000):
+    """
+    Parses one combined_data file reading it directly from the zip archive.
+    The file contains a 'movie_id:' row for each movie followed by the 'user_id,rating,date' rows of its ratings,
+    it is read in chunks and the movie of each rating is found as the last movie row preceding it.
+    :param split_file_name:
+    :param zip_file_path:
+    :param chunk_size:
+    :return: user_id, movie_id, rating arrays in order of appearance
+    """
+
+    user_id_chunks = []
+    movie_id_chunks = []
+    rating_chunks = []
+
+    # Ratings preceding the first movie row are ignored
+    current_movie_id = -1
+
+    with zipfile.ZipFile(zip_file_path) as dataFile, dataFile.open(split_file_name) as split_file:
+
+        # Movie rows have only one column, their rating is NaN
+        df_chunk_iterator = pd.read_csv(split_file, sep=",", header=None, usecols=[0, 1], names=["id", "rating"],
+                                        dtype={"id": str, "rating": float}, chunksize=chunk_size)
+
+        for df_chunk in df_chunk_iterator:
+
+            is_movie_row = df_chunk["rating"].isna().values
+            movie_row_position = np.flatnonzero(is_movie_row)
+
+            # Movie of the row, the one of the previous chunk is the first of the list
+            movie_id = np.array([current_movie_id] + [int(row_id.rstrip(":")) for row_id in df_chunk["id"].values[movie_row_position]], dtype=np.int64)
+            row_movie_index = np.cumsum(is_movie_row)
+
+            is_rating_row = np.logical_not(is_movie_row)
+            rating_movie_id = movie_id[row_movie_index[is_rating_row]]
+            is_valid = rating_movie_id != -1
+
+            user_id_chunks.append(df_chunk["id"].values[is_rating_row][is_valid].astype(np.int64).astype(np.int32))
+            movie_id_chunks.append(rating_movie_id[is_valid].astype(np.int32))
+            rating_chunks.append(df_chunk["rating"].values[is_rating_row][is_valid].astype(np.float32))
+
+            current_movie_id = movie_id[-1]
+
+    return np.concatenate(user_id_chunks), np.concatenate(movie_id_chunks), np.concatenate(rating_chunks)
+
+
+
 
 class NetflixPrizeReader(DataReader):
 
@@ -33,7 +84,6 @@ class NetflixPrizeReader(DataReader):
         # Load data from original
 
         self.zip_file_folder = self.DATASET_OFFLINE_ROOT_FOLDER + self.DATASET_SUBFOLDER
-        self.decompressed_zip_file_folder = self.DATASET_SPLIT_ROOT_FOLDER + self.DATASET_SUBFOLDER
 
         try:
 
@@ -78,64 +128,41 @@ class NetflixPrizeReader(DataReader):
 
 
     def _loadURM(self):
+        """
+        The four combined_data files are parsed in parallel, one per process, into integer arrays which are then merged.
+        Users and movies are indexed in order of first appearance and their original IDs are strings, as in the
+        original data
+        :return:
+        """
 
-        from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix
-
-        numCells = 0
-        URM_builder = IncrementalSparseMatrix(auto_create_col_mapper=True, auto_create_row_mapper=True)
-
-
-        for current_split in [1, 2, 3, 4]:
-
-            current_split_path = self.dataFile.extract("combined_data_{}.txt".format(current_split), path=self.decompressed_zip_file_folder + "decompressed/")
-
-            fileHandle = open(current_split_path, "r")
-
-            print("NetflixPrizeReader: loading split {}".format(current_split))
-
-            currentMovie_id = None
-
-            for line in fileHandle:
-
-
-                if numCells % 1000000 == 0 and numCells!=0:
-                    print("Processed {} cells".format(numCells))
-
-                if (len(line)) > 1:
-
-                    line_split = line.split(",")
-
-                    # If line has 3 components, it is a 'user_id,rating,date' row
-                    if len(line_split) == 3 and currentMovie_id!= None:
-
-                        user_id = line_split[0]
-
-                        URM_builder.add_data_lists([user_id], [currentMovie_id], [float(line_split[1])])
-
-                        numCells += 1
-
-                    # If line has 1 component, it MIGHT be a 'item_id:' row
-                    elif len(line_split) == 1:
-                        line_split = line.split(":")
+        split_file_name_list = ["combined_data_{}.txt".format(current_split) for current_split in [1, 2, 3, 4]]
 
-                        # Confirm it is a 'item_id:' row
-                        if len(line_split) == 2:
-                            currentMovie_id = line_split[0]
+        self._print("loading {} splits with {} processes".format(len(split_file_name_list), min(len(split_file_name_list), multiprocessing.cpu_count())))
 
-                        else:
-                            print("Unexpected row: '{}'".format(line))
+        _load_split_file_partial = partial(_load_split_file, zip_file_path = self.dataFile.filename)
 
-                    else:
-                        print("Unexpected row: '{}'".format(line))
+        # If an exception is raised the pool is terminated when leaving the block
+        with multiprocessing.Pool(processes=min(len(split_file_name_list), multiprocessing.cpu_count()), maxtasksperchild=1) as pool:
+            split_data_list = pool.map(_load_split_file_partial, split_file_name_list)
 
+            pool.close()
+            pool.join()
 
-            fileHandle.close()
+        user_id = np.concatenate([split_data[0] for split_data in split_data_list])
+        movie_id = np.concatenate([split_data[1] for split_data in split_data_list])
+        rating = np.concatenate([split_data[2] for split_data in split_data_list])
 
+        del split_data_list
 
-            print("NetflixPrizeReader: cleaning temporary files")
+        self._print("loaded {} cells".format(len(rating)))
 
-            shutil.rmtree(self.decompressed_zip_file_folder + "decompressed/", ignore_errors=True)
+        user_index, user_id_unique = pd.factorize(user_id)
+        movie_index, movie_id_unique = pd.factorize(movie_id)
 
+        user_original_ID_to_index = {str(original_id): index for index, original_id in enumerate(user_id_unique.tolist())}
+        item_original_ID_to_index = {str(original_id): index for index, original_id in enumerate(movie_id_unique.tolist())}
 
-        return  URM_builder.get_SparseMatrix(), URM_builder.get_column_token_to_id_mapper(), URM_builder.get_row_token_to_id_mapper()
+        URM_all = sps.csr_matrix((rating, (user_index, movie_index)), shape=(len(user_id_unique), len(movie_id_unique)), dtype=np.float64)
+        URM_all.eliminate_zeros()
 
+        return  URM_all, item_original_ID_to_index, user_original_ID_to_index
@@ -7,7 +7,8 @@ Created on 09/01/18
 """
 
 
-import re
+import re, itertools, multiprocessing
+from functools import lru_cache, partial
 from nltk.stem import PorterStemmer
 
 import nltk
@@ -17,15 +18,43 @@ nltk.download('stopwords')
 from nltk.corpus import stopwords
 
 
-def tagFilter(originalTag):
+# The regular expressions, stopwords and stemmer are created only once and shared by all calls
+_NON_ALPHANUMERIC_REGEX = re.compile("[^a-zA-Z0-9]")
+_MULTIPLE_SPACES_REGEX = re.compile(" +")
+
+_STEMMER = PorterStemmer()
+
+# Maximum number of distinct tokens whose stem is cached
+_STEM_CACHE_SIZE = 2**20
+
+
+
+@lru_cache(maxsize=None)
+def _get_stopwords_set():
+    return frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=_STEM_CACHE_SIZE)
+def _stem(tag):
+    return _STEMMER.stem(tag)
+
+
+
+def _split_tag(originalTag):
 
     # Remove non alphabetical character and split on spaces
-    processedTag = re.sub("[^a-zA-Z0-9]", " ", originalTag)
-    processedTag = re.sub(" +", " ", processedTag)
+    processedTag = _NON_ALPHANUMERIC_REGEX.sub(" ", originalTag)
+    processedTag = _MULTIPLE_SPACES_REGEX.sub(" ", processedTag)
+
+    return processedTag.split(" ")
 
-    processedTag = processedTag.split(" ")
 
-    stopwords_set = set(stopwords.words('english'))
+
+def tagFilter(originalTag):
+
+    processedTag = _split_tag(originalTag)
+
+    stopwords_set = _get_stopwords_set()
 
     result = []
 
@@ -41,23 +70,89 @@ def tagFilter(originalTag):
 
 def tagFilterAndStemming(originalTag):
 
-    # Remove non alphabetical character and split on spaces
-    processedTag = re.sub("[^a-zA-Z0-9]", " ", originalTag)
-    processedTag = re.sub(" +", " ", processedTag)
-
-    processedTag = processedTag.split(" ")
+    processedTag = _split_tag(originalTag)
 
-    stopwords_set = set(stopwords.words('english'))
-
-    stemmer = PorterStemmer()
+    stopwords_set = _get_stopwords_set()
 
     result = []
 
     for tag in processedTag:
 
-        tag_stemmed = stemmer.stem(tag)
+        tag_stemmed = _stem(tag)
 
         if tag_stemmed not in stopwords_set:
             result.append(tag_stemmed)
 
-    return result
\ No newline at end of file
+    return result
+
+
+
+
+def _get_tag_list_batch(originalTag_list, stemming, remove_duplicates):
+
+    tag_function = tagFilterAndStemming if stemming else tagFilter
+
+    tag_list_batch = [tag_function(originalTag) for originalTag in originalTag_list]
+
+    if remove_duplicates:
+        tag_list_batch = [list(set(tag_list)) for tag_list in tag_list_batch]
+
+    return tag_list_batch
+
+
+
+
+def get_tag_rows_in_bulk(row_id_and_tag_iterator, stemming = True, remove_duplicates = False,
+                         processes = None, batch_size = 100000, chunk_size = 1000):
+    """
+    Applies tagFilterAndStemming (or tagFilter if stemming is False) to a stream of (row_id, originalTag) pairs and
+    yields the result in bulk, ready for IncrementalSparseMatrix.add_data_lists.
+    The pairs are read in batches of batch_size, each batch is split in chunks of chunk_size strings which are
+    processed in parallel by a pool of processes, each process keeps its own stem cache across chunks.
+    The order of the rows and of the tags is preserved.
+    :param row_id_and_tag_iterator:     iterator of (row_id, originalTag) pairs
+    :param stemming:
+    :param remove_duplicates:           If True each tag appears at most once for each row
+    :param processes:                   number of processes, by default the number of cores
+    :param batch_size:
+    :param chunk_size:
+    :return: iterator of (row_id_list, tag_list) with the row_id of each tag
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    row_id_and_tag_iterator = iter(row_id_and_tag_iterator)
+
+    get_tag_list_batch = partial(_get_tag_list_batch, stemming = stemming, remove_duplicates = remove_duplicates)
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes=processes)
+        map_function = pool.map
+    else:
+        pool = None
+        map_function = lambda function, iterable: list(map(function, iterable))
+
+    try:
+
+        while True:
+
+            batch = list(itertools.islice(row_id_and_tag_iterator, batch_size))
+
+            if len(batch) == 0:
+                break
+
+            row_id_batch, originalTag_batch = zip(*batch)
+
+            chunk_list = [originalTag_batch[chunk_start:chunk_start + chunk_size] for chunk_start in range(0, len(originalTag_batch), chunk_size)]
+            tag_list_batch = list(itertools.chain.from_iterable(map_function(get_tag_list_batch, chunk_list)))
+
+            row_id_list = list(itertools.chain.from_iterable([row_id]*len(tag_list) for row_id, tag_list in zip(row_id_batch, tag_list_batch)))
+            tag_list = list(itertools.chain.from_iterable(tag_list_batch))
+
+            yield row_id_list, tag_list
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
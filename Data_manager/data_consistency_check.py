@@ -107,13 +107,13 @@ def assert_URM_ICM_mapper_consistency(URM_DICT, user_original_ID_to_index, item_
 
 
     # Check if every non-empty user and item has a mapper value
-    URM_all = sps.csc_matrix(URM_all)
-    nonzero_items_mask = np.ediff1d(URM_all.indptr)>0
+    # The non-empty items are the column indices of the CSR, which avoids converting the URM to CSC
+    URM_all = sps.csr_matrix(URM_all)
+    nonzero_items_mask = np.bincount(URM_all.indices, minlength = n_items_URM)>0
     nonzero_items = np.arange(0, n_items_URM, dtype=int)[nonzero_items_mask]
     assert np.isin(nonzero_items, np.array(list(item_original_ID_to_index.values()))).all(), print_preamble + "there exist items with interactions that do not have a mapper entry"
 
 
-    URM_all = sps.csr_matrix(URM_all)
     nonzero_users_mask = np.ediff1d(URM_all.indptr)>0
     nonzero_users = np.arange(0, n_users_URM, dtype=int)[nonzero_users_mask]
     assert np.isin(nonzero_users, np.array(list(user_original_ID_to_index.values()))).all(), print_preamble + "there exist users with interactions that do not have a mapper entry"
@@ -9,86 +9,168 @@ Created on 28/10/2018
 import numpy as np
 import scipy.sparse as sps
 
-from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix
 
 
 
-def split_data_on_timestamp(URM_all, URM_timestamp, negative_items_per_positive=100):
+def _sample_unobserved_items(URM, n_items_per_row):
+    """
+    Samples for each row n_items_per_row distinct columns which are not in the row, or all of them if there are fewer.
+    Columns are sampled uniformly with a vectorized rejection sampling: at each round every row still requiring samples
+    draws a batch of random columns, those already in the row or already drawn are rejected.
+    Rows that have fewer than twice the required unobserved columns would reject most draws, their unobserved columns
+    are enumerated and shuffled.
+    Sampling depends on the numpy global random state, use np.random.seed to reproduce it
+    :param URM:
+    :param n_items_per_row:
+    :return: row, col arrays of the sampled cells
+    """
 
-    URM_all = sps.csr_matrix(URM_all)
-    URM_timestamp = sps.csr_matrix(URM_timestamp)
+    URM = sps.csr_matrix(URM)
 
-    n_rows, n_cols = URM_all.shape
+    if not URM.has_sorted_indices:
+        URM = URM.copy()
+        URM.sort_indices()
 
+    n_rows, n_cols = URM.shape
 
-    URM_train_builder = IncrementalSparseMatrix(n_rows=n_rows, n_cols=n_cols)
-    URM_test_builder = IncrementalSparseMatrix(n_rows=n_rows, n_cols=n_cols)
-    URM_validation_builder = IncrementalSparseMatrix(n_rows=n_rows, n_cols=n_cols)
-    URM_negative_builder = IncrementalSparseMatrix(n_rows=n_rows, n_cols=n_cols)
+    # Cells are identified by row*n_cols + col, the keys of the observed cells are sorted
+    observed_keys = np.repeat(np.arange(n_rows, dtype=np.int64), np.ediff1d(URM.indptr))*n_cols + URM.indices
 
-    all_items = np.arange(0, n_cols, dtype=int)
+    n_unobserved = n_cols - np.ediff1d(URM.indptr)
+    n_to_sample = np.minimum(n_items_per_row, n_unobserved)
 
+    use_rejection = n_unobserved >= 2*n_to_sample
 
-    for user_index in range(URM_all.shape[0]):
+    sampled_row_list = []
+    sampled_col_list = []
 
-        if user_index % 10000 == 0:
-            print("split_data_on_sequence: user {} of {}".format(user_index, URM_all.shape[0]))
+    # Dense rows, enumerate all their unobserved columns
+    for row_index in np.flatnonzero(np.logical_and(np.logical_not(use_rejection), n_to_sample > 0)):
 
-        start_pos = URM_all.indptr[user_index]
-        end_pos = URM_all.indptr[user_index+1]
+        unobserved_mask = np.ones(n_cols, dtype=bool)
+        unobserved_mask[URM.indices[URM.indptr[row_index]:URM.indptr[row_index+1]]] = False
 
-        user_profile = URM_all.indices[start_pos:end_pos]
-        user_data = URM_all.data[start_pos:end_pos]
-        user_sequence = URM_timestamp.data[start_pos:end_pos]
+        unobserved_items = np.flatnonzero(unobserved_mask)
+        np.random.shuffle(unobserved_items)
 
+        sampled_row_list.append(np.full(n_to_sample[row_index], row_index, dtype=np.int64))
+        sampled_col_list.append(unobserved_items[:n_to_sample[row_index]])
 
-        unobserved_index = np.in1d(all_items, user_profile, assume_unique=True, invert=True)
 
-        unobserved_items = all_items[unobserved_index]
-        np.random.shuffle(unobserved_items)
+    # Sparse rows, rejection sampling
+    # accepted_keys contains the keys of the accepted cells grouped by row and in order of acceptance
+    accepted_keys = np.zeros(0, dtype=np.int64)
+    accepted_rows = np.zeros(0, dtype=np.int64)
+    n_missing = np.where(use_rejection, n_to_sample, 0)
 
-        URM_negative_builder.add_single_row(user_index, unobserved_items[:negative_items_per_positive], 1.0)
+    while n_missing.sum() > 0:
 
+        pending_rows = np.flatnonzero(n_missing)
 
-        if len(user_profile) >= 3:
+        # Draw more than the missing samples so that in most cases one round is enough
+        n_draws = np.ceil(n_missing[pending_rows] * n_cols / n_unobserved[pending_rows] * 1.2).astype(np.int64) + 1
 
+        drawn_rows = np.repeat(pending_rows, n_draws)
+        drawn_keys = drawn_rows*n_cols + np.random.randint(0, n_cols, size=len(drawn_rows))
 
+        candidate_keys = np.concatenate((accepted_keys, drawn_keys))
+        candidate_rows = np.concatenate((accepted_rows, drawn_rows))
 
-            # Test contain the first one, validation the second
-            min_pos = np.argmax(user_sequence)
+        # Reject cells already drawn keeping the first occurrence, previous rounds come first.
+        # With a stable sort the first occurrence of a key precedes the others
+        sorted_position = np.argsort(candidate_keys, kind="stable")
+        sorted_keys = candidate_keys[sorted_position]
 
-            venue_index = user_profile[min_pos]
-            venue_data = user_data[min_pos]
+        is_rejected_sorted = np.zeros(len(sorted_keys), dtype=bool)
+        is_rejected_sorted[1:] = sorted_keys[1:] == sorted_keys[:-1]
 
-            URM_test_builder.add_data_lists([user_index], [venue_index], [venue_data])
+        # Reject observed cells, searching sorted keys is much faster than searching them in random order
+        if len(observed_keys) > 0:
+            observed_position = np.minimum(np.searchsorted(observed_keys, sorted_keys), len(observed_keys)-1)
+            is_rejected_sorted |= observed_keys[observed_position] == sorted_keys
 
-            user_profile = np.delete(user_profile, min_pos)
-            user_data = np.delete(user_data, min_pos)
-            user_sequence = np.delete(user_sequence, min_pos)
+        is_accepted = np.ones(len(candidate_keys), dtype=bool)
+        is_accepted[sorted_position[is_rejected_sorted]] = False
 
+        candidate_keys = candidate_keys[is_accepted]
+        candidate_rows = candidate_rows[is_accepted]
 
-            min_pos = np.argmax(user_sequence)
+        # Keep for each row only the first n_to_sample, the stable sort by row preserves the order of acceptance
+        sorted_position = np.argsort(candidate_rows, kind="stable")
+        candidate_keys = candidate_keys[sorted_position]
+        candidate_rows = candidate_rows[sorted_position]
 
-            venue_index = user_profile[min_pos]
-            venue_data = user_data[min_pos]
+        n_candidates = np.bincount(candidate_rows, minlength=n_rows)
+        row_start = np.cumsum(n_candidates) - n_candidates
+        is_accepted = np.arange(len(candidate_keys)) - row_start[candidate_rows] < n_to_sample[candidate_rows]
 
-            URM_validation_builder.add_data_lists([user_index], [venue_index], [venue_data])
+        accepted_keys = candidate_keys[is_accepted]
+        accepted_rows = candidate_rows[is_accepted]
 
-            user_profile = np.delete(user_profile, min_pos)
-            user_data = np.delete(user_data, min_pos)
-            #user_sequence = np.delete(user_sequence, min_pos)
+        n_missing = np.where(use_rejection, n_to_sample - np.minimum(n_candidates, n_to_sample), 0)
 
 
-            URM_train_builder.add_data_lists([user_index]*len(user_profile), user_profile, user_data)
+    sampled_row_list.append(accepted_rows)
+    sampled_col_list.append(accepted_keys - accepted_rows*n_cols)
 
+    return np.concatenate(sampled_row_list), np.concatenate(sampled_col_list)
 
-    URM_train = URM_train_builder.get_SparseMatrix()
-    URM_validation = URM_validation_builder.get_SparseMatrix()
-    URM_test = URM_test_builder.get_SparseMatrix()
-    URM_negative = URM_negative_builder.get_SparseMatrix()
 
 
 
-    return URM_train, URM_validation, URM_test, URM_negative
+def split_data_on_timestamp(URM_all, URM_timestamp, negative_items_per_positive=100):
+    """
+    For each user with at least 3 interactions, the most recent one goes in test, the second most recent in validation
+    and all the others in train. Users with fewer interactions are not included in any split.
+    For each user negative_items_per_positive unobserved items are sampled as negatives.
+    All users are processed at once with a single sort of the interactions on (user, -timestamp), if two interactions
+    have the same timestamp the one appearing first in the user profile is considered the most recent.
+    Sampling depends on the numpy global random state, use np.random.seed to reproduce it
+    :param URM_all:
+    :param URM_timestamp:   Same structure of URM_all, the data contains the timestamp of each interaction
+    :param negative_items_per_positive:
+    :return:
+    """
+
+    URM_all = sps.csr_matrix(URM_all)
+    URM_timestamp = sps.csr_matrix(URM_timestamp)
+
+    n_rows, n_cols = URM_all.shape
 
+    profile_length = np.ediff1d(URM_all.indptr)
+    interaction_user = np.repeat(np.arange(n_rows, dtype=np.int64), profile_length)
 
+    # Rank of each interaction in the user profile from the most recent one
+    # The priority is distinct for every interaction, ties keep the profile order
+    interaction_priority = np.empty(URM_all.nnz, dtype=np.int64)
+    interaction_priority[np.argsort(-URM_timestamp.data, kind="stable")] = np.arange(URM_all.nnz)
+
+    sorted_position = np.argsort(interaction_user*URM_all.nnz + interaction_priority)
+
+    interaction_items = URM_all.indices[sorted_position]
+    interaction_data = URM_all.data[sorted_position]
+    interaction_rank = np.arange(URM_all.nnz) - np.repeat(URM_all.indptr[:-1], profile_length)
+
+    user_has_enough_interactions = (profile_length >= 3)[interaction_user]
+
+    def get_URM_subset(interaction_mask):
+        interaction_mask = np.logical_and(interaction_mask, user_has_enough_interactions)
+
+        URM_subset = sps.csr_matrix((interaction_data[interaction_mask], (interaction_user[interaction_mask], interaction_items[interaction_mask])),
+                                    shape = (n_rows, n_cols), dtype = np.float64)
+        URM_subset.eliminate_zeros()
+
+        return URM_subset
+
+    URM_test = get_URM_subset(interaction_rank == 0)
+    URM_validation = get_URM_subset(interaction_rank == 1)
+    URM_train = get_URM_subset(interaction_rank >= 2)
+
+
+    negative_rows, negative_cols = _sample_unobserved_items(URM_all, negative_items_per_positive)
+
+    URM_negative = sps.csr_matrix((np.ones(len(negative_rows), dtype=np.float64), (negative_rows, negative_cols)),
+                                  shape = (n_rows, n_cols))
+
+
+    return URM_train, URM_validation, URM_test, URM_negative
@@ -8,14 +8,30 @@ Created on 23/04/2019
 
 import numpy as np
 import scipy.sparse as sps
-from Data_manager.IncrementalSparseMatrix import IncrementalSparseMatrix
+
+
+
+def _get_interaction_subset(interaction_mask, interaction_user, interaction_items, interaction_data, shape):
+    """
+    Builds the sparse matrix containing only the interactions selected by the mask, explicit zeros are removed
+    """
+
+    URM_subset = sps.csr_matrix((interaction_data[interaction_mask], (interaction_user[interaction_mask], interaction_items[interaction_mask])),
+                                shape = shape, dtype = np.float64)
+    URM_subset.eliminate_zeros()
+
+    return URM_subset
 
 
 
 
 def split_train_leave_k_out_user_wise(URM, k_out = 1, use_validation_set = True, leave_random_out = True):
     """
-    The function splits an URM in two matrices selecting the k_out interactions one user at a time
+    The function splits an URM in two matrices selecting the k_out interactions of each user.
+    The interactions of all users are ranked at once with a single sort, on (user, random priority) for random splits
+    and on (user, decreasing data, item) for deterministic ones. The first k_out go in test, the following k_out
+    in validation and the others in train.
+    Random splits depend on the numpy global random state, use np.random.seed to reproduce them
     :param URM:
     :param k_out:
     :param use_validation_set:
@@ -28,72 +44,44 @@ def split_train_leave_k_out_user_wise(URM, k_out = 1, use_validation_set = True,
     URM = sps.csr_matrix(URM)
     n_users, n_items = URM.shape
 
+    profile_length = np.ediff1d(URM.indptr)
+    interaction_user = np.repeat(np.arange(n_users, dtype=np.int32), profile_length)
 
-    URM_train_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                        auto_create_col_mapper=False, n_cols = n_items)
-
-    URM_test_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                        auto_create_col_mapper=False, n_cols = n_items)
-
-    if use_validation_set:
-         URM_validation_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                                          auto_create_col_mapper=False, n_cols = n_items)
-
-
-
-    for user_id in range(n_users):
-
-        start_user_position = URM.indptr[user_id]
-        end_user_position = URM.indptr[user_id+1]
+    if leave_random_out:
+        # Every interaction gets a distinct global priority, then the interactions of all users are sorted at once with a
+        # single integer key user*nnz + priority. Each user remains in its segment and the position of an interaction
+        # within the segment is its rank
+        interaction_priority = np.random.permutation(URM.nnz)
+        sorted_position = np.argsort(interaction_user.astype(np.int64)*URM.nnz + interaction_priority)
 
-        user_profile = URM.indices[start_user_position:end_user_position]
+    else:
+        # The first will be sampled so the last interaction must be the first one
+        # The interactions of all users are sorted at once on (user, decreasing data, item), ties are therefore ranked
+        # by increasing item index regardless of the order in which they are stored
+        sorted_position = np.lexsort((URM.indices, -URM.data, interaction_user))
 
+    interaction_items = URM.indices[sorted_position]
+    interaction_data = URM.data[sorted_position]
+    interaction_rank = np.arange(URM.nnz) - np.repeat(URM.indptr[:-1], profile_length)
 
-        if leave_random_out:
-            indices_to_suffle = np.arange(len(user_profile), dtype=int)
 
-            np.random.shuffle(indices_to_suffle)
+    #Test interactions
+    URM_test = _get_interaction_subset(interaction_rank < k_out, interaction_user, interaction_items, interaction_data, URM.shape)
 
-            user_interaction_items = user_profile[indices_to_suffle]
-            user_interaction_data = URM.data[start_user_position:end_user_position][indices_to_suffle]
 
-        else:
-
-            # The first will be sampled so the last interaction must be the first one
-            interaction_position = URM.data[start_user_position:end_user_position]
-
-            sort_interaction_index = np.argsort(-interaction_position)
-
-            user_interaction_items = user_profile[sort_interaction_index]
-            user_interaction_data = URM.data[start_user_position:end_user_position][sort_interaction_index]
-
-
-
-        #Test interactions
-        user_interaction_items_test = user_interaction_items[0:k_out]
-        user_interaction_data_test = user_interaction_data[0:k_out]
-
-        URM_test_builder.add_data_lists([user_id]*len(user_interaction_items_test), user_interaction_items_test, user_interaction_data_test)
-
-
-        #validation interactions
-        if use_validation_set:
-            user_interaction_items_validation = user_interaction_items[k_out:k_out*2]
-            user_interaction_data_validation = user_interaction_data[k_out:k_out*2]
-
-            URM_validation_builder.add_data_lists([user_id]*k_out, user_interaction_items_validation, user_interaction_data_validation)
-
-
-        #Train interactions
-        user_interaction_items_train = user_interaction_items[k_out*2:]
-        user_interaction_data_train = user_interaction_data[k_out*2:]
+    #validation interactions
+    if use_validation_set:
+        validation_mask = np.logical_and(interaction_rank >= k_out, interaction_rank < k_out*2)
+        URM_validation = _get_interaction_subset(validation_mask, interaction_user, interaction_items, interaction_data, URM.shape)
 
-        URM_train_builder.add_data_lists([user_id]*len(user_interaction_items_train), user_interaction_items_train, user_interaction_data_train)
+        n_interactions_not_train = k_out*2
 
+    else:
+        n_interactions_not_train = k_out
 
 
-    URM_train = URM_train_builder.get_SparseMatrix()
-    URM_test = URM_test_builder.get_SparseMatrix()
+    #Train interactions
+    URM_train = _get_interaction_subset(interaction_rank >= n_interactions_not_train, interaction_user, interaction_items, interaction_data, URM.shape)
 
 
     URM_train = sps.csr_matrix(URM_train)
@@ -105,8 +93,6 @@ def split_train_leave_k_out_user_wise(URM, k_out = 1, use_validation_set = True,
 
 
     if use_validation_set:
-        URM_validation = URM_validation_builder.get_SparseMatrix()
-
         URM_validation = sps.csr_matrix(URM_validation)
         user_no_item_validation = np.sum(np.ediff1d(URM_validation.indptr) == 0)
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from Data_manager.split_functions.split_train_validation_leave_k_out import split_train_leave_k_out_user_wise
+
+
+def sparse_are_equals(A, B):
+
+    if A.shape != B.shape:
+        return False
+
+    return  (A!=B).nnz==0
+
+
+
+def split_train_leave_k_out_user_wise_reference(URM, k_out):
+    """
+    Deterministic split selecting the k_out interactions one user at a time, ranked by decreasing data and,
+    among ties, by increasing item index
+    """
+
+    URM = sps.csr_matrix(URM)
+    n_users, n_items = URM.shape
+
+    split_rows = [[], [], []]
+    split_cols = [[], [], []]
+    split_data = [[], [], []]
+
+    for user_id in range(n_users):
+
+        start_user_position = URM.indptr[user_id]
+        end_user_position = URM.indptr[user_id+1]
+
+        user_profile = URM.indices[start_user_position:end_user_position]
+        user_data = URM.data[start_user_position:end_user_position]
+
+        sort_interaction_index = np.array(sorted(range(len(user_data)), key = lambda position: (-user_data[position], user_profile[position])), dtype=np.int64)
+
+        user_interaction_items = user_profile[sort_interaction_index]
+        user_interaction_data = user_data[sort_interaction_index]
+
+        # Train, validation and test
+        for split_index, split_slice in enumerate([slice(k_out*2, None), slice(k_out, k_out*2), slice(0, k_out)]):
+            split_rows[split_index].extend([user_id]*len(user_interaction_items[split_slice]))
+            split_cols[split_index].extend(user_interaction_items[split_slice])
+            split_data[split_index].extend(user_interaction_data[split_slice])
+
+    return [sps.csr_matrix((split_data[split_index], (split_rows[split_index], split_cols[split_index])), shape=URM.shape)
+            for split_index in range(3)]
+
+
+
+
+class MyTestCase(unittest.TestCase):
+
+
+    def test_leave_k_out_ties(self):
+
+        n_users = 200
+        n_items = 300
+
+        random_state = np.random.RandomState(0)
+
+        URM = sps.random(n_users, n_items, density=0.3, format='csr', random_state=random_state)
+
+        for URM_data in [np.ones(URM.nnz), random_state.randint(1, 6, URM.nnz).astype(np.float64)]:
+
+            URM.data = URM_data.copy()
+
+            # The ties must be ranked by item index also when the indices of each row are not sorted
+            URM_unsorted = URM.copy()
+
+            for user_id in range(n_users):
+                profile_slice = slice(URM.indptr[user_id], URM.indptr[user_id+1])
+                permutation = random_state.permutation(profile_slice.stop - profile_slice.start)
+                URM_unsorted.indices[profile_slice] = URM.indices[profile_slice][permutation]
+                URM_unsorted.data[profile_slice] = URM.data[profile_slice][permutation]
+
+            URM_unsorted.has_sorted_indices = False
+
+            for k_out in [1, 3]:
+
+                URM_train_reference, URM_validation_reference, URM_test_reference = split_train_leave_k_out_user_wise_reference(URM, k_out)
+
+                for URM_input in [URM, URM_unsorted]:
+
+                    URM_train, URM_validation, URM_test = split_train_leave_k_out_user_wise(URM_input, k_out = k_out, use_validation_set = True, leave_random_out = False)
+
+                    assert sparse_are_equals(URM_train, URM_train_reference)
+                    assert sparse_are_equals(URM_validation, URM_validation_reference)
+                    assert sparse_are_equals(URM_test, URM_test_reference)
+
+
+
+
+if __name__ == '__main__':
+
+
+    unittest.main()
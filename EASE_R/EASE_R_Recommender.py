@@ -109,8 +109,8 @@ class EASE_R_Recommender(BaseItemSimilarityMatrixRecommender):
 
 
 
-    def load_model(self, folder_path, file_name = None):
-        super(EASE_R_Recommender, self).load_model(folder_path, file_name = file_name)
+    def load_model(self, folder_path, file_name = None, mmap_mode = None):
+        super(EASE_R_Recommender, self).load_model(folder_path, file_name = file_name, mmap_mode = mmap_mode)
 
         if not sps.issparse(self.W_sparse):
             self._W_sparse_format_checked = True
@@ -8,7 +8,7 @@ import numpy as np
 import scipy.sparse as sps
 
 from sklearn.preprocessing import normalize
-from Base.Recommender_utils import check_matrix, similarityMatrixTopK
+from Base.Recommender_utils import check_matrix, similarityMatrixTopK, build_sparse_matrix_top_k
 from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
 
 from Base.BaseSimilarityMatrixRecommender import BaseItemSimilarityMatrixRecommender
@@ -70,60 +70,28 @@ class P3alphaRecommender(BaseItemSimilarityMatrixRecommender):
         block_dim = 200
         d_t = Piu
 
-        # Use array as it reduces memory requirements compared to lists
-        dataBlock = 10000000
-
-        rows = np.zeros(dataBlock, dtype=np.int32)
-        cols = np.zeros(dataBlock, dtype=np.int32)
-        values = np.zeros(dataBlock, dtype=np.float32)
-
-        numCells = 0
-
+        n_items = Pui.shape[1]
 
         start_time = time.time()
         start_time_printBatch = start_time
 
-        for current_block_start_row in range(0, Pui.shape[1], block_dim):
-
-            if current_block_start_row + block_dim > Pui.shape[1]:
-                block_dim = Pui.shape[1] - current_block_start_row
-
-            similarity_block = d_t[current_block_start_row:current_block_start_row + block_dim, :] * Pui
-            similarity_block = similarity_block.toarray()
-
-            for row_in_block in range(block_dim):
-                row_data = similarity_block[row_in_block, :]
-                row_data[current_block_start_row + row_in_block] = 0
-
-                best = row_data.argsort()[::-1][:self.topK]
 
-                notZerosMask = row_data[best] != 0.0
+        def get_similarity_block(current_block_start_row, current_block_end_row):
 
-                values_to_add = row_data[best][notZerosMask]
-                cols_to_add = best[notZerosMask]
+            nonlocal start_time_printBatch
 
-                for index in range(len(values_to_add)):
-
-                    if numCells == len(rows):
-                        rows = np.concatenate((rows, np.zeros(dataBlock, dtype=np.int32)))
-                        cols = np.concatenate((cols, np.zeros(dataBlock, dtype=np.int32)))
-                        values = np.concatenate((values, np.zeros(dataBlock, dtype=np.float32)))
-
-
-                    rows[numCells] = current_block_start_row + row_in_block
-                    cols[numCells] = cols_to_add[index]
-                    values[numCells] = values_to_add[index]
-
-                    numCells += 1
+            similarity_block = d_t[current_block_start_row:current_block_end_row, :] * Pui
+            similarity_block = similarity_block.toarray()
 
+            similarity_block[np.arange(current_block_end_row - current_block_start_row), np.arange(current_block_start_row, current_block_end_row)] = 0
 
             if time.time() - start_time_printBatch > 300:
                 new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time)
 
                 self._print("Similarity column {} ({:4.1f}%), {:.2f} column/sec. Elapsed time {:.2f} {}".format(
-                     current_block_start_row + block_dim,
-                    100.0 * float( current_block_start_row + block_dim) / Pui.shape[1],
-                    float( current_block_start_row + block_dim) / (time.time() - start_time),
+                     current_block_end_row,
+                    100.0 * float(current_block_end_row) / n_items,
+                    float(current_block_end_row) / (time.time() - start_time),
                     new_time_value, new_time_unit))
 
                 sys.stdout.flush()
@@ -131,7 +99,11 @@ class P3alphaRecommender(BaseItemSimilarityMatrixRecommender):
 
                 start_time_printBatch = time.time()
 
-        self.W_sparse = sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])), shape=(Pui.shape[1], Pui.shape[1]))
+            return similarity_block
+
+
+        # Keep the topK of each row, the whole block is processed at once
+        self.W_sparse = build_sparse_matrix_top_k(get_similarity_block, (n_items, n_items), self.topK, block_size = block_dim)
 
 
         if self.normalize_similarity:
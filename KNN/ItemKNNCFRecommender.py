@@ -28,7 +28,11 @@ class ItemKNNCFRecommender(BaseItemSimilarityMatrixRecommender):
         super(ItemKNNCFRecommender, self).__init__(URM_train, verbose = verbose)
 
 
-    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none", **similarity_args):
+    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none", similarity_cache = None, **similarity_args):
+        """
+        :param similarity_cache:    Compute_Similarity_Cache object, if provided the similarity is derived from the
+                                    dot products it caches, which are computed only once for all the fit calls sharing it
+        """
 
         self.topK = topK
         self.shrink = shrink
@@ -47,8 +51,11 @@ class ItemKNNCFRecommender(BaseItemSimilarityMatrixRecommender):
             self.URM_train = TF_IDF(self.URM_train.T).T
             self.URM_train = check_matrix(self.URM_train, 'csr')
 
-        similarity = Compute_Similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+        if similarity_cache is not None:
+            self.W_sparse = similarity_cache.compute_similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
 
+        else:
+            similarity = Compute_Similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+            self.W_sparse = similarity.compute_similarity()
 
-        self.W_sparse = similarity.compute_similarity()
         self.W_sparse = check_matrix(self.W_sparse, format='csr')
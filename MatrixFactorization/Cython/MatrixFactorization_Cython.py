@@ -37,8 +37,11 @@ class _MatrixFactorization_Cython(BaseMatrixFactorizationRecommender, Incrementa
             negative_interactions_quota = 0.0,
             init_mean = 0.0, init_std_dev = 0.1,
             user_reg = 0.0, item_reg = 0.0, bias_reg = 0.0, positive_reg = 0.0, negative_reg = 0.0,
-            random_seed = None,
+            random_seed = None, num_threads = 1,
             **earlystopping_kwargs):
+        """
+        :param num_threads:     number of OpenMP threads running the epoch with lock-free (Hogwild) updates
+        """
 
 
         self.num_factors = num_factors
@@ -70,7 +73,8 @@ class _MatrixFactorization_Cython(BaseMatrixFactorizationRecommender, Incrementa
                                                                 negative_interactions_quota = negative_interactions_quota,
                                                                 init_std_dev = init_std_dev,
                                                                 verbose = self.verbose,
-                                                                random_seed = random_seed)
+                                                                random_seed = random_seed,
+                                                                num_threads = num_threads)
 
         elif self.algorithm_name == "MF_BPR":
 
@@ -96,7 +100,8 @@ class _MatrixFactorization_Cython(BaseMatrixFactorizationRecommender, Incrementa
                                                                 init_mean = init_mean,
                                                                 init_std_dev = init_std_dev,
                                                                 verbose = self.verbose,
-                                                                random_seed = random_seed)
+                                                                random_seed = random_seed,
+                                                                num_threads = num_threads)
         self._prepare_model_for_validation()
         self._update_best_model()
 
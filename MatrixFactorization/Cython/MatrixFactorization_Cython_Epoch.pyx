@@ -25,8 +25,8 @@ cimport numpy as np
 import time, math
 import sys
 
-from libc.math cimport exp, sqrt
-from libc.stdlib cimport rand, srand, RAND_MAX
+from cython.parallel import prange, threadid
+from libc.math cimport exp, sqrt, pow
 
 
 cdef struct BPR_sample:
@@ -42,6 +42,25 @@ cdef struct MSE_sample:
 
 
 
+cdef inline unsigned long long xorshift_next(unsigned long long * state) noexcept nogil:
+    """
+    xorshift64* generator, each thread has its own state so the sampling does not share the libc rand() global state
+    """
+    state[0] ^= state[0] >> 12
+    state[0] ^= state[0] << 25
+    state[0] ^= state[0] >> 27
+    return state[0] * <unsigned long long> 2685821657736338717
+
+
+cdef inline long xorshift_randint(unsigned long long * state, long n) noexcept nogil:
+    return <long> ((xorshift_next(state) >> 11) % <unsigned long long> n)
+
+
+cdef inline double xorshift_uniform(unsigned long long * state) noexcept nogil:
+    return (xorshift_next(state) >> 11) * (1.0 / 9007199254740992.0)
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.initializedcheck(False)
@@ -56,7 +75,7 @@ cdef class MatrixFactorization_Cython_Epoch:
     cdef double learning_rate, user_reg, item_reg, positive_reg, negative_reg, bias_reg
     cdef double init_mean, init_std_dev, MSE_negative_interactions_quota, MSE_sample_negative_interactions_flag
 
-    cdef int batch_size
+    cdef int batch_size, num_threads
 
     cdef int algorithm_is_funk_svd, algorithm_is_asy_svd, algorithm_is_BPR
 
@@ -66,14 +85,21 @@ cdef class MatrixFactorization_Cython_Epoch:
     cdef double[:,:] USER_factors, ITEM_factors
     cdef double[:] USER_bias, ITEM_bias, GLOBAL_bias
 
+    # One random generator state per thread, padded to 8 values so that each thread writes its own cache line
+    cdef unsigned long long[:,:] random_state
+
 
-    # Mini-batch sample data
-    cdef double[:,:] USER_factors_minibatch_accumulator, ITEM_factors_minibatch_accumulator
-    cdef double[:] USER_bias_minibatch_accumulator, ITEM_bias_minibatch_accumulator, GLOBAL_bias_minibatch_accumulator
+    # Mini-batch sample data, the first dimension is the thread
+    # The accumulators have one row for each distinct user or item sampled in the current mini-batch,
+    # mini_batch_user_position and mini_batch_item_position map the user or item to its row, -1 if not sampled
+    cdef double[:,:,:] USER_factors_minibatch_accumulator, ITEM_factors_minibatch_accumulator
+    cdef double[:,:] USER_bias_minibatch_accumulator, ITEM_bias_minibatch_accumulator
 
-    cdef long[:] mini_batch_sampled_items, mini_batch_sampled_users
-    cdef long[:] mini_batch_sampled_items_flag, mini_batch_sampled_users_flag
-    cdef long mini_batch_sampled_items_counter, mini_batch_sampled_users_counter
+    cdef long[:,:] mini_batch_sampled_items, mini_batch_sampled_users
+    cdef int[:,:] mini_batch_item_position, mini_batch_user_position
+
+    # ASY_SVD user factors, estimated from the profile of the sampled user
+    cdef double[:,:] user_factors_accumulated
 
     # Adaptive gradient
     cdef int useAdaGrad, useRmsprop, useAdam, verbose, use_bias
@@ -86,8 +112,10 @@ cdef class MatrixFactorization_Cython_Epoch:
     cdef double [:,:] sgd_cache_bias_I_momentum_1, sgd_cache_bias_I_momentum_2
     cdef double [:,:] sgd_cache_bias_U_momentum_1, sgd_cache_bias_U_momentum_2
     cdef double [:,:] sgd_cache_bias_GLOBAL_momentum_1, sgd_cache_bias_GLOBAL_momentum_2
-    cdef double beta_1, beta_2, beta_1_power_t, beta_2_power_t
-    cdef double momentum_1, momentum_2
+    cdef double beta_1, beta_2
+
+    # Number of mini-batches of the previous epochs, the Adam bias correction of a mini-batch depends on its global index
+    cdef long n_completed_batches
 
     SGD_MODE_VALUES = ["sgd", "adam", "adagrad", "rmsprop"]
     ALGORITHM_NAME_VALUES = ["FUNK_SVD", "ASY_SVD", "MF_BPR"]
@@ -100,11 +128,20 @@ cdef class MatrixFactorization_Cython_Epoch:
                  user_reg = 0.0, item_reg = 0.0, bias_reg = 0.0, positive_reg = 0.0, negative_reg = 0.0,
                  verbose = False, print_step_seconds = 300, random_seed = None,
                  init_mean = 0.0, init_std_dev = 0.1,
-                 sgd_mode='sgd', gamma=0.995, beta_1=0.9, beta_2=0.999):
+                 sgd_mode='sgd', gamma=0.995, beta_1=0.9, beta_2=0.999,
+                 num_threads = 1):
+        """
+        :param num_threads:     Number of OpenMP threads the mini-batches of an epoch are split across.
+                                Each thread samples with its own random generator and applies its updates
+                                to the shared latent factors without locking (Hogwild)
+        """
 
         super(MatrixFactorization_Cython_Epoch, self).__init__()
 
 
+        if num_threads < 1:
+            raise ValueError("Value for 'num_threads' must be a positive integer, provided was '{}'".format(num_threads))
+
         if sgd_mode not in self.SGD_MODE_VALUES:
            raise ValueError("Value for 'sgd_mode' not recognized. Acceptable values are {}, provided was '{}'".format(self.SGD_MODE_VALUES, sgd_mode))
 
@@ -133,6 +170,7 @@ cdef class MatrixFactorization_Cython_Epoch:
 
         self.use_bias = use_bias
         self.batch_size = batch_size
+        self.num_threads = num_threads
         self.init_mean = init_mean
         self.init_std_dev = init_std_dev
         self.MSE_negative_interactions_quota = negative_interactions_quota
@@ -144,12 +182,18 @@ cdef class MatrixFactorization_Cython_Epoch:
 
         if random_seed is not None:
             np.random.seed(seed=random_seed)
-            srand(<unsigned int> int(random_seed))
 
         self._init_latent_factors()
         self._init_minibatch_data_structures()
         self._init_adaptive_gradient_cache(sgd_mode, gamma, beta_1, beta_2)
 
+        # xorshift requires a non-zero state
+        random_state = np.zeros((self.num_threads, 8), dtype=np.uint64)
+        random_state[:,0] = np.random.randint(1, np.iinfo(np.int64).max, size=self.num_threads, dtype=np.int64)
+        self.random_state = random_state
+
+        self.n_completed_batches = 0
+
 
 
     def _init_latent_factors(self):
@@ -177,19 +221,12 @@ cdef class MatrixFactorization_Cython_Epoch:
         self.USER_factors = np.random.normal(self.init_mean, self.init_std_dev, (n_user_factors, self.n_factors)).astype(np.float64)
         self.ITEM_factors = np.random.normal(self.init_mean, self.init_std_dev, (n_item_factors, self.n_factors)).astype(np.float64)
 
-        self.USER_factors_minibatch_accumulator = np.zeros((n_user_factors, self.n_factors), dtype=np.float64)
-        self.ITEM_factors_minibatch_accumulator = np.zeros((n_item_factors, self.n_factors), dtype=np.float64)
-
 
         if self.use_bias:
             self.USER_bias = np.zeros(self.n_users, dtype=np.float64)
             self.ITEM_bias = np.zeros(self.n_items, dtype=np.float64)
             self.GLOBAL_bias = np.zeros(1, dtype=np.float64)
 
-            self.USER_bias_minibatch_accumulator = np.zeros(self.n_users, dtype=np.float64)
-            self.ITEM_bias_minibatch_accumulator = np.zeros(self.n_items, dtype=np.float64)
-            self.GLOBAL_bias_minibatch_accumulator = np.zeros(1, dtype=np.float64)
-
 
 
 
@@ -217,8 +254,6 @@ cdef class MatrixFactorization_Cython_Epoch:
             # beta_1=0.9, beta_2=0.999
             self.beta_1 = beta_1
             self.beta_2 = beta_2
-            self.beta_1_power_t = beta_1
-            self.beta_2_power_t = beta_2
 
 
 
@@ -274,408 +309,330 @@ cdef class MatrixFactorization_Cython_Epoch:
 
 
     def epochIteration_Cython(self):
+        """
+        The mini-batches of the epoch are split across num_threads OpenMP threads.
+        Each thread samples its mini-batches with its own random generator, accumulates the gradients in its own
+        mini-batch accumulators and applies the updates to the shared latent factors without locking (Hogwild).
+        With num_threads = 1 the mini-batches are processed sequentially.
 
-        if self.algorithm_is_funk_svd:
-            self.epochIteration_Cython_FUNK_SVD_SGD()
-
-        elif self.algorithm_is_asy_svd:
-            self.epochIteration_Cython_ASY_SVD_SGD()
-
-        elif self.algorithm_is_BPR:
-            self.epochIteration_Cython_BPR_SGD()
+        See:
+        F. Niu, B. Recht, C. Re and S. J. Wright, Hogwild!: A lock-free approach to parallelizing stochastic gradient descent,
+        NIPS 2011.
+        """
 
+        cdef long n_total_batch, n_batch, block_start = 0, block_end, print_block_size
+        cdef double cumulative_loss = 0.0
 
-
-    def epochIteration_Cython_FUNK_SVD_SGD(self):
+        if self.algorithm_is_asy_svd:
+            assert self.batch_size == 1, "Batch size other than 1 not supported for ASY_SVD"
 
         # Get number of available interactions
-        cdef long n_total_batch = int(len(self.URM_train_data) / self.batch_size) + 1
-
-        cdef MSE_sample sample
-        cdef long factor_index, n_current_batch, n_sample_in_batch, processed_samples_last_print=0, print_block_size = 500
-        cdef double prediction, prediction_error
-        cdef double local_gradient_item, local_gradient_user, local_gradient_bias_item, local_gradient_bias_user, local_gradient_bias_global
-
-        cdef double H_i, W_u, cumulative_loss = 0.0
-
-
-        cdef long start_time_epoch = time.time()
-        cdef long last_print_time = start_time_epoch
-
-        for n_current_batch in range(n_total_batch):
-
-            self._clear_minibatch_data_structures()
-
-            # Iterate over samples in batch
-            for n_sample_in_batch in range(self.batch_size):
-
-                # Uniform user sampling with replacement
-                sample = self.sampleMSE_Cython()
-
-                self._add_MSE_sample_in_minibatch(sample)
-
-                # Compute prediction
-                if self.use_bias:
-                    prediction = self.GLOBAL_bias[0] + self.USER_bias[sample.user] + self.ITEM_bias[sample.item]
-                else:
-                    prediction = 0.0
-
-                for factor_index in range(self.n_factors):
-                    prediction += self.USER_factors[sample.user, factor_index] * self.ITEM_factors[sample.item, factor_index]
-
-
-                # Compute gradients
-                prediction_error = sample.rating - prediction
-                cumulative_loss += prediction_error**2
-
-
-                if self.use_bias:
-                    local_gradient_bias_global = prediction_error - self.bias_reg * self.GLOBAL_bias[0]
-                    local_gradient_bias_item = prediction_error - self.bias_reg * self.ITEM_bias[sample.item]
-                    local_gradient_bias_user = prediction_error - self.bias_reg * self.USER_bias[sample.user]
-
-                    self.GLOBAL_bias_minibatch_accumulator[0] += local_gradient_bias_global
-                    self.ITEM_bias_minibatch_accumulator[sample.item] += local_gradient_bias_item
-                    self.USER_bias_minibatch_accumulator[sample.user] += local_gradient_bias_user
-
-
-                for factor_index in range(self.n_factors):
-
-                    # Copy original value to avoid messing up the updates
-                    H_i = self.ITEM_factors[sample.item, factor_index]
-                    W_u = self.USER_factors[sample.user, factor_index]
-
-                    # Compute gradients
-                    local_gradient_item = prediction_error * W_u - self.positive_reg * H_i
-                    local_gradient_user = prediction_error * H_i - self.user_reg * W_u
-
-                    # Store the gradient in the temporary accumulator
-                    self.ITEM_factors_minibatch_accumulator[sample.item, factor_index] += local_gradient_item
-                    self.USER_factors_minibatch_accumulator[sample.user, factor_index] += local_gradient_user
+        if self.algorithm_is_BPR:
+            n_total_batch = int(self.n_users / self.batch_size) + 1
+        else:
+            n_total_batch = int(len(self.URM_train_data) / self.batch_size) + 1
 
+        # The mini-batches are processed in blocks, progress is printed between blocks
+        if self.verbose:
+            print_block_size = max(500, self.num_threads)
+        else:
+            print_block_size = n_total_batch
 
-            self._apply_minibatch_updates_to_latent_factors()
+        start_time_epoch = time.time()
+        last_print_time = start_time_epoch
 
+        while block_start < n_total_batch:
 
-            # Exponentiation of beta at the end of each mini batch
-            if self.useAdam:
+            block_end = min(block_start + print_block_size, n_total_batch)
 
-                self.beta_1_power_t *= self.beta_1
-                self.beta_2_power_t *= self.beta_2
+            with nogil:
+                for n_batch in prange(block_start, block_end, schedule='dynamic', num_threads=self.num_threads):
+                    cumulative_loss += self._run_minibatch(n_batch)
 
-            processed_samples_last_print += 1
+            block_start = block_end
 
-            if self.verbose and (processed_samples_last_print >= print_block_size or n_current_batch == n_total_batch-1):
+            if self.verbose:
 
-                # Set block size to the number of items necessary in order to print every 300 seconds
+                # Set block size to the number of batches necessary in order to print every 300 seconds
                 current_time = time.time()
-                samples_per_sec = n_current_batch/(current_time - start_time_epoch)
-                print_block_size = math.ceil(samples_per_sec * self.print_step_seconds)
+                samples_per_sec = block_end/(current_time - start_time_epoch)
+                print_block_size = max(math.ceil(samples_per_sec * self.print_step_seconds), self.num_threads)
 
-                if current_time - last_print_time > self.print_step_seconds or n_current_batch == n_total_batch-1:
+                if current_time - last_print_time > self.print_step_seconds or block_end == n_total_batch:
                     new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time_epoch)
 
                     print("{}: Processed {} ({:4.1f}%) in {:.2f} {}. MSE loss {:.2E}. Sample per second: {:.0f}".format(
                         self.algorithm_name,
-                        (n_current_batch+1)*self.batch_size,
-                        100.0* (n_current_batch+1)/n_total_batch,
+                        block_end*self.batch_size,
+                        100.0* block_end/n_total_batch,
                         new_time_value, new_time_unit,
-                        cumulative_loss/((n_current_batch+1)*self.batch_size),
-                        float((n_current_batch+1)*self.batch_size) / (time.time() - start_time_epoch)))
+                        cumulative_loss/(block_end*self.batch_size),
+                        float(block_end*self.batch_size) / (time.time() - start_time_epoch)))
 
                     last_print_time = current_time
-                    processed_samples_last_print = 0
 
                     sys.stdout.flush()
                     sys.stderr.flush()
 
 
+        self.n_completed_batches += n_total_batch
 
 
 
-    def epochIteration_Cython_ASY_SVD_SGD(self):
+    cdef double _run_minibatch(self, long n_batch) noexcept nogil:
 
+        if self.algorithm_is_funk_svd:
+            return self._minibatch_FUNK_SVD_SGD(n_batch)
 
-        assert self.batch_size == 1, "Batch size other than 1 not supported for ASY_SVD"
+        elif self.algorithm_is_asy_svd:
+            return self._minibatch_ASY_SVD_SGD(n_batch)
 
-        # Get number of available interactions
-        cdef long n_total_batch = int(len(self.URM_train_data) / self.batch_size) + 1
+        else:
+            return self._minibatch_BPR_SGD(n_batch)
 
-        cdef MSE_sample sample
-        cdef long n_current_batch, n_sample_in_batch, processed_samples_last_print = 0, print_block_size = 500
-        cdef double prediction, prediction_error
-        cdef double local_gradient_item, local_gradient_user, local_gradient_bias_item, local_gradient_bias_user, local_gradient_bias_global
 
-        cdef double[:] user_factors_accumulated = np.zeros(self.n_factors, dtype=np.float64)
-        cdef long start_pos_seen_items, end_pos_seen_items, item_id, factor_index, item_index, user_index
 
-        cdef double H_i, W_u, cumulative_loss = 0.0, denominator
+    cdef double _minibatch_FUNK_SVD_SGD(self, long n_batch) noexcept nogil:
 
+        cdef int thread_id = threadid()
 
-        cdef long start_time_epoch = time.time()
-        cdef long last_print_time = start_time_epoch
+        cdef MSE_sample sample
+        cdef long factor_index, n_sample_in_batch, user_position, item_position
+        cdef long n_sampled_users = 0, n_sampled_items = 0
+        cdef double prediction, prediction_error
+        cdef double local_gradient_item, local_gradient_user
 
+        cdef double H_i, W_u, cumulative_loss = 0.0, GLOBAL_bias_minibatch_accumulator = 0.0
 
-        for n_current_batch in range(n_total_batch):
 
+        # Iterate over samples in batch
+        for n_sample_in_batch in range(self.batch_size):
 
-            prediction_error = 0.0
+            # Uniform user sampling with replacement
+            sample = self.sampleMSE_Cython(thread_id)
 
-            # Iterate over samples in batch
-            for n_sample_in_batch in range(self.batch_size):
+            user_position = self._add_user_in_minibatch(thread_id, sample.user, &n_sampled_users)
+            item_position = self._add_item_in_minibatch(thread_id, sample.item, &n_sampled_items)
 
-                # Uniform user sampling with replacement
-                sample = self.sampleMSE_Cython()
+            # Compute prediction
+            if self.use_bias:
+                prediction = self.GLOBAL_bias[0] + self.USER_bias[sample.user] + self.ITEM_bias[sample.item]
+            else:
+                prediction = 0.0
 
-                self.mini_batch_sampled_items[n_sample_in_batch] = sample.item
-                self.mini_batch_sampled_users[n_sample_in_batch] = sample.user
+            for factor_index in range(self.n_factors):
+                prediction += self.USER_factors[sample.user, factor_index] * self.ITEM_factors[sample.item, factor_index]
 
 
-                for factor_index in range(self.n_factors):
-                    user_factors_accumulated[factor_index] = 0.0
+            # Compute gradients
+            prediction_error = sample.rating - prediction
+            cumulative_loss += prediction_error**2
 
 
-                # Accumulate latent factors of rated items
-                start_pos_seen_items = self.URM_train_indptr[sample.user]
-                end_pos_seen_items = self.URM_train_indptr[sample.user+1]
+            if self.use_bias:
+                GLOBAL_bias_minibatch_accumulator += prediction_error - self.bias_reg * self.GLOBAL_bias[0]
+                self.ITEM_bias_minibatch_accumulator[thread_id, item_position] += prediction_error - self.bias_reg * self.ITEM_bias[sample.item]
+                self.USER_bias_minibatch_accumulator[thread_id, user_position] += prediction_error - self.bias_reg * self.USER_bias[sample.user]
 
-                for item_index in range(start_pos_seen_items, end_pos_seen_items):
-                    item_id = self.URM_train_indices[item_index]
 
-                    for factor_index in range(self.n_factors):
-                        user_factors_accumulated[factor_index] += self.USER_factors[item_id, factor_index]
+            for factor_index in range(self.n_factors):
 
+                # Copy original value to avoid messing up the updates
+                H_i = self.ITEM_factors[sample.item, factor_index]
+                W_u = self.USER_factors[sample.user, factor_index]
 
-                denominator = sqrt(self.profile_length[sample.user])
+                # Compute gradients
+                local_gradient_item = prediction_error * W_u - self.positive_reg * H_i
+                local_gradient_user = prediction_error * H_i - self.user_reg * W_u
 
+                # Store the gradient in the temporary accumulator
+                self.ITEM_factors_minibatch_accumulator[thread_id, item_position, factor_index] += local_gradient_item
+                self.USER_factors_minibatch_accumulator[thread_id, user_position, factor_index] += local_gradient_user
 
-                for factor_index in range(self.n_factors):
-                    user_factors_accumulated[factor_index] /= denominator
 
-                # Compute prediction
-                if self.use_bias:
-                    prediction = self.GLOBAL_bias[0] + self.USER_bias[sample.user] + self.ITEM_bias[sample.item]
-                else:
-                    prediction = 0.0
+        self._apply_minibatch_updates_to_latent_factors(thread_id, n_batch, n_sampled_users, n_sampled_items, GLOBAL_bias_minibatch_accumulator)
 
-                for factor_index in range(self.n_factors):
-                    prediction += user_factors_accumulated[factor_index] * self.ITEM_factors[sample.item, factor_index]
+        return cumulative_loss
 
 
 
-                prediction_error += sample.rating - prediction
 
 
-            prediction_error /= self.batch_size
-            cumulative_loss += prediction_error**2
+    cdef double _minibatch_ASY_SVD_SGD(self, long n_batch) noexcept nogil:
+        # Batch size other than 1 not supported for ASY_SVD, each mini-batch is a single sample
 
+        cdef int thread_id = threadid()
 
+        cdef MSE_sample sample
+        cdef double prediction, prediction_error
+        cdef double local_gradient_item, local_gradient_user, local_gradient_bias_item, local_gradient_bias_user, local_gradient_bias_global
 
-            if self.use_bias:
+        cdef long start_pos_seen_items, end_pos_seen_items, item_id, factor_index, item_index
 
-                # Compute gradients
-                local_gradient_bias_global = prediction_error - self.bias_reg * self.GLOBAL_bias[0]
+        cdef double H_i, W_u, denominator
+        cdef double beta_1_power_t = pow(self.beta_1, self.n_completed_batches + n_batch + 1)
+        cdef double beta_2_power_t = pow(self.beta_2, self.n_completed_batches + n_batch + 1)
 
-                # Compute adaptive gradients
-                local_gradient_bias_global = self.adaptive_gradient(local_gradient_bias_global, 0, 0, self.sgd_cache_bias_GLOBAL, self.sgd_cache_bias_GLOBAL_momentum_1, self.sgd_cache_bias_GLOBAL_momentum_2)
 
-                # Apply updates to bias and latent factors
-                self.GLOBAL_bias[0] += self.learning_rate * local_gradient_bias_global
+        # Uniform user sampling with replacement
+        sample = self.sampleMSE_Cython(thread_id)
 
+        for factor_index in range(self.n_factors):
+            self.user_factors_accumulated[thread_id, factor_index] = 0.0
 
 
-            # Iterate over samples in batch
-            for n_sample_in_batch in range(self.batch_size):
+        # Accumulate latent factors of rated items
+        start_pos_seen_items = self.URM_train_indptr[sample.user]
+        end_pos_seen_items = self.URM_train_indptr[sample.user+1]
 
-                sample.item = self.mini_batch_sampled_items[n_sample_in_batch]
-                sample.user = self.mini_batch_sampled_users[n_sample_in_batch]
+        for item_index in range(start_pos_seen_items, end_pos_seen_items):
+            item_id = self.URM_train_indices[item_index]
 
-                if self.use_bias:
+            for factor_index in range(self.n_factors):
+                self.user_factors_accumulated[thread_id, factor_index] += self.USER_factors[item_id, factor_index]
 
-                    # Compute gradients
-                    local_gradient_bias_item = prediction_error - self.bias_reg * self.ITEM_bias[sample.item]
-                    local_gradient_bias_user = prediction_error - self.bias_reg * self.USER_bias[sample.user]
 
-                    # Compute adaptive gradients
-                    local_gradient_bias_item = self.adaptive_gradient(local_gradient_bias_item, sample.item, 0, self.sgd_cache_bias_I, self.sgd_cache_bias_I_momentum_1, self.sgd_cache_bias_I_momentum_2)
-                    local_gradient_bias_user = self.adaptive_gradient(local_gradient_bias_user, sample.user, 0, self.sgd_cache_bias_U, self.sgd_cache_bias_U_momentum_1, self.sgd_cache_bias_U_momentum_2)
+        denominator = sqrt(self.profile_length[sample.user])
 
-                    # Apply updates to bias
-                    self.ITEM_bias[sample.item] += self.learning_rate * local_gradient_bias_item
-                    self.USER_bias[sample.user] += self.learning_rate * local_gradient_bias_user
 
+        for factor_index in range(self.n_factors):
+            self.user_factors_accumulated[thread_id, factor_index] /= denominator
 
-                # Update USER factors, therefore all item factors for seen items
-                for item_index in range(start_pos_seen_items, end_pos_seen_items):
-                    item_id = self.URM_train_indices[item_index]
+        # Compute prediction
+        if self.use_bias:
+            prediction = self.GLOBAL_bias[0] + self.USER_bias[sample.user] + self.ITEM_bias[sample.item]
+        else:
+            prediction = 0.0
 
-                    for factor_index in range(self.n_factors):
+        for factor_index in range(self.n_factors):
+            prediction += self.user_factors_accumulated[thread_id, factor_index] * self.ITEM_factors[sample.item, factor_index]
 
-                        H_i = self.ITEM_factors[sample.item, factor_index]
-                        W_u = self.USER_factors[item_id, factor_index]
 
-                        # Compute gradients USER
-                        # Both matrices will have the size |I|x|F|
-                        local_gradient_user = prediction_error * H_i - self.user_reg * W_u
+        prediction_error = sample.rating - prediction
 
-                        # Compute adaptive gradients USER
-                        # I need to update NOT sample.item but item_id
-                        local_gradient_user = self.adaptive_gradient(local_gradient_user, item_id, factor_index, self.sgd_cache_U, self.sgd_cache_U_momentum_1, self.sgd_cache_U_momentum_2)
 
-                        # Apply update to latent factors
-                        self.USER_factors[item_id, factor_index] += self.learning_rate * local_gradient_user
+        if self.use_bias:
 
+            # Compute gradients
+            local_gradient_bias_global = prediction_error - self.bias_reg * self.GLOBAL_bias[0]
+            local_gradient_bias_item = prediction_error - self.bias_reg * self.ITEM_bias[sample.item]
+            local_gradient_bias_user = prediction_error - self.bias_reg * self.USER_bias[sample.user]
 
-                # Update ITEM factors
-                for factor_index in range(self.n_factors):
+            # Compute adaptive gradients
+            local_gradient_bias_global = self.adaptive_gradient(local_gradient_bias_global, 0, 0, self.sgd_cache_bias_GLOBAL, self.sgd_cache_bias_GLOBAL_momentum_1, self.sgd_cache_bias_GLOBAL_momentum_2, beta_1_power_t, beta_2_power_t)
+            local_gradient_bias_item = self.adaptive_gradient(local_gradient_bias_item, sample.item, 0, self.sgd_cache_bias_I, self.sgd_cache_bias_I_momentum_1, self.sgd_cache_bias_I_momentum_2, beta_1_power_t, beta_2_power_t)
+            local_gradient_bias_user = self.adaptive_gradient(local_gradient_bias_user, sample.user, 0, self.sgd_cache_bias_U, self.sgd_cache_bias_U_momentum_1, self.sgd_cache_bias_U_momentum_2, beta_1_power_t, beta_2_power_t)
 
-                    # Copy original value to avoid messing up the updates
-                    H_i = self.ITEM_factors[sample.item, factor_index]
-                    W_u = user_factors_accumulated[factor_index]
+            # Apply updates to bias
+            self.GLOBAL_bias[0] += self.learning_rate * local_gradient_bias_global
+            self.ITEM_bias[sample.item] += self.learning_rate * local_gradient_bias_item
+            self.USER_bias[sample.user] += self.learning_rate * local_gradient_bias_user
 
-                    # Compute gradients ITEM
-                    # Both matrices will have the size |I|x|F|
-                    local_gradient_item = prediction_error * W_u - self.item_reg * H_i
 
-                    # Compute adaptive gradients ITEM
-                    local_gradient_item = self.adaptive_gradient(local_gradient_item, sample.item, factor_index, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2)
+        # Update USER factors, therefore all item factors for seen items
+        for item_index in range(start_pos_seen_items, end_pos_seen_items):
+            item_id = self.URM_train_indices[item_index]
 
-                    # Apply update to latent factors
-                    self.ITEM_factors[sample.item, factor_index] += self.learning_rate * local_gradient_item
+            for factor_index in range(self.n_factors):
 
+                H_i = self.ITEM_factors[sample.item, factor_index]
+                W_u = self.USER_factors[item_id, factor_index]
 
+                # Compute gradients USER
+                # Both matrices will have the size |I|x|F|
+                local_gradient_user = prediction_error * H_i - self.user_reg * W_u
 
-            # Exponentiation of beta at the end of each sample
-            if self.useAdam:
+                # Compute adaptive gradients USER
+                # I need to update NOT sample.item but item_id
+                local_gradient_user = self.adaptive_gradient(local_gradient_user, item_id, factor_index, self.sgd_cache_U, self.sgd_cache_U_momentum_1, self.sgd_cache_U_momentum_2, beta_1_power_t, beta_2_power_t)
 
-                self.beta_1_power_t *= self.beta_1
-                self.beta_2_power_t *= self.beta_2
+                # Apply update to latent factors
+                self.USER_factors[item_id, factor_index] += self.learning_rate * local_gradient_user
 
-            processed_samples_last_print += 1
 
-            if self.verbose and (processed_samples_last_print >= print_block_size or n_current_batch == n_total_batch-1):
+        # Update ITEM factors
+        for factor_index in range(self.n_factors):
 
-                # Set block size to the number of items necessary in order to print every 300 seconds
-                current_time = time.time()
-                samples_per_sec = n_current_batch/(current_time - start_time_epoch)
-                print_block_size = math.ceil(samples_per_sec * self.print_step_seconds)
+            # Copy original value to avoid messing up the updates
+            H_i = self.ITEM_factors[sample.item, factor_index]
+            W_u = self.user_factors_accumulated[thread_id, factor_index]
 
-                if current_time - last_print_time > self.print_step_seconds or n_current_batch == n_total_batch-1:
-                    new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time_epoch)
+            # Compute gradients ITEM
+            # Both matrices will have the size |I|x|F|
+            local_gradient_item = prediction_error * W_u - self.item_reg * H_i
 
-                    print("{}: Processed {} ({:4.1f}%) in {:.2f} {}. MSE loss {:.2E}. Sample per second: {:.0f}".format(
-                        self.algorithm_name,
-                        (n_current_batch+1)*self.batch_size,
-                        100.0* (n_current_batch+1)/n_total_batch,
-                        new_time_value, new_time_unit,
-                        cumulative_loss/((n_current_batch+1)*self.batch_size),
-                        float((n_current_batch+1)*self.batch_size) / (time.time() - start_time_epoch)))
+            # Compute adaptive gradients ITEM
+            local_gradient_item = self.adaptive_gradient(local_gradient_item, sample.item, factor_index, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
 
-                    last_print_time = current_time
-                    processed_samples_last_print = 0
+            # Apply update to latent factors
+            self.ITEM_factors[sample.item, factor_index] += self.learning_rate * local_gradient_item
 
-                    sys.stdout.flush()
-                    sys.stderr.flush()
 
+        return prediction_error**2
 
 
 
-    def epochIteration_Cython_BPR_SGD(self):
 
-        # Get number of available interactions
-        cdef long n_total_batch = int(self.n_users / self.batch_size) + 1
 
+    cdef double _minibatch_BPR_SGD(self, long n_batch) noexcept nogil:
+
+        cdef int thread_id = threadid()
 
         cdef BPR_sample sample
-        cdef long u, i, j
-        cdef long factor_index, n_current_batch, n_sample_in_batch, processed_samples_last_print = 0, print_block_size = 500
+        cdef long u, i, j, u_position, i_position, j_position
+        cdef long factor_index, n_sample_in_batch
+        cdef long n_sampled_users = 0, n_sampled_items = 0
         cdef double x_uij, sigmoid_user, sigmoid_item, local_gradient_i, local_gradient_j, local_gradient_u
 
         cdef double H_i, H_j, W_u, cumulative_loss = 0.0
 
 
-        cdef long start_time_epoch = time.time()
-        cdef long last_print_time = start_time_epoch
-
-        for n_current_batch in range(n_total_batch):
-
-            self._clear_minibatch_data_structures()
+        # Iterate over samples in batch
+        for n_sample_in_batch in range(self.batch_size):
 
-            # Iterate over samples in batch
-            for n_sample_in_batch in range(self.batch_size):
+            # Uniform user sampling with replacement
+            sample = self.sampleBPR_Cython(thread_id)
 
-                # Uniform user sampling with replacement
-                sample = self.sampleBPR_Cython()
+            u = sample.user
+            i = sample.pos_item
+            j = sample.neg_item
 
-                self._add_BPR_sample_in_minibatch(sample)
+            u_position = self._add_user_in_minibatch(thread_id, u, &n_sampled_users)
+            i_position = self._add_item_in_minibatch(thread_id, i, &n_sampled_items)
+            j_position = self._add_item_in_minibatch(thread_id, j, &n_sampled_items)
 
-                u = sample.user
-                i = sample.pos_item
-                j = sample.neg_item
+            x_uij = 0.0
 
-                x_uij = 0.0
-
-                for factor_index in range(self.n_factors):
-                    x_uij += self.USER_factors[u,factor_index] * (self.ITEM_factors[i,factor_index] - self.ITEM_factors[j,factor_index])
-
-                # Use gradient of log(sigm(-x_uij))
-                sigmoid_item = 1 / (1 + exp(x_uij))
-                sigmoid_user = sigmoid_item
+            for factor_index in range(self.n_factors):
+                x_uij += self.USER_factors[u,factor_index] * (self.ITEM_factors[i,factor_index] - self.ITEM_factors[j,factor_index])
 
-                cumulative_loss += x_uij**2
+            # Use gradient of log(sigm(-x_uij))
+            sigmoid_item = 1 / (1 + exp(x_uij))
+            sigmoid_user = sigmoid_item
 
+            cumulative_loss += x_uij**2
 
-                for factor_index in range(self.n_factors):
 
-                    # Copy original value to avoid messing up the updates
-                    H_i = self.ITEM_factors[i, factor_index]
-                    H_j = self.ITEM_factors[j, factor_index]
-                    W_u = self.USER_factors[u, factor_index]
+            for factor_index in range(self.n_factors):
 
-                    # Compute gradients
-                    local_gradient_i = sigmoid_item * ( W_u ) - self.positive_reg * H_i
-                    local_gradient_j = sigmoid_item * (-W_u ) - self.negative_reg * H_j
-                    local_gradient_u = sigmoid_user * ( H_i - H_j ) - self.user_reg * W_u
+                # Copy original value to avoid messing up the updates
+                H_i = self.ITEM_factors[i, factor_index]
+                H_j = self.ITEM_factors[j, factor_index]
+                W_u = self.USER_factors[u, factor_index]
 
-                    self.USER_factors_minibatch_accumulator[u, factor_index] += local_gradient_u
-                    self.ITEM_factors_minibatch_accumulator[i, factor_index] += local_gradient_i
-                    self.ITEM_factors_minibatch_accumulator[j, factor_index] += local_gradient_j
+                # Compute gradients
+                local_gradient_i = sigmoid_item * ( W_u ) - self.positive_reg * H_i
+                local_gradient_j = sigmoid_item * (-W_u ) - self.negative_reg * H_j
+                local_gradient_u = sigmoid_user * ( H_i - H_j ) - self.user_reg * W_u
 
+                self.USER_factors_minibatch_accumulator[thread_id, u_position, factor_index] += local_gradient_u
+                self.ITEM_factors_minibatch_accumulator[thread_id, i_position, factor_index] += local_gradient_i
+                self.ITEM_factors_minibatch_accumulator[thread_id, j_position, factor_index] += local_gradient_j
 
-            self._apply_minibatch_updates_to_latent_factors()
 
+        self._apply_minibatch_updates_to_latent_factors(thread_id, n_batch, n_sampled_users, n_sampled_items, 0.0)
 
-            # Exponentiation of beta at the end of each sample
-            if self.useAdam:
-
-                self.beta_1_power_t *= self.beta_1
-                self.beta_2_power_t *= self.beta_2
-
-            processed_samples_last_print += 1
-
-            if self.verbose and (processed_samples_last_print >= print_block_size or n_current_batch == n_total_batch-1):
-
-                # Set block size to the number of items necessary in order to print every 300 seconds
-                current_time = time.time()
-                samples_per_sec = n_current_batch/(current_time - start_time_epoch)
-                print_block_size = math.ceil(samples_per_sec * self.print_step_seconds)
-
-                if current_time - last_print_time > self.print_step_seconds or n_current_batch == n_total_batch-1:
-                    new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time_epoch)
-
-                    print("{}: Processed {} ({:4.1f}%) in {:.2f} {}. MSE loss {:.2E}. Sample per second: {:.0f}".format(
-                        self.algorithm_name,
-                        (n_current_batch+1)*self.batch_size,
-                        100.0* (n_current_batch+1)/n_total_batch,
-                        new_time_value, new_time_unit,
-                        cumulative_loss/((n_current_batch+1)*self.batch_size),
-                        float((n_current_batch+1)*self.batch_size) / (time.time() - start_time_epoch)))
-
-                    last_print_time = current_time
-                    processed_samples_last_print = 0
-
-                    sys.stdout.flush()
-                    sys.stderr.flush()
+        return cumulative_loss
 
 
 
@@ -709,136 +666,143 @@ cdef class MatrixFactorization_Cython_Epoch:
     def _init_minibatch_data_structures(self):
 
         # The shape depends on the batch size. 1 for FunkSVD 2 for BPR as it samples two items
-        self.mini_batch_sampled_items = np.zeros(self.batch_size*2, dtype=int)
-        self.mini_batch_sampled_users = np.zeros(self.batch_size, dtype=int)
+        self.mini_batch_sampled_items = np.zeros((self.num_threads, self.batch_size*2), dtype=int)
+        self.mini_batch_sampled_users = np.zeros((self.num_threads, self.batch_size), dtype=int)
+
+        self.mini_batch_item_position = np.full((self.num_threads, self.n_items), -1, dtype=np.int32)
+        self.mini_batch_user_position = np.full((self.num_threads, self.n_users), -1, dtype=np.int32)
 
-        self.mini_batch_sampled_items_flag = np.zeros(self.n_items, dtype=int)
-        self.mini_batch_sampled_users_flag = np.zeros(self.n_users, dtype=int)
+        self.ITEM_factors_minibatch_accumulator = np.zeros((self.num_threads, self.batch_size*2, self.n_factors), dtype=np.float64)
+        self.USER_factors_minibatch_accumulator = np.zeros((self.num_threads, self.batch_size, self.n_factors), dtype=np.float64)
 
-        self.mini_batch_sampled_items_counter = 0
-        self.mini_batch_sampled_users_counter = 0
+        if self.use_bias:
+            self.ITEM_bias_minibatch_accumulator = np.zeros((self.num_threads, self.batch_size*2), dtype=np.float64)
+            self.USER_bias_minibatch_accumulator = np.zeros((self.num_threads, self.batch_size), dtype=np.float64)
 
+        self.user_factors_accumulated = np.zeros((self.num_threads, self.n_factors), dtype=np.float64)
 
 
-    cdef void _clear_minibatch_data_structures(self):
 
-        cdef long array_index, item_index
+    cdef long _add_item_in_minibatch(self, int thread_id, long item_id, long * n_sampled_items) noexcept nogil:
+        """
+        Returns the row of item_id in the mini-batch accumulators of thread_id,
+        if the item was not yet sampled in the current mini-batch a new row is assigned and cleared
+        """
 
-        for array_index in range(self.mini_batch_sampled_items_counter):
-            item_index = self.mini_batch_sampled_items[array_index]
-            self.mini_batch_sampled_items_flag[item_index] = False
+        cdef long factor_index
+        cdef long item_position = self.mini_batch_item_position[thread_id, item_id]
 
-        for array_index in range(self.mini_batch_sampled_users_counter):
-            item_index = self.mini_batch_sampled_users[array_index]
-            self.mini_batch_sampled_users_flag[item_index] = False
+        if item_position == -1:
+            item_position = n_sampled_items[0]
+            n_sampled_items[0] += 1
 
-        self.mini_batch_sampled_items_counter = 0
-        self.mini_batch_sampled_users_counter = 0
+            self.mini_batch_item_position[thread_id, item_id] = item_position
+            self.mini_batch_sampled_items[thread_id, item_position] = item_id
 
+            for factor_index in range(self.n_factors):
+                self.ITEM_factors_minibatch_accumulator[thread_id, item_position, factor_index] = 0.0
 
+            if self.use_bias:
+                self.ITEM_bias_minibatch_accumulator[thread_id, item_position] = 0.0
 
-    cdef void _add_MSE_sample_in_minibatch(self, MSE_sample sample):
+        return item_position
 
-        if not self.mini_batch_sampled_items_flag[sample.item]:
-            self.mini_batch_sampled_items_flag[sample.item] = True
-            self.mini_batch_sampled_items[self.mini_batch_sampled_items_counter] = sample.item
-            self.mini_batch_sampled_items_counter += 1
 
-        if not self.mini_batch_sampled_users_flag[sample.user]:
-            self.mini_batch_sampled_users_flag[sample.user] = True
-            self.mini_batch_sampled_users[self.mini_batch_sampled_users_counter] = sample.user
-            self.mini_batch_sampled_users_counter += 1
 
+    cdef long _add_user_in_minibatch(self, int thread_id, long user_id, long * n_sampled_users) noexcept nogil:
 
+        cdef long factor_index
+        cdef long user_position = self.mini_batch_user_position[thread_id, user_id]
 
-    cdef void _add_BPR_sample_in_minibatch(self, BPR_sample sample):
+        if user_position == -1:
+            user_position = n_sampled_users[0]
+            n_sampled_users[0] += 1
 
-        if not self.mini_batch_sampled_items_flag[sample.pos_item]:
-            self.mini_batch_sampled_items_flag[sample.pos_item] = True
-            self.mini_batch_sampled_items[self.mini_batch_sampled_items_counter] = sample.pos_item
-            self.mini_batch_sampled_items_counter += 1
+            self.mini_batch_user_position[thread_id, user_id] = user_position
+            self.mini_batch_sampled_users[thread_id, user_position] = user_id
 
-        if not self.mini_batch_sampled_items_flag[sample.neg_item]:
-            self.mini_batch_sampled_items_flag[sample.neg_item] = True
-            self.mini_batch_sampled_items[self.mini_batch_sampled_items_counter] = sample.neg_item
-            self.mini_batch_sampled_items_counter += 1
+            for factor_index in range(self.n_factors):
+                self.USER_factors_minibatch_accumulator[thread_id, user_position, factor_index] = 0.0
 
-        if not self.mini_batch_sampled_users_flag[sample.user]:
-            self.mini_batch_sampled_users_flag[sample.user] = True
-            self.mini_batch_sampled_users[self.mini_batch_sampled_users_counter] = sample.user
-            self.mini_batch_sampled_users_counter += 1
+            if self.use_bias:
+                self.USER_bias_minibatch_accumulator[thread_id, user_position] = 0.0
+
+        return user_position
 
 
 
-    cdef void _apply_minibatch_updates_to_latent_factors(self):
+    cdef void _apply_minibatch_updates_to_latent_factors(self, int thread_id, long n_batch, long n_sampled_users, long n_sampled_items,
+                                                         double GLOBAL_bias_minibatch_accumulator) noexcept nogil:
 
         cdef double local_gradient_item, local_gradient_user, local_gradient_bias_item, local_gradient_bias_user, local_gradient_bias_global
-        cdef long sampled_user, sampled_item, n_sample_in_batch
+        cdef long sampled_user, sampled_item, n_sample_in_batch, factor_index
+
+        # Exponentiation of beta, one step for each mini batch
+        cdef double beta_1_power_t = pow(self.beta_1, self.n_completed_batches + n_batch + 1)
+        cdef double beta_2_power_t = pow(self.beta_2, self.n_completed_batches + n_batch + 1)
 
 
         if self.use_bias:
 
             # Compute adaptive gradients
-            local_gradient_bias_global = self.GLOBAL_bias_minibatch_accumulator[0] / self.batch_size
-            local_gradient_bias_global = self.adaptive_gradient(local_gradient_bias_global, 0, 0, self.sgd_cache_bias_GLOBAL, self.sgd_cache_bias_GLOBAL_momentum_1, self.sgd_cache_bias_GLOBAL_momentum_2)
+            local_gradient_bias_global = GLOBAL_bias_minibatch_accumulator / self.batch_size
+            local_gradient_bias_global = self.adaptive_gradient(local_gradient_bias_global, 0, 0, self.sgd_cache_bias_GLOBAL, self.sgd_cache_bias_GLOBAL_momentum_1, self.sgd_cache_bias_GLOBAL_momentum_2, beta_1_power_t, beta_2_power_t)
 
             # Apply updates to bias
             self.GLOBAL_bias[0] += self.learning_rate * local_gradient_bias_global
-            self.GLOBAL_bias_minibatch_accumulator[0] = 0.0
 
 
 
 
-        for n_sample_in_batch in range(self.mini_batch_sampled_items_counter):
+        for n_sample_in_batch in range(n_sampled_items):
 
-            sampled_item = self.mini_batch_sampled_items[n_sample_in_batch]
+            sampled_item = self.mini_batch_sampled_items[thread_id, n_sample_in_batch]
+            self.mini_batch_item_position[thread_id, sampled_item] = -1
 
             if self.use_bias:
-                local_gradient_bias_item = self.ITEM_bias_minibatch_accumulator[sampled_item] / self.batch_size
-                local_gradient_bias_item = self.adaptive_gradient(local_gradient_bias_item, sampled_item, 0, self.sgd_cache_bias_I, self.sgd_cache_bias_I_momentum_1, self.sgd_cache_bias_I_momentum_2)
+                local_gradient_bias_item = self.ITEM_bias_minibatch_accumulator[thread_id, n_sample_in_batch] / self.batch_size
+                local_gradient_bias_item = self.adaptive_gradient(local_gradient_bias_item, sampled_item, 0, self.sgd_cache_bias_I, self.sgd_cache_bias_I_momentum_1, self.sgd_cache_bias_I_momentum_2, beta_1_power_t, beta_2_power_t)
 
                 self.ITEM_bias[sampled_item] += self.learning_rate * local_gradient_bias_item
-                self.ITEM_bias_minibatch_accumulator[sampled_item] = 0.0
 
 
             for factor_index in range(self.n_factors):
-                local_gradient_item = self.ITEM_factors_minibatch_accumulator[sampled_item, factor_index] / self.batch_size
-                local_gradient_item = self.adaptive_gradient(local_gradient_item, sampled_item, factor_index, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2)
+                local_gradient_item = self.ITEM_factors_minibatch_accumulator[thread_id, n_sample_in_batch, factor_index] / self.batch_size
+                local_gradient_item = self.adaptive_gradient(local_gradient_item, sampled_item, factor_index, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
 
                 self.ITEM_factors[sampled_item, factor_index] += self.learning_rate * local_gradient_item
-                self.ITEM_factors_minibatch_accumulator[sampled_item, factor_index] = 0.0
 
 
 
 
 
-        for n_sample_in_batch in range(self.mini_batch_sampled_users_counter):
+        for n_sample_in_batch in range(n_sampled_users):
 
-            sampled_user = self.mini_batch_sampled_users[n_sample_in_batch]
+            sampled_user = self.mini_batch_sampled_users[thread_id, n_sample_in_batch]
+            self.mini_batch_user_position[thread_id, sampled_user] = -1
 
             if self.use_bias:
-                local_gradient_bias_user = self.USER_bias_minibatch_accumulator[sampled_user] / self.batch_size
-                local_gradient_bias_user = self.adaptive_gradient(local_gradient_bias_user, sampled_user, 0, self.sgd_cache_bias_U, self.sgd_cache_bias_U_momentum_1, self.sgd_cache_bias_U_momentum_2)
+                local_gradient_bias_user = self.USER_bias_minibatch_accumulator[thread_id, n_sample_in_batch] / self.batch_size
+                local_gradient_bias_user = self.adaptive_gradient(local_gradient_bias_user, sampled_user, 0, self.sgd_cache_bias_U, self.sgd_cache_bias_U_momentum_1, self.sgd_cache_bias_U_momentum_2, beta_1_power_t, beta_2_power_t)
 
                 self.USER_bias[sampled_user] += self.learning_rate * local_gradient_bias_user
-                self.USER_bias_minibatch_accumulator[sampled_user] = 0.0
 
 
             for factor_index in range(self.n_factors):
-                local_gradient_user = self.USER_factors_minibatch_accumulator[sampled_user, factor_index] / self.batch_size
-                local_gradient_user = self.adaptive_gradient(local_gradient_user, sampled_user, factor_index, self.sgd_cache_U, self.sgd_cache_U_momentum_1, self.sgd_cache_U_momentum_2)
+                local_gradient_user = self.USER_factors_minibatch_accumulator[thread_id, n_sample_in_batch, factor_index] / self.batch_size
+                local_gradient_user = self.adaptive_gradient(local_gradient_user, sampled_user, factor_index, self.sgd_cache_U, self.sgd_cache_U_momentum_1, self.sgd_cache_U_momentum_2, beta_1_power_t, beta_2_power_t)
 
                 self.USER_factors[sampled_user, factor_index] += self.learning_rate * local_gradient_user
-                self.USER_factors_minibatch_accumulator[sampled_user, factor_index] = 0.0
 
 
 
 
 
-    cdef double adaptive_gradient(self, double gradient, long user_or_item_id, long factor_id, double[:,:] sgd_cache, double[:,:] sgd_cache_momentum_1, double[:,:] sgd_cache_momentum_2):
+    cdef double adaptive_gradient(self, double gradient, long user_or_item_id, long factor_id, double[:,:] sgd_cache, double[:,:] sgd_cache_momentum_1, double[:,:] sgd_cache_momentum_2,
+                                  double beta_1_power_t, double beta_2_power_t) noexcept nogil:
 
 
-        cdef double gradient_update
+        cdef double gradient_update, momentum_1, momentum_2
 
         if self.useAdaGrad:
             sgd_cache[user_or_item_id, factor_id] += gradient ** 2
@@ -861,10 +825,10 @@ cdef class MatrixFactorization_Cython_Epoch:
                 sgd_cache_momentum_2[user_or_item_id, factor_id] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
 
-            self.momentum_1 = sgd_cache_momentum_1[user_or_item_id, factor_id]/ (1 - self.beta_1_power_t)
-            self.momentum_2 = sgd_cache_momentum_2[user_or_item_id, factor_id]/ (1 - self.beta_2_power_t)
+            momentum_1 = sgd_cache_momentum_1[user_or_item_id, factor_id]/ (1 - beta_1_power_t)
+            momentum_2 = sgd_cache_momentum_2[user_or_item_id, factor_id]/ (1 - beta_2_power_t)
 
-            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
 
         else:
@@ -878,17 +842,18 @@ cdef class MatrixFactorization_Cython_Epoch:
 
 
 
-    cdef MSE_sample sampleMSE_Cython(self):
+    cdef MSE_sample sampleMSE_Cython(self, int thread_id) noexcept nogil:
 
         cdef MSE_sample sample = MSE_sample(-1,-1,-1.0)
         cdef long index, start_pos_seen_items, end_pos_seen_items
+        cdef unsigned long long * random_state = &self.random_state[thread_id, 0]
 
         cdef int neg_item_selected, sample_positive, n_seen_items = 0
 
         # Skip users with no interactions or with no negative items
         while n_seen_items == 0 or n_seen_items == self.n_items:
 
-            sample.user = rand() % self.n_users
+            sample.user = xorshift_randint(random_state, self.n_users)
 
             start_pos_seen_items = self.URM_train_indptr[sample.user]
             end_pos_seen_items = self.URM_train_indptr[sample.user+1]
@@ -898,7 +863,7 @@ cdef class MatrixFactorization_Cython_Epoch:
 
         # Decide to sample positive or negative
         if self.MSE_sample_negative_interactions_flag:
-            sample_positive = rand() <= self.MSE_negative_interactions_quota * RAND_MAX
+            sample_positive = xorshift_uniform(random_state) <= self.MSE_negative_interactions_quota
         else:
             sample_positive = True
 
@@ -906,7 +871,7 @@ cdef class MatrixFactorization_Cython_Epoch:
         if sample_positive:
 
             # Sample positive
-            index = rand() % n_seen_items
+            index = xorshift_randint(random_state, n_seen_items)
 
             sample.item = self.URM_train_indices[start_pos_seen_items + index]
             sample.rating = self.URM_train_data[start_pos_seen_items + index]
@@ -920,7 +885,7 @@ cdef class MatrixFactorization_Cython_Epoch:
             # for every user
             while not neg_item_selected:
 
-                sample.item = rand() % self.n_items
+                sample.item = xorshift_randint(random_state, self.n_items)
                 sample.rating = 0.0
 
                 index = 0
@@ -940,10 +905,11 @@ cdef class MatrixFactorization_Cython_Epoch:
 
 
 
-    cdef BPR_sample sampleBPR_Cython(self):
+    cdef BPR_sample sampleBPR_Cython(self, int thread_id) noexcept nogil:
 
         cdef BPR_sample sample = BPR_sample(-1,-1,-1)
         cdef long index, start_pos_seen_items, end_pos_seen_items
+        cdef unsigned long long * random_state = &self.random_state[thread_id, 0]
 
         cdef int neg_item_selected, n_seen_items = 0
 
@@ -951,7 +917,7 @@ cdef class MatrixFactorization_Cython_Epoch:
         # Skip users with no interactions or with no negative items
         while n_seen_items == 0 or n_seen_items == self.n_items:
 
-            sample.user = rand() % self.n_users
+            sample.user = xorshift_randint(random_state, self.n_users)
 
             start_pos_seen_items = self.URM_train_indptr[sample.user]
             end_pos_seen_items = self.URM_train_indptr[sample.user+1]
@@ -959,7 +925,7 @@ cdef class MatrixFactorization_Cython_Epoch:
             n_seen_items = end_pos_seen_items - start_pos_seen_items
 
 
-        index = rand() % n_seen_items
+        index = xorshift_randint(random_state, n_seen_items)
 
         sample.pos_item = self.URM_train_indices[start_pos_seen_items + index]
 
@@ -971,7 +937,7 @@ cdef class MatrixFactorization_Cython_Epoch:
         # for every user
         while not neg_item_selected:
 
-            sample.neg_item = rand() % self.n_items
+            sample.neg_item = xorshift_randint(random_state, self.n_items)
 
             index = 0
             # Indices data is sorted, so I don't need to go to the end of the current row
@@ -9,9 +9,83 @@ Created on 23/03/2019
 from Base.BaseMatrixFactorizationRecommender import BaseMatrixFactorizationRecommender
 from Base.Incremental_Training_Early_Stopping import Incremental_Training_Early_Stopping
 from Base.Recommender_utils import check_matrix
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 
+
+def _batched_cholesky_solve(B, b):
+    """
+    Solves the linear systems B[k] x[k] = b[k] for a batch of symmetric positive definite matrices.
+    The Cholesky factors are computed for the whole batch, the two triangular systems are then solved with
+    forward and backward substitution, each step is vectorized over the batch.
+    :param B:   |n_systems|x|n_factors|x|n_factors|
+    :param b:   |n_systems|x|n_factors|
+    :return:    |n_systems|x|n_factors|
+    """
+
+    n_factors = B.shape[1]
+
+    L = np.linalg.cholesky(B)
+
+    # Forward substitution L z = b
+    z = np.empty_like(b)
+
+    for factor_index in range(n_factors):
+        z[:,factor_index] = (b[:,factor_index] - np.einsum("ij,ij->i", L[:,factor_index,:factor_index], z[:,:factor_index])) / L[:,factor_index,factor_index]
+
+    # Backward substitution L^T x = z
+    x = np.empty_like(b)
+
+    for factor_index in reversed(range(n_factors)):
+        x[:,factor_index] = (z[:,factor_index] - np.einsum("ij,ij->i", L[:,factor_index+1:,factor_index], x[:,factor_index+1:])) / L[:,factor_index,factor_index]
+
+    return x
+
+
+
+def _get_row_groups(n_interactions_per_row, max_cells, max_rows):
+    """
+    Splits the rows in groups of rows with a similar number of interactions.
+    The interactions of a group are stored in a |n_rows_group|x|max_interactions_group| padded matrix, each group has
+    at most max_cells cells in it and at most max_rows rows. A row with more than max_cells interactions is a group on its own.
+    :param n_interactions_per_row:
+    :param max_cells:
+    :param max_rows:
+    :return: list of arrays with the positions of the rows in each group
+    """
+
+    n_rows = len(n_interactions_per_row)
+
+    # Sorting the rows by number of interactions minimizes the padding
+    rows_sorted = np.argsort(n_interactions_per_row, kind="stable")
+    n_interactions_sorted = n_interactions_per_row[rows_sorted]
+
+    group_list = []
+    group_start = 0
+
+    while group_start < n_rows:
+
+        # The padded size (end - start) * n_interactions_sorted[end-1] is increasing with end, find with a binary search
+        # the last end for which it fits, the group contains at least a row
+        low = group_start + 1
+        high = min(group_start + max_rows, n_rows)
+
+        while low < high:
+            middle = (low + high + 1)//2
+
+            if (middle - group_start) * n_interactions_sorted[middle-1] <= max_cells:
+                low = middle
+            else:
+                high = middle - 1
+
+        group_list.append(rows_sorted[group_start:low])
+        group_start = low
+
+    return group_list
+
+
+
 class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_Early_Stopping):
     """
 
@@ -35,6 +109,10 @@ class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_E
     RECOMMENDER_NAME = "IALSRecommender"
 
     AVAILABLE_CONFIDENCE_SCALING = ["linear", "log"]
+    AVAILABLE_SOLVER = ["cholesky", "cg"]
+
+    # Memory each thread may use for the batched updates
+    SOLVER_MEMORY_BUDGET_BYTES = 2**27
 
 
     def fit(self, epochs = 300,
@@ -45,6 +123,9 @@ class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_E
             reg = 1e-3,
             init_mean=0.0,
             init_std=0.1,
+            solver = "cholesky",
+            cg_steps = 3,
+            num_threads = 1,
             **earlystopping_kwargs):
         """
 
@@ -56,19 +137,30 @@ class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_E
         :param epsilon: epsilon used in log scaling only
         :param init_mean: mean used to initialize the latent factors
         :param init_std: standard deviation used to initialize the latent factors
+        :param solver: 'cholesky' solves exactly the least squares problem of each user/item,
+                       'cg' approximates it with a few steps of conjugate gradient starting from the current factors
+        :param cg_steps: number of conjugate gradient steps, used by the 'cg' solver only
+        :param num_threads: number of threads that update the groups of users and items in parallel
         :return:
         """
 
         if confidence_scaling not in self.AVAILABLE_CONFIDENCE_SCALING:
            raise ValueError("Value for 'confidence_scaling' not recognized. Acceptable values are {}, provided was '{}'".format(self.AVAILABLE_CONFIDENCE_SCALING, confidence_scaling))
 
+        if solver not in self.AVAILABLE_SOLVER:
+           raise ValueError("Value for 'solver' not recognized. Acceptable values are {}, provided was '{}'".format(self.AVAILABLE_SOLVER, solver))
+
 
         self.num_factors = num_factors
         self.alpha = alpha
         self.epsilon = epsilon
         self.reg = reg
+        self.solver = solver
+        self.cg_steps = cg_steps
+        self.num_threads = num_threads
 
-        self.USER_factors = self._init_factors(self.n_users, False)  # don't need values, will compute them
+        # The conjugate gradient starts from the current factors, the cholesky solver does not need their values
+        self.USER_factors = self._init_factors(self.n_users, self.solver == "cg")
         self.ITEM_factors = self._init_factors(self.n_items)
 
 
@@ -83,11 +175,29 @@ class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_E
 
         self.regularization_diagonal = np.diag(self.reg * np.ones(self.num_factors))
 
-        self._update_best_model()
+        # Warm users and items are updated in groups, each group requires the latent factors of its padded interactions
+        # |n_rows_group|x|max_interactions_group|x|n_factors| and a |n_factors|x|n_factors| matrix per row
+        max_cells = max(1, self.SOLVER_MEMORY_BUDGET_BYTES // (self.num_factors * 8))
+        max_rows = max(1, self.SOLVER_MEMORY_BUDGET_BYTES // (self.num_factors**2 * 8))
+
+        self.warm_users_groups = [self.warm_users[group] for group in _get_row_groups(np.ediff1d(self.C.indptr)[self.warm_users], max_cells, max_rows)]
+        self.warm_items_groups = [self.warm_items[group] for group in _get_row_groups(np.ediff1d(self.C_csc.indptr)[self.warm_items], max_cells, max_rows)]
+
+        # The same threads update users and items in all epochs, they are terminated also if an exception is raised
+        self._thread_pool = ThreadPool(processes=self.num_threads) if self.num_threads > 1 else None
+
+        try:
+            self._update_best_model()
 
-        self._train_with_early_stopping(epochs,
-                                        algorithm_name = self.RECOMMENDER_NAME,
-                                        **earlystopping_kwargs)
+            self._train_with_early_stopping(epochs,
+                                            algorithm_name = self.RECOMMENDER_NAME,
+                                            **earlystopping_kwargs)
+
+        finally:
+            if self._thread_pool is not None:
+                self._thread_pool.terminate()
+                self._thread_pool.join()
+                self._thread_pool = None
 
 
         self.USER_factors = self.USER_factors_best
@@ -137,68 +247,150 @@ class IALSRecommender(BaseMatrixFactorizationRecommender, Incremental_Training_E
     def _run_epoch(self, num_epoch):
 
         # fit user factors
-        # VV = n_factors x n_factors
-        VV = self.ITEM_factors.T.dot(self.ITEM_factors)
+        self._update_factors(self.USER_factors, self.ITEM_factors, self.C, self.warm_users_groups)
 
-        for user_id in self.warm_users:
-            # get (positive i.e. non-zero scored) items for user
+        # fit item factors
+        # the transpose of the CSC confidence matrix is the CSR |n_items|x|n_users|
+        self._update_factors(self.ITEM_factors, self.USER_factors, self.C_csc.T, self.warm_items_groups)
 
-            start_pos = self.C.indptr[user_id]
-            end_pos = self.C.indptr[user_id + 1]
 
-            user_profile = self.C.indices[start_pos:end_pos]
-            user_confidence = self.C.data[start_pos:end_pos]
 
-            self.USER_factors[user_id, :] = self._update_row(user_profile, user_confidence, self.ITEM_factors, VV)
+    def _update_factors(self, X, Y, C, warm_rows_groups):
+        """
+        Update the latent factors of all the warm rows of the confidence matrix, keeping the others fixed.
+        The groups of warm rows are independent and are updated by the num_threads threads of the pool created in fit.
 
-        # fit item factors
-        # UU = n_factors x n_factors
-        UU = self.USER_factors.T.dot(self.USER_factors)
+        X = |n_rows|x|n_factors|            factors to update
+        Y = |n_columns|x|n_factors|         fixed factors
+        C = |n_rows|x|n_columns|            CSR confidence matrix
+        """
 
-        for item_id in self.warm_items:
+        # YtY = n_factors x n_factors
+        YtY = Y.T.dot(Y)
 
-            start_pos = self.C_csc.indptr[item_id]
-            end_pos = self.C_csc.indptr[item_id + 1]
+        if self.solver == "cholesky":
+            update_group_function = self._update_group_cholesky
+        else:
+            update_group_function = self._update_group_cg
 
-            item_profile = self.C_csc.indices[start_pos:end_pos]
-            item_confidence = self.C_csc.data[start_pos:end_pos]
+        update_group = lambda group_rows: update_group_function(X, Y, YtY, C, group_rows)
 
-            self.ITEM_factors[item_id, :] = self._update_row(item_profile, item_confidence, self.USER_factors, UU)
+        if self._thread_pool is not None:
+            self._thread_pool.map(update_group, warm_rows_groups)
 
+        else:
+            for group_rows in warm_rows_groups:
+                update_group(group_rows)
 
 
-    def _update_row(self, interaction_profile, interaction_confidence, Y, YtY):
-        """
-        Update latent factors for a single user or item.
 
-        Y = |n_interactions|x|n_factors|
-        YtY =   |n_factors|x|n_factors|
+    def _get_padded_interactions(self, C, group_rows, Y):
+        """
+        Builds the padded interactions of a group of warm rows
+        :return: Y_interactions     |n_rows_group|x|max_interactions_group|x|n_factors| latent factors of the observed columns
+                 interaction_confidence  |n_rows_group|x|max_interactions_group| confidence of the observed columns, zero for the padding
         """
 
+        start_pos = C.indptr[group_rows]
+        n_interactions = C.indptr[group_rows + 1] - start_pos
+
+        interaction_index = np.arange(n_interactions.max())
+        interaction_mask = interaction_index < n_interactions[:,None]
+
+        # Padding cells point to the first interaction of the row and have zero confidence
+        interaction_pos = start_pos[:,None] + interaction_index * interaction_mask
+
         # Latent factors ony of item/users for which an interaction exists in the interaction profile
-        Y_interactions = Y[interaction_profile, :]
+        Y_interactions = Y[C.indices[interaction_pos], :]
+        interaction_confidence = C.data[interaction_pos] * interaction_mask
+
+        return Y_interactions, interaction_confidence
 
-        # Following the notation of the original paper we report the update rule for the Item factors (User factors are identical):
-        # Y are the item factors |n_items|x|n_factors|
-        # Cu is a diagonal matrix |n_interactions|x|n_interactions| with the user confidence for the observed items
-        # p(u) is a boolean vectors indexing only observed items. Here it will disappear as we already extract only the observed latent factors
-        #       however, it will have an impact in the dimensions of the matrix, since it transforms Cu from a diagonal matrix to a row vector of 1 row and |n_interactions| columns
-        # (Yt*Cu*Y + reg*I)^-1 * Yt*Cu*profile
-        # which can be decomposed as
-        # (YtY + Yt*(Cu-I)*Y + reg*I)^-1 * Yt*Cu*p(u)
 
-        # A = (|n_interactions|x|n_factors|) dot (|n_interactions|x|n_interactions| ) dot (|n_interactions|x|n_factors| )
-        #   = |n_factors|x|n_factors|
-        # A_slow = Y_interactions.T.dot(np.diag(interaction_confidence - 1)).dot(Y_interactions)
 
+    def _update_group_cholesky(self, X, Y, YtY, C, group_rows):
+        """
+        Update latent factors for a group of users or items solving exactly their least squares problems.
+
+        Following the notation of the original paper we report the update rule for the Item factors (User factors are identical):
+        Y are the item factors |n_items|x|n_factors|
+        Cu is a diagonal matrix |n_interactions|x|n_interactions| with the user confidence for the observed items
+        p(u) is a boolean vectors indexing only observed items. Here it will disappear as we already extract only the observed latent factors
+              however, it will have an impact in the dimensions of the matrix, since it transforms Cu from a diagonal matrix to a row vector of 1 row and |n_interactions| columns
+        (Yt*Cu*Y + reg*I)^-1 * Yt*Cu*profile
+        which can be decomposed as
+        (YtY + Yt*(Cu-I)*Y + reg*I)^-1 * Yt*Cu*p(u)
+
+        The matrices B = YtY + Yt*(Cu-I)*Y + reg*I of the whole group are built with a single batched product
+        and all systems are solved with a batched Cholesky decomposition.
+        """
+
+        Y_interactions, interaction_confidence = self._get_padded_interactions(C, group_rows, Y)
+
+        # The padding has confidence zero, hence Cu-I would be -1, mask it
+        interaction_weight = np.where(interaction_confidence != 0, interaction_confidence - 1, 0.0)
+
+        # A = |n_rows_group|x|n_factors|x|n_factors|
         # if v = diag(|n_interactions|) and k = |n_interactions|x|n_factors|
-        # computing np.diag(v).dot(k) will be SLOW
-        # we use an equivalent formulation (v * k.T).T which is much faster
-        A = Y_interactions.T.dot(((interaction_confidence - 1) * Y_interactions.T).T)
+        # computing np.diag(v).dot(k) will be SLOW, we use an equivalent formulation (v * k.T) which is much faster
+        A = np.matmul(np.swapaxes(Y_interactions, 1, 2) * interaction_weight[:,None,:], Y_interactions)
+
+        B = A + YtY + self.regularization_diagonal
+        b = np.einsum("ij,ijk->ik", interaction_confidence, Y_interactions)
+
+        X[group_rows, :] = _batched_cholesky_solve(B, b)
+
+
+
+    def _update_group_cg(self, X, Y, YtY, C, group_rows):
+        """
+        Update latent factors for a group of users or items approximating their least squares problems
+        with cg_steps steps of conjugate gradient, starting from the current factors.
+        The matrices B = YtY + Yt*(Cu-I)*Y + reg*I are never built, the product B*x is computed from the interactions.
+
+        See:
+        G. Takacs, I. Pilaszy and D. Tikk, Applications of the conjugate gradient method for implicit feedback
+        collaborative filtering, RecSys 2011.
+        """
+
+        Y_interactions, interaction_confidence = self._get_padded_interactions(C, group_rows, Y)
+        interaction_weight = np.where(interaction_confidence != 0, interaction_confidence - 1, 0.0)
+
+        def B_dot(x):
+            # B*x = YtY*x + reg*x + Yt*(Cu-I)*Y*x
+            Y_interactions_x = np.matmul(Y_interactions, x[:,:,None])[:,:,0] * interaction_weight
+            return x.dot(YtY) + self.reg * x + np.matmul(Y_interactions_x[:,None,:], Y_interactions)[:,0,:]
+
+        # b = Yt*Cu*p(u)
+        b = np.einsum("ij,ijk->ik", interaction_confidence, Y_interactions)
+
+        x = X[group_rows, :]
+
+        residual = b - B_dot(x)
+        direction = residual.copy()
+        residual_norm = np.einsum("ij,ij->i", residual, residual)
+
+        for cg_step in range(self.cg_steps):
+
+            B_direction = B_dot(direction)
+            direction_B_direction = np.einsum("ij,ij->i", direction, B_direction)
+
+            # Rows which already converged have a zero residual, leave them unchanged
+            step_size = np.divide(residual_norm, direction_B_direction, out=np.zeros_like(residual_norm), where=direction_B_direction > 0)
+
+            x += step_size[:,None] * direction
+            residual -= step_size[:,None] * B_direction
+
+            new_residual_norm = np.einsum("ij,ij->i", residual, residual)
+
+            direction_weight = np.divide(new_residual_norm, residual_norm, out=np.zeros_like(residual_norm), where=residual_norm > 0)
+            direction = residual + direction_weight[:,None] * direction
+
+            residual_norm = new_residual_norm
+
+        X[group_rows, :] = x
 
-        B = YtY + A + self.regularization_diagonal
 
-        return np.dot(np.linalg.inv(B), Y_interactions.T.dot(interaction_confidence))
 
 
     def _init_factors(self, num_factors, assign_values=True):
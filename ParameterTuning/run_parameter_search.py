@@ -20,6 +20,7 @@ from Base.NonPersonalizedRecommender import TopPop, Random, GlobalEffects
 # KNN
 from KNN.UserKNNCFRecommender import UserKNNCFRecommender
 from KNN.ItemKNNCFRecommender import ItemKNNCFRecommender
+from Base.Similarity.Compute_Similarity_Cache import Compute_Similarity_Cache
 from GraphBased.P3alphaRecommender import P3alphaRecommender
 from GraphBased.RP3betaRecommender import RP3betaRecommender
 from EASE_R.EASE_R_Recommender import EASE_R_Recommender
@@ -388,7 +389,8 @@ def runParameterSearch_Collaborative(recommender_class, URM_train, URM_train_las
     :param output_folder_path:  Folder in which to save the output files
     :param parallelizeKNN:      Boolean value, if True the various heuristics of the KNNs will be computed in parallel, if False sequentially
     :param allow_weighting:     Boolean value, if True it enables the use of TF-IDF and BM25 to weight features, users and items in KNNs
-    :param similarity_type_list: List of strings with the similarity heuristics to be used for the KNNs
+    :param similarity_type_list: List of strings with the similarity heuristics to be used for the KNNs.
+                                The dot products of ItemKNNCF and UserKNNCF are cached in output_folder_path + "similarity_cache/"
     """
 
 
@@ -463,11 +465,14 @@ def runParameterSearch_Collaborative(recommender_class, URM_train, URM_train_las
             if similarity_type_list is None:
                 similarity_type_list = ['cosine', 'jaccard', "asymmetric", "dice", "tversky"]
 
+            # The dot products are computed once for each feature weighting and shared by all the similarity types
+            similarity_cache = Compute_Similarity_Cache(folder_path = output_folder_path + "similarity_cache/")
+
             recommender_input_args = SearchInputRecommenderArgs(
                 CONSTRUCTOR_POSITIONAL_ARGS = [URM_train],
                 CONSTRUCTOR_KEYWORD_ARGS = {},
                 FIT_POSITIONAL_ARGS = [],
-                FIT_KEYWORD_ARGS = {}
+                FIT_KEYWORD_ARGS = {"similarity_cache": similarity_cache}
             )
 
 
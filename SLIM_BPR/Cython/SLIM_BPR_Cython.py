@@ -71,8 +71,12 @@ class SLIM_BPR_Cython(BaseItemSimilarityMatrixRecommender, Incremental_Training_
             random_seed = None,
             lambda_i = 0.0, lambda_j = 0.0, learning_rate = 1e-4, topK = 200,
             sgd_mode='adagrad', gamma=0.995, beta_1=0.9, beta_2=0.999,
+            num_threads = 1,
             **earlystopping_kwargs):
-
+        """
+        :param num_threads:     number of OpenMP threads running the epoch with lock-free (Hogwild) updates,
+                                the sparse weights are always trained by a single thread
+        """
 
         # Import compiled module
         from SLIM_BPR.Cython.SLIM_BPR_Cython_Epoch import SLIM_BPR_Cython_Epoch
@@ -103,6 +107,10 @@ class SLIM_BPR_Cython(BaseItemSimilarityMatrixRecommender, Incremental_Training_
                 self.train_with_sparse_weights = True
 
 
+        if self.train_with_sparse_weights and num_threads > 1:
+            self._print("Training with sparse weights is single threaded, num_threads will be ignored.")
+
+
         # Select only positive interactions
         URM_train_positive = self.URM_train.copy()
 
@@ -131,7 +139,8 @@ class SLIM_BPR_Cython(BaseItemSimilarityMatrixRecommender, Incremental_Training_
                                                  random_seed = random_seed,
                                                  gamma=gamma,
                                                  beta_1=beta_1,
-                                                 beta_2=beta_2)
+                                                 beta_2=beta_2,
+                                                 num_threads = num_threads)
 
 
 
@@ -39,8 +39,8 @@ cimport numpy as np
 import time
 import sys
 
-from libc.math cimport exp, sqrt
-from libc.stdlib cimport rand, srand, RAND_MAX
+from cython.parallel import prange, threadid
+from libc.math cimport exp, sqrt, pow
 
 
 cdef struct BPR_sample:
@@ -51,6 +51,22 @@ cdef struct BPR_sample:
     long seen_items_end_pos
 
 
+
+cdef inline unsigned long long xorshift_next(unsigned long long * state) noexcept nogil:
+    """
+    xorshift64* generator, each thread has its own state so the sampling does not share the libc rand() global state
+    """
+    state[0] ^= state[0] >> 12
+    state[0] ^= state[0] << 25
+    state[0] ^= state[0] >> 27
+    return state[0] * <unsigned long long> 2685821657736338717
+
+
+cdef inline long xorshift_randint(unsigned long long * state, long n) noexcept nogil:
+    return <long> ((xorshift_next(state) >> 11) % <unsigned long long> n)
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.initializedcheck(False)
@@ -60,7 +76,7 @@ cdef struct BPR_sample:
 cdef class SLIM_BPR_Cython_Epoch:
 
     cdef int n_users, n_items
-    cdef int topK
+    cdef int topK, num_threads
     cdef int symmetric, train_with_sparse_weights, final_model_sparse_weights
 
     cdef double learning_rate, li_reg, lj_reg
@@ -71,6 +87,12 @@ cdef class SLIM_BPR_Cython_Epoch:
     cdef Triangular_Matrix S_symmetric
     cdef double[:,:] S_dense
 
+    # Values of S for the positive and negative item read while computing x_uij, used by the sparse weights update
+    cdef double[:] S_sparse_i_seen, S_sparse_j_seen
+
+    # One random generator state per thread, padded to 8 values so that each thread writes its own cache line
+    cdef unsigned long long[:,:] random_state
+
 
     # Adaptive gradient
 
@@ -80,8 +102,10 @@ cdef class SLIM_BPR_Cython_Epoch:
     cdef double gamma
 
     cdef double [:] sgd_cache_I_momentum_1, sgd_cache_I_momentum_2
-    cdef double beta_1, beta_2, beta_1_power_t, beta_2_power_t
-    cdef double momentum_1, momentum_2
+    cdef double beta_1, beta_2
+
+    # Number of samples of the previous epochs, the Adam bias correction of a sample depends on its global index
+    cdef long n_completed_samples
 
 
 
@@ -91,10 +115,20 @@ cdef class SLIM_BPR_Cython_Epoch:
                  learning_rate = 0.01, li_reg = 0.0, lj_reg = 0.0,
                  topK = 150, symmetric = True,
                  verbose = False, random_seed = None,
-                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999):
+                 sgd_mode='adam', gamma=0.995, beta_1=0.9, beta_2=0.999,
+                 num_threads = 1):
+        """
+        :param num_threads:     Number of OpenMP threads the samples of an epoch are split across when training
+                                the dense or symmetric S. Each thread samples with its own random generator and
+                                applies its updates to S without locking (Hogwild).
+                                The sparse weights are always trained by a single thread
+        """
 
         super(SLIM_BPR_Cython_Epoch, self).__init__()
 
+        if num_threads < 1:
+            raise ValueError("Value for 'num_threads' must be a positive integer, provided was '{}'".format(num_threads))
+
         # Create copy of URM_train in csr format
         # make sure indices are sorted
         URM_mask = check_matrix(URM_mask, 'csr')
@@ -110,10 +144,12 @@ cdef class SLIM_BPR_Cython_Epoch:
 
         if train_with_sparse_weights:
             symmetric = False
+            num_threads = 1
 
         self.train_with_sparse_weights = train_with_sparse_weights
         self.final_model_sparse_weights = final_model_sparse_weights
         self.symmetric = symmetric
+        self.num_threads = num_threads
 
         self.URM_mask_indices = np.array(URM_mask.indices, dtype=np.int32)
         self.URM_mask_indptr = np.array(URM_mask.indptr, dtype=np.int32)
@@ -122,14 +158,22 @@ cdef class SLIM_BPR_Cython_Epoch:
         if self.train_with_sparse_weights:
             self.S_sparse = Sparse_Matrix_Tree_CSR(self.n_items, self.n_items)
 
+            max_profile_length = np.ediff1d(URM_mask.indptr).max(initial=0)
+            self.S_sparse_i_seen = np.zeros(max_profile_length, dtype=np.float64)
+            self.S_sparse_j_seen = np.zeros(max_profile_length, dtype=np.float64)
+
         elif self.symmetric:
             self.S_symmetric = Triangular_Matrix(self.n_items, isSymmetric = True)
         else:
             self.S_dense = np.zeros((self.n_items, self.n_items), dtype=np.float64)
 
-        if random_seed is not None:
-            srand(<unsigned> random_seed)
 
+        # xorshift requires a non-zero state
+        random_state = np.zeros((self.num_threads, 8), dtype=np.uint64)
+        random_state[:,0] = np.random.RandomState(random_seed).randint(1, np.iinfo(np.int64).max, size=self.num_threads, dtype=np.int64)
+        self.random_state = random_state
+
+        self.n_completed_samples = 0
 
         self._init_adaptive_gradient_cache(sgd_mode, gamma, beta_1, beta_2)
 
@@ -159,8 +203,6 @@ cdef class SLIM_BPR_Cython_Epoch:
             # beta_1=0.9, beta_2=0.999
             self.beta_1 = beta_1
             self.beta_2 = beta_2
-            self.beta_1_power_t = beta_1
-            self.beta_2_power_t = beta_2
 
 
 
@@ -209,130 +251,214 @@ cdef class SLIM_BPR_Cython_Epoch:
 
 
     def epochIteration_Cython(self):
+        """
+        One epoch has one sample for each user.
+        With the dense or symmetric S the samples are split across num_threads OpenMP threads in a single nogil kernel,
+        each thread samples with its own random generator and updates S without locking (Hogwild).
+
+        See:
+        F. Niu, B. Recht, C. Re and S. J. Wright, Hogwild!: A lock-free approach to parallelizing stochastic gradient descent,
+        NIPS 2011.
+        """
+
+        cdef long n_current_sample, block_start = 0, block_end, print_step
+        cdef double loss = 0.0
+
+        if self.train_with_sparse_weights:
+            self._epochIteration_sparse_weights()
+            return
+
+        # The samples are processed in blocks, progress is printed between blocks
+        if self.verbose:
+            print_step = 5000000
+        else:
+            print_step = self.n_users
+
+        start_time_epoch = time.time()
+
+        while block_start < self.n_users:
+
+            block_end = min(block_start + print_step, self.n_users)
+
+            with nogil:
+                for n_current_sample in prange(block_start, block_end, schedule='dynamic', chunksize=64, num_threads=self.num_threads):
+                    loss += self._sample_and_update_dense(n_current_sample)
+
+            block_start = block_end
 
-        cdef long start_time_epoch = time.time()
-        cdef long start_time_batch = time.time()
+            if self.verbose:
+                self._print_progress(block_end, loss, start_time_epoch)
+
+
+        self.n_completed_samples += self.n_users
+
+
+
+    def _epochIteration_sparse_weights(self):
+        """
+        The tree of the sparse weights allocates its cells with the GIL and cannot be updated concurrently,
+        the samples are processed sequentially
+        """
 
         cdef BPR_sample sample
         cdef long i, j
-        cdef long index, seen_item, n_current_sample
+        cdef long index, seen_item, n_current_sample, n_seen_items
         cdef double x_uij, gradient, loss = 0.0
         cdef double local_gradient_i, local_gradient_j
+        cdef double beta_1_power_t, beta_2_power_t
 
-        cdef int print_step
-
-        if self.train_with_sparse_weights:
-            print_step = 500000
-        else:
-            print_step = 5000000
+        cdef int print_step = 500000
 
+        start_time_epoch = time.time()
 
         # Uniform user sampling without replacement
         for n_current_sample in range(self.n_users):
 
-            sample = self.sampleBPR_Cython()
+            sample = self.sampleBPR_Cython(0)
 
             i = sample.pos_item
             j = sample.neg_item
+            n_seen_items = sample.seen_items_end_pos - sample.seen_items_start_pos
 
             x_uij = 0.0
 
             # The difference is computed on the user_seen items
-
-            index = 0
-            while index <  sample.seen_items_end_pos - sample.seen_items_start_pos:
+            # The values are kept for the regularization of the update
+            for index in range(n_seen_items):
 
                 seen_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
-                index +=1
-
-                if self.train_with_sparse_weights:
-                   x_uij += self.S_sparse.get_value(i, seen_item) - self.S_sparse.get_value(j, seen_item)
 
-                elif self.symmetric:
-                    x_uij += self.S_symmetric.get_value(i, seen_item) - self.S_symmetric.get_value(j, seen_item)
+                self.S_sparse_i_seen[index] = self.S_sparse.get_value(i, seen_item)
+                self.S_sparse_j_seen[index] = self.S_sparse.get_value(j, seen_item)
 
-                else:
-                    x_uij += self.S_dense[i, seen_item] - self.S_dense[j, seen_item]
+                x_uij += self.S_sparse_i_seen[index] - self.S_sparse_j_seen[index]
 
 
             gradient = 1 / (1 + exp(x_uij))
             loss += x_uij**2
 
+            # Exponentiation of beta, one step for each sample
+            beta_1_power_t = pow(self.beta_1, self.n_completed_samples + n_current_sample + 1)
+            beta_2_power_t = pow(self.beta_2, self.n_completed_samples + n_current_sample + 1)
 
-            local_gradient_i = self.adaptive_gradient(gradient, i, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2)
-            local_gradient_j = self.adaptive_gradient(gradient, j, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2)
+            local_gradient_i = self.adaptive_gradient(gradient, i, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
+            local_gradient_j = self.adaptive_gradient(gradient, j, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
 
 
-            index = 0
-            while index < sample.seen_items_end_pos - sample.seen_items_start_pos:
+            for index in range(n_seen_items):
 
                 seen_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
-                index +=1
 
-                if self.train_with_sparse_weights:
-                    # Since the sparse matrix is slower compared to the others
-                    # If no reg is required, avoid accessing it
+                # The seen items are distinct and j is not among them, so the cells of the same sample never overlap
+                # and the values read while computing x_uij are still current
+                if seen_item != i:
+                    self.S_sparse.add_value(i, seen_item, self.learning_rate * (local_gradient_i - self.li_reg * self.S_sparse_i_seen[index]))
+
+                if seen_item != j:
+                    self.S_sparse.add_value(j, seen_item, -self.learning_rate * (local_gradient_j - self.lj_reg * self.S_sparse_j_seen[index]))
+
+
+            # If I have reached at least 20% of the total number of batches or samples
+            # This allows to limit the memory occupancy of the sparse matrix
+            if n_current_sample % (self.n_users/5) == 0 and n_current_sample!=0:
+                self.S_sparse.rebalance_tree(TopK=self.topK)
 
-                    if seen_item != i:
-                        if self.li_reg!= 0.0:
-                            self.S_sparse.add_value(i, seen_item, self.learning_rate * (local_gradient_i - self.li_reg * self.S_sparse.get_value(i, seen_item)))
-                        else:
-                            self.S_sparse.add_value(i, seen_item, self.learning_rate * local_gradient_i)
 
+            if self.verbose and ((n_current_sample+1) % print_step==0 or n_current_sample==self.n_users-1):
+                self._print_progress(n_current_sample+1, loss, start_time_epoch)
 
-                    if seen_item != j:
-                        if self.lj_reg!= 0.0:
-                            self.S_sparse.add_value(j, seen_item, -self.learning_rate * (local_gradient_j - self.lj_reg * self.S_sparse.get_value(j, seen_item)))
-                        else:
-                            self.S_sparse.add_value(j, seen_item, -self.learning_rate * local_gradient_j)
 
+        self.n_completed_samples += self.n_users
 
-                elif self.symmetric:
 
-                    if seen_item != i:
-                        self.S_symmetric.add_value(i, seen_item, self.learning_rate * (local_gradient_i - self.li_reg * self.S_symmetric.get_value(i, seen_item)))
 
-                    if seen_item != j:
-                        self.S_symmetric.add_value(j, seen_item, -self.learning_rate * (local_gradient_j - self.lj_reg * self.S_symmetric.get_value(j, seen_item)))
+    def _print_progress(self, n_processed_samples, loss, start_time_epoch):
 
-                else:
+        new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time_epoch)
 
-                    if seen_item != i:
-                        self.S_dense[i, seen_item] += self.learning_rate * (local_gradient_i - self.li_reg * self.S_dense[i, seen_item])
+        print("Processed {} ({:4.1f}%) in {:.2f} {}. BPR loss is {:.2E}. Sample per second: {:.0f}".format(
+            n_processed_samples,
+            100.0* float(n_processed_samples)/self.n_users,
+            new_time_value, new_time_unit,
+            loss/n_processed_samples,
+            float(n_processed_samples) / (time.time() - start_time_epoch)))
 
-                    if seen_item != j:
-                        self.S_dense[j, seen_item] -= self.learning_rate * (local_gradient_j - self.lj_reg * self.S_dense[j, seen_item])
+        sys.stdout.flush()
+        sys.stderr.flush()
 
 
 
-            # Exponentiation of beta at the end of each sample
-            if self.useAdam:
+    cdef double _sample_and_update_dense(self, long n_current_sample) noexcept nogil:
+        """
+        Samples a triplet with the random generator of the calling thread and updates the dense or symmetric S
+        :return: x_uij**2
+        """
 
-                self.beta_1_power_t *= self.beta_1
-                self.beta_2_power_t *= self.beta_2
+        cdef int thread_id = threadid()
 
+        cdef BPR_sample sample
+        cdef long i, j
+        cdef long index, seen_item
+        cdef double x_uij, gradient
+        cdef double local_gradient_i, local_gradient_j
+        cdef double * S_i_seen
+        cdef double * S_j_seen
 
+        # Exponentiation of beta, one step for each sample
+        cdef double beta_1_power_t = pow(self.beta_1, self.n_completed_samples + n_current_sample + 1)
+        cdef double beta_2_power_t = pow(self.beta_2, self.n_completed_samples + n_current_sample + 1)
 
-            # If I have reached at least 20% of the total number of batches or samples
-            # This allows to limit the memory occupancy of the sparse matrix
-            if self.train_with_sparse_weights and n_current_sample % (self.n_users/5) == 0 and n_current_sample!=0:
-                self.S_sparse.rebalance_tree(TopK=self.topK)
 
+        sample = self.sampleBPR_Cython(thread_id)
 
-            if self.verbose and ((n_current_sample+1) % print_step==0 or n_current_sample==self.n_users-1):
-                new_time_value, new_time_unit = seconds_to_biggest_unit(time.time() - start_time_epoch)
+        i = sample.pos_item
+        j = sample.neg_item
+
+        x_uij = 0.0
+
+        # The difference is computed on the user_seen items
+        for index in range(sample.seen_items_start_pos, sample.seen_items_end_pos):
+
+            seen_item = self.URM_mask_indices[index]
+
+            if self.symmetric:
+                x_uij += self.S_symmetric.get_cell_pointer(i, seen_item)[0] - self.S_symmetric.get_cell_pointer(j, seen_item)[0]
+
+            else:
+                x_uij += self.S_dense[i, seen_item] - self.S_dense[j, seen_item]
+
+
+        gradient = 1 / (1 + exp(x_uij))
+
+
+        local_gradient_i = self.adaptive_gradient(gradient, i, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
+        local_gradient_j = self.adaptive_gradient(gradient, j, self.sgd_cache_I, self.sgd_cache_I_momentum_1, self.sgd_cache_I_momentum_2, beta_1_power_t, beta_2_power_t)
 
-                print("Processed {} ({:4.1f}%) in {:.2f} {}. BPR loss is {:.2E}. Sample per second: {:.0f}".format(
-                    n_current_sample+1,
-                    100.0* float(n_current_sample+1)/self.n_users,
-                    new_time_value, new_time_unit,
-                    loss/(n_current_sample+1),
-                    float(n_current_sample+1) / (time.time() - start_time_epoch)))
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+        for index in range(sample.seen_items_start_pos, sample.seen_items_end_pos):
 
-                start_time_batch = time.time()
+            seen_item = self.URM_mask_indices[index]
+
+            if self.symmetric:
+
+                if seen_item != i:
+                    S_i_seen = self.S_symmetric.get_cell_pointer(i, seen_item)
+                    S_i_seen[0] += self.learning_rate * (local_gradient_i - self.li_reg * S_i_seen[0])
+
+                if seen_item != j:
+                    S_j_seen = self.S_symmetric.get_cell_pointer(j, seen_item)
+                    S_j_seen[0] -= self.learning_rate * (local_gradient_j - self.lj_reg * S_j_seen[0])
+
+            else:
+
+                if seen_item != i:
+                    self.S_dense[i, seen_item] += self.learning_rate * (local_gradient_i - self.li_reg * self.S_dense[i, seen_item])
+
+                if seen_item != j:
+                    self.S_dense[j, seen_item] -= self.learning_rate * (local_gradient_j - self.lj_reg * self.S_dense[j, seen_item])
+
+
+        return x_uij**2
 
 
 
@@ -392,10 +518,11 @@ cdef class SLIM_BPR_Cython_Epoch:
 
 
 
-    cdef double adaptive_gradient(self, double gradient, long user_or_item_id, double[:] sgd_cache, double[:] sgd_cache_momentum_1, double[:] sgd_cache_momentum_2):
+    cdef double adaptive_gradient(self, double gradient, long user_or_item_id, double[:] sgd_cache, double[:] sgd_cache_momentum_1, double[:] sgd_cache_momentum_2,
+                                  double beta_1_power_t, double beta_2_power_t) noexcept nogil:
 
 
-        cdef double gradient_update
+        cdef double gradient_update, momentum_1, momentum_2
 
         if self.useAdaGrad:
             sgd_cache[user_or_item_id] += gradient ** 2
@@ -418,10 +545,10 @@ cdef class SLIM_BPR_Cython_Epoch:
                 sgd_cache_momentum_2[user_or_item_id] * self.beta_2 + (1 - self.beta_2) * gradient**2
 
 
-            self.momentum_1 = sgd_cache_momentum_1[user_or_item_id]/ (1 - self.beta_1_power_t)
-            self.momentum_2 = sgd_cache_momentum_2[user_or_item_id]/ (1 - self.beta_2_power_t)
+            momentum_1 = sgd_cache_momentum_1[user_or_item_id]/ (1 - beta_1_power_t)
+            momentum_2 = sgd_cache_momentum_2[user_or_item_id]/ (1 - beta_2_power_t)
 
-            gradient_update = self.momentum_1/ (sqrt(self.momentum_2) + 1e-8)
+            gradient_update = momentum_1/ (sqrt(momentum_2) + 1e-8)
 
 
         else:
@@ -433,11 +560,12 @@ cdef class SLIM_BPR_Cython_Epoch:
         return gradient_update
 
 
-    cdef BPR_sample sampleBPR_Cython(self):
+    cdef BPR_sample sampleBPR_Cython(self, int thread_id) noexcept nogil:
 
         cdef BPR_sample sample = BPR_sample(-1,-1,-1,-1,-1)
+        cdef unsigned long long * random_state = &self.random_state[thread_id, 0]
 
-        cdef long index
+        cdef long index, low, high
 
         cdef int neg_item_selected, n_seen_items = 0
 
@@ -445,7 +573,7 @@ cdef class SLIM_BPR_Cython_Epoch:
         # Skip users with no interactions or with no negative items
         while n_seen_items == 0 or n_seen_items == self.n_items:
 
-            sample.user = rand() % self.n_users
+            sample.user = xorshift_randint(random_state, self.n_users)
 
             sample.seen_items_start_pos = self.URM_mask_indptr[sample.user]
             sample.seen_items_end_pos = self.URM_mask_indptr[sample.user + 1]
@@ -453,7 +581,7 @@ cdef class SLIM_BPR_Cython_Epoch:
             n_seen_items = sample.seen_items_end_pos - sample.seen_items_start_pos
 
 
-        index = rand() % n_seen_items
+        index = xorshift_randint(random_state, n_seen_items)
 
         sample.pos_item = self.URM_mask_indices[sample.seen_items_start_pos + index]
 
@@ -464,16 +592,23 @@ cdef class SLIM_BPR_Cython_Epoch:
         # for every user
         while not neg_item_selected:
 
-            sample.neg_item = rand() % self.n_items
+            sample.neg_item = xorshift_randint(random_state, self.n_items)
 
-            index = 0
-            # Indices data is sorted, so I don't need to go to the end of the current row
-            while index < n_seen_items and self.URM_mask_indices[sample.seen_items_start_pos + index] < sample.neg_item:
-                index+=1
+            # Indices data is sorted, binary search for the first seen item >= sample.neg_item
+            low = sample.seen_items_start_pos
+            high = sample.seen_items_end_pos
+
+            while low < high:
+                index = (low + high) // 2
+
+                if self.URM_mask_indices[index] < sample.neg_item:
+                    low = index + 1
+                else:
+                    high = index
 
-            # If the positive item in position 'index' is == sample.neg_item, negative not selected
-            # If the positive item in position 'index' is > sample.neg_item or index == n_seen_items, negative selected
-            if index == n_seen_items or self.URM_mask_indices[sample.seen_items_start_pos + index] > sample.neg_item:
+            # If the seen item in position 'low' is == sample.neg_item, negative not selected
+            # If the seen item in position 'low' is > sample.neg_item or there is none, negative selected
+            if low == sample.seen_items_end_pos or self.URM_mask_indices[low] > sample.neg_item:
                 neg_item_selected = True
 
 
@@ -481,6 +616,7 @@ cdef class SLIM_BPR_Cython_Epoch:
 
 
 
+
 ##################################################################################################################
 #####################
 #####################            SPARSE MATRIX
@@ -531,7 +667,7 @@ cdef matrix_element_tree_s * pointer_new_matrix_element_tree_s(long column, doub
 
 
 # Functions to compare structs to be used in C qsort
-cdef int compare_struct_on_column(const void *a_input, const void *b_input):
+cdef int compare_struct_on_column(const void *a_input, const void *b_input) noexcept:
     """
     The function compares the column contained in the two struct passed.
     If a.column > b.column returns >0
@@ -547,7 +683,7 @@ cdef int compare_struct_on_column(const void *a_input, const void *b_input):
 
 
 
-cdef int compare_struct_on_data(const void * a_input, const void * b_input):
+cdef int compare_struct_on_data(const void * a_input, const void * b_input) noexcept:
     """
     The function compares the data contained in the two struct passed.
     If a.data > b.data returns >0
@@ -1332,6 +1468,24 @@ cdef class Triangular_Matrix:
 
 
 
+    cdef double * get_cell_pointer(self, long row, long col) noexcept nogil:
+        """
+        The function returns the address of the specified cell of a symmetric matrix,
+        the coordinates are not checked so that it can be used without the GIL.
+
+        :param row: cell coordinates
+        :param col:  cell coordinates
+        :return double *: cell address
+        """
+
+        if col > row:
+            return &self.row_pointer[col][row]
+        else:
+            return &self.row_pointer[row][col]
+
+
+
+
     cdef get_scipy_csr(self, long TopK = False):
         """
         The function returns the current sparse matrix as a scipy_csr object
@@ -7,13 +7,15 @@
 
 import numpy as np
 import scipy.sparse as sps
-from Base.Recommender_utils import check_matrix
+from Base.Recommender_utils import check_matrix, build_sparse_matrix_top_k
 from sklearn.linear_model import ElasticNet
 from sklearn.exceptions import ConvergenceWarning
 
 from Base.BaseSimilarityMatrixRecommender import BaseItemSimilarityMatrixRecommender
+from Base.BaseTempFolder import BaseTempFolder
 from Utils.seconds_to_biggest_unit import seconds_to_biggest_unit
-import time, sys, warnings
+import time, sys, warnings, os, multiprocessing
+from functools import partial
 
 
 
@@ -62,87 +64,223 @@ class SLIMElasticNetRecommender(BaseItemSimilarityMatrixRecommender):
 
         n_items = URM_train.shape[1]
 
-        # Use array as it reduces memory requirements compared to lists
-        dataBlock = 10000000
+        start_time = time.time()
+        start_time_printBatch = start_time
 
-        rows = np.zeros(dataBlock, dtype=np.int32)
-        cols = np.zeros(dataBlock, dtype=np.int32)
-        values = np.zeros(dataBlock, dtype=np.float32)
 
-        numCells = 0
+        def fit_item_block(start_item, end_item):
 
-        start_time = time.time()
-        start_time_printBatch = start_time
+            nonlocal start_time_printBatch
+
+            block_coef = []
 
-        # fit each item's factors sequentially (not in parallel)
-        for currentItem in range(n_items):
+            # fit each item's factors sequentially (not in parallel)
+            for currentItem in range(start_item, end_item):
 
-            # get the target column
-            y = URM_train[:, currentItem].toarray()
+                # get the target column
+                y = URM_train[:, currentItem].toarray()
 
-            # set the j-th column of X to zero
-            start_pos = URM_train.indptr[currentItem]
-            end_pos = URM_train.indptr[currentItem + 1]
+                # set the j-th column of X to zero
+                start_pos = URM_train.indptr[currentItem]
+                end_pos = URM_train.indptr[currentItem + 1]
 
-            current_item_data_backup = URM_train.data[start_pos: end_pos].copy()
-            URM_train.data[start_pos: end_pos] = 0.0
+                current_item_data_backup = URM_train.data[start_pos: end_pos].copy()
+                URM_train.data[start_pos: end_pos] = 0.0
 
-            # fit one ElasticNet model per column
-            self.model.fit(URM_train, y)
+                # fit one ElasticNet model per column
+                self.model.fit(URM_train, y)
 
-            # self.model.coef_ contains the coefficient of the ElasticNet model
-            # let's keep only the non-zero values
+                # self.model.coef_ contains the coefficient of the ElasticNet model
+                # the topK of the non-zero values are selected on the whole block
+                block_coef.append(self.model.sparse_coef_)
 
-            # Select topK values
-            # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-            # - Partition the data to extract the set of relevant items
-            # - Sort only the relevant items
-            # - Get the original item index
+                # finally, replace the original values of the j-th column
+                URM_train.data[start_pos:end_pos] = current_item_data_backup
 
-            nonzero_model_coef_index = self.model.sparse_coef_.indices
-            nonzero_model_coef_value = self.model.sparse_coef_.data
+                elapsed_time = time.time() - start_time
+                new_time_value, new_time_unit = seconds_to_biggest_unit(elapsed_time)
 
-            local_topK = min(len(nonzero_model_coef_value)-1, self.topK)
 
-            relevant_items_partition = (-nonzero_model_coef_value).argpartition(local_topK)[0:local_topK]
-            relevant_items_partition_sorting = np.argsort(-nonzero_model_coef_value[relevant_items_partition])
-            ranking = relevant_items_partition[relevant_items_partition_sorting]
+                if time.time() - start_time_printBatch > 300 or currentItem == n_items-1:
+                    self._print("Processed {} ({:4.1f}%) in {:.2f} {}. Items per second: {:.2f}".format(
+                        currentItem+1,
+                        100.0* float(currentItem+1)/n_items,
+                        new_time_value,
+                        new_time_unit,
+                        float(currentItem)/elapsed_time))
 
-            for index in range(len(ranking)):
+                    sys.stdout.flush()
+                    sys.stderr.flush()
 
-                if numCells == len(rows):
-                    rows = np.concatenate((rows, np.zeros(dataBlock, dtype=np.int32)))
-                    cols = np.concatenate((cols, np.zeros(dataBlock, dtype=np.int32)))
-                    values = np.concatenate((values, np.zeros(dataBlock, dtype=np.float32)))
+                    start_time_printBatch = time.time()
 
+            return sps.vstack(block_coef, format="csr")
+
+
+        # Row i of the result contains the coefficients of the model of item i, which is column i of W_sparse
+        W_sparse_T = build_sparse_matrix_top_k(fit_item_block, (n_items, n_items), self.topK, block_size = 1000)
+
+        # generate the sparse weight matrix
+        self.W_sparse = sps.csr_matrix(W_sparse_T.T, dtype=np.float32)
 
-                rows[numCells] = nonzero_model_coef_index[ranking[index]]
-                cols[numCells] = currentItem
-                values[numCells] = nonzero_model_coef_value[ranking[index]]
 
-                numCells += 1
 
-            # finally, replace the original values of the j-th column
-            URM_train.data[start_pos:end_pos] = current_item_data_backup
 
-            elapsed_time = time.time() - start_time
-            new_time_value, new_time_unit = seconds_to_biggest_unit(elapsed_time)
 
 
-            if time.time() - start_time_printBatch > 300 or currentItem == n_items-1:
-                self._print("Processed {} ({:4.1f}%) in {:.2f} {}. Items per second: {:.2f}".format(
-                    currentItem+1,
-                    100.0* float(currentItem+1)/n_items,
-                    new_time_value,
-                    new_time_unit,
-                    float(currentItem)/elapsed_time))
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+def _partial_fit_item_range(item_range, URM_train_folder, URM_train_shape, model_parameters, topK):
+    """
+    Fits the ElasticNet models of the items in [start_item, end_item), in a worker process.
+    The CSC URM_train is memory mapped from URM_train_folder, indices and indptr are read-only and shared among all
+    workers while data is mapped copy-on-write. Excluding the target column only alters the private pages of this
+    worker, the shared data is never modified.
+    :param item_range:          (start_item, end_item)
+    :param URM_train_folder:
+    :param URM_train_shape:
+    :param model_parameters:    dictionary of ElasticNet parameters
+    :param topK:
+    :return: values, rows, cols of the TopK coefficients of each item, as COO triplets of W_sparse
+    """
+
+    start_item, end_item = item_range
+
+    URM_train = sps.csc_matrix((np.load(URM_train_folder + "data.npy", mmap_mode="c"),
+                                np.load(URM_train_folder + "indices.npy", mmap_mode="r"),
+                                np.load(URM_train_folder + "indptr.npy", mmap_mode="r")),
+                               shape=URM_train_shape, copy=False)
+
+    model = ElasticNet(**model_parameters)
+
+    block_coef = []
+
+    for currentItem in range(start_item, end_item):
+
+        start_pos = URM_train.indptr[currentItem]
+        end_pos = URM_train.indptr[currentItem + 1]
+
+        # get the target column
+        y = np.zeros((URM_train_shape[0], 1), dtype=np.float32)
+        y[URM_train.indices[start_pos:end_pos], 0] = URM_train.data[start_pos:end_pos]
+
+        # set the j-th column of X to zero, in the private copy-on-write pages
+        URM_train.data[start_pos:end_pos] = 0.0
+
+        # fit one ElasticNet model per column
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=ConvergenceWarning)
+            model.fit(URM_train, y)
+
+        block_coef.append(model.sparse_coef_)
+
+        URM_train.data[start_pos:end_pos] = y[URM_train.indices[start_pos:end_pos], 0]
+
+
+    # Row i of W_sparse_T contains the coefficients of the model of item start_item + i
+    block_coef = sps.vstack(block_coef, format="csr")
+
+    W_sparse_T = build_sparse_matrix_top_k(lambda start_row, end_row: block_coef[start_row:end_row],
+                                           block_coef.shape, topK, block_size = block_coef.shape[0])
+
+    W_sparse_T = W_sparse_T.tocoo()
+
+    return W_sparse_T.data, W_sparse_T.col, W_sparse_T.row + start_item
+
+
+
+
+class MultiThreadSLIM_ElasticNet(SLIMElasticNetRecommender, BaseTempFolder):
+    """
+    Multi-process version of SLIMElasticNetRecommender, the item columns are split in ranges fitted by different workers.
+    The workers share a read-only copy of URM_train memory mapped from a temporary folder.
+    """
+
+    RECOMMENDER_NAME = "MultiThreadSLIM_ElasticNet"
+
+    def __init__(self, URM_train, verbose = True):
+        super(MultiThreadSLIM_ElasticNet, self).__init__(URM_train, verbose = verbose)
+
+
+    def fit(self, l1_ratio=0.1, alpha = 1.0, positive_only=True, topK = 100, workers = multiprocessing.cpu_count(),
+            items_per_task = 100, temp_file_folder = None):
+
+        assert l1_ratio>= 0 and l1_ratio<=1, "{}: l1_ratio must be between 0 and 1, provided value was {}".format(self.RECOMMENDER_NAME, l1_ratio)
+
+        self.l1_ratio = l1_ratio
+        self.positive_only = positive_only
+        self.topK = topK
+        self.workers = workers
+
+        model_parameters = {"alpha": alpha,
+                            "l1_ratio": self.l1_ratio,
+                            "positive": self.positive_only,
+                            "fit_intercept": False,
+                            "copy_X": False,
+                            "precompute": True,
+                            "selection": 'random',
+                            "max_iter": 100,
+                            "tol": 1e-4}
+
+        URM_train = check_matrix(self.URM_train, 'csc', dtype=np.float32)
+
+        n_items = URM_train.shape[1]
+
+        self.temp_file_folder = self._get_unique_temp_folder(input_temp_file_folder=temp_file_folder)
+
+        try:
+            np.save(self.temp_file_folder + "data.npy", URM_train.data)
+            np.save(self.temp_file_folder + "indices.npy", URM_train.indices)
+            np.save(self.temp_file_folder + "indptr.npy", URM_train.indptr)
+
+            item_range_list = [(start_item, min(start_item + items_per_task, n_items)) for start_item in range(0, n_items, items_per_task)]
+
+            _pfit = partial(_partial_fit_item_range,
+                            URM_train_folder = self.temp_file_folder,
+                            URM_train_shape = URM_train.shape,
+                            model_parameters = model_parameters,
+                            topK = self.topK)
+
+            values, rows, cols = [], [], []
+            processed_items = 0
+
+            start_time = time.time()
+            start_time_printBatch = start_time
+
+            # Each task maps URM_train again, its private copy-on-write pages are released when the task ends, so the
+            # worker processes can be reused. If an exception is raised the pool is terminated when leaving the block
+            with multiprocessing.Pool(processes=self.workers) as pool:
+
+                for item_range, (range_values, range_rows, range_cols) in zip(item_range_list, pool.imap(_pfit, item_range_list)):
+
+                    values.append(range_values)
+                    rows.append(range_rows)
+                    cols.append(range_cols)
+
+                    processed_items += item_range[1] - item_range[0]
+
+                    if time.time() - start_time_printBatch > 300 or processed_items == n_items:
+                        elapsed_time = time.time() - start_time
+                        new_time_value, new_time_unit = seconds_to_biggest_unit(elapsed_time)
+
+                        self._print("Processed {} ({:4.1f}%) in {:.2f} {}. Items per second: {:.2f}".format(
+                            processed_items,
+                            100.0* float(processed_items)/n_items,
+                            new_time_value,
+                            new_time_unit,
+                            float(processed_items)/elapsed_time))
+
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+
+                        start_time_printBatch = time.time()
+
+                pool.close()
+                pool.join()
+
+        finally:
+            self._clean_temp_folder(temp_file_folder=self.temp_file_folder)
 
-                start_time_printBatch = time.time()
 
         # generate the sparse weight matrix
-        self.W_sparse = sps.csr_matrix((values[:numCells], (rows[:numCells], cols[:numCells])),
+        self.W_sparse = sps.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
                                        shape=(n_items, n_items), dtype=np.float32)
-